@@ -0,0 +1,137 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.containercodec`` -- Binary encoding for container columns.
+
+SchemaReprContainer, SchemaTuple, SchemaList, SchemaDict and
+SchemaTimeDelta columns used to be stored as the python repr() of the
+value and read back with eval().  Parsing python source for every row is
+slow, so now we store them as a BLOB that starts with a short header
+followed by a pickle (protocol 2) of the value.
+
+Only the types that SchemaReprContainer allows get stored.  Unpickling
+refuses to load any class except datetime.datetime and
+datetime.timedelta, so a bad value in the database can't run arbitrary
+code.
+
+Values are normalized before they're encoded so that decoding gives the
+same thing eval(repr(value)) would: subclasses of dict, list, unicode,
+etc. (for example FeedParserDict) become the base type and
+time.struct_time becomes a plain 9-tuple.
+"""
+
+import cPickle
+import datetime
+import time
+from cStringIO import StringIO
+
+# Every encoded value starts with HEADER followed by a single byte for the
+# format version.
+HEADER = 'MC'
+FORMAT_VERSION = 1
+_PREFIX = HEADER + chr(FORMAT_VERSION)
+
+_SIMPLE_TYPES = frozenset([bool, int, long, float, str, unicode,
+                           type(None), datetime.datetime,
+                           datetime.timedelta])
+
+_ALLOWED_GLOBALS = {
+    ('datetime', 'datetime'): datetime.datetime,
+    ('datetime', 'timedelta'): datetime.timedelta,
+}
+
+class DecodeError(ValueError):
+    """Data passed to decode() isn't something encode() created."""
+    pass
+
+def is_encoded(data):
+    """Check if a value from the database was created by encode().
+
+    Legacy values were stored as repr() strings, which SQLite gives back
+    as unicode.  Encoded values are BLOBs, which come back as buffers.
+    """
+    return isinstance(data, (buffer, str)) and data[:len(HEADER)] == HEADER
+
+def encode(value):
+    """Encode a container value to a string.
+
+    The caller should wrap the result in a buffer() before handing it to
+    SQLite so that it gets stored as a BLOB.
+    """
+    return _PREFIX + cPickle.dumps(_normalize(value), 2)
+
+def decode(data):
+    """Decode a value created by encode()."""
+    data = str(data)
+    if data[:len(HEADER)] != HEADER or len(data) <= len(_PREFIX):
+        raise DecodeError("Not an encoded container: %r" % data[:10])
+    version = ord(data[len(HEADER)])
+    if version != FORMAT_VERSION:
+        raise DecodeError("Unknown container format version: %s" % version)
+    unpickler = cPickle.Unpickler(StringIO(data[len(_PREFIX):]))
+    unpickler.find_global = _find_global
+    try:
+        return unpickler.load()
+    except (cPickle.UnpicklingError, EOFError, ValueError, TypeError,
+            KeyError, IndexError), e:
+        raise DecodeError("Error decoding container: %s" % e)
+
+def _find_global(module, name):
+    try:
+        return _ALLOWED_GLOBALS[(module, name)]
+    except KeyError:
+        raise cPickle.UnpicklingError("Can't load %s.%s" % (module, name))
+
+def _normalize(value):
+    value_type = type(value)
+    if value_type in _SIMPLE_TYPES:
+        return value
+    elif isinstance(value, dict):
+        return dict((_normalize(k), _normalize(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_normalize(v) for v in value]
+    elif isinstance(value, (tuple, time.struct_time)):
+        return tuple([_normalize(v) for v in value])
+    elif isinstance(value, unicode):
+        return unicode(value)
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, (int, long)):
+        return long(value) if isinstance(value, long) else int(value)
+    elif isinstance(value, float):
+        return float(value)
+    elif isinstance(value, datetime.datetime):
+        return datetime.datetime(*value.timetuple()[:6] +
+                                 (value.microsecond,))
+    elif isinstance(value, datetime.timedelta):
+        return datetime.timedelta(value.days, value.seconds,
+                                  value.microseconds)
+    else:
+        raise TypeError("Can't encode %r (type: %s)" % (value, value_type))
@@ -42,8 +42,12 @@ class ConnectionLimitError(StandardError):
 class Connection(object):
     """Wraps the sqlite3.Connection object."""
     def __init__(self, path):
+        # check_same_thread is off because ItemTracker prefetches rows in a
+        # background thread.  ItemFetcher.lock ensures that only one thread
+        # uses a connection at once.
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False)
 
     def execute(self, sql, values=()):
         return self._connection.execute(sql, values)
@@ -0,0 +1,88 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.downloadstats -- In-memory transfer stats for downloads.
+
+The downloader daemon sends us new stats for each active download about
+once a second.  Writing those to the remote_downloader table every time
+is a lot of disk traffic for values that are out of date a second later,
+so RemoteDownloader only saves them every so often.  In between, the
+latest values get stored here and ItemInfo reads them from here instead
+of its row data.
+
+The backend thread updates the table and the frontend reads it.  Each
+update replaces the whole dict for a downloader, which is atomic, so we
+don't need a lock.
+"""
+
+# remote_downloader columns that only matter while we're transferring.
+# RemoteDownloader doesn't keep them across restarts.
+TEMP_STAT_COLUMNS = (
+    'eta',
+    'rate',
+    'upload_rate',
+    'activity',
+    'seeders',
+    'leechers',
+    'connections',
+)
+
+# remote_downloader columns that are stored in the table
+STAT_COLUMNS = frozenset(('current_size', 'upload_size') + TEMP_STAT_COLUMNS)
+
+# maps downloader ids to dicts that map the names in STAT_COLUMNS to values
+_stats = {}
+
+def update(downloader_id, stats):
+    """Store the latest stats for a downloader.
+
+    :param downloader_id: id of the RemoteDownloader
+    :param stats: dict mapping each name in STAT_COLUMNS to its value
+    """
+    _stats[downloader_id] = stats
+
+def get(downloader_id):
+    """Get the stats for a downloader.
+
+    :returns: dict passed to update() or None if we don't have stats for
+        the downloader
+    """
+    return _stats.get(downloader_id)
+
+def remove(downloader_id):
+    """Remove the stats for a downloader.
+
+    Call this once the values are saved in the remote_downloader table and
+    the downloader isn't transferring anymore.
+    """
+    _stats.pop(downloader_id, None)
+
+def reset():
+    """Remove all stats."""
+    _stats.clear()
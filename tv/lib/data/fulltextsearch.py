@@ -28,18 +28,44 @@
 # statement from all source files in the program, then also delete it here.
 
 """miro.data.fulltextsearch -- Set up full text search in our SQLite DB
+
+item_fts is an FTS4 table that mirrors the text columns of the item table.
+It's kept up to date using triggers.  The UPDATE triggers only fire when one
+of the indexed columns is part of the UPDATE statement, so changes to things
+like the watched state or resume time don't touch item_fts at all.
+
+For the main database we also support a batched mode.  Instead of
+re-indexing rows inside the triggers, the ids of inserted/updated rows get
+queued in the item_fts_dirty table.  The statements from
+flush_dirty_rows_sql() then re-index each queued row once, right before the
+transaction is committed.
 """
 from miro import app
 
-def setup_fulltext_search(connection, table='item', path_column='filename'):
-    """Set up fulltext search on a newly created database."""
+# The FTS4 merge command was added in SQLite 3.7.14.  Before that, the only
+# way to merge segments is the (much more expensive) optimize command.
+MERGE_COMMAND = "merge=200,8"
+
+def _indexed_columns(path_column):
+    # FIXME: Description should also match entry_description
+    return ['title', 'description', 'artist', 'album', 'genre',
+            path_column, 'parent_title', ]
+
+def setup_fulltext_search(connection, table='item', path_column='filename',
+                          batched=False):
+    """Set up fulltext search on a newly created database.
+
+    :param connection: sqlite3 connection to use
+    :param table: table to index
+    :param path_column: column that stores the item's path
+    :param batched: Use batched mode.  If this is True, the statements from
+        flush_dirty_rows_sql() must be run before each commit.
+    """
     if hasattr(app, 'in_unit_tests') and _no_item_table(connection, table):
         # handle unittests not defining the item table in their schemas
         return
 
-    # FIXME: Description should also match entry_description
-    columns = ['title', 'description', 'artist', 'album', 'genre',
-               path_column, 'parent_title', ]
+    columns = _indexed_columns(path_column)
     column_list = ', '.join(c for c in columns)
     column_list_for_new = ', '.join("new.%s" % c for c in columns)
     column_list_with_types = ', '.join('%s text' % c for c in columns)
@@ -48,11 +74,14 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
     connection.execute("INSERT INTO item_fts(docid, %s)"
                        "SELECT %s.id, %s FROM %s" %
                        (column_list, table, column_list, table))
+    if batched:
+        _setup_batched_triggers(connection, table, column_list)
+        return
     # make triggers to keep item_fts up to date
     connection.execute("CREATE TRIGGER item_bu "
-                       "BEFORE UPDATE ON %s BEGIN "
+                       "BEFORE UPDATE OF %s ON %s BEGIN "
                        "DELETE FROM item_fts WHERE docid=old.id; "
-                       "END;" % (table,))
+                       "END;" % (column_list, table))
 
     connection.execute("CREATE TRIGGER item_bd "
                        "BEFORE DELETE ON %s BEGIN "
@@ -60,10 +89,11 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
                        "END;" % (table,))
 
     connection.execute("CREATE TRIGGER item_au "
-                       "AFTER UPDATE ON %s BEGIN "
+                       "AFTER UPDATE OF %s ON %s BEGIN "
                        "INSERT INTO item_fts(docid, %s) "
                        "VALUES(new.id, %s); "
-                       "END;" % (table, column_list, column_list_for_new))
+                       "END;" % (column_list, table, column_list,
+                                 column_list_for_new))
 
     connection.execute("CREATE TRIGGER item_ai "
                        "AFTER INSERT ON %s BEGIN "
@@ -71,6 +101,60 @@ def setup_fulltext_search(connection, table='item', path_column='filename'):
                        "VALUES(new.id, %s); "
                        "END;" % (table, column_list, column_list_for_new))
 
+def _setup_batched_triggers(connection, table, column_list):
+    connection.execute("CREATE TABLE item_fts_dirty "
+                       "(docid integer PRIMARY KEY)")
+    connection.execute("CREATE TRIGGER item_bd "
+                       "BEFORE DELETE ON %s BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "DELETE FROM item_fts_dirty WHERE docid=old.id; "
+                       "END;" % (table,))
+
+    connection.execute("CREATE TRIGGER item_au "
+                       "AFTER UPDATE OF %s ON %s BEGIN "
+                       "INSERT OR IGNORE INTO item_fts_dirty(docid) "
+                       "VALUES(new.id); "
+                       "END;" % (column_list, table))
+
+    connection.execute("CREATE TRIGGER item_ai "
+                       "AFTER INSERT ON %s BEGIN "
+                       "INSERT OR IGNORE INTO item_fts_dirty(docid) "
+                       "VALUES(new.id); "
+                       "END;" % (table,))
+
+def has_dirty_queue(connection):
+    """Check if a database is using batched mode."""
+    cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
+                                "WHERE type='table' and name='item_fts_dirty'")
+    return (cursor.fetchone()[0] > 0)
+
+def flush_dirty_rows_sql(table='item', path_column='filename'):
+    """Get SQL statements that re-index the rows queued in item_fts_dirty.
+
+    The statements should be run inside the transaction that queued the
+    rows, right before it gets committed.
+    """
+    column_list = ', '.join(_indexed_columns(path_column))
+    return [
+        "DELETE FROM item_fts "
+        "WHERE docid IN (SELECT docid FROM item_fts_dirty)",
+        "INSERT INTO item_fts(docid, %s) "
+        "SELECT id, %s FROM %s "
+        "WHERE id IN (SELECT docid FROM item_fts_dirty)" %
+        (column_list, column_list, table),
+        "DELETE FROM item_fts_dirty",
+    ]
+
+def merge_command(sqlite_version_info):
+    """Get the command to merge the item_fts b-tree segments.
+
+    Use it like this: INSERT INTO item_fts(item_fts) VALUES(<command>)
+    """
+    if sqlite_version_info >= (3, 7, 14):
+        return MERGE_COMMAND
+    else:
+        return 'optimize'
+
 def _no_item_table(connection, table_name):
     cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
                                 "WHERE type='table' and name=?",
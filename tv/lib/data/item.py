@@ -49,6 +49,7 @@ from miro import fileutil
 from miro import prefs
 from miro import schema
 from miro import util
+from miro.data import downloadstats
 from miro.gtcache import gettext as _
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
@@ -238,6 +239,26 @@ class ItemInfoAttributeGetter(object):
             raise AttributeError("class attribute not supported")
         return instance.row_data[self.index]
 
+class DownloadStatsAttributeGetter(object):
+    """Attribute getter for the transfer stats in remote_downloader.
+
+    RemoteDownloader doesn't save these to disk every time they change.  If
+    downloadstats has newer values than our row data, we use them.
+    """
+    def __init__(self, index, downloader_id_index, column):
+        self.index = index
+        self.downloader_id_index = downloader_id_index
+        self.column = column
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError("class attribute not supported")
+        stats = downloadstats.get(
+            instance.row_data[self.downloader_id_index])
+        if stats is not None:
+            return stats[self.column]
+        return instance.row_data[self.index]
+
 class ItemInfoMeta(type):
     """Metaclass for ItemInfo.
 
@@ -251,8 +272,19 @@ class ItemInfoMeta(type):
         count = itertools.count()
         select_info = dct.get('select_info')
         if select_info is not None:
+            downloader_id_index = None
+            for i, select_column in enumerate(select_info.select_columns):
+                if select_column.attr_name == 'downloader_id':
+                    downloader_id_index = i
             for select_column in select_info.select_columns:
-                attribute = ItemInfoAttributeGetter(count.next())
+                index = count.next()
+                if (downloader_id_index is not None and
+                        select_column.table == 'remote_downloader' and
+                        select_column.column in downloadstats.STAT_COLUMNS):
+                    attribute = DownloadStatsAttributeGetter(
+                        index, downloader_id_index, select_column.column)
+                else:
+                    attribute = ItemInfoAttributeGetter(index)
                 dct[select_column.attr_name] = attribute
         return type.__new__(cls, classname, bases, dct)
 
@@ -31,9 +31,11 @@
 """
 import collections
 import logging
+import Queue
 import string
 import sqlite3
 import random
+import threading
 import weakref
 
 from miro import app
@@ -68,6 +70,45 @@ ItemTrackerOrderBy = util.namedtuple(
     :attribute sql: sql expression
     """)
 
+ItemTrackerSortTerm = util.namedtuple(
+    "ItemTrackerSortTerm",
+    "table column descending collation",
+
+    """ItemTrackerSortTerm describes one column in a simple ORDER BY clause.
+
+    :attribute table: table of the column
+    :attribute column: name of the column
+    :attribute descending: True for a descending sort
+    :attribute collation: collation used to sort the column, or None
+    """)
+
+ItemTrackerRowChanges = util.namedtuple(
+    "ItemTrackerRowChanges",
+    "removed inserted moved",
+
+    """ItemTrackerRowChanges describes how ItemTracker updated its id list.
+
+    :attribute removed: list of (start, count) ranges of rows removed.  These
+    refer to indexes in the old list.
+    :attribute inserted: list of (start, count) ranges of rows inserted.
+    These refer to indexes in the new list.
+    :attribute moved: list of (old_index, new_index) tuples for rows that
+    moved to a different position.
+    """)
+
+ItemTrackerStats = util.namedtuple(
+    "ItemTrackerStats",
+    "hits misses prefetched chunk_size cached_rows",
+
+    """ItemTrackerStats stores counters used to tune row prefetching.
+
+    :attribute hits: get_row() calls that found the row already loaded
+    :attribute misses: get_row() calls that had to read from the database
+    :attribute prefetched: rows loaded by the background prefetcher
+    :attribute chunk_size: current prefetch chunk size
+    :attribute cached_rows: number of ItemInfo objects currently in memory
+    """)
+
 class ItemTrackerQueryBase(object):
     """Query used to select item ids for ItemTracker.  """
 
@@ -77,7 +118,12 @@ class ItemTrackerQueryBase(object):
         self.conditions = []
         self.match_string = None
         self.order_by = None
+        # list of ItemTrackerSortTerm objects for our ORDER BY clause, or
+        # None if we use a complex ORDER BY.
+        self.sort_terms = []
         self.limit = None
+        # (table, column) tuples for extra values to select with the ids
+        self.value_columns = []
 
     def join_sql(self, table, join_type='LEFT JOIN'):
         return self.select_info.join_sql(table, join_type=join_type)
@@ -94,6 +140,16 @@ class ItemTrackerQueryBase(object):
             return True
         return False
 
+    def can_update_incrementally(self, message):
+        """Can ItemTracker handle an ItemChanges message without re-running
+        this query?
+
+        This is possible if all the rows that could have changed are listed
+        in the message and we can compare the ORDER BY values for rows in
+        python.  That rules out complex ORDER BY clauses and LIMIT clauses.
+        """
+        return self.sort_terms is not None and self.limit is None
+
     def _parse_column(self, column):
         """Parse a column specification.
 
@@ -180,6 +236,7 @@ class ItemTrackerQueryBase(object):
 
         sql_parts = []
         order_by_columns = []
+        sort_terms = []
         for column, collation in zip(columns, collations):
             if column[0] == '-':
                 descending = True
@@ -188,10 +245,13 @@ class ItemTrackerQueryBase(object):
                 descending = False
             table, column = self._parse_column(column)
             order_by_columns.append((table, column))
+            sort_terms.append(ItemTrackerSortTerm(table, column, descending,
+                                                  collation))
             sql_parts.append(self._order_by_expression(table, column,
                                                        descending, collation))
         self.order_by = ItemTrackerOrderBy(order_by_columns,
                                            ', '.join(sql_parts))
+        self.sort_terms = sort_terms
 
     def set_complex_order_by(self, columns, sql):
         """Change the ORDER BY clause to a complex SQL expression
@@ -201,6 +261,7 @@ class ItemTrackerQueryBase(object):
         """
         order_by_columns = [self._parse_column(c) for c in columns]
         self.order_by = ItemTrackerOrderBy(order_by_columns, sql)
+        self.sort_terms = None
 
     def _order_by_expression(self, table, column, descending, collation):
         parts = []
@@ -216,6 +277,17 @@ class ItemTrackerQueryBase(object):
     def set_limit(self, limit):
         self.limit = limit
 
+    def set_value_columns(self, columns):
+        """Set extra columns to select along with the item ids.
+
+        ItemTracker keeps the values for these columns in its column_values
+        dict, and keeps them up to date as items change.
+
+        :param columns: list of column names, in the same format as
+        add_condition() uses.
+        """
+        self.value_columns = [self._parse_column(c) for c in columns]
+
     def get_columns_to_track(self):
         """Get the columns that affect the results of the query """
         columns = set()
@@ -229,6 +301,11 @@ class ItemTrackerQueryBase(object):
             columns.update(column for (table, column)
                            in self.order_by.columns
                            if table == self.table_name())
+        for table, column in self.value_columns:
+            if table == self.table_name():
+                columns.add(column)
+            else:
+                columns.add(self.select_info.item_join_column(table))
         return columns
 
     def get_other_tables_to_track(self):
@@ -239,6 +316,7 @@ class ItemTrackerQueryBase(object):
         if self.order_by:
             other_tables.update(table for (table, column)
                                 in self.order_by.columns)
+        other_tables.update(table for (table, column) in self.value_columns)
         other_tables.discard('item')
         return other_tables
 
@@ -261,6 +339,63 @@ class ItemTrackerQueryBase(object):
         logging.debug("ItemTracker: done running query")
         return item_ids
 
+    def select_sort_keys(self, connection, id_list=None):
+        """Run the select statement for this query and also fetch the values
+        of the columns in the ORDER BY clause.
+
+        This only works if we use a simple ORDER BY clause (sort_terms is not
+        None).
+
+        :param id_list: if given, only select items with these ids and don't
+        sort the results.
+        :returns: list of (id, sort_key) tuples.  sort_key is a tuple of
+        values for each of our ORDER BY columns.
+        """
+        return [(id_, sort_key) for (id_, sort_key, values)
+                in self.select_rows(connection, id_list)]
+
+    def select_rows(self, connection, id_list=None):
+        """Run the select statement for this query and also fetch the values
+        of the ORDER BY columns and our value columns.
+
+        :param id_list: if given, only select items with these ids and don't
+        sort the results.
+        :returns: list of (id, sort_key, values) tuples.  sort_key is a tuple
+        of values for each of our ORDER BY columns, or an empty tuple if we
+        use a complex ORDER BY.  values is a tuple of values for each of our
+        value columns.
+        """
+        select_columns = ['%s.id' % self.table_name()]
+        if self.sort_terms is not None:
+            select_columns.extend('%s.%s' % (term.table, term.column)
+                                  for term in self.sort_terms)
+        values_start = len(select_columns)
+        select_columns.extend('%s.%s' % (table, column)
+                              for (table, column) in self.value_columns)
+        sql_parts = []
+        arg_list = []
+        sql_parts.append("SELECT %s FROM %s" %
+                         (', '.join(select_columns), self.table_name()))
+        self._add_joins(sql_parts, arg_list)
+        if id_list is None:
+            self._add_conditions(sql_parts, arg_list)
+            self._add_order_by(sql_parts, arg_list)
+            self._add_limit(sql_parts, arg_list)
+        else:
+            id_condition = ItemTrackerCondition(
+                [(self.table_name(), 'id')],
+                "%s.id IN (%s)" % (self.table_name(),
+                                   ', '.join(str(id_) for id_ in id_list)),
+                ())
+            self._add_conditions(sql_parts, arg_list, [id_condition])
+        sql = ' '.join(sql_parts)
+        logging.debug("ItemTracker: running query %s (%s)", sql, arg_list)
+        rows = [(row[0], tuple(row[1:values_start]),
+                 tuple(row[values_start:]))
+                for row in connection.execute(sql, arg_list)]
+        logging.debug("ItemTracker: done running query")
+        return rows
+
     def select_item_data(self, connection):
         """Run the select statement for this query
 
@@ -292,6 +427,7 @@ class ItemTrackerQueryBase(object):
         if self.order_by:
             join_tables.update(table for (table, column)
                                in self.order_by.columns)
+        join_tables.update(table for (table, column) in self.value_columns)
         if include_select_columns:
             join_tables.update(col.table
                                for col in self.select_info.select_columns)
@@ -320,11 +456,12 @@ class ItemTrackerQueryBase(object):
         if self.match_string:
             sql_parts.append(self.join_sql('item_fts'))
 
-    def _add_conditions(self, sql_parts, arg_list):
-        if not (self.conditions or self.match_string):
+    def _add_conditions(self, sql_parts, arg_list, extra_conditions=()):
+        conditions = self.conditions + list(extra_conditions)
+        if not (conditions or self.match_string):
             return
         where_parts = []
-        for c in self.conditions:
+        for c in conditions:
             where_parts.append(c.sql)
             arg_list.extend(c.values)
         if self.match_string:
@@ -345,7 +482,9 @@ class ItemTrackerQueryBase(object):
         retval = self.__class__()
         retval.conditions = self.conditions[:]
         retval.order_by = self.order_by
+        retval.sort_terms = self.sort_terms
         retval.match_string = self.match_string
+        retval.value_columns = self.value_columns[:]
         return retval
 
 class ItemTrackerQuery(ItemTrackerQueryBase):
@@ -361,6 +500,16 @@ class ItemTrackerQuery(ItemTrackerQueryBase):
             return True
         return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def can_update_incrementally(self, message):
+        # Changes to the downloader and playlist tables don't tell us which
+        # items were affected.
+        other_tables = self.get_other_tables_to_track()
+        if message.dlstats_changed and 'remote_downloader' in other_tables:
+            return False
+        if message.playlists_changed and 'playlist_item_map' in other_tables:
+            return False
+        return ItemTrackerQueryBase.can_update_incrementally(self, message)
+
 class DeviceItemTrackerQuery(ItemTrackerQueryBase):
     """ItemTrackerQuery for DeviceItems."""
 
@@ -384,6 +533,13 @@ class SharingItemTrackerQuery(ItemTrackerQueryBase):
         else:
             return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def can_update_incrementally(self, message):
+        if message.changed_playlists and self.tracking_playlist_map():
+            return False
+        else:
+            return ItemTrackerQueryBase.can_update_incrementally(self,
+                                                                 message)
+
 class ItemTracker(signals.SignalEmitter):
     """Track items in the database
 
@@ -397,16 +553,38 @@ class ItemTracker(signals.SignalEmitter):
       idle callbacks.
     - Can efficently tell what's changed in an item list when another process
       modifies the item data
+    - Prefetches rows around the visible part of the list in a background
+      thread once the frontend calls set_visible_range().
+    - Keeps at most ROW_CACHE_SIZE ItemInfo objects in memory, dropping the
+      least recently used ones first.
 
     Signals:
 
     - "items-changed" (changed_id_list): some items have been changed, but the
     list is the same.
     - "list-changed": items have been added, removed, or reorded in the list.
+    - "rows-changed" (changes): emitted before list-changed when we updated
+      the list without re-running the query.  changes is an
+      ItemTrackerRowChanges object that describes which rows moved.
+
+    If the query has value columns, column_values maps the ids in the list to
+    tuples of values for those columns.  Otherwise it's None.
     """
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # bounds for the number of rows we prefetch in a single background read.
+    # The chunk size grows when the user scrolls past our prefetched rows and
+    # shrinks back when the prefetched rows cover the visible range.
+    MIN_PREFETCH_CHUNK_SIZE = 25
+    MAX_PREFETCH_CHUNK_SIZE = 400
+    # max number of added/changed items that we handle by updating our id
+    # list in place.  For bigger changes it's faster to re-run the query.
+    MAX_INCREMENTAL_CHANGES = 500
+    # max number of ItemInfo objects to keep in memory.  Lists longer than
+    # this are not loaded completely in idle callbacks, we rely on the
+    # prefetcher to load the rows around the visible range instead.
+    ROW_CACHE_SIZE = 5000
 
     def __init__(self, idle_scheduler, query, item_source):
         """Create an ItemTracker
@@ -421,11 +599,21 @@ class ItemTracker(signals.SignalEmitter):
         self.create_signal("will-change")
         self.create_signal("items-changed")
         self.create_signal("list-changed")
+        self.create_signal("rows-changed")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
         self.item_fetcher = None
         self.item_source = item_source
         self._db_retry_callback_pending = False
+        # prefetch state.  _prefetch_results is filled by the prefetch thread
+        # and emptied by us, deques are safe to use that way without locking.
+        self._prefetch_results = collections.deque()
+        self._prefetch_requests = []
+        self._prefetch_generation = 0
+        self._prefetch_chunk_size = self.MIN_PREFETCH_CHUNK_SIZE
+        self._visible_range = None
+        self._last_prefetch_start = None
+        self._hits = self._misses = self._prefetched = 0
         self._set_query(query)
         self._fetch_id_list()
         self._schedule_idle_work()
@@ -436,6 +624,7 @@ class ItemTracker(signals.SignalEmitter):
         We will release any open connections to the database and reset our
         self to an empty list.
         """
+        self._cancel_prefetch_requests()
         self._destroy_item_fetcher()
         self.id_list = self.id_to_index = self.row_data = None
 
@@ -454,7 +643,8 @@ class ItemTracker(signals.SignalEmitter):
 
     def _destroy_item_fetcher(self):
         if self.item_fetcher:
-            self.item_fetcher.destroy()
+            with self.item_fetcher.lock:
+                self.item_fetcher.destroy()
             self.item_fetcher = None
 
     def _run_db_error_dialog(self):
@@ -480,17 +670,46 @@ class ItemTracker(signals.SignalEmitter):
     def _fetch_id_list(self):
         """Fetch the ids for this list.  """
         self._destroy_item_fetcher()
+        # If we can update the list incrementally, we also fetch the values
+        # of the ORDER BY columns so that we can tell where new items go.
+        self._sort_keys = None
+        self.column_values = None
         try:
             connection = self.item_source.get_connection()
-            self.id_list = self.query.select_ids(connection)
+            if self.item_source.wal_mode():
+                # Keep a read transaction open so that ItemFetcherWAL loads
+                # rows from the same snapshot as the id list.
+                connection.execute("BEGIN")
+            if (self.query.sort_terms is not None or
+                    self.query.value_columns):
+                rows = self.query.select_rows(connection)
+                id_list = [row[0] for row in rows]
+                if self.query.sort_terms is not None:
+                    self._sort_keys = dict((id_, sort_key)
+                                           for (id_, sort_key, values)
+                                           in rows)
+                if self.query.value_columns:
+                    self.column_values = dict((id_, values)
+                                              for (id_, sort_key, values)
+                                              in rows)
+            else:
+                id_list = self.query.select_ids(connection)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
-            self.id_list = []
+            id_list = []
+            self._sort_keys = None
+            if self.query.value_columns:
+                self.column_values = {}
             self._run_db_error_dialog()
-        self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
-        self.row_data = {}
+        self._set_id_list(id_list)
+        self.row_data = ItemInfoCache(self.ROW_CACHE_SIZE)
+        self._start_new_prefetch_generation()
         self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
 
+    def _set_id_list(self, id_list):
+        self.id_list = id_list
+        self.id_to_index = dict((id_, i) for i, id_ in enumerate(id_list))
+
     def _schedule_idle_work(self):
         """Schedule do_idle_work to be called some time in the
         future using idle_scheduler.
@@ -505,6 +724,15 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
+        if len(self.id_list) > self.row_data.capacity:
+            # We can't keep all the rows in memory, so there's no point in
+            # loading them all.  The prefetcher handles loading rows as the
+            # user scrolls through the list, so we can't call
+            # done_fetching() here.  The ItemFetcher needs to keep reading
+            # from the snapshot that id_list came from until we fetch a new
+            # one.
+            return
+        self._apply_prefetch_results()
         for i in xrange(len(self.id_list)):
             if not self._row_loaded(i):
                 # row data unloaded, call _ensure_row_loaded to load this row
@@ -513,7 +741,8 @@ class ItemTracker(signals.SignalEmitter):
                 self._schedule_idle_work()
                 return
         # no rows need loading
-        self.item_fetcher.done_fetching()
+        with self.item_fetcher.lock:
+            self.item_fetcher.done_fetching()
 
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
@@ -526,25 +755,32 @@ class ItemTracker(signals.SignalEmitter):
         self.emit('will-change')
         self._fetch_id_list()
         self.emit("list-changed")
+        self._schedule_prefetch()
 
     def get_items(self):
         """Get a list of all items in sorted order."""
         return [self.get_row(i) for i in xrange(len(self.id_list))]
 
+    def _all_rows_loaded(self):
+        return (not self.idle_work_scheduled and
+                len(self.row_data) == len(self.id_list))
+
     def get_playable_ids(self):
         """Get a list of ids for items that can be played."""
         # If we have loaded all items, then we can just use that data
-        if not self.idle_work_scheduled:
+        if self._all_rows_loaded():
             return [i.id for i in self.get_items() if i.is_playable]
         else:
-            return self.item_fetcher.select_playable_ids()
+            with self.item_fetcher.lock:
+                return self.item_fetcher.select_playable_ids()
 
     def has_playables(self):
         """Can we play any items from this item list?"""
-        if not self.idle_work_scheduled:
+        if self._all_rows_loaded():
             return any(i for i in self.get_items() if i.is_playable)
         else:
-            return self.item_fetcher.select_has_playables()
+            with self.item_fetcher.lock:
+                return self.item_fetcher.select_has_playables()
 
     def __len__(self):
         return len(self.id_list)
@@ -561,15 +797,17 @@ class ItemTracker(signals.SignalEmitter):
             return
         rows_to_load = [index]
         # as long as we're reading from disk, load a chunk of rows instead of
-        # just one.
-        start_row = max(index - (self.FETCH_ROW_CHUNK_SIZE // 2), 0)
+        # just one.  Don't load more than we can store though, or we might
+        # drop the row we were asked for.
+        chunk_size = min(self.FETCH_ROW_CHUNK_SIZE, self.row_data.capacity)
+        start_row = max(index - (chunk_size // 2), 0)
         for i in xrange(start_row, index):
             if not self._row_loaded(i):
                 rows_to_load.append(i)
         for i in xrange(index+1, len(self.id_list)):
             if not self._row_loaded(i):
                 rows_to_load.append(i)
-                if len(rows_to_load) >= self.FETCH_ROW_CHUNK_SIZE:
+                if len(rows_to_load) >= chunk_size:
                     break
         self._load_rows(rows_to_load)
 
@@ -581,14 +819,24 @@ class ItemTracker(signals.SignalEmitter):
         """
         ids_to_load = [self.id_list[i] for i in rows_to_load]
         try:
-            items = self.item_fetcher.fetch_items(ids_to_load)
+            with self.item_fetcher.lock:
+                items = self.item_fetcher.fetch_items(ids_to_load)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
             items = [item.DBErrorItemInfo(item_id) for item_id in ids_to_load]
             self._run_db_error_dialog()
         for item_info in items:
-            pos = self.id_to_index[item_info.id]
-            self.row_data[item_info.id] = item_info
+            self.row_data.add(item_info)
+        if len(items) < len(ids_to_load):
+            # This shouldn't happen, since the ItemFetcher reads from the
+            # same data as our id list.  Use placeholders for the missing
+            # rows rather than failing in get_row().
+            loaded_ids = set(item_info.id for item_info in items)
+            for item_id in ids_to_load:
+                if item_id not in loaded_ids:
+                    logging.warn("ItemTracker: couldn't load item %s",
+                                 item_id)
+                    self.row_data.add(item.DBErrorItemInfo(item_id))
 
     def item_in_list(self, item_id):
         """Test if an item is in the list.
@@ -608,13 +856,25 @@ class ItemTracker(signals.SignalEmitter):
 
         :raises IndexError: index out of range
         """
-        self._ensure_row_loaded(index)
+        self._apply_prefetch_results()
         try:
             id_ = self.id_list[index]
         except IndexError:
             # re-raise the error with a bit more information
             raise IndexError("%s is out of range" % index)
-        return self.row_data[id_]
+        try:
+            item_info = self.row_data.get_and_touch(id_)
+        except KeyError:
+            self._misses += 1
+            if self._visible_range is not None:
+                # The user scrolled past the rows we prefetched, read bigger
+                # chunks from now on.
+                self._grow_prefetch_chunk_size()
+            self._ensure_row_loaded(index)
+            return self.row_data[id_]
+        else:
+            self._hits += 1
+            return item_info
 
     def get_first_item(self):
         return self.get_row(0)
@@ -649,16 +909,473 @@ class ItemTracker(signals.SignalEmitter):
                        if self.item_in_list(item_id)]
         self._uncache_row_data(changed_ids)
         if self._could_list_change(message):
-            self._refetch_id_list()
+            if self._can_update_incrementally(message):
+                self._update_id_list(message, changed_ids)
+            else:
+                self._refetch_id_list()
         else:
-            self.item_fetcher.refresh_items(changed_ids)
+            # any rows prefetched before this point may contain old data
+            self._start_new_prefetch_generation()
+            with self.item_fetcher.lock:
+                self.item_fetcher.refresh_items(changed_ids)
             self.emit('will-change')
             self.emit('items-changed', changed_ids)
+            self._schedule_prefetch()
 
     def _could_list_change(self, message):
         """Calculate if an ItemChanges means the list may have changed."""
         return self.query.could_list_change(message)
 
+    def _can_update_incrementally(self, message):
+        """Calculate if we can handle an ItemChanges message using
+        _update_id_list()
+        """
+        if self._sort_keys is None:
+            return False
+        change_count = len(message.added) + len(message.changed)
+        if change_count > self.MAX_INCREMENTAL_CHANGES:
+            return False
+        return self.query.can_update_incrementally(message)
+
+    def _update_id_list(self, message, changed_ids):
+        """Update our id list for an ItemChanges message without re-running
+        our query.
+
+        We select the added and changed items that match our query, remove
+        the ones that don't from the list, then use a binary search to find
+        the position for the others.
+
+        :param message: ItemChanges message
+        :param changed_ids: ids in message.changed that were in our list
+        """
+        candidates = set(message.added)
+        candidates.update(message.changed)
+        # any rows prefetched before this point may contain old data
+        self._start_new_prefetch_generation()
+        try:
+            with self.item_fetcher.lock:
+                self.item_fetcher.refresh_items(list(candidates))
+                connection = self.item_fetcher.connection
+                rows = self.query.select_rows(connection, candidates)
+                new_sort_keys = dict((id_, sort_key)
+                                     for (id_, sort_key, values) in rows)
+                comparer = SortKeyComparer(connection, self.query.sort_terms)
+                new_id_list, removed_ids, inserted_ids = \
+                        self._calc_new_id_list(message, candidates,
+                                               new_sort_keys, comparer)
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while updating item list", e, exc_info=True)
+            self._refetch_id_list()
+            return
+        self._uncache_row_data(removed_ids)
+        if not (removed_ids or inserted_ids):
+            # The list is the same, but some items may have changed
+            if self.column_values is not None:
+                self._update_column_values(rows, removed_ids)
+            if changed_ids:
+                self.emit('will-change')
+                self.emit('items-changed', changed_ids)
+            return
+        old_id_to_index = self.id_to_index
+        self.emit('will-change')
+        self._set_id_list(new_id_list)
+        self.item_fetcher.id_list = new_id_list
+        if self.column_values is not None:
+            self._update_column_values(rows, removed_ids)
+        changes = self._calc_row_changes(old_id_to_index, removed_ids,
+                                         inserted_ids)
+        self.emit('rows-changed', changes)
+        self.emit('list-changed')
+        self._schedule_prefetch()
+
+    def _update_column_values(self, rows, removed_ids):
+        """Update column_values for _update_id_list()
+
+        :param rows: rows from select_rows() for the changed items
+        :param removed_ids: ids that were removed from the list
+        """
+        changed_ids = []
+        for id_ in removed_ids:
+            del self.column_values[id_]
+        for (id_, sort_key, values) in rows:
+            if self.column_values.get(id_) != values:
+                self.column_values[id_] = values
+                changed_ids.append(id_)
+        if changed_ids:
+            self._column_values_changed(changed_ids)
+
+    def _column_values_changed(self, changed_ids):
+        """Called when column_values changes for items in the list.
+
+        This gets called after id_list is updated, but before any signals are
+        emitted for the change.
+        Subclasses can override this to update data derived from the values.
+        """
+        pass
+
+    def _calc_new_id_list(self, message, candidates, new_sort_keys,
+                          comparer):
+        """Calculate the new id list for _update_id_list()
+
+        This method updates self._sort_keys to match the new list.
+
+        :returns: (new_id_list, removed_ids, inserted_ids) tuple.
+        removed_ids and inserted_ids will both contain ids for items that
+        moved positions.
+        """
+        removed_ids = set(id_ for id_ in message.removed
+                          if id_ in self.id_to_index)
+        inserted_ids = []
+        for id_ in candidates:
+            sort_key = new_sort_keys.get(id_)
+            if id_ in self.id_to_index:
+                if sort_key is None:
+                    # item doesn't match our query anymore
+                    removed_ids.add(id_)
+                elif sort_key != self._sort_keys[id_]:
+                    # item may need to be moved
+                    removed_ids.add(id_)
+                    inserted_ids.append(id_)
+            elif sort_key is not None:
+                inserted_ids.append(id_)
+        if not (removed_ids or inserted_ids):
+            return self.id_list, removed_ids, inserted_ids
+
+        for id_ in removed_ids:
+            del self._sort_keys[id_]
+        if removed_ids:
+            new_id_list = [id_ for id_ in self.id_list
+                           if id_ not in removed_ids]
+        else:
+            new_id_list = list(self.id_list)
+        inserted_ids.sort()
+        for id_ in inserted_ids:
+            sort_key = new_sort_keys[id_]
+            pos = self._find_insert_position(new_id_list, sort_key, comparer)
+            new_id_list.insert(pos, id_)
+            self._sort_keys[id_] = sort_key
+        if new_id_list == self.id_list:
+            # sort keys changed, but every item stayed in the same place
+            return self.id_list, set(), []
+        return new_id_list, removed_ids, inserted_ids
+
+    def _find_insert_position(self, id_list, sort_key, comparer):
+        """Binary search for the position to insert a new item to id_list.
+
+        Items that sort equally are inserted after the existing items, like
+        bisect.bisect_right().
+        """
+        low = 0
+        high = len(id_list)
+        while low < high:
+            middle = (low + high) // 2
+            if comparer.compare(sort_key,
+                                self._sort_keys[id_list[middle]]) < 0:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _calc_row_changes(self, old_id_to_index, removed_ids, inserted_ids):
+        """Create an ItemTrackerRowChanges object for _update_id_list()."""
+        moved_ids = removed_ids.intersection(inserted_ids)
+        removed_rows = [old_id_to_index[id_] for id_ in removed_ids
+                        if id_ not in moved_ids]
+        inserted_rows = [self.id_to_index[id_] for id_ in inserted_ids
+                         if id_ not in moved_ids]
+        moved = [(old_id_to_index[id_], self.id_to_index[id_])
+                 for id_ in moved_ids
+                 if old_id_to_index[id_] != self.id_to_index[id_]]
+        moved.sort()
+        return ItemTrackerRowChanges(_index_ranges(removed_rows),
+                                     _index_ranges(inserted_rows),
+                                     moved)
+
+    def set_visible_range(self, first_row, last_row):
+        """Tell ItemTracker which rows the frontend is currently displaying.
+
+        We will load the rows around that range in a background thread, so
+        that they are ready by the time the user scrolls to them.
+
+        :param first_row: index of the first visible row
+        :param last_row: index of the last visible row
+        """
+        new_range = (first_row, last_row)
+        if new_range == self._visible_range:
+            return
+        self._visible_range = new_range
+        self._schedule_prefetch()
+
+    def get_stats(self):
+        """Get an ItemTrackerStats object for this tracker."""
+        return ItemTrackerStats(self._hits, self._misses, self._prefetched,
+                                self._prefetch_chunk_size,
+                                len(self.row_data))
+
+    def _grow_prefetch_chunk_size(self):
+        self._prefetch_chunk_size = min(self._prefetch_chunk_size * 2,
+                                        self.MAX_PREFETCH_CHUNK_SIZE)
+
+    def _shrink_prefetch_chunk_size(self):
+        self._prefetch_chunk_size = max(self._prefetch_chunk_size // 2,
+                                        self.MIN_PREFETCH_CHUNK_SIZE)
+
+    def _start_new_prefetch_generation(self):
+        """Ignore results from any prefetch requests currently running."""
+        self._cancel_prefetch_requests()
+        self._prefetch_generation += 1
+        self._prefetch_results.clear()
+
+    def _cancel_prefetch_requests(self):
+        for request in self._prefetch_requests:
+            request.cancel()
+        self._prefetch_requests = []
+
+    def _calc_prefetch_rows(self):
+        """Calculate which rows the prefetcher should load.
+
+        We load a chunk behind the visible range and 2 chunks ahead of it,
+        where ahead means the direction the user is scrolling in.
+
+        :returns: list of row indexes, ordered so that the rows closest to
+        the visible range come first.
+        """
+        first_row, last_row = self._visible_range
+        first_row = max(first_row, 0)
+        last_row = min(last_row, len(self.id_list) - 1)
+        chunk_size = self._prefetch_chunk_size
+        scrolling_up = (self._last_prefetch_start is not None and
+                        first_row < self._last_prefetch_start)
+        self._last_prefetch_start = first_row
+        if scrolling_up:
+            above_count, below_count = chunk_size * 2, chunk_size
+        else:
+            above_count, below_count = chunk_size, chunk_size * 2
+        rows_above = range(first_row - 1,
+                           max(first_row - above_count, 0) - 1, -1)
+        rows_below = range(last_row + 1,
+                           min(last_row + below_count + 1, len(self.id_list)))
+        rows = range(first_row, last_row + 1)
+        if scrolling_up:
+            rows.extend(rows_above + rows_below)
+        else:
+            rows.extend(rows_below + rows_above)
+        return [i for i in rows if not self._row_loaded(i)]
+
+    def _schedule_prefetch(self):
+        """Send requests to the prefetch thread for the rows around the
+        visible range.
+        """
+        if (self._visible_range is None or self.item_fetcher is None or
+                not self.id_list):
+            return
+        self._apply_prefetch_results()
+        # Requests for the old range are now useless, drop them if they
+        # haven't started yet.
+        self._cancel_prefetch_requests()
+        rows_to_load = self._calc_prefetch_rows()
+        if not rows_to_load:
+            self._shrink_prefetch_chunk_size()
+            return
+        worker = get_prefetch_worker()
+        chunk_size = self._prefetch_chunk_size
+        for start in xrange(0, len(rows_to_load), chunk_size):
+            ids = [self.id_list[i]
+                   for i in rows_to_load[start:start+chunk_size]]
+            request = RowPrefetchRequest(self.item_fetcher, ids,
+                                         self._prefetch_generation,
+                                         self._prefetch_results)
+            self._prefetch_requests.append(request)
+            worker.add_request(request)
+
+    def _apply_prefetch_results(self):
+        """Add rows that the prefetch thread has loaded to row_data."""
+        while self._prefetch_results:
+            generation, items = self._prefetch_results.popleft()
+            if generation != self._prefetch_generation:
+                continue
+            for item_info in items:
+                if item_info.id in self.id_to_index:
+                    self.row_data.add(item_info)
+            self._prefetched += len(items)
+
+def _index_ranges(indexes):
+    """Convert a list of row indexes into a list of (start, count) ranges."""
+    ranges = []
+    for index in sorted(indexes):
+        if ranges and ranges[-1][0] + ranges[-1][1] == index:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([index, 1])
+    return [tuple(r) for r in ranges]
+
+class SortKeyComparer(object):
+    """Compare sort keys from ItemTrackerQuery.select_sort_keys()
+
+    SortKeyComparer compares values the same way that SQLite does when it
+    sorts them: NULLs first, then numbers, then text, then blobs.  Text is
+    compared by its UTF-8 bytes, unless the column uses a collation.  Our
+    collations are implemented in C++, so for those we ask SQLite to do the
+    comparison.
+    """
+    def __init__(self, connection, sort_terms):
+        self.connection = connection
+        self.sort_terms = sort_terms
+
+    def compare(self, key1, key2):
+        """Compare 2 sort keys.
+
+        :returns: negative if key1 sorts before key2, positive if it sorts
+        after it and 0 if they sort the same.
+        """
+        for value1, value2, term in zip(key1, key2, self.sort_terms):
+            result = self._compare_values(value1, value2, term.collation)
+            if result != 0:
+                if term.descending:
+                    return -result
+                else:
+                    return result
+        return 0
+
+    def _compare_values(self, value1, value2, collation):
+        rank1 = self._storage_class_rank(value1)
+        rank2 = self._storage_class_rank(value2)
+        if rank1 != rank2:
+            return cmp(rank1, rank2)
+        elif rank1 == 2:
+            if collation is not None:
+                return self._compare_with_collation(value1, value2,
+                                                    collation)
+            return cmp(self._text_bytes(value1), self._text_bytes(value2))
+        elif rank1 == 3:
+            return cmp(str(value1), str(value2))
+        else:
+            return cmp(value1, value2)
+
+    def _storage_class_rank(self, value):
+        if value is None:
+            return 0
+        elif isinstance(value, (int, long, float)):
+            return 1
+        elif isinstance(value, buffer):
+            return 3
+        else:
+            # strings, and datetimes, which are stored as text
+            return 2
+
+    def _text_bytes(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        else:
+            return str(value)
+
+    def _compare_with_collation(self, value1, value2, collation):
+        sql = ("SELECT CASE "
+               "WHEN ? = ? COLLATE %s THEN 0 "
+               "WHEN ? < ? COLLATE %s THEN -1 "
+               "ELSE 1 END" % (collation, collation))
+        values = (self._text_value(value1), self._text_value(value2)) * 2
+        return self.connection.execute(sql, values).fetchone()[0]
+
+    def _text_value(self, value):
+        if isinstance(value, basestring):
+            return value
+        else:
+            return unicode(value)
+
+class ItemInfoCache(collections.OrderedDict):
+    """Stores ItemInfo objects for ItemTracker.
+
+    ItemInfoCache is a dict that maps item ids to ItemInfo objects.  It holds
+    at most capacity items, once that's reached, adding a new item drops the
+    least recently used one.
+    """
+    def __init__(self, capacity):
+        collections.OrderedDict.__init__(self)
+        self.capacity = capacity
+
+    def add(self, item_info):
+        """Add an ItemInfo, possibly removing the least recently used one."""
+        if item_info.id in self:
+            del self[item_info.id]
+        self[item_info.id] = item_info
+        while len(self) > self.capacity:
+            self.popitem(last=False)
+
+    def get_and_touch(self, id_):
+        """Get an ItemInfo and mark it as recently used.
+
+        :raises KeyError: id_ not in the cache
+        """
+        item_info = self.pop(id_)
+        self[id_] = item_info
+        return item_info
+
+class RowPrefetchRequest(object):
+    """Request to load a chunk of rows in the prefetch thread.
+
+    The rows are fetched using the ItemFetcher for the ItemTracker, so that
+    the data comes from the same read transaction as the rest of the rows.
+    The ItemFetcher's lock ensures that only one thread uses its connection at
+    a time.
+    """
+    def __init__(self, item_fetcher, id_list, generation, results):
+        self.item_fetcher = item_fetcher
+        self.id_list = id_list
+        self.generation = generation
+        self.results = results
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        with self.item_fetcher.lock:
+            if self.cancelled or self.item_fetcher.connection is None:
+                return
+            try:
+                items = self.item_fetcher.fetch_items(self.id_list)
+            except sqlite3.DatabaseError, e:
+                # Don't bother showing an error dialog here, if the error
+                # persists the frontend will hit it when it loads the rows.
+                logging.warn("%s while prefetching items", e, exc_info=True)
+                return
+        self.results.append((self.generation, items))
+
+class RowPrefetchWorker(object):
+    """Runs RowPrefetchRequest objects in a background thread."""
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._thread_body,
+                                       name="ItemTracker prefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _thread_body(self):
+        while True:
+            request = self.queue.get()
+            try:
+                request.run()
+            except StandardError:
+                logging.exception("Error running %s", request)
+            finally:
+                self.queue.task_done()
+
+    def add_request(self, request):
+        self.queue.put(request)
+
+    def wait_until_idle(self):
+        """Block until all requests sent so far have been run."""
+        self.queue.join()
+
+_prefetch_worker = None
+def get_prefetch_worker():
+    """Get the RowPrefetchWorker shared by all ItemTrackers."""
+    global _prefetch_worker
+    if _prefetch_worker is None:
+        _prefetch_worker = RowPrefetchWorker()
+    return _prefetch_worker
+
 class ItemFetcher(object):
     """Create ItemInfo objects for ItemTracker
 
@@ -693,6 +1410,9 @@ class ItemFetcher(object):
         self.connection = connection
         self.item_source = item_source
         self.id_list = id_list
+        # ItemTracker and the prefetch thread both use our connection.  They
+        # must hold this lock while calling any of our methods.
+        self.lock = threading.Lock()
 
     def select_columns(self):
         return self.item_source.select_info.select_columns
@@ -764,6 +1484,9 @@ class ItemFetcherWAL(ItemFetcher):
         self._prepare_sql()
 
     def destroy(self):
+        if self.connection is not None:
+            # finish the read transaction before returning the connection
+            self.connection.commit()
         self.release_connection()
 
     def done_fetching(self):
@@ -73,3 +73,7 @@ class SharingItemPlaylistMap(object):
             "INSERT INTO sharing_item_playlist_map(playlist_id, item_id) "
             "VALUES (?, ?)",
             [(playlist_id, item_id) for item_id in item_ids])
+
+    def clear(self):
+        """Remove all entries."""
+        self.connection.execute("DELETE FROM sharing_item_playlist_map")
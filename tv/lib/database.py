@@ -35,6 +35,7 @@ import threading
 from miro import app
 from miro import signals
 from miro import threadcheck
+from miro import viewpredicate
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -210,6 +211,8 @@ class ViewTrackerManager(object):
         self.table_to_tracker = {}
         # maps joined tables to trackers
         self.joined_table_to_tracker = {}
+        # maps (table_name, where, joins) to compiled Predicates
+        self._predicates = {}
 
     def trackers_for_table(self, table_name):
         try:
@@ -221,12 +224,47 @@ class ViewTrackerManager(object):
     def trackers_for_ddb_class(self, klass):
         return self.trackers_for_table(self.db.table_name(klass))
 
+    def get_predicate(self, table_name, where, joins):
+        """Get a compiled viewpredicate.Predicate for a view.
+
+        Predicates are compiled once and shared between all trackers that use
+        the same WHERE clause.
+
+        :returns: Predicate or None if the WHERE clause can't be compiled
+        """
+        if joins:
+            joins_key = tuple(sorted(joins.items()))
+        else:
+            joins_key = None
+        key = (table_name, where, joins_key)
+        try:
+            return self._predicates[key]
+        except KeyError:
+            predicate = viewpredicate.compile_where(where, table_name, joins,
+                                                    self.db.table_fields)
+            self._predicates[key] = predicate
+            return predicate
+
     def update_view_trackers(self, obj, can_change_views=True):
         """Update view trackers based on an object change."""
 
         for tracker in self.trackers_for_ddb_class(obj.__class__):
             tracker.object_changed(obj, can_change_views)
 
+    def update_view_trackers_for_objects(self, objects):
+        """Update view trackers based on changes to a list of objects.
+
+        This works like calling update_view_trackers() for each object, but
+        each tracker checks all of the objects at once.
+        """
+        objects_by_table = {}
+        for obj in objects:
+            table_name = self.db.table_name(obj.__class__)
+            objects_by_table.setdefault(table_name, []).append(obj)
+        for table_name, table_objects in objects_by_table.items():
+            for tracker in list(self.trackers_for_table(table_name)):
+                tracker.check_objects(table_objects)
+
     def bulk_update_view_trackers(self, table_name):
         for tracker in self.trackers_for_table(table_name):
             tracker.check_all_objects()
@@ -254,6 +292,7 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self.predicate = self._get_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -271,8 +310,42 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _get_predicate(self):
+        vt_manager = self.db_info.view_tracker_manager
+        predicate = vt_manager.get_predicate(self.table_name, self.where,
+                                             self.joins)
+        if predicate is not None and predicate.param_count != len(self.values):
+            return None
+        return predicate
+
+    def _evaluate_predicate(self, obj):
+        """Check if an object is in our view without using SQL.
+
+        :returns: True/False, or None if we need to ask SQLite
+        """
+        if self.predicate is None or obj.changed_attributes:
+            # If obj has unsaved changes, SQLite may see different values
+            # than we do.
+            return None
+        try:
+            return self.predicate.evaluate(obj, self.values,
+                                           self._fetch_joined_obj)
+        except viewpredicate.CantEvaluate:
+            return None
+
+    def _fetch_joined_obj(self, id_, table_name):
+        if self.db_info.bulk_sql_manager.will_insert(id_):
+            raise viewpredicate.CantEvaluate("%s not inserted yet" % id_)
+        obj = self.db_info.db.get_loaded_obj(id_, table_name)
+        if obj is None or obj.changed_attributes:
+            raise viewpredicate.CantEvaluate("%s not loaded/saved" % id_)
+        return obj
+
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        in_view = self._evaluate_predicate(obj)
+        if in_view is not None:
+            return in_view
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -281,6 +354,26 @@ class ViewTracker(signals.SignalEmitter):
         return self.db_info.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _ids_in_view(self, id_list):
+        """Check which ids from a list are in our view.
+
+        :returns: set of ids
+        """
+        # we can only feed sqlite so many variables at once, leave room for
+        # our values in each chunk.
+        chunk_size = 990 - len(self.values)
+        ids = set()
+        for start in xrange(0, len(id_list), chunk_size):
+            chunk = tuple(id_list[start:start+chunk_size])
+            where = '%s.id IN (%s)' % (self.table_name,
+                                       ', '.join('?' for id_ in chunk))
+            if self.where:
+                where += ' AND (%s)' % (self.where,)
+            ids.update(self.db_info.db.query_ids(self.table_name, where,
+                                                 chunk + self.values,
+                                                 joins=self.joins))
+        return ids
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(self.db_info.db.query_ids(self.table_name,
@@ -299,9 +392,12 @@ class ViewTracker(signals.SignalEmitter):
             self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
     def remove_objects(self, objects):
-        for obj in [o for o in objects if o.id in self.current_ids]:
+        removed = [o for o in objects if o.id in self.current_ids]
+        for obj in removed:
             self.current_ids.remove(obj.id)
-            self.emit('removed', self.fetcher.fetch_obj_for_ddb_object(obj))
+        if removed:
+            self._emit_for_objects('removed',
+                [self.fetcher.fetch_obj_for_ddb_object(o) for o in removed])
 
     def check_object(self, obj):
         before = (obj.id in self.current_ids)
@@ -315,6 +411,48 @@ class ViewTracker(signals.SignalEmitter):
         elif before and now:
             self.emit('changed', self.fetcher.fetch_obj_for_ddb_object(obj))
 
+    def check_objects(self, objects):
+        """Check if a list of objects are in our view.
+
+        This works like calling check_object() for each object, but objects
+        that we can't check in python are checked with a single query and in
+        bulk mode we emit the bulk signals.
+        """
+        in_view = {}
+        unknown_ids = []
+        for obj in objects:
+            result = self._evaluate_predicate(obj)
+            if result is None:
+                unknown_ids.append(obj.id)
+            else:
+                in_view[obj.id] = result
+        if unknown_ids:
+            ids_in_view = self._ids_in_view(unknown_ids)
+            for id_ in unknown_ids:
+                in_view[id_] = id_ in ids_in_view
+
+        added = []
+        removed = []
+        changed = []
+        for obj in objects:
+            before = (obj.id in self.current_ids)
+            now = in_view[obj.id]
+            if before and not now:
+                self.current_ids.remove(obj.id)
+                removed.append(obj)
+            elif now and not before:
+                self.current_ids.add(obj.id)
+                added.append(obj)
+            elif before and now:
+                changed.append(obj)
+        fetch_obj = self.fetcher.fetch_obj_for_ddb_object
+        for signal, signal_objects in (('added', added),
+                                       ('removed', removed),
+                                       ('changed', changed)):
+            if signal_objects:
+                self._emit_for_objects(signal,
+                                       [fetch_obj(o) for o in signal_objects])
+
     def _emit_for_objects(self, signal, objects):
         if self.bulk_mode:
             self.emit('bulk-' + signal, objects)
@@ -432,17 +570,22 @@ class BulkSQLManager(object):
         # Figure out which strategy is fastest based on the number of objects
         # that have changed
         if len(changed_objs) < 100:
-            self._update_view_trackers_by_object(changed_objs)
+            self._update_view_trackers_by_object(to_insert, to_remove)
         else:
             self._update_view_trackers_by_table(to_insert, to_remove)
 
-    def _update_view_trackers_by_object(self, changed_objs):
+    def _update_view_trackers_by_object(self, to_insert, to_remove):
         """Update view trackers by checking each changed object.
 
         This method is the fastest when there are not a lot of changed objects
         """
-        for obj in changed_objs:
-            self.view_tracker_manager.update_view_trackers(obj)
+        inserted = []
+        for objects in to_insert.values():
+            inserted.extend(objects)
+        self.view_tracker_manager.update_view_trackers_for_objects(inserted)
+        for table_name, objects in to_remove.items():
+            self.view_tracker_manager.bulk_remove_from_view_trackers(
+                table_name, objects)
 
     def _update_view_trackers_by_table(self, to_insert, to_remove):
         """Update view trackers by checking each table
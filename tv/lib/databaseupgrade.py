@@ -53,6 +53,7 @@ from miro import schema
 from miro import util
 import types
 from miro import app
+from miro import containercodec
 from miro import dbupgradeprogress
 from miro import prefs
 
@@ -2480,11 +2481,23 @@ class TimeModuleShadow:
 _TIME_MODULE_SHADOW = TimeModuleShadow()
 
 def eval_container(repr):
-    """Convert a column that's stored using repr to a python
-    list/dict."""
+    """Convert a container column to a python list/dict.
+
+    Starting with upgrade198 these columns are stored using
+    containercodec, but rows that haven't been restored since then still
+    have the repr() from older versions.  This handles both.
+    """
+    if containercodec.is_encoded(repr):
+        return containercodec.decode(repr)
     return eval(repr, __builtins__, {'datetime': datetime,
                                      'time': _TIME_MODULE_SHADOW})
 
+def encode_container(value):
+    """Convert a python list/dict to the value we store for container
+    columns.  This is the reverse of eval_container().
+    """
+    return buffer(containercodec.encode(value))
+
 def upgrade100(cursor):
     """Adds the Miro audio guide as a site for anyone who doesn't
     already have it and isn't using a theme.
@@ -4298,3 +4311,109 @@ def upgrade195(cursor):
         else:
             size = None
         cursor.execute("UPDATE item SET size=? WHERE id=?", (size, item_id))
+
+@run_on_both
+def upgrade196(cursor):
+    """Only update item_fts when the indexed columns change.
+
+    For the main database, also switch to batched updates: the triggers just
+    queue ids in the item_fts_dirty table and LiveStorage re-indexes those
+    rows right before it commits.  Device databases can be written by older
+    versions of miro that don't know about item_fts_dirty, so they keep
+    updating item_fts inside the triggers.
+    """
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                   "WHERE type='table' AND name='device_item'")
+    if cursor.fetchone()[0] > 0:
+        table = 'device_item'
+    else:
+        table = 'item'
+    columns = ['title', 'description', 'artist', 'album', 'genre',
+               'filename', 'parent_title', ]
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    for trigger in ('item_bu', 'item_bd', 'item_au', 'item_ai'):
+        cursor.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+
+    if table == 'item':
+        cursor.execute("CREATE TABLE item_fts_dirty "
+                       "(docid integer PRIMARY KEY)")
+        cursor.execute("CREATE TRIGGER item_bd "
+                       "BEFORE DELETE ON item BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "DELETE FROM item_fts_dirty WHERE docid=old.id; "
+                       "END;")
+
+        cursor.execute("CREATE TRIGGER item_au "
+                       "AFTER UPDATE OF %s ON item BEGIN "
+                       "INSERT OR IGNORE INTO item_fts_dirty(docid) "
+                       "VALUES(new.id); "
+                       "END;" % (column_list,))
+
+        cursor.execute("CREATE TRIGGER item_ai "
+                       "AFTER INSERT ON item BEGIN "
+                       "INSERT OR IGNORE INTO item_fts_dirty(docid) "
+                       "VALUES(new.id); "
+                       "END;")
+    else:
+        cursor.execute("CREATE TRIGGER item_bu "
+                       "BEFORE UPDATE OF %s ON %s BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "END;" % (column_list, table))
+
+        cursor.execute("CREATE TRIGGER item_bd "
+                       "BEFORE DELETE ON %s BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "END;" % (table,))
+
+        cursor.execute("CREATE TRIGGER item_au "
+                       "AFTER UPDATE OF %s ON %s BEGIN "
+                       "INSERT INTO item_fts(docid, %s) "
+                       "VALUES(new.id, %s); "
+                       "END;" % (column_list, table, column_list,
+                                 column_list_for_new))
+
+        cursor.execute("CREATE TRIGGER item_ai "
+                       "AFTER INSERT ON %s BEGIN "
+                       "INSERT INTO item_fts(docid, %s) "
+                       "VALUES(new.id, %s); "
+                       "END;" % (table, column_list, column_list_for_new))
+    # Copying the database before an upgrade used to drop the triggers and
+    # renumber the item_fts docids, so item_fts may be out of date.  Rebuild
+    # it from scratch.
+    cursor.execute("DELETE FROM item_fts")
+    cursor.execute("INSERT INTO item_fts(docid, %s)"
+                   "SELECT %s.id, %s FROM %s" %
+                   (column_list, table, column_list, table))
+
+def upgrade197(cursor):
+    """Add indexes to look up items in a feed by rss_id and url."""
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                   "WHERE type='table' AND name='item'")
+    if cursor.fetchone()[0] == 0:
+        # device database, these don't have feeds
+        return
+    cursor.execute("CREATE INDEX item_feed_rss_id ON item (feed_id, rss_id)")
+    cursor.execute("CREATE INDEX item_feed_url_title "
+                   "ON item (feed_id, url, entry_title)")
+
+def upgrade198(cursor):
+    """Switch container columns from repr() to containercodec.
+
+    We don't rewrite anything here.  eval_container() and
+    LiveStorage can still read the repr() values and each row gets
+    converted the first time its object is restored.  Bumping the version
+    stops older versions of Miro, which can't read the new format, from
+    opening the database.
+    """
+    pass
+
+def upgrade199(cursor):
+    """Add indexes to look up icon caches by url and filename."""
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                   "WHERE type='table' AND name='icon_cache'")
+    if cursor.fetchone()[0] == 0:
+        # device database, these don't have icon caches
+        return
+    cursor.execute("CREATE INDEX icon_cache_url ON icon_cache (url)")
+    cursor.execute("CREATE INDEX icon_cache_filename ON icon_cache (filename)")
@@ -39,7 +39,9 @@ import os, os.path
 import re
 import time
 import bisect
+import collections
 import tempfile
+import threading
 try:
     from collections import Counter
 except ImportError:
@@ -73,13 +75,21 @@ from miro.download_utils import next_free_filename
 
 from miro.plat import resources
 from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
-                             utf8_to_filename)
+                             utf8_to_filename, thread_body)
 
 
 # how much slower converting a file is, compared to copying
 CONVERSION_SCALE = 500
 # schema version for device databases
-DB_VERSION = 194
+DB_VERSION = 196
+# default number of files we copy to a device at the same time.  Devices
+# can override this with the copy_streams setting.
+SYNC_COPY_STREAMS = 2
+# default buffer size for copying files to a device.  Devices can override
+# this with the copy_buffer_size setting.
+SYNC_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+# how often we send copy progress back to the eventloop
+SYNC_PROGRESS_INTERVAL = 0.5
 
 def unicode_to_path(path):
     """
@@ -618,6 +628,127 @@ class DeviceManager(object):
             dsm.set_device(device)
             return dsm
 
+class DeviceFileCopier(object):
+    """Copies files to a device using background threads.
+
+    copy() queues a file to copy.  Up to stream_count files get copied at
+    once, each on its own thread, so copying doesn't block the eventloop.
+    Progress from the copy threads is collected and sent to the eventloop
+    in batches every SYNC_PROGRESS_INTERVAL seconds.
+
+    :param progress_callback: called in the eventloop with a dict that maps
+        keys to the number of bytes copied since the last call
+    :param finished_callback: called in the eventloop with (key, success)
+        when a copy is done.  success is False if the copy failed or was
+        canceled.
+    :param should_cancel: called from the copy threads.  If it returns
+        True, in-progress copies are stopped and queued copies are skipped.
+    """
+    def __init__(self, progress_callback, finished_callback, should_cancel,
+                 stream_count=SYNC_COPY_STREAMS,
+                 buffer_size=SYNC_COPY_BUFFER_SIZE):
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.should_cancel = should_cancel
+        self.stream_count = max(1, stream_count)
+        self.buffer_size = buffer_size
+        # lock protects queue, thread_count and pending_progress
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.thread_count = 0
+        self.pending_progress = {}
+        self._progress_timeout = None
+
+    def copy(self, key, source, dest):
+        """Queue a file to copy."""
+        with self.lock:
+            self.queue.append((key, source, dest))
+            start_thread = self.thread_count < self.stream_count
+            if start_thread:
+                self.thread_count += 1
+        if start_thread:
+            thread = threading.Thread(target=thread_body,
+                                      args=[self._thread_loop],
+                                      name='Device Copy Thread')
+            thread.setDaemon(True)
+            thread.start()
+        self._schedule_progress_update()
+
+    def is_active(self):
+        with self.lock:
+            return bool(self.queue) or self.thread_count > 0
+
+    def _thread_loop(self):
+        with self.lock:
+            next_copy = self._pop_copy()
+        while next_copy is not None:
+            key, source, dest = next_copy
+            success = self._copy(key, source, dest)
+            # pick the next copy before posting _copy_finished, so that
+            # is_active() is already False when the last one runs.
+            with self.lock:
+                next_copy = self._pop_copy()
+            eventloop.add_idle(self._copy_finished, 'device copy finished',
+                               args=(key, success))
+
+    def _pop_copy(self):
+        """Get the next queued copy for a copy thread.
+
+        If the queue is empty, the calling thread is done and we return
+        None.  Must be called with lock held.
+        """
+        if not self.queue:
+            self.thread_count -= 1
+            return None
+        return self.queue.popleft()
+
+    def _copy(self, key, source, dest):
+        """Copy one file.
+
+        Any error counts as a failed copy.  We can't let one escape, since
+        it would kill the copy thread before it posts _copy_finished() and
+        releases its spot in thread_count.
+
+        :returns: True if the file was copied
+        """
+        def callback(count):
+            with self.lock:
+                self.pending_progress[key] = (
+                    self.pending_progress.get(key, 0) + count)
+            return self.should_cancel()
+        try:
+            if self.should_cancel():
+                return False
+            return fileutil.copy_with_callback(source, dest, callback,
+                                               self.buffer_size)
+        except Exception:
+            logging.warn('error copying %r to %r', source, dest,
+                         exc_info=True)
+            return False
+
+    def _copy_finished(self, key, success):
+        self._send_progress()
+        self.finished_callback(key, success)
+
+    def _schedule_progress_update(self):
+        if self._progress_timeout is None:
+            self._progress_timeout = eventloop.add_timeout(
+                SYNC_PROGRESS_INTERVAL, self._on_progress_timeout,
+                'device copy progress')
+
+    def _on_progress_timeout(self):
+        self._progress_timeout = None
+        self._send_progress()
+        if self.is_active():
+            self._schedule_progress_update()
+
+    def _send_progress(self):
+        with self.lock:
+            progress = self.pending_progress
+            self.pending_progress = {}
+        if progress:
+            self.progress_callback(progress)
+
 class DeviceSyncManager(object):
     """
     Represents a sync to a given device.
@@ -638,7 +769,7 @@ class DeviceSyncManager(object):
         self.auto_syncs = set()
         self.stopping = False
         self._change_timeout = None
-        self._copy_iter_running = False
+        self._copier = None
         self._info_to_conversion = {}
         self.started = False
 
@@ -1046,47 +1177,46 @@ class DeviceSyncManager(object):
                                       # will see it
         self.copying[final_path] = info
         self.total_size[info.id] = info.size
-        if not self._copy_iter_running:
-            self._copy_iter_running = True
-            eventloop.idle_iterate(self._copy_as_iter,
-                                   'copying files to device')
-
-    def _copy_as_iter(self):
-        while self.copying:
-            final_path, info = self.copying.popitem()
-            iterable = fileutil.copy_with_progress(info.filename, final_path,
-                                                   block_size=128 * 1024)
-            try:
-                for count in iterable:
-                    self.progress_size[info.id] += count
-                    if self.stopping:
-                        iterable.close()
-                        eventloop.add_idle(fileutil.delete,
-                                           "deleting canceled sync",
-                                           args=(final_path,))
-                        final_path = None
-                        break
-                    # let other stuff run
-                    self._schedule_sync_changed()
-                    yield
-            except IOError:
-                final_path = None
-            if final_path:
-                self._add_item(final_path, info)
-            # don't throw off the progress bar; we're done so pretend we got
-            # all the bytes
-            self.progress_size[info.id] = self.total_size[info.id]
-            self.finished += 1
-            self._check_finished()
-            if self.stopping:
-                break # no more copies
-            yield
-        for final_path in self.copying:
-            # canceled the sync, so remove the non-synced files
-            eventloop.add_idle(fileutil.delete,
-                               "deleting canceled sync",
+        self._get_copier().copy(final_path, info.filename, final_path)
+
+    def _get_copier(self):
+        if self._copier is None:
+            self._copier = DeviceFileCopier(
+                self._copy_progress, self._copy_finished,
+                self._copy_should_cancel,
+                stream_count=self.device_settings.get(u'copy_streams',
+                                                      SYNC_COPY_STREAMS),
+                buffer_size=self.device_settings.get(u'copy_buffer_size',
+                                                     SYNC_COPY_BUFFER_SIZE))
+        return self._copier
+
+    def _copy_should_cancel(self):
+        # called from the copy threads
+        return self.stopping
+
+    def _copy_progress(self, progress):
+        for final_path, count in progress.iteritems():
+            info = self.copying.get(final_path)
+            if info is not None:
+                self.progress_size[info.id] += count
+        self._schedule_sync_changed()
+
+    def _copy_finished(self, final_path, success):
+        info = self.copying.pop(final_path, None)
+        if info is None:
+            return
+        if success and not self.stopping:
+            self._add_item(final_path, info)
+        else:
+            # canceled the sync or the copy failed, so remove the partial
+            # file
+            eventloop.add_idle(fileutil.delete, "deleting canceled sync",
                                args=(final_path,))
-        self._copy_iter_running = False
+        # don't throw off the progress bar; we're done so pretend we got
+        # all the bytes
+        self.progress_size[info.id] = self.total_size[info.id]
+        self.finished += 1
+        self._check_finished()
 
     def _conversion_changed_callback(self, conversion_manager, task):
         total = self.total_size[task.key]
@@ -1212,8 +1342,29 @@ class DeviceSyncManager(object):
         self._send_sync_changed()
         self._send_sync_finished()
 
+class _RawValue(object):
+    """JSON for a device database value that we haven't decoded yet."""
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def decode(self):
+        return json.loads(self.data[self.start:self.end])
+
+    def encode(self):
+        return self.data[self.start:self.end]
+
 class DeviceDatabase(dict, signals.SignalEmitter):
-    def __init__(self, data=None, parent=None):
+    """Dictionary of data stored on a device.
+
+    Values loaded from the device are decoded from JSON the first time they
+    are accessed.  The root database keeps track of which top-level keys
+    changed, so that write_database() only needs to save those.
+    """
+    def __init__(self, data=None, parent=None, top_key=None):
         if data:
             dict.__init__(self, data)
             self.created_new = False
@@ -1223,19 +1374,39 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         signals.SignalEmitter.__init__(self, 'changed', 'item-added',
                                        'item-changed', 'item-removed')
         self.parent = parent
+        # top-level key that this database is stored under, for nested
+        # databases
+        self.top_key = top_key
+        # top-level keys changed since the last write, for the root
+        # database
+        self.dirty_keys = set()
         self.changing = False
         self.bulk_mode = False
         self.did_change = False
         self.check_old_key_usage = False
 
+    def _decode(self, key, value):
+        if isinstance(value, _RawValue):
+            value = value.decode()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _decode_all(self):
+        for key, value in dict.items(self):
+            self._decode(key, value)
+
     def __getitem__(self, key):
         check_u(key)
         if self.check_old_key_usage:
             if key in (u'audio', u'video', u'other'):
                 raise AssertionError()
-        value = super(DeviceDatabase, self).__getitem__(key)
+        value = self._decode(key,
+                             super(DeviceDatabase, self).__getitem__(key))
         if isinstance(value, dict) and not isinstance(value, DeviceDatabase):
-            value = DeviceDatabase(value, self.parent or self)
+            if self.parent:
+                value = DeviceDatabase(value, self.parent, self.top_key)
+            else:
+                value = DeviceDatabase(value, self, key)
              # don't trip the changed signal
             super(DeviceDatabase, self).__setitem__(key, value)
         return value
@@ -1243,12 +1414,68 @@ class DeviceDatabase(dict, signals.SignalEmitter):
     def __setitem__(self, key, value):
         check_u(key)
         super(DeviceDatabase, self).__setitem__(key, value)
+        self._changed(key)
+
+    def __delitem__(self, key):
+        super(DeviceDatabase, self).__delitem__(key)
+        self._changed(key)
+
+    def _changed(self, key):
         if self.parent:
-            self.parent.notify_changed()
+            self.parent.notify_changed(self.top_key)
         else:
-            self.notify_changed()
+            self.notify_changed(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._decode(key,
+                                super(DeviceDatabase, self).__getitem__(key))
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self.get(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self.get(key)
+            del self[key]
+            return value
+        return super(DeviceDatabase, self).pop(key, *args)
+
+    def items(self):
+        self._decode_all()
+        return super(DeviceDatabase, self).items()
+
+    def iteritems(self):
+        self._decode_all()
+        return super(DeviceDatabase, self).iteritems()
+
+    def values(self):
+        self._decode_all()
+        return super(DeviceDatabase, self).values()
+
+    def itervalues(self):
+        self._decode_all()
+        return super(DeviceDatabase, self).itervalues()
+
+    def copy(self):
+        self._decode_all()
+        return super(DeviceDatabase, self).copy()
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, DeviceDatabase):
+            other._decode_all()
+        return super(DeviceDatabase, self).__eq__(other)
 
-    def notify_changed(self):
+    def __ne__(self, other):
+        return not self == other
+
+    def notify_changed(self, key=None):
+        if key is not None:
+            self.dirty_keys.add(key)
         self.did_change = True
         if not self.bulk_mode and not self.changing:
             self.changing = True
@@ -1296,31 +1523,221 @@ class DatabaseWriteManager(object):
         write_database(self.database, self.mount)
         self.database = self.scheduled_write = None
 
-def load_database(mount, countdown=0):
+# The device database is stored in [MOUNT]/.miro/devicedb.  The file
+# starts with a header line, then a line with a JSON index, then the JSON
+# for each value.  The index maps each top-level key to either
+# {"v": [offset, length]} for a single value, or to
+# {"d": {subkey: [offset, length], ...}} for big dictionaries, which we
+# store one entry at a time so that we can decode the entries separately.
+# Offsets are relative to the end of the index line.
+#
+# Changes since the file was written are appended to
+# [MOUNT]/.miro/devicedb-journal.  Each line is [key, value] if key was
+# set, or [key] if it was deleted.  When the journal gets big, we rewrite
+# the database file and remove the journal.
+#
+# Old versions of Miro stored the whole database as JSON in
+# [MOUNT]/.miro/json.  We still load that, and replace it with the new
+# format the first time we write the database.  Once the new database is
+# written, we remove the JSON file.  If it shows up again, an older version
+# of Miro wrote it after we migrated, so we merge its changes into the new
+# database and migrate again.
+DEVICE_DB_HEADER = 'miro-device-db 1\n'
+# dictionaries with at least this many entries get stored entry by entry
+DEVICE_DB_SPLIT_SIZE = 50
+# rewrite the database once the journal gets bigger than this
+DEVICE_DB_JOURNAL_LIMIT = 256 * 1024
+
+def _device_db_path(mount):
+    return os.path.join(mount, '.miro', 'devicedb')
+
+def _device_db_journal_path(mount):
+    return os.path.join(mount, '.miro', 'devicedb-journal')
+
+def _legacy_device_db_path(mount):
+    return os.path.join(mount, '.miro', 'json')
+
+def _encode_device_db_value(value):
+    """Encode a value from a DeviceDatabase as JSON.
+
+    Values that we never decoded are written out as-is.
     """
-    Returns a dictionary of the JSON database that lives on the given device.
+    if isinstance(value, _RawValue):
+        return value.encode()
+    elif isinstance(value, dict):
+        return '{%s}' % ','.join('%s:%s' % (_encode_device_db_key(key),
+                                            _encode_device_db_value(value))
+                                 for key, value in dict.iteritems(value))
+    else:
+        return json.dumps(value)
 
-    The database lives at [MOUNT]/.miro/json
+def _encode_device_db_key(key):
+    # JSON object keys must be strings
+    if not isinstance(key, basestring):
+        key = unicode(key)
+    return json.dumps(key)
+
+def _read_device_db(path):
+    """Read a database written by _write_device_db().
+
+    Values aren't decoded until they are accessed.
+
+    :raises ValueError: the file is corrupt
     """
-    file_name = os.path.join(mount, '.miro', 'json')
-    if not os.path.exists(file_name):
-        db = {}
-    else:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(DEVICE_DB_HEADER):
+        raise ValueError("Invalid device database header")
+    index_end = data.find('\n', len(DEVICE_DB_HEADER))
+    if index_end < 0:
+        raise ValueError("Device database index not terminated")
+    index = json.loads(data[len(DEVICE_DB_HEADER):index_end])
+    base = index_end + 1
+    db = DeviceDatabase()
+    db.created_new = False
+    for key, entry in index.iteritems():
+        if 'v' in entry:
+            offset, length = entry['v']
+            value = _RawValue(data, base + offset, base + offset + length)
+        else:
+            value = DeviceDatabase(parent=db, top_key=key)
+            for subkey, (offset, length) in entry['d'].iteritems():
+                dict.__setitem__(value, subkey,
+                                 _RawValue(data, base + offset,
+                                           base + offset + length))
+        dict.__setitem__(db, key, value)
+    return db
+
+def _replay_device_db_journal(db, path):
+    """Apply the changes in the journal at path to db."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
         try:
-            fp = codecs.open(file_name, 'rb', 'utf8')
-            db = json.load(fp)
+            record = json.loads(line)
         except ValueError:
-            logging.exception('JSON decode error on %s', mount)
-            db = {}
-        except EnvironmentError:
-            if countdown == 5:
-                logging.exception('file error with JSON on %s', mount)
-                db = {}
+            if i == len(lines) - 1:
+                # we probably got interrupted writing the last line
+                logging.warn("Ignoring incomplete device database journal "
+                             "entry")
+                break
+            raise
+        if len(record) == 2:
+            dict.__setitem__(db, record[0], record[1])
+        else:
+            dict.pop(db, record[0], None)
+
+def _write_device_db(db, mount):
+    """Write out the entire database and remove the journal."""
+    index = {}
+    chunks = []
+    offset = 0
+    for key, value in dict.iteritems(db):
+        if isinstance(value, dict) and len(value) >= DEVICE_DB_SPLIT_SIZE:
+            entry_index = {}
+            for subkey, subvalue in dict.iteritems(value):
+                chunk = _encode_device_db_value(subvalue)
+                entry_index[subkey] = (offset, len(chunk))
+                chunks.append(chunk)
+                offset += len(chunk)
+            index[key] = {'d': entry_index}
+        else:
+            chunk = _encode_device_db_value(value)
+            index[key] = {'v': (offset, len(chunk))}
+            chunks.append(chunk)
+            offset += len(chunk)
+    path = _device_db_path(mount)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as output:
+        output.write(DEVICE_DB_HEADER)
+        output.write(json.dumps(index))
+        output.write('\n')
+        output.writelines(chunks)
+    if os.path.exists(path):
+        # windows can't rename over an existing file
+        os.remove(path)
+    os.rename(temp_path, path)
+    journal_path = _device_db_journal_path(mount)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    # remove the database from older versions, so that they don't load it
+    # and overwrite it with stale data
+    legacy_path = _legacy_device_db_path(mount)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def _merge_legacy_device_db(db, legacy):
+    """Merge a database written by an older version of Miro into db.
+
+    The older version wrote the database after we migrated it, so its values
+    win.  For dictionaries, we merge the entries, since the older version
+    started without the entries that only we knew about.
+    """
+    for key, value in legacy.iteritems():
+        current = db.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merged = dict(current)
+            merged.update(value)
+            value = merged
+        dict.__setitem__(db, key, value)
+
+def _append_device_db_journal(db, keys, mount):
+    """Append the current values for keys to the journal."""
+    lines = []
+    for key in keys:
+        if key in db:
+            lines.append('[%s,%s]\n' % (
+                json.dumps(key),
+                _encode_device_db_value(dict.__getitem__(db, key))))
+        else:
+            lines.append('[%s]\n' % json.dumps(key))
+    with open(_device_db_journal_path(mount), 'ab') as output:
+        output.writelines(lines)
+
+def load_database(mount, countdown=0):
+    """
+    Returns a DeviceDatabase for the database that lives on the given device.
+
+    The database lives at [MOUNT]/.miro/devicedb, with recent changes in
+    [MOUNT]/.miro/devicedb-journal.  We also load the JSON database from
+    older versions at [MOUNT]/.miro/json.  If both exist, an older version
+    wrote the JSON database after we migrated it, so we merge it in.
+    """
+    db_path = _device_db_path(mount)
+    file_name = _legacy_device_db_path(mount)
+    ddb = None
+    try:
+        if os.path.exists(db_path):
+            try:
+                ddb = _read_device_db(db_path)
+                _replay_device_db_journal(ddb,
+                                          _device_db_journal_path(mount))
+            except ValueError:
+                logging.exception('device database decode error on %s',
+                                  mount)
+                ddb = None
+        if os.path.exists(file_name):
+            try:
+                fp = codecs.open(file_name, 'rb', 'utf8')
+                legacy = json.load(fp)
+            except ValueError:
+                logging.exception('JSON decode error on %s', mount)
             else:
-                # wait a little while; total time is ~1.5s
-                time.sleep(0.20 * 1.2 ** countdown)
-                return load_database(mount, countdown + 1)
-    ddb = DeviceDatabase(db)
+                if ddb is None:
+                    ddb = DeviceDatabase(legacy)
+                else:
+                    _merge_legacy_device_db(ddb, legacy)
+    except EnvironmentError:
+        if countdown == 5:
+            logging.exception('file error with JSON on %s', mount)
+        else:
+            # wait a little while; total time is ~1.5s
+            time.sleep(0.20 * 1.2 ** countdown)
+            return load_database(mount, countdown + 1)
+    if ddb is None:
+        ddb = DeviceDatabase()
     ddb.connect('changed', DatabaseWriteManager(mount))
     return ddb
 
@@ -1434,9 +1851,12 @@ def on_new_metadata(metadata_manager, new_metadata, device_id):
 
 def write_database(db, mount):
     """
-    Writes the given dictionary to the device.
+    Saves changes to the given database to the device.
 
-    The database lives at [MOUNT]/.miro/json
+    Normally we just append the keys that changed to the journal.  If the
+    journal is getting big, there's no database file yet, there's a
+    database from an older version to replace, or db isn't a
+    DeviceDatabase, we write out the whole database.
     """
     threadcheck.confirm_eventloop_thread()
     if not os.path.exists(mount):
@@ -1446,14 +1866,25 @@ def write_database(db, mount):
         fileutil.makedirs(os.path.join(mount, '.miro'))
     except OSError:
         pass
+    dirty_keys = getattr(db, 'dirty_keys', None)
+    journal_path = _device_db_journal_path(mount)
     try:
-        with file(os.path.join(mount, '.miro', 'json'), 'wb') as output:
-            iterable = json._default_encoder.iterencode(db)
-            output.writelines(iterable)
-    except IOError:
+        if (dirty_keys is None or
+                not os.path.exists(_device_db_path(mount)) or
+                os.path.exists(_legacy_device_db_path(mount)) or
+                (os.path.exists(journal_path) and
+                 os.path.getsize(journal_path) > DEVICE_DB_JOURNAL_LIMIT)):
+            _write_device_db(db, mount)
+        elif dirty_keys:
+            _append_device_db_journal(db, dirty_keys, mount)
+        else:
+            return
+    except EnvironmentError:
         # couldn't write to the device
         # XXX throw up an error?
-        pass
+        return
+    if dirty_keys:
+        dirty_keys.clear()
 
 def clean_database(device):
     """Go through a device and remove any items that have been deleted.
@@ -0,0 +1,298 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""directorysnapshot -- remember the state of a directory tree between
+scans.
+
+A DirectorySnapshot stores the mtime, inode and listing of every directory
+under a root.  Rescanning only lists directories whose mtime or inode
+changed since the last scan; unchanged directories just get a stat() so we
+can tell whether their subdirectories changed.  This makes rescanning big
+trees (for example network shares) much cheaper than walking everything
+with fileutil.miro_allfiles().
+
+Snapshots don't touch the database, so they are safe to use from the thread
+pool.
+"""
+
+import cPickle
+import logging
+import os
+import time
+
+from miro import fileutil
+from miro.plat.filebundle import is_file_bundle
+
+# Bump this when the pickled format changes.  Snapshots with a different
+# version are thrown away and we start from scratch.
+SNAPSHOT_VERSION = 1
+
+# Directory mtimes closer than this to the time we scanned them aren't
+# trusted, since the directory might change again without the mtime
+# changing (lots of filesystems only store mtime with a 1-2 second
+# resolution).  We always re-list those directories on the next scan.
+MTIME_GRANULARITY = 2.0
+
+class DirectoryChanges(object):
+    """Result of DirectorySnapshot.rescan().
+
+    :attribute added: paths of files that appeared since the last scan
+    :attribute deleted: paths of files that went away since the last scan
+    :attribute initial_scan: True if this was the first scan of the tree
+    :attribute directories_listed: number of directories we called
+        listdir() on
+    :attribute directories_reused: number of directories whose listing
+        we took from the snapshot
+    """
+    def __init__(self, initial_scan):
+        self.added = []
+        self.deleted = []
+        self.initial_scan = initial_scan
+        self.directories_listed = 0
+        self.directories_reused = 0
+
+    def __str__(self):
+        return ("DirectoryChanges (added: %d, deleted: %d, listed: %d, "
+                "reused: %d)" % (len(self.added), len(self.deleted),
+                    self.directories_listed, self.directories_reused))
+
+class _DirectoryEntry(object):
+    """Snapshot of a single directory."""
+    __slots__ = ('path', 'mtime', 'inode', 'files', 'subdirs')
+
+    def __init__(self, path, mtime, inode, files, subdirs):
+        self.path = path
+        self.mtime = mtime
+        self.inode = inode
+        self.files = files
+        self.subdirs = subdirs
+
+    def __getstate__(self):
+        return (self.path, self.mtime, self.inode, self.files, self.subdirs)
+
+    def __setstate__(self, state):
+        (self.path, self.mtime, self.inode, self.files,
+                self.subdirs) = state
+
+def _normalize(path):
+    return os.path.normcase(os.path.normpath(path))
+
+class DirectorySnapshot(object):
+    """Snapshot of a directory tree.
+
+    The set of files in the snapshot matches what fileutil.miro_allfiles()
+    would return for root: hidden files are skipped, names are run through
+    os.path.normcase, file bundles and deletes in progress are skipped and
+    symlinks to directories are only followed once.
+    """
+    def __init__(self, root):
+        self.root = root
+        # maps normalized directory paths to _DirectoryEntry objects
+        self.directories = {}
+
+    def is_empty(self):
+        return len(self.directories) == 0
+
+    def rescan(self):
+        """Bring the snapshot up to date with the filesystem.
+
+        :returns: DirectoryChanges object
+        """
+        changes = DirectoryChanges(self.is_empty())
+        new_directories = {}
+        if (fileutil.isdir(self.root) and
+                not is_file_bundle(fileutil.expand_filename(self.root))):
+            self._scan_directory(self.root, set(), new_directories, changes,
+                    time.time())
+        for key, entry in self.directories.iteritems():
+            if key not in new_directories:
+                changes.deleted.extend(os.path.join(entry.path, name)
+                        for name in entry.files)
+        self.directories = new_directories
+        return changes
+
+    def _scan_directory(self, directory, checked, new_directories, changes,
+            scan_time):
+        expanded_directory = fileutil.expand_filename(directory)
+        expanded_directory = os.path.abspath(os.path.normcase(
+            expanded_directory))
+        real_directory = os.path.realpath(expanded_directory)
+        if real_directory in checked:
+            logging.debug('%s is a symlink to a directory that has '
+                'already been checked; skipping', repr(expanded_directory))
+            return
+        checked.add(real_directory)
+        if expanded_directory in fileutil.deletes_in_progress:
+            return
+        if is_file_bundle(expanded_directory):
+            return
+        try:
+            stat = os.stat(expanded_directory)
+        except OSError:
+            logging.debug('OSError scanning directory; continuing',
+                    exc_info=1)
+            return
+        key = _normalize(directory)
+        old_entry = self.directories.get(key)
+        if (old_entry is not None and old_entry.mtime is not None and
+                old_entry.mtime == stat.st_mtime and
+                old_entry.inode == stat.st_ino):
+            entry = old_entry
+            changes.directories_reused += 1
+        else:
+            entry = self._list_directory(directory, expanded_directory,
+                    stat, scan_time)
+            changes.directories_listed += 1
+            if old_entry is not None:
+                old_files = old_entry.files
+            else:
+                old_files = frozenset()
+            for name in entry.files:
+                if name not in old_files:
+                    changes.added.append(os.path.join(directory, name))
+            for name in old_files:
+                if name not in entry.files:
+                    changes.deleted.append(os.path.join(directory, name))
+        new_directories[key] = entry
+        for name in entry.subdirs:
+            self._scan_directory(os.path.join(directory, name), checked,
+                    new_directories, changes, scan_time)
+
+    def _list_directory(self, directory, expanded_directory, stat,
+            scan_time):
+        files = []
+        subdirs = []
+        try:
+            listing = os.listdir(expanded_directory)
+        except OSError:
+            logging.debug('OSError walking directory; continuing',
+                    exc_info=1)
+            listing = []
+        for name in listing:
+            if fileutil.is_ignored_name(name):
+                continue
+            name = os.path.normcase(name)
+            expanded_path = os.path.join(expanded_directory, name)
+            if expanded_path in fileutil.deletes_in_progress:
+                continue
+            try:
+                if (os.path.isdir(expanded_path) and
+                        not is_file_bundle(expanded_path)):
+                    subdirs.append(name)
+                elif os.path.isfile(expanded_path):
+                    files.append(name)
+            except OSError:
+                logging.debug('OSError walking directory; continuing',
+                        exc_info=1)
+        if scan_time - stat.st_mtime < MTIME_GRANULARITY:
+            # the directory may still be changing, don't trust its mtime
+            mtime = None
+        else:
+            mtime = stat.st_mtime
+        return _DirectoryEntry(directory, mtime, stat.st_ino,
+                frozenset(files), tuple(subdirs))
+
+    def contains_file(self, path):
+        """Check if a file was present in the last scan."""
+        dirname, name = os.path.split(_normalize(path))
+        entry = self.directories.get(dirname)
+        return entry is not None and name in entry.files
+
+    def contains_directory(self, path):
+        """Check if path is inside the tree that we scan."""
+        root = _normalize(self.root)
+        path = _normalize(path)
+        return path == root or path.startswith(root + os.sep)
+
+    def all_files(self):
+        """Iterate through all files in the snapshot."""
+        for entry in self.directories.itervalues():
+            for name in entry.files:
+                yield os.path.join(entry.path, name)
+
+    def file_count(self):
+        return sum(len(entry.files)
+                for entry in self.directories.itervalues())
+
+    def get_state(self):
+        """Get an object that can be passed to save() from another thread.
+
+        rescan() never modifies the directory map in place, so the returned
+        object stays valid after later rescans.
+        """
+        return (SNAPSHOT_VERSION, self.root, self.directories)
+
+def save(path, state):
+    """Save the state from DirectorySnapshot.get_state() to disk."""
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        fileutil.makedirs(directory)
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    if os.path.exists(path):
+        # windows can't rename over an existing file
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def load(path, root):
+    """Load a snapshot saved with save().
+
+    If there isn't a snapshot at path, it can't be read, or it's for a
+    different root directory, then we return an empty snapshot.
+    """
+    snapshot = DirectorySnapshot(root)
+    if not os.path.exists(path):
+        return snapshot
+    try:
+        f = open(path, 'rb')
+        try:
+            version, saved_root, directories = cPickle.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError):
+        logging.warn("Error loading directory snapshot %s", path,
+                exc_info=True)
+        return snapshot
+    if version != SNAPSHOT_VERSION or saved_root != root:
+        logging.debug("Ignoring out of date directory snapshot %s", path)
+        return snapshot
+    snapshot.directories = directories
+    return snapshot
+
+def remove(path):
+    """Remove a saved snapshot, if it exists."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -51,6 +51,7 @@ from miro.plat.utils import samefile, unicode_to_filename
 from miro import flashscraper
 from miro import fileutil
 from miro import util
+from miro.data import downloadstats
 from miro.fileobject import FilenameType
 
 class DownloadStateManager(object):
@@ -258,20 +259,13 @@ class RemoteDownloader(DDBObject):
         'state': u'downloading',
     }
     # status attributes that don't get saved to disk
-    temp_status_attributes = [
-        'eta',
-        'rate',
-        'upload_rate',
-        'activity',
-        'seeders',
-        'leechers',
-        'connections'
-    ]
-    # status attributes that we can wait a little while to save to disk
-    status_attributes_to_defer = set([
-        'current_size',
-        'upload_size',
-    ])
+    temp_status_attributes = downloadstats.TEMP_STAT_COLUMNS
+    # Status attributes that change with nearly every update while we're
+    # transferring.  update_status() stores these in
+    # miro.data.downloadstats and only saves them to disk every
+    # STATS_CHECKPOINT_INTERVAL seconds or when another attribute changes.
+    volatile_status_attributes = downloadstats.STAT_COLUMNS
+    STATS_CHECKPOINT_INTERVAL = 30
 
     def setup_new(self, url, item, content_type=None, channel_name=None):
         check_u(url)
@@ -295,7 +289,7 @@ class RemoteDownloader(DDBObject):
         self.manualUpload = False
         self._update_retry_time_dc = None
         self.status_updates_frozen = False
-        self.last_update = time.time()
+        self.last_update = self.last_stats_checkpoint = time.time()
         self.reset_status_attributes()
         if content_type is None:
             self.content_type = u""
@@ -309,7 +303,7 @@ class RemoteDownloader(DDBObject):
 
     def setup_restored(self):
         self.status_updates_frozen = False
-        self.last_update = time.time()
+        self.last_update = self.last_stats_checkpoint = time.time()
         self._update_retry_time_dc = None
         self.delete_files = True
         self.item_list = []
@@ -324,7 +318,11 @@ class RemoteDownloader(DDBObject):
             setattr(self, attr_name, default)
 
     def update_status_attributes(self, status_dict):
-        """Reset the attributes that track downloading info."""
+        """Update the attributes that track downloading info.
+
+        :returns: set of attribute names that changed
+        """
+        changed = set()
         for attr_name in self.status_attributes:
             if attr_name in status_dict:
                 value = status_dict[attr_name]
@@ -334,6 +332,8 @@ class RemoteDownloader(DDBObject):
             # UPDATE statments contain less data
             if getattr(self, attr_name) != value:
                 setattr(self, attr_name, value)
+                changed.add(attr_name)
+        return changed
 
     def get_status_for_downloader(self):
         status = dict((name, getattr(self, name))
@@ -369,11 +369,39 @@ class RemoteDownloader(DDBObject):
         return cls.make_view('id NOT IN (SELECT downloader_id from item)')
 
     def signal_change(self, needs_save=True, needs_signal_item=True):
+        if needs_save:
+            self.last_stats_checkpoint = time.time()
+        self._update_download_stats()
         DDBObject.signal_change(self, needs_save=needs_save)
         if needs_signal_item:
             for item in self.item_list:
                 item.download_stats_changed()
 
+    def signal_stats_change(self):
+        """Call this when only volatile_status_attributes changed.
+
+        This is much cheaper than signal_change().  We don't save anything to
+        disk and we know our views can't change.
+        """
+        self._update_download_stats()
+        DDBObject.signal_change(self, needs_save=False,
+                                can_change_views=False)
+        for item in self.item_list:
+            item.download_stats_changed(stats_only=True)
+
+    def _stats_checkpoint_due(self, now):
+        return (now - self.last_stats_checkpoint >=
+                self.STATS_CHECKPOINT_INTERVAL)
+
+    def _update_download_stats(self):
+        if self.state in (u'downloading', u'uploading'):
+            downloadstats.update(self.id, dict(
+                (name, getattr(self, name))
+                for name in self.volatile_status_attributes))
+        else:
+            # the values on disk are up to date once we stop transferring
+            downloadstats.remove(self.id)
+
     def on_content_type(self, info):
         if not self.id_exists():
             return
@@ -515,7 +543,7 @@ class RemoteDownloader(DDBObject):
             old_filename = self.get_filename()
 
             self.before_changing_rates()
-            self.update_status_attributes(data)
+            changed = self.update_status_attributes(data)
             self.after_changing_rates()
 
             # Store the time the download finished
@@ -529,7 +557,14 @@ class RemoteDownloader(DDBObject):
                       and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
                 self.stop_upload()
 
-            self.signal_change()
+            # Most updates only change the transfer stats.  Keep those in
+            # memory and save them every once in a while, rather than
+            # writing to the database on every update.
+            if (changed.difference(self.volatile_status_attributes) or
+                    self._stats_checkpoint_due(now)):
+                self.signal_change()
+            elif changed:
+                self.signal_stats_change()
 
             self.update_item_list(finished, file_migrated)
         return True
@@ -753,6 +788,7 @@ class RemoteDownloader(DDBObject):
         if self.is_finished():
             app.local_metadata_manager.remove_file(self.get_filename())
         self.stop(self.delete_files)
+        downloadstats.remove(self.id)
         DDBObject.remove(self)
 
     def get_type(self):
@@ -1136,6 +1172,9 @@ def shutdown_downloader_objects():
     """
     for downloader in RemoteDownloader.make_view():
         downloader._cancel_retry_time_update()
+        if downloader.changed_attributes:
+            # save the stats that update_status() hasn't written yet
+            downloader.signal_change(needs_signal_item=False)
 
 def reset_download_stats():
     """Set columns in the remote_downloader table to None if they track
@@ -1148,5 +1187,6 @@ def reset_download_stats():
     app.db.cursor.execute("UPDATE remote_downloader SET %s" %
                           ', '.join(setters))
     app.db.connection.commit()
+    downloadstats.reset()
 
 
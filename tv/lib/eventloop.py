@@ -35,8 +35,11 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import bisect
+import collections
 import errno
 import heapq
+import itertools
 import logging
 import Queue
 import select
@@ -54,13 +57,99 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+class CallStats(object):
+    """Dispatch time stats for one DelayedCall name.
+
+    :attribute count: number of calls dispatched
+    :attribute total_time: total time spent in the calls
+    :attribute max_time: longest time spent in a single call
+    :attribute histogram: number of calls that took less than each of
+        DispatchStats.HISTOGRAM_LIMITS, with a final entry for calls slower
+        than all of them.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(DispatchStats.HISTOGRAM_LIMITS) + 1)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect.bisect(DispatchStats.HISTOGRAM_LIMITS,
+                                     elapsed)] += 1
+
+    def average_time(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_time / self.count
+
+class DispatchStats(object):
+    """Tracks the calls that go through the eventloop.
+
+    Stats are kept per DelayedCall name, so "timeout (foo)" and "idle (foo)"
+    are tracked separately.  We also keep the max depth of each of our queues
+    and the most recent slow calls.
+
+    DispatchStats can be used by multiple threads at once.
+    """
+    # upper limits for the histogram buckets, in seconds
+    HISTOGRAM_LIMITS = (0.001, 0.01, 0.1, 0.5, 1.0)
+    # calls that take longer than this are slow
+    SLOW_CALL_TIME = 0.5
+    # how many slow calls to remember
+    SLOW_CALL_COUNT = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = collections.defaultdict(CallStats)
+            self.max_queue_depth = collections.defaultdict(int)
+            self.slow_calls = collections.deque(maxlen=self.SLOW_CALL_COUNT)
+
+    def record_call(self, name, elapsed):
+        with self.lock:
+            self.calls[name].add(elapsed)
+            if elapsed > self.SLOW_CALL_TIME:
+                self.slow_calls.append((name, elapsed))
+
+    def record_queue_depth(self, queue_name, depth):
+        # This gets called a lot, so try to avoid grabbing the lock
+        if depth > self.max_queue_depth[queue_name]:
+            with self.lock:
+                if depth > self.max_queue_depth[queue_name]:
+                    self.max_queue_depth[queue_name] = depth
+
+    def log_summary(self):
+        with self.lock:
+            for queue_name, depth in sorted(self.max_queue_depth.items()):
+                logging.debug("%s queue: max depth %d", queue_name, depth)
+            for name, stats in sorted(self.calls.items()):
+                logging.debug("%s: %d calls, %0.3f avg, %0.3f max, "
+                              "histogram: %s", name, stats.count,
+                              stats.average_time(), stats.max_time,
+                              stats.histogram)
+            for name, elapsed in self.slow_calls:
+                logging.debug("slow call: %s (%0.3f secs)", name, elapsed)
+
+stats = DispatchStats()
+
 class DelayedCall(object):
-    def __init__(self, function, name, args, kwargs):
+    def __init__(self, function, name, args, kwargs, key=None):
         self.function = function
         self.name = name
         self.args = args
         self.kwargs = kwargs
+        self.key = key
         self.canceled = False
+        # Scheduler that this call is waiting in, if any
+        self._scheduler = None
+        # Scheduler bucket that this call is in, if any
+        self._bucket = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -71,6 +160,8 @@ class DelayedCall(object):
 
     def cancel(self):
         self.canceled = True
+        if self._scheduler is not None:
+            self._scheduler.remove(self)
         self._unlink()
 
     def dispatch(self):
@@ -81,6 +172,7 @@ class DelayedCall(object):
             success = trapcall.trap_call(when, self.function, *self.args,
                     **self.kwargs)
             end = clock()
+            stats.record_call(self.name, end - start)
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -98,8 +190,41 @@ class DelayedCall(object):
         return success
 
 class Scheduler(object):
+    """Keeps track of timeouts using a hierarchical timer wheel.
+
+    Time is divided into ticks of TICK_LENGTH seconds.  Each level of the
+    wheel has buckets that cover SLOT_BITS more bits of the tick number than
+    the level below it: level 0 buckets hold a single tick, level 1 buckets
+    hold 256 ticks, and so on.  Calls go in the lowest level whose bucket
+    shares the current block of ticks for the level above it.  As time
+    advances, buckets from the higher levels are cascaded down and level 0
+    buckets move to the due heap, which orders the calls that are ready to
+    go by their exact time.
+
+    Each call keeps a reference to its bucket, so cancel() removes it from
+    the wheel right away rather than leaving it around until its time comes.
+    """
+    TICK_LENGTH = 0.01
+    SLOT_BITS = 8
+    LEVELS = 4
+
     def __init__(self):
-        self.heap = []
+        self.lock = threading.RLock()
+        # for each level, map bucket numbers to the set of calls in them
+        self.buckets = [{} for i in xrange(self.LEVELS)]
+        # for each level, heap of bucket numbers.  This can contain numbers
+        # for buckets that have been removed.
+        self.bucket_heaps = [[] for i in xrange(self.LEVELS)]
+        # heap of (scheduled_time, counter, DelayedCall) for calls in
+        # ticks that have started.  This can contain canceled calls.
+        self.due = []
+        self.counter = itertools.count()
+        self.current_tick = self._tick_for_time(clock())
+        # number of calls that are scheduled and not canceled
+        self.call_count = 0
+
+    def _tick_for_time(self, t):
+        return int(t / self.TICK_LENGTH)
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -108,35 +233,141 @@ class Scheduler(object):
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
-        heapq.heappush(self.heap, (scheduled_time, dc))
+        dc._scheduler = self
+        with self.lock:
+            self._place(dc, scheduled_time, self.counter.next())
+            self.call_count += 1
+            stats.record_queue_depth('timeout', self.call_count)
         return dc
 
+    def _place(self, dc, scheduled_time, order):
+        tick = self._tick_for_time(scheduled_time)
+        if tick <= self.current_tick:
+            dc._bucket = None
+            heapq.heappush(self.due, (scheduled_time, order, dc))
+            return
+        for level in xrange(self.LEVELS):
+            shift = self.SLOT_BITS * (level + 1)
+            if (tick >> shift == self.current_tick >> shift or
+                level == self.LEVELS - 1):
+                break
+        bucket_number = tick >> (self.SLOT_BITS * level)
+        buckets = self.buckets[level]
+        try:
+            bucket = buckets[bucket_number]
+        except KeyError:
+            bucket = buckets[bucket_number] = {}
+            heapq.heappush(self.bucket_heaps[level], bucket_number)
+        bucket[dc] = (scheduled_time, order)
+        dc._bucket = bucket
+
+    def remove(self, dc):
+        """Remove a canceled call."""
+        with self.lock:
+            if dc._scheduler is None:
+                return
+            dc._scheduler = None
+            self.call_count -= 1
+            if dc._bucket is not None:
+                del dc._bucket[dc]
+                dc._bucket = None
+            # calls in the due heap are dropped when they get to the top
+
+    def _advance(self):
+        """Move calls whose time has come to the due heap."""
+        tick = self._tick_for_time(clock())
+        if tick <= self.current_tick:
+            return
+        self.current_tick = tick
+        for level in xrange(self.LEVELS - 1, -1, -1):
+            current_bucket = tick >> (self.SLOT_BITS * level)
+            heap = self.bucket_heaps[level]
+            buckets = self.buckets[level]
+            while heap and heap[0] <= current_bucket:
+                bucket = buckets.pop(heapq.heappop(heap), None)
+                if bucket:
+                    for dc, (scheduled_time, order) in bucket.iteritems():
+                        self._place(dc, scheduled_time, order)
+
+    def _clean_due(self):
+        while self.due and self.due[0][2]._scheduler is None:
+            heapq.heappop(self.due)
+
     def next_timeout(self):
-        if len(self.heap) == 0:
+        with self.lock:
+            self._advance()
+            self._clean_due()
+            if self.due:
+                return max(0, self.due[0][0] - clock())
+            # Wake up at the start of the first non-empty bucket.  If it's
+            # in a higher level, that's when it will get cascaded down.
+            for level in xrange(self.LEVELS):
+                heap = self.bucket_heaps[level]
+                buckets = self.buckets[level]
+                while heap and not buckets.get(heap[0]):
+                    buckets.pop(heapq.heappop(heap), None)
+                if heap:
+                    start_tick = heap[0] << (self.SLOT_BITS * level)
+                    return max(0, start_tick * self.TICK_LENGTH - clock())
             return None
-        else:
-            return max(0, self.heap[0][0] - clock())
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        with self.lock:
+            self._advance()
+            self._clean_due()
+            return len(self.due) > 0 and self.due[0][0] < clock()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
+        with self.lock:
+            self._clean_due()
+            if not self.due:
+                # the call got canceled from another thread
+                return True
+            time, order, dc = heapq.heappop(self.due)
+            dc._scheduler = None
+            self.call_count -= 1
         return dc.dispatch()
 
 class CallQueue(object):
-    def __init__(self):
+    def __init__(self, name='idle'):
+        self.name = name
         self.queue = Queue.Queue()
         self.quit_flag = False
         self.queue_size_warning_count = 0
+        # maps keys to pending DelayedCalls added with that key
+        self.keyed_calls = {}
+        self.keyed_calls_lock = threading.Lock()
 
-    def add_idle(self, function, name, args=None, kwargs=None):
+    def add_idle(self, function, name, args=None, kwargs=None, key=None):
+        """Add a call to the queue.
+
+        If key is given and there's already a call pending with that key,
+        then that call gets replaced: it keeps its spot in the queue but
+        calls the new function/args instead.  In that case, the
+        DelayedCall for the pending call is returned.
+        """
         if args is None:
             args = ()
         if kwargs is None:
             kwargs = {}
-        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        if key is not None:
+            with self.keyed_calls_lock:
+                dc = self.keyed_calls.get(key)
+                if dc is not None and not dc.canceled:
+                    dc.function = function
+                    dc.name = "%s (%s)" % (self.name, name)
+                    dc.args = args
+                    dc.kwargs = kwargs
+                    return dc
+                dc = DelayedCall(function, "%s (%s)" % (self.name, name),
+                                 args, kwargs, key)
+                self.keyed_calls[key] = dc
+        else:
+            dc = DelayedCall(function, "%s (%s)" % (self.name, name), args,
+                             kwargs)
         self.queue.put(dc)
+        queue_size = self.queue.qsize()
+        stats.record_queue_depth(self.name, queue_size)
 
         # Check if our queue size is too big and log a warning if so.  Only do
         # this a few times.  That should be enough to track down errors, but
@@ -145,7 +376,7 @@ class CallQueue(object):
         # NOTE: the code below doesn't take into account that this method
         # runs on multiple threads.  However, the worst that can happen is
         # we log an extra warning or two, so this doesn't seem bad.
-        if self.queue_size_warning_count < 5 and self.queue.qsize() > 1000:
+        if self.queue_size_warning_count < 5 and queue_size > 1000:
             if self.queue_size_warning_count < 5:
                 logging.stacktrace("Queued called size too large")
                 self.queue_size_warning_count += 1
@@ -154,6 +385,12 @@ class CallQueue(object):
 
     def process_next_idle(self):
         dc = self.queue.get()
+        if dc.key is not None:
+            # once we start dispatching, calls with the same key need a
+            # new DelayedCall
+            with self.keyed_calls_lock:
+                if self.keyed_calls.get(dc.key) is dc:
+                    del self.keyed_calls[dc.key]
         return dc.dispatch()
 
     def has_pending_idle(self):
@@ -286,8 +523,8 @@ class EventLoop(SimpleEventLoop):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
-        self.urgent_queue = CallQueue()
+        self.idle_queue = CallQueue('idle')
+        self.urgent_queue = CallQueue('urgent')
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
@@ -455,12 +692,15 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None, key=None):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    If key is given, then adding another idle with the same key before
+    this one runs will replace it, rather than adding a second call.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs, key)
     _eventloop.wakeup()
     return dc
 
@@ -473,6 +713,10 @@ def add_urgent_call(function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
+def log_stats():
+    """Log a summary of the time spent in eventloop calls."""
+    stats.log_summary()
+
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
@@ -32,6 +32,7 @@
 FIXME - talk about Feed architecture here
 """
 
+import itertools
 import os
 import re
 import time
@@ -54,6 +55,7 @@ from miro import autodler
 from miro import iconcache
 from miro import databaselog
 from miro import dialogs
+from miro import directorysnapshot
 from miro import download_utils
 from miro import eventloop
 from miro import feedupdate
@@ -66,7 +68,6 @@ from miro.util import (returns_unicode, returns_filename, unicodify, check_u,
                        is_url, stringify, is_magnet_uri)
 from miro import fileutil
 from miro.plat.utils import filename_to_unicode, make_url_safe, unmake_url_safe
-from miro.plat.filebundle import is_file_bundle
 from miro import filetypes
 from miro.item import FeedParserValues
 from miro import searchengines
@@ -108,6 +109,69 @@ class _RateLimiter(object):
         # get ready for the next check() call
         self.last_time = time.time()
 
+class _ExistingItemIndex(object):
+    """Finds the existing items in a feed that match its parsed entries.
+
+    Rather than loading every item in the feed, we only load the items whose
+    rss_id or url match one of the entries.  The item table has indexes on
+    (feed_id, rss_id) and (feed_id, url, entry_title) to make those queries
+    fast.
+
+    :attribute by_rss_id: maps rss_ids to items
+    :attribute by_url_title: maps (url, entry_title) tuples to items
+    :attribute keyless_by_url: maps urls to a list of items without an rss_id
+    """
+    # max number of values to put in a single IN clause
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, feed_id, fp_values_list):
+        self.feed_id = feed_id
+        self.by_rss_id = {}
+        self.by_url_title = {}
+        self.keyless_by_url = {}
+        rss_ids = set()
+        urls = set()
+        titles_without_url = set()
+        for fp_values in fp_values_list:
+            data = fp_values.data
+            if data['rss_id'] is not None:
+                rss_ids.add(data['rss_id'])
+            if data['url'] is not None:
+                urls.add(data['url'])
+            elif data['entry_title'] is not None:
+                titles_without_url.add(data['entry_title'])
+        items = {}
+        for item in self._query_items('rss_id', rss_ids):
+            items[item.id] = item
+        for item in self._query_items('url', urls):
+            items[item.id] = item
+        for item in self._query_items('entry_title', titles_without_url,
+                                      'url IS NULL'):
+            items[item.id] = item
+        # go through items in id order, so that if multiple items have the
+        # same key, the newest one wins
+        for id_ in sorted(items):
+            item = items[id_]
+            if item.rss_id is not None:
+                self.by_rss_id[item.rss_id] = item
+            else:
+                self.keyless_by_url.setdefault(item.url, []).append(item)
+            by_url_title_key = (item.url, item.entry_title)
+            if by_url_title_key != (None, None):
+                self.by_url_title[by_url_title_key] = item
+
+    def _query_items(self, column, values, extra_where=None):
+        values = list(values)
+        where = 'feed_id=? AND %s IN (%%s)' % column
+        if extra_where is not None:
+            where += ' AND %s' % extra_where
+        for start in xrange(0, len(values), self.QUERY_CHUNK_SIZE):
+            chunk = values[start:start+self.QUERY_CHUNK_SIZE]
+            view = models.Item.make_view(where % ', '.join('?' * len(chunk)),
+                                         [self.feed_id] + chunk)
+            for item in view:
+                yield item
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -1218,18 +1282,22 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 item.remove()
 
     def remember_old_items(self):
-        self.old_items = set(self.items)
+        self.old_item_ids = set(self.items.id_list())
 
     def create_items_for_parsed(self, parsed):
-        """Update the feed using parsed XML passed in"""
+        """Update the feed using parsed XML passed in
+
+        :returns: number of new entries in parsed
+        """
         app.bulk_sql_manager.start()
         try:
-            self._create_items_for_parsed(parsed)
+            return self._create_items_for_parsed(parsed)
         finally:
             app.bulk_sql_manager.finish()
 
     def _create_items_for_parsed(self, parsed):
         rate_limiter = _RateLimiter()
+        new_count = 0
         channel_title = None
         try:
             channel_title = parsed["feed"]["title"]
@@ -1258,55 +1326,60 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 self.thumbURL = image_url
                 self.ufeed.icon_cache.request_update(is_vital=True)
 
-        items_byid = {}
-        items_byURLTitle = {}
-        items_nokey = []
-        for item in self.items:
-            rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
-            by_url_title_key = (item.url, item.entry_title)
-            if by_url_title_key != (None, None):
-                items_byURLTitle[by_url_title_key] = item
+        entries = []
         for entry in parsed.entries:
             rate_limiter.check_for_sleep()
             entry = self.add_scraped_thumbnail(entry)
-            fp_values = FeedParserValues(entry)
-            new = True
-            if fp_values.data['rss_id'] is not None:
-                id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
-                    if not fp_values.compare_to_item(item):
-                        item.update_from_feed_parser_values(fp_values)
-                    new = False
-                    self.old_items.discard(item)
-            if new:
-                by_url_title_key = (fp_values.data['url'],
-                        fp_values.data['entry_title'])
-                if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
-                        if not fp_values.compare_to_item(item):
-                            item.update_from_feed_parser_values(fp_values)
-                        new = False
-                        self.old_items.discard(item)
-            if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
-            if new and fp_values.first_video_enclosure is not None:
+            entries.append((entry, FeedParserValues(entry)))
+        existing_items = _ExistingItemIndex(self.ufeed_id,
+                                            [fp_values for entry, fp_values
+                                             in entries])
+        for entry, fp_values in entries:
+            rate_limiter.check_for_sleep()
+            item = self._find_existing_item(fp_values, existing_items)
+            if item is not None:
+                self.old_item_ids.discard(item.id)
+            elif fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
+                new_count += 1
+        return new_count
+
+    def _find_existing_item(self, fp_values, existing_items):
+        """Find the item that matches a parsed entry.
+
+        If we find a match, we update the item with the entry's data.
+
+        :param fp_values: FeedParserValues for the entry
+        :param existing_items: _ExistingItemIndex for the feed
+        :returns: the matching Item or None
+        """
+        rss_id = fp_values.data['rss_id']
+        item = None
+        if rss_id is not None:
+            item = existing_items.by_rss_id.get(rss_id)
+        if item is None:
+            by_url_title_key = (fp_values.data['url'],
+                    fp_values.data['entry_title'])
+            if by_url_title_key != (None, None):
+                item = existing_items.by_url_title.get(by_url_title_key)
+        if item is not None:
+            if not fp_values.compare_to_item(item):
+                item.update_from_feed_parser_values(fp_values)
+            return item
+        # Items without an rss_id can still match if their enclosure is the
+        # same.  Both compare methods check the url, so we only need to look
+        # at items with the same url.
+        for item in existing_items.keyless_by_url.get(fp_values.data['url'],
+                                                      ()):
+            if fp_values.compare_to_item(item):
+                return item
+            try:
+                if fp_values.compare_to_item_enclosures(item):
+                    item.update_from_feed_parser_values(fp_values)
+                    return item
+            except StandardError:
+                pass
+        return None
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1338,9 +1411,9 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             self.ufeed.signal_change()
 
         self.ufeed.recalc_counts()
-        if hasattr(self, "old_items"):
+        if hasattr(self, "old_item_ids"):
             self.truncate_old_items()
-            del self.old_items
+            del self.old_item_ids
         self.signal_change()
 
     def truncate_old_items(self):
@@ -1357,19 +1430,30 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
         item_count = self.items.count()
         if item_count > app.config.get(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS):
             truncate = item_count - app.config.get(prefs.TRUNCATE_CHANNEL_AFTER_X_ITEMS)
-            if truncate > len(self.old_items):
+            if truncate > len(self.old_item_ids):
                 truncate = 0
             limit = min(limit, truncate)
-        extra = len(self.old_items) - limit
+        extra = len(self.old_item_ids) - limit
         if extra <= 0:
             return
 
-        candidates = []
-        for item in self.old_items:
-            if item.downloader is None:
-                candidates.append((item.creation_time, item))
+        # only load the items that we might remove
+        candidates = [(creation_time, id_) for id_, creation_time in
+                      models.Item.select(['id', 'creation_time'],
+                                         'feed_id=?', (self.ufeed_id,))
+                      if id_ in self.old_item_ids]
         candidates.sort()
-        for time_, item in candidates[:extra]:
+        to_remove = []
+        for time_, id_ in candidates:
+            if len(to_remove) >= extra:
+                break
+            try:
+                item = models.Item.get_by_id(id_)
+            except ObjectNotFoundError:
+                continue
+            if item.downloader is None:
+                to_remove.append(item)
+        for item in to_remove:
             item.remove()
 
     def add_scraped_thumbnail(self, entry):
@@ -1430,7 +1514,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         start = clock()
         self.parsed = parsed
         self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        new_count = self.create_items_for_parsed(parsed)
+        feedupdate.record_new_items(self.ufeed, new_count)
 
         try:
             updateFreq = self.parsed["feed"]["ttl"]
@@ -1483,6 +1568,7 @@ class RSSFeedImpl(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s -- %s",
             self.ufeed, stringify(error))
+        feedupdate.report_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
@@ -1594,7 +1680,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
         start = clock()
-        self.create_items_for_parsed(parsed)
+        new_count = self.create_items_for_parsed(parsed)
+        feedupdate.record_new_items(self.ufeed, new_count)
         self.feedparser_finished(url)
         end = clock()
         if end - start > 1.0:
@@ -1631,6 +1718,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             return
         logging.warn("WARNING: error in Feed.update for %s (%s) -- %s",
                      self.ufeed, stringify(url), stringify(error))
+        feedupdate.report_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating -= 1
         self.check_update_finished()
@@ -1997,11 +2085,23 @@ class DirectoryScannerImplBase(FeedImpl):
 
     def setup_new(self, *args, **kwargs):
         FeedImpl.setup_new(self, *args, **kwargs)
-        self.pending_paths_to_add = []
+        self._setup_scanner()
 
     def setup_restored(self):
         FeedImpl.setup_restored(self)
+        self._setup_scanner()
+
+    def _setup_scanner(self):
         self.pending_paths_to_add = []
+        # DirectorySnapshot from our last scan.  We load it from disk
+        # during the first update.
+        self._snapshot = None
+        # files that we didn't add because another feed has an item for
+        # them
+        self._skipped_known_paths = set()
+
+    def on_remove(self):
+        directorysnapshot.remove(self._snapshot_path())
 
     def expire_items(self):
         """Directory Items shouldn't automatically expire
@@ -2153,8 +2253,48 @@ class DirectoryScannerImplBase(FeedImpl):
             self.updating = True
             self.schedule_update()
 
-    @eventloop.idle_iterator
     def do_update(self):
+        """Start scanning our directory.
+
+        The filesystem work happens in the thread pool, using a
+        DirectorySnapshot so that we only list directories that changed
+        since the last scan.  Once that's done we apply the changes to our
+        items in _apply_directory_changes().
+        """
+        if not self.id_exists():
+            return
+
+        self._before_update()
+        scan_dir = self._scan_dir()
+        eventloop.call_in_thread(self._on_directory_scanned,
+                self._on_directory_scan_error, _scan_directory_tree,
+                "Scan directory %r" % scan_dir, self._snapshot, scan_dir,
+                self._snapshot_path())
+
+    def _snapshot_path(self):
+        return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                'directory-snapshots', 'feed-%d.snapshot' % self.ufeed_id)
+
+    def _on_directory_scanned(self, result):
+        if not self.id_exists():
+            return
+        snapshot, changes = result
+        # The first scan after startup reconciles every file in the
+        # snapshot with our items.  After that we only need to look at the
+        # changes.
+        initial_scan = self._snapshot is None or changes.initial_scan
+        self._snapshot = snapshot
+        self._apply_directory_changes(changes, initial_scan)
+
+    def _on_directory_scan_error(self, error):
+        logging.warn("Error scanning directory for %s: %s", self, error)
+        if not self.id_exists():
+            return
+        self.updating = False
+        self.schedule_update_events(-1)
+
+    @eventloop.idle_iterator
+    def _apply_directory_changes(self, changes, initial_scan):
 
         def should_halt_early():
             """Check if we should halt before completing the entire update.
@@ -2163,36 +2303,29 @@ class DirectoryScannerImplBase(FeedImpl):
             """
             return not self.id_exists()
 
-        if should_halt_early():
-            return
-
-        self._before_update()
-
+        snapshot = self._snapshot
         known_files = self.calc_known_files()
         my_files = set()
-        my_items = list(self.items)
-        # pause after doing prep work
-        yield
-        if should_halt_early():
-            return
 
-        # Remove items with deleted files or that that are in feeds
+        # Remove items with deleted files or that that are in feeds.  We
+        # check the snapshot first to avoid stat() calls for every item.
+        # Items for files that appeared since the scan (for example from
+        # the directory watcher) still get checked on the filesystem.
         to_remove = []
         duplicate_paths = []
         start = time.time()
-        for item in my_items:
-            if not item.id_exists():
-                continue
-            filename = item.get_filename()
+        for item_id, filename in models.Item.select(['id', 'filename'],
+                'feed_id=?', (self.ufeed_id,)):
             if (filename is None or
-                not fileutil.isfile(filename) or
-                known_files.contains_path(filename)):
-                to_remove.append(item)
+                known_files.contains_path(filename) or
+                not (snapshot.contains_file(filename) or
+                    fileutil.isfile(filename))):
+                to_remove.append(item_id)
             if filename not in my_files:
                 my_files.add(filename)
             else:
                 duplicate_paths.append(filename)
-                to_remove.append(item)
+                to_remove.append(item_id)
             if time.time() - start > 0.4:
                 yield
                 if should_halt_early():
@@ -2204,9 +2337,14 @@ class DirectoryScannerImplBase(FeedImpl):
                 (duplicate_paths, self))
         app.bulk_sql_manager.start()
         try:
-            for item in to_remove:
-                if item.id_exists():
-                    item.remove()
+            for item_id in to_remove:
+                try:
+                    item = models.Item.get_by_id(item_id)
+                except ObjectNotFoundError:
+                    # already removed, or listed twice because it was a
+                    # duplicate
+                    continue
+                item.remove()
         finally:
             app.bulk_sql_manager.finish()
 
@@ -2214,52 +2352,65 @@ class DirectoryScannerImplBase(FeedImpl):
         # add our items to known_files so that they don't get added
         # multiple times to this feed.
         for path in my_files:
-            known_files.add_path(path)
+            if path is not None:
+                known_files.add_path(path)
 
-        # adds any files we don't know about
-        # files on the filesystem
-        scan_dir = self._scan_dir()
-        if fileutil.isdir(scan_dir) and not is_file_bundle(scan_dir):
-            all_files = []
-            start = time.time()
-            for f in fileutil.miro_allfiles(scan_dir):
-                all_files.append(f)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-            start = time.time()
-            to_add = []
-            for path in self._filter_paths(all_files, known_files):
+        # Files that we skipped last time because another feed owned them
+        # get another look, in case that feed's item went away.
+        if initial_scan:
+            candidates = snapshot.all_files()
+        else:
+            candidates = itertools.chain(changes.added,
+                    [p for p in self._skipped_known_paths
+                        if snapshot.contains_file(p)])
+        to_add = []
+        skipped_known_paths = set()
+        start = time.time()
+        for path in candidates:
+            if known_files.contains_path(path):
+                if path not in my_files:
+                    skipped_known_paths.add(path)
+            elif filetypes.is_media_filename(filename_to_unicode(path)):
                 to_add.append(path)
-                if time.time() - start > 0.4:
-                    yield
-                    if should_halt_early():
-                        return
-                    start = time.time()
-
-            # Keep track of the paths we will add in case we get directory
-            # watcher updates.  In that case, we want these paths to be in
-            # known_files.  It's very important that the next line come before
-            # the first yield statement to avoid a race condition.
-            self.pending_paths_to_add = to_add
-            path_iter = iter(to_add)
-            finished = False
-            yield # yield after doing prep work
-            if should_halt_early():
-                return
-            with app.local_metadata_manager.bulk_add():
-                while not finished:
-                    finished = self._add_batch_of_videos(path_iter, 0.1)
-                    yield # yield after each batch
-                    if should_halt_early():
-                        return
+            if time.time() - start > 0.4:
+                yield
+                if should_halt_early():
+                    return
+                start = time.time()
+        self._skipped_known_paths = skipped_known_paths
+
+        # Keep track of the paths we will add in case we get directory
+        # watcher updates.  In that case, we want these paths to be in
+        # known_files.  It's very important that the next line come before
+        # the first yield statement to avoid a race condition.
+        self.pending_paths_to_add = to_add
+        path_iter = iter(to_add)
+        finished = False
+        yield # yield after doing prep work
+        if should_halt_early():
+            return
+        with app.local_metadata_manager.bulk_add():
+            while not finished:
+                finished = self._add_batch_of_videos(path_iter, 0.1)
+                yield # yield after each batch
+                if should_halt_early():
+                    return
+        if changes.directories_listed > 0:
+            # Only save the snapshot once our items reflect it, otherwise a
+            # crash could make us forget about changes.
+            eventloop.call_in_thread(lambda result: None,
+                    self._on_snapshot_save_error, directorysnapshot.save,
+                    "Save directory snapshot", self._snapshot_path(),
+                    snapshot.get_state())
         self._after_update()
         self.updating = False
         self.pending_paths_to_add = []
         self.schedule_update_events(-1)
 
+    def _on_snapshot_save_error(self, error):
+        logging.warn("Error saving directory snapshot for %s: %s", self,
+                error)
+
     def _add_batch_of_videos(self, path_iter, max_time):
         """Make a bunch of filenames, but don't take too long.
 
@@ -2288,6 +2439,21 @@ class DirectoryScannerImplBase(FeedImpl):
         return (p for p in paths if not known_files.contains_path(p) and
               filetypes.is_media_filename(filename_to_unicode(p)))
 
+def _scan_directory_tree(snapshot, scan_dir, snapshot_path):
+    """Rescan a directory tree.  This runs in the thread pool.
+
+    :param snapshot: DirectorySnapshot from the last scan, or None to load
+        the snapshot saved at snapshot_path
+    :returns: (snapshot, changes) tuple
+    """
+    if snapshot is None or snapshot.root != scan_dir:
+        snapshot = directorysnapshot.load(snapshot_path, scan_dir)
+    start = time.time()
+    changes = snapshot.rescan()
+    logging.timing("scanned %r in %.3f secs: %s", scan_dir,
+            time.time() - start, changes)
+    return snapshot, changes
+
 class DirectoryWatchFeedImpl(DirectoryScannerImplBase):
     def setup_new(self, ufeed, directory):
         # calculate url and title arguments to FeedImpl's constructor
@@ -30,61 +30,404 @@
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time.  The limit adapts to how long
+updates take: we slowly raise it while updates finish quickly and cut it
+in half when they start to drag.
+
+When more feeds are due than we can update, the feed the user is looking
+at goes first, then feeds that auto-download, then feeds that often have
+new items.  Feeds from the same host are updated back to back so that
+libcurl can reuse its connection, but we never update more than
+MAX_UPDATES_PER_HOST feeds from one host at once, and we back off from
+hosts that give us errors.
 """
 
 import collections
+import heapq
+import itertools
+import logging
+import urlparse
 
 from miro import eventloop
+from miro.clock import clock
+
+# Limits for the number of feeds that update at once
+MIN_UPDATES = 2
+INITIAL_UPDATES = 3
+MAX_UPDATES = 12
+MAX_UPDATES_PER_HOST = 2
+# If updates take longer than this on average, we lower the number of
+# feeds that update at once.
+TARGET_UPDATE_TIME = 10.0
+# Weight of the newest value when we update running averages
+AVERAGE_WEIGHT = 0.2
+# How long to wait before updating feeds from a host after an error.  This
+# doubles with each error in a row, up to BACKOFF_MAX.
+BACKOFF_MIN = 60
+BACKOFF_MAX = 3600
+# Priorities for feeds.  These get added together.
+PRIORITY_VISIBLE = 4
+PRIORITY_AUTODOWNLOAD = 2
+PRIORITY_FREQUENT_PUBLISHER = 1
+# Feeds that average this many new items per update are frequent publishers
+FREQUENT_PUBLISHER_ITEMS = 1.0
+
+def _get_host(feed):
+    """Get the host to use for per-host limits for a feed.
+
+    Returns None for feeds that don't have one, like search feeds.
+    """
+    try:
+        host = urlparse.urlparse(feed.get_url())[1]
+    except (AttributeError, ValueError):
+        return None
+    return host.lower() or None
+
+class UpdateStats(object):
+    """Metrics for feed updates.
+
+    A cycle starts when a feed becomes due and no other feeds are waiting or
+    updating.  It finishes when no feeds are waiting or updating.
+
+    :attribute update_count: number of updates that finished
+    :attribute error_count: number of updates that failed
+    :attribute total_wait_time: time that feeds spent waiting to update
+        after they were due
+    :attribute total_update_time: time spent updating feeds
+    :attribute max_update_time: longest time spent updating a single feed
+    :attribute cycle_count: number of cycles that finished
+    :attribute last_cycle_time: time the last cycle took
+    :attribute last_cycle_updates: number of updates in the last cycle
+    """
+    def __init__(self):
+        self.update_count = 0
+        self.error_count = 0
+        self.total_wait_time = 0.0
+        self.total_update_time = 0.0
+        self.max_update_time = 0.0
+        self.cycle_count = 0
+        self.last_cycle_time = None
+        self.last_cycle_updates = 0
+
+    def record_update(self, wait_time, update_time, error):
+        self.update_count += 1
+        if error:
+            self.error_count += 1
+        self.total_wait_time += wait_time
+        self.total_update_time += update_time
+        self.max_update_time = max(self.max_update_time, update_time)
 
-MAX_UPDATES = 3
+    def record_cycle(self, cycle_time, update_count):
+        self.cycle_count += 1
+        self.last_cycle_time = cycle_time
+        self.last_cycle_updates = update_count
+
+    def average_wait_time(self):
+        if self.update_count == 0:
+            return 0.0
+        return self.total_wait_time / self.update_count
+
+    def average_update_time(self):
+        if self.update_count == 0:
+            return 0.0
+        return self.total_update_time / self.update_count
+
+    def log_summary(self):
+        logging.debug("feed updates: %d updates, %d errors, %0.1f avg wait, "
+                      "%0.1f avg update, %0.1f max update", self.update_count,
+                      self.error_count, self.average_wait_time(),
+                      self.average_update_time(), self.max_update_time)
+        if self.last_cycle_time is not None:
+            logging.debug("feed updates: %d cycles, last one was %d updates "
+                          "in %0.1f secs", self.cycle_count,
+                          self.last_cycle_updates, self.last_cycle_time)
+
+class _PendingUpdate(object):
+    """A feed that's waiting to update."""
+    def __init__(self, feed, update_callback, due_time, order):
+        self.feed = feed
+        self.update_callback = update_callback
+        self.due_time = due_time
+        self.order = order
+        self.host = _get_host(feed)
+        self.canceled = False
+        self.start_time = None
+        self.error = False
 
 class FeedUpdateQueue(object):
     def __init__(self):
-        self.update_queue = collections.deque()
-        self.timeouts = {}
+        # maps feed ids to _PendingUpdates that aren't due yet
+        self.scheduled = {}
+        # heap of (due_time, order, _PendingUpdate) for self.scheduled.
+        # This can contain canceled updates.
+        self.schedule_heap = []
+        # maps feed ids to _PendingUpdates that are due
+        self.ready = {}
+        # maps hosts to a heap of (-priority, order, _PendingUpdate) for
+        # self.ready.  This can contain canceled updates.
+        self.ready_heaps = collections.defaultdict(list)
+        # maps feed ids to the _PendingUpdate for feeds currently updating
+        self.currently_updating = {}
         self.callback_handles = {}
-        self.currently_updating = set()
+        self.host_update_counts = collections.defaultdict(int)
+        # maps hosts to (error count, retry time)
+        self.host_errors = {}
+        self.last_host = None
+        self.visible_feed_ids = set()
+        # maps feed ids to the average number of new items per update
+        self.new_item_averages = {}
+        self.max_updates = INITIAL_UPDATES
+        self.average_update_time = None
+        self.updates_since_limit_change = 0
+        self.counter = itertools.count()
+        self.wakeup_timeout = None
+        self.wakeup_time = None
+        self.cycle_start = None
+        self.cycle_updates = 0
+        self.stats = UpdateStats()
 
     def schedule_update(self, delay, feed, update_callback):
-        name = "Feed update (%s)" % feed.get_title()
-        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
-                name, args=(feed, update_callback))
+        self.cancel_update(feed)
+        due_time = clock() + delay
+        pending = _PendingUpdate(feed, update_callback, due_time,
+                                 self.counter.next())
+        self.scheduled[feed.id] = pending
+        heapq.heappush(self.schedule_heap, (due_time, pending.order, pending))
+        self._schedule_wakeup()
 
     def cancel_update(self, feed):
+        for pending_map in (self.scheduled, self.ready):
+            try:
+                pending = pending_map.pop(feed.id)
+            except KeyError:
+                pass
+            else:
+                pending.canceled = True
+
+    def set_feed_visible(self, feed_id, visible):
+        """Set if the user is looking at a feed or folder.
+
+        Visible feeds (and feeds inside visible folders) update first.
+        """
+        if visible:
+            self.visible_feed_ids.add(feed_id)
+        else:
+            self.visible_feed_ids.discard(feed_id)
+        # the priority for feeds that are already due needs to change
+        for pending in self.ready.values():
+            if (pending.feed.id == feed_id or
+                getattr(pending.feed, 'folder_id', None) == feed_id):
+                pending.canceled = True
+                new_pending = _PendingUpdate(pending.feed,
+                                             pending.update_callback,
+                                             pending.due_time, pending.order)
+                self._make_ready(new_pending)
+
+    def record_new_items(self, feed, count):
+        """Record how many new items a feed update found."""
         try:
-            timeout = self.timeouts.pop(feed.id)
+            average = self.new_item_averages[feed.id]
+        except KeyError:
+            average = count
+        else:
+            average += (count - average) * AVERAGE_WEIGHT
+        self.new_item_averages[feed.id] = average
+
+    def report_error(self, feed):
+        """Report that a feed's update failed with a network error."""
+        try:
+            self.currently_updating[feed.id].error = True
         except KeyError:
             pass
+
+    def _priority(self, feed):
+        priority = 0
+        if (feed.id in self.visible_feed_ids or
+            getattr(feed, 'folder_id', None) in self.visible_feed_ids):
+            priority += PRIORITY_VISIBLE
+        if feed.get_autodownload_mode() != u'off':
+            priority += PRIORITY_AUTODOWNLOAD
+        if (self.new_item_averages.get(feed.id, 0) >=
+            FREQUENT_PUBLISHER_ITEMS):
+            priority += PRIORITY_FREQUENT_PUBLISHER
+        return priority
+
+    def _schedule_wakeup(self):
+        """Make sure that do_updates() runs when the next feed is due."""
+        wakeup_time = self._calc_wakeup_time()
+        if wakeup_time is None:
+            return
+        if self.wakeup_timeout is not None:
+            if self.wakeup_time <= wakeup_time:
+                return
+            self.wakeup_timeout.cancel()
+        self.wakeup_time = wakeup_time
+        self.wakeup_timeout = eventloop.add_timeout(
+            max(0, wakeup_time - clock()), self.do_updates,
+            'run feed update queue')
+
+    def _calc_wakeup_time(self):
+        heap = self.schedule_heap
+        while heap and heap[0][2].canceled:
+            heapq.heappop(heap)
+        times = []
+        if heap:
+            times.append(heap[0][0])
+        # we also need to wake up when a host that has due feeds comes out
+        # of backoff
+        now = clock()
+        for host, (error_count, retry_time) in self.host_errors.items():
+            if retry_time > now and self.ready_heaps.get(host):
+                times.append(retry_time)
+        if times:
+            return min(times)
         else:
-            timeout.cancel()
+            return None
 
-    def do_update(self, feed, update_callback):
-        del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+    def do_updates(self):
+        self.wakeup_timeout = self.wakeup_time = None
+        now = clock()
+        heap = self.schedule_heap
+        while heap and heap[0][0] <= now:
+            pending = heapq.heappop(heap)[2]
+            if not pending.canceled:
+                del self.scheduled[pending.feed.id]
+                self._make_ready(pending)
         self.run_update_queue()
 
+    def _make_ready(self, pending):
+        if self.cycle_start is None:
+            self.cycle_start = clock()
+        self.ready[pending.feed.id] = pending
+        heapq.heappush(self.ready_heaps[pending.host],
+                       (-self._priority(pending.feed), pending.order,
+                        pending))
+
+    def _choose_next_host(self):
+        """Pick the host to update a feed from next.
+
+        We pick the host that has the highest priority feed waiting.  If
+        there's a tie, we pick the host that we last updated a feed from, so
+        that we can reuse the connection.  Hosts that are at
+        MAX_UPDATES_PER_HOST or backing off from an error are skipped.
+        """
+        now = clock()
+        best_key = best_host = None
+        for host, heap in self.ready_heaps.items():
+            while heap and heap[0][2].canceled:
+                heapq.heappop(heap)
+            if not heap:
+                del self.ready_heaps[host]
+                continue
+            if host is not None:
+                if self.host_update_counts[host] >= MAX_UPDATES_PER_HOST:
+                    continue
+                if (host in self.host_errors and
+                    self.host_errors[host][1] > now):
+                    continue
+            neg_priority, order = heap[0][:2]
+            if host == self.last_host:
+                order = -1
+            if best_key is None or (neg_priority, order) < best_key:
+                best_key = (neg_priority, order)
+                best_host = host
+        if best_key is None:
+            return False, None
+        return True, best_host
+
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
-        self.currently_updating.remove(feed)
+        pending = self.currently_updating.pop(feed.id)
+        if pending.host is not None:
+            self.host_update_counts[pending.host] -= 1
+        self._record_update(pending, clock())
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
+    def _record_update(self, pending, now):
+        update_time = now - pending.start_time
+        self.stats.record_update(pending.start_time - pending.due_time,
+                                 update_time, pending.error)
+        self.cycle_updates += 1
+        if pending.host is not None:
+            if pending.error:
+                error_count = self.host_errors.get(pending.host, (0, 0))[0]
+                error_count += 1
+                backoff = min(BACKOFF_MIN * 2 ** (error_count - 1),
+                              BACKOFF_MAX)
+                self.host_errors[pending.host] = (error_count, now + backoff)
+            else:
+                self.host_errors.pop(pending.host, None)
+        self._adapt_max_updates(update_time)
+
+    def _adapt_max_updates(self, update_time):
+        """Adjust max_updates based on how long updates are taking.
+
+        We only make a change once every max_updates updates, so that
+        each change has a chance to affect the update times.
+        """
+        if self.average_update_time is None:
+            self.average_update_time = update_time
+        else:
+            self.average_update_time += ((update_time -
+                                          self.average_update_time) *
+                                         AVERAGE_WEIGHT)
+        self.updates_since_limit_change += 1
+        if self.updates_since_limit_change < self.max_updates:
+            return
+        if self.average_update_time > TARGET_UPDATE_TIME:
+            new_max = max(MIN_UPDATES, self.max_updates // 2)
+        elif self.ready:
+            # updates are going fast and feeds are waiting, try more at once
+            new_max = min(MAX_UPDATES, self.max_updates + 1)
+        else:
+            new_max = self.max_updates
+        if new_max != self.max_updates:
+            logging.debug("feed updates: changing max updates to %d "
+                          "(average update time: %0.1f)", new_max,
+                          self.average_update_time)
+            self.max_updates = new_max
+            self.updates_since_limit_change = 0
+
     def run_update_queue(self):
-        while (len(self.update_queue) > 0 and 
-               len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.popleft()
-            if feed in self.currently_updating:
+        while len(self.currently_updating) < self.max_updates:
+            found, host = self._choose_next_host()
+            if not found:
+                break
+            pending = heapq.heappop(self.ready_heaps[host])[2]
+            del self.ready[pending.feed.id]
+            if pending.feed.id in self.currently_updating:
                 continue
-            handle = feed.connect('update-finished', self.update_finished)
-            handle2 = feed.connect('removed', self.update_finished)
-            self.callback_handles[feed.id] = (handle, handle2)
-            self.currently_updating.add(feed)
-            update_callback()
+            self._start_update(pending)
+        self._check_cycle_finished()
+        # hosts may have been skipped because they're backing off
+        self._schedule_wakeup()
+
+    def _start_update(self, pending):
+        feed = pending.feed
+        handle = feed.connect('update-finished', self.update_finished)
+        handle2 = feed.connect('removed', self.update_finished)
+        self.callback_handles[feed.id] = (handle, handle2)
+        self.currently_updating[feed.id] = pending
+        if pending.host is not None:
+            self.host_update_counts[pending.host] += 1
+        self.last_host = pending.host
+        pending.start_time = clock()
+        pending.update_callback()
+
+    def _check_cycle_finished(self):
+        if (self.cycle_start is None or self.ready or
+            self.currently_updating):
+            return
+        cycle_time = clock() - self.cycle_start
+        self.stats.record_cycle(cycle_time, self.cycle_updates)
+        logging.debug("feed update cycle finished: %d updates in %0.1f secs",
+                      self.cycle_updates, cycle_time)
+        self.cycle_start = None
+        self.cycle_updates = 0
 
 global_update_queue = FeedUpdateQueue()
 
@@ -97,3 +440,19 @@ def schedule_update(delay, feed, update_callback):
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def set_feed_visible(feed_id, visible):
+    """Set if the user is looking at a feed/folder."""
+    global_update_queue.set_feed_visible(feed_id, visible)
+
+def record_new_items(feed, count):
+    """Record how many new items an update for feed found."""
+    global_update_queue.record_new_items(feed, count)
+
+def report_error(feed):
+    """Report that the current update for feed failed."""
+    global_update_queue.report_error(feed)
+
+def get_stats():
+    """Get the UpdateStats for feed updates."""
+    return global_update_queue.stats
@@ -32,9 +32,11 @@
 where file locking semantics can cause problems.
 """
 
+import errno
 import logging
 import os
 import shutil
+import sys
 
 from miro import u3info
 
@@ -139,6 +141,102 @@ def copy_with_progress(input_path, output_path, block_size=32*1024):
                     break
                 data = input.read(block_size)
 
+def _load_sendfile():
+    """Get a wrapper for the sendfile() system call, if we can use it.
+
+    sendfile() copies between file descriptors inside the kernel, which
+    saves us from copying every block into python and back out again.  We
+    only use it on linux, where it works for regular files.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        c_sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    c_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(output_fd, input_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        result = c_sendfile(output_fd, input_fd, ctypes.byref(c_offset),
+                            count)
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+    return sendfile
+
+# sendfile(output_fd, input_fd, offset, count) copies up to count bytes
+# starting at offset and returns the number of bytes it copied.  It's None if
+# we can't use sendfile() on this platform.
+sendfile = _load_sendfile()
+
+def copy_with_callback(input_path, output_path, callback,
+                       buffer_size=4*1024*1024, use_sendfile=True):
+    """Copy a file, calling callback after each chunk we write.
+
+    This blocks until the copy is done, so call it from a thread, not the
+    eventloop.
+
+    We use sendfile() if the platform supports it, otherwise we read into a
+    single buffer of buffer_size bytes and write it out.
+
+    :param callback: called with the number of bytes written for each
+        chunk.  Return True to cancel the copy.  NB: you should probably
+        remove the output file if that happens.
+    :returns: True if the whole file was copied, False if it was canceled
+    """
+    input_path = expand_filename(input_path)
+    output_path = expand_filename(output_path)
+    binary_flag = getattr(os, 'O_BINARY', 0)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | binary_flag
+    if hasattr(os, 'O_SYNC'):
+        flags |= os.O_SYNC
+    input_file = open(input_path, 'rb', 0)
+    try:
+        output_fd = os.open(output_path, flags)
+        try:
+            input_fd = input_file.fileno()
+            send_func = None
+            if use_sendfile:
+                send_func = sendfile
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            offset = 0
+            while True:
+                if send_func is not None:
+                    try:
+                        count = send_func(output_fd, input_fd, offset,
+                                          buffer_size)
+                    except OSError, e:
+                        if (offset == 0 and
+                                e.errno in (errno.EINVAL, errno.ENOSYS)):
+                            # filesystem doesn't support sendfile(), fall
+                            # back to reading and writing.
+                            send_func = None
+                            continue
+                        raise
+                else:
+                    count = input_file.readinto(buf)
+                    written = 0
+                    while written < count:
+                        written += os.write(output_fd, view[written:count])
+                if not count:
+                    return True
+                offset += count
+                if callback(count):
+                    return False
+        finally:
+            os.close(output_fd)
+    finally:
+        input_file.close()
+
 try:
     samefile = os.path.samefile
 except AttributeError:
@@ -289,6 +387,16 @@ def miro_listdir(directory):
             pass
     return files, directories
 
+def is_ignored_name(name):
+    """Check if a directory entry should be skipped when looking for
+    new videos.
+    """
+    name_lower = name.lower()
+    # thumbs.db is a windows file that speeds up thumbnails.  We know it's
+    # not a movie file.
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
+
 def miro_allfiles(directory, checked=None):
     """Directory listing that's safe and convenient for finding new
     videos in a directory.
@@ -318,11 +426,7 @@ def miro_allfiles(directory, checked=None):
         logging.debug('OSError walking directory; continuing', exc_info=1)
         return
     for name in listing:
-        name_lower = name.lower()
-        if (name.startswith('.') or name_lower == 'thumbs.db' or
-                name_lower == "incomplete downloads"):
-            # thumbs.db is a windows file that speeds up thumbnails.
-            # We know it's not a movie file.
+        if is_ignored_name(name):
             continue
         path = os.path.join(directory, os.path.normcase(name))
         expanded_path = os.path.join(expanded_directory, os.path.normcase(name))
@@ -488,11 +488,13 @@ class FeedDisplay(ItemListDisplay):
 
     def cleanup(self):
         ItemListDisplay.cleanup(self)
+        messages.SetFeedVisible(self.feed_id, False).send_to_backend()
         if widgetutil.feed_exists(self.feed_id):
             messages.MarkFeedSeen(self.feed_id).send_to_backend()
 
     def make_controller(self, tab):
         self.feed_id = tab.id
+        messages.SetFeedVisible(self.feed_id, True).send_to_backend()
         return feedcontroller.FeedController(tab.id, tab.is_folder,
                                              tab.is_directory_feed)
 
@@ -84,6 +84,13 @@ class Image(object):
                 gtk.gdk.INTERP_BILINEAR)
         return TransformedImage(dest)
 
+    def save(self, path):
+        """Save the image to path in PNG format."""
+        try:
+            self.pixbuf.save(path, 'png')
+        except gobject.GError, ge:
+            raise IOError("%s" % ge)
+
 class TransformedImage(Image):
     def __init__(self, pixbuf):
         # XXX intentionally not calling direct super's __init__; we should do
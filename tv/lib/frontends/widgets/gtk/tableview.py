@@ -1750,6 +1750,17 @@ class ItemListModelHandler(ModelHandler):
     def __init__(self, model, gtk_treeview):
         ModelHandler.__init__(self, model, gtk_treeview)
         item_list = self.model.item_list
+        weak_connect(gtk_treeview, 'expose-event', self.on_expose_event)
+
+    def on_expose_event(self, gtk_treeview, event):
+        # Let the ItemList know which rows are visible so it can prefetch the
+        # rows around them.
+        visible_range = gtk_treeview.get_visible_range()
+        if visible_range is not None:
+            start_path, end_path = visible_range
+            self.model.item_list.set_visible_range(start_path[0],
+                                                   end_path[0])
+        return False
 
     def model_changed(self):
         if self.model._model != self.gtk_treeview.get_model():
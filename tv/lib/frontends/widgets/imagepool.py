@@ -33,18 +33,43 @@ filenames.
 imagepool handles creating Image and ImageSurface objects for image
 filenames.  It caches Image/ImageSurface objecsts so to avoid re-creating
 them.
+
+Resized images are also saved in an on-disk thumbnail cache, so that we
+don't need to decode full-sized images again on the next startup.
+get_surface_async() loads images in background threads, for renderers that
+can draw a placeholder while the image loads.
 """
 
 import logging
+import os
+import Queue
+import threading
 import traceback
+from hashlib import sha1
 
+from miro import app
+from miro import fileutil
+from miro import prefs
 from miro import util
 from miro.plat import resources
 from miro.plat.frontends.widgets import widgetset
+from miro.plat.frontends.widgets.threads import call_on_ui_thread
 
 broken_image = widgetset.Image(resources.path('images/broken-image.gif'))
 
 CACHE_SIZE = 2000 # number of objects to keep in memory
+# memory budget for each pool.  We estimate the memory an image uses from
+# its decoded size.
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+BYTES_PER_PIXEL = 4
+# number of threads that load images for get_surface_async()
+LOADER_THREAD_COUNT = 2
+# max number of files in the thumbnail cache directory
+THUMBNAIL_CACHE_MAX_FILES = 5000
+
+def image_bytes(image):
+    """Estimate the memory used by an Image or ImageSurface."""
+    return int(image.width * image.height * BYTES_PER_PIXEL)
 
 def resize_image(image, dest_width, dest_height, upsize_threshold=1.5):
     # handle corner case of empty dest
@@ -85,25 +110,198 @@ def resize_one_dimension(image, width_scale, height_scale,
     # okay, give up on scaling and just return the image
     return image
 
-class ImagePool(util.Cache):
-    def create_new_value(self, (path, size), invalidator=None):
+def load_image(path, size, save_thumbnail=False):
+    """Load an image, resizing it if needed.
+
+    This uses the on-disk thumbnail cache for resized images.  It's safe to
+    call from any thread.
+
+    :param save_thumbnail: store the resized image in the thumbnail cache.
+        Encoding and writing it out is slow, so only ImageLoader threads
+        should do this, not the UI thread.
+    """
+    if size is not None:
+        image = _thumbnail_cache.load(path, size)
+        if image is not None:
+            return image
+    try:
+        image = widgetset.Image(path)
+    except StandardError:
+        logging.warn("error loading image %s:\n%s", path,
+                traceback.format_exc())
+        image = broken_image
+    if size is not None:
+        resized = resize_image(image, *size)
+        if (save_thumbnail and image is not broken_image and
+                resized is not image and resized is not broken_image):
+            _thumbnail_cache.save(path, size, resized)
+        image = resized
+    return image
+
+class ThumbnailCache(object):
+    """On-disk cache of resized images.
+
+    Images are stored as PNG files named by a hash of the source path, its
+    mtime and the size we resized to.  Changing the source file changes its
+    mtime, so we never return a stale thumbnail.  Any number of threads can
+    use the cache at once.
+    """
+    def __init__(self):
+        self._directory = None
+        self._lock = threading.Lock()
+
+    def directory(self):
+        with self._lock:
+            if self._directory is None:
+                directory = os.path.join(
+                    app.config.get(prefs.SUPPORT_DIRECTORY),
+                    'thumbnail-cache')
+                if not fileutil.exists(directory):
+                    fileutil.makedirs(directory)
+                self._directory = directory
+            return self._directory
+
+    def cache_path(self, path, size):
+        """Get the path to the cached thumbnail for path.
+
+        :returns: path to the cache file, or None if path doesn't exist
+        """
+        try:
+            mtime = fileutil.getmtime(path)
+        except (OSError, IOError):
+            return None
+        key = sha1(repr((path, mtime, tuple(size)))).hexdigest()
+        return os.path.join(self.directory(), key + '.png')
+
+    def load(self, path, size):
+        """Load a cached thumbnail.
+
+        :returns: Image, or None if we don't have one cached
+        """
+        try:
+            cache_path = self.cache_path(path, size)
+            if cache_path is None or not fileutil.exists(cache_path):
+                return None
+            return widgetset.Image(cache_path)
+        except StandardError:
+            logging.warn("error loading cached thumbnail for %s", path,
+                         exc_info=True)
+            return None
+
+    def save(self, path, size, image):
+        """Store a thumbnail in the cache."""
         try:
-            image = widgetset.Image(path)
+            cache_path = self.cache_path(path, size)
+            if cache_path is None:
+                return
+            # write to a temp file, then rename it so other threads never
+            # see partially written files.
+            temp_path = '%s.%s.tmp' % (cache_path,
+                                       threading.current_thread().ident)
+            image.save(temp_path)
+            fileutil.rename(temp_path, cache_path)
         except StandardError:
-            logging.warn("error loading image %s:\n%s", path,
-                    traceback.format_exc())
-            image = broken_image
-        if size is not None:
-            image = resize_image(image, *size)
-        return image
+            logging.warn("error saving cached thumbnail for %s", path,
+                         exc_info=True)
+
+    def trim(self, max_files=THUMBNAIL_CACHE_MAX_FILES):
+        """Remove the least recently modified files if the cache is too big.
+        """
+        directory = self.directory()
+        paths = [os.path.join(directory, name)
+                 for name in fileutil.listdir(directory)]
+        if len(paths) <= max_files:
+            return
+        paths.sort(key=fileutil.getmtime)
+        for path in paths[:len(paths) - max_files]:
+            try:
+                fileutil.remove(path)
+            except (OSError, IOError):
+                logging.warn("error removing %s", path, exc_info=True)
+
+class ImageLoader(object):
+    """Loads images in background threads for get_surface_async()
+
+    The most recently requested images are loaded first, since they are
+    probably the ones that are visible.  Requests for the same image are
+    merged.
+    """
+    def __init__(self, thread_count=LOADER_THREAD_COUNT):
+        self.queue = Queue.LifoQueue()
+        # maps (path, size) keys to callbacks to run when the load is done.
+        # Only used on the UI thread.
+        self.pending = {}
+        self.threads = []
+        # look up the directory now, rather than in a loader thread
+        _thumbnail_cache.directory()
+        for i in xrange(thread_count):
+            thread = threading.Thread(target=self._thread_body,
+                                      name="Image loader")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.queue.put(_thumbnail_cache.trim)
+
+    def _thread_body(self):
+        while True:
+            request = self.queue.get()
+            try:
+                request()
+            except StandardError:
+                logging.exception("Error running %s", request)
+            finally:
+                self.queue.task_done()
+
+    def load(self, key, invalidator, callback):
+        """Start loading an image.
+
+        :param key: (path, size) tuple for the image
+        :param invalidator: invalidator for the cache entry
+        :param callback: function to call on the UI thread once the image
+        is in the cache.
+        """
+        if key in self.pending:
+            if callback is not None:
+                self.pending[key].append(callback)
+            return
+        self.pending[key] = [callback] if callback is not None else []
+        def request():
+            path, size = key
+            image = load_image(path, size, save_thumbnail=True)
+            call_on_ui_thread(self._image_loaded, key, image, invalidator)
+        self.queue.put(request)
+
+    def _image_loaded(self, key, image, invalidator):
+        _imagepool.set(key, image, invalidator=invalidator)
+        for callback in self.pending.pop(key, []):
+            try:
+                callback()
+            except StandardError:
+                logging.exception("Error running image loaded callback")
+
+    def wait_until_idle(self):
+        """Block until all requests sent so far have been run."""
+        self.queue.join()
+
+class ImagePool(util.Cache):
+    def value_size(self, image):
+        return image_bytes(image)
+
+    def create_new_value(self, (path, size), invalidator=None):
+        return load_image(path, size)
 
 class ImageSurfacePool(util.Cache):
+    def value_size(self, surface):
+        return image_bytes(surface)
+
     def create_new_value(self, (path, size), invalidator=None):
         image = _imagepool.get((path, size), invalidator=invalidator)
         return widgetset.ImageSurface(image)
 
-_imagepool = ImagePool(CACHE_SIZE)
-_image_surface_pool = ImageSurfacePool(CACHE_SIZE)
+_imagepool = ImagePool(CACHE_SIZE, CACHE_MAX_BYTES)
+_image_surface_pool = ImageSurfacePool(CACHE_SIZE, CACHE_MAX_BYTES)
+_thumbnail_cache = ThumbnailCache()
+_image_loader = None
 
 def get(path, size=None, invalidator=None):
     """Returns an Image for path.
@@ -131,6 +329,32 @@ def get_surface(path, size=None, invalidator=None):
     """
     return _image_surface_pool.get((path, size), invalidator=invalidator)
 
+def get_surface_async(path, size=None, invalidator=None, callback=None):
+    """Get an ImageSurface for path without blocking to load it.
+
+    If the image is already loaded, this works like get_surface().
+    Otherwise, we load the image in a background thread and return None.
+    Callers should draw a placeholder in that case.
+
+    :param path: the filename for the image
+    :param size: size to scale the image to (see get())
+    :param invalidator: an optional functions which returns True if
+                        the cache value is no longer valid
+    :param callback: function to call on the UI thread once the image is
+                     ready to be drawn.
+    """
+    global _image_loader
+    key = (path, size)
+    surface = _image_surface_pool.get_if_cached(key)
+    if surface is not None:
+        return surface
+    if _imagepool.is_cached(key):
+        return _image_surface_pool.get(key, invalidator=invalidator)
+    if _image_loader is None:
+        _image_loader = ImageLoader()
+    _image_loader.load(key, invalidator, callback)
+    return None
+
 def get_image_display(path, size=None, invalidator=None):
     """Returns an ImageDisplay for path.
 
@@ -157,3 +381,23 @@ def clear_cache_for_path(path):
                 invalid.add(key)
         for key in invalid:
             pool.remove(key)
+
+def release_memory(fraction=0.5):
+    """Drop cached images to free up memory.
+
+    Call this when the system is low on memory.  fraction is the part of
+    the cached images to keep.
+    """
+    for pool in _imagepool, _image_surface_pool:
+        pool.shrink(fraction)
+
+def get_stats():
+    """Get hit/miss/eviction counts and memory use for the image caches.
+
+    :returns: dict mapping 'images' and 'surfaces' to util.Cache.stats()
+    dicts
+    """
+    return {
+        'images': _imagepool.stats(),
+        'surfaces': _image_surface_pool.stats(),
+    }
@@ -36,15 +36,21 @@ It also defines several ItemTrackerQuery subclasses that correspond to tabs
 in the interface.
 """
 
+import bisect
 import collections
 
 from miro import app
+from miro import messages
+from miro import util
 from miro.data import item
 from miro.data import itemtrack
 from miro.frontends.widgets import itemfilter
 from miro.frontends.widgets import itemsort
 from miro.plat.frontends.widgets.threads import call_on_ui_thread
 
+# max number of visible rows to send in PrioritizeItemIcons
+MAX_PRIORITY_ICONS = 200
+
 class ItemList(itemtrack.ItemTracker):
     """ItemList -- Track a list of items for TableView
 
@@ -86,10 +92,25 @@ class ItemList(itemtrack.ItemTracker):
             self.sorter = sort
         self.search_text = search_text
         self.group_func = group_func
+        self._setup_group_keys()
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
                                        self._make_query(),
                                        self._make_item_source())
 
+    def set_visible_range(self, first_row, last_row):
+        if (first_row, last_row) != self._visible_range:
+            self._prioritize_icons(first_row, last_row)
+        itemtrack.ItemTracker.set_visible_range(self, first_row, last_row)
+
+    def _prioritize_icons(self, first_row, last_row):
+        # Ask the backend to download the icons for the rows we're showing
+        # before other icons.  Devices and shares don't use icon caches.
+        if self.is_for_device() or self.is_for_share():
+            return
+        last_row = min(last_row, first_row + MAX_PRIORITY_ICONS - 1)
+        item_ids = self.id_list[first_row:last_row+1]
+        messages.PrioritizeItemIcons(item_ids).send_to_backend()
+
     def is_for_device(self):
         return self.tab_type.startswith('device-')
 
@@ -108,9 +129,14 @@ class ItemList(itemtrack.ItemTracker):
         # This code should work for either
         return int(self.tab_id.split("-")[1])
 
+    def _set_id_list(self, id_list):
+        itemtrack.ItemTracker._set_id_list(self, id_list)
+        self._reset_group_info()
+
     def _fetch_id_list(self):
+        # we're getting new column values for all items
+        self._group_key_cache = {}
         itemtrack.ItemTracker._fetch_id_list(self)
-        self._reset_group_info()
 
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
@@ -214,6 +240,9 @@ class ItemList(itemtrack.ItemTracker):
         self.sorter.add_to_query(query)
         if self.search_text:
             query.set_search(self.search_text)
+        if self._group_key_func is not None:
+            query.set_value_columns(
+                self.group_func.sql_columns(query.select_info))
         return query
 
     def _update_query(self):
@@ -265,6 +294,8 @@ class ItemList(itemtrack.ItemTracker):
         """
         if self.group_func is None:
             raise ValueError("no grouping set")
+        if self._group_key_func is not None:
+            return self._get_group_info_from_starts(row)
         if self.group_info[row] is None:
             self._calc_group_info(row)
         return self.group_info[row]
@@ -291,22 +322,102 @@ class ItemList(itemtrack.ItemTracker):
 
         get_group_info() can be used to find the position of an info inside
         its group.
+
+        If func is an ItemListGrouping, we calculate the groups from column
+        values that we select along with the item ids, so we don't need to
+        load any rows.
         """
         self.group_func = func
-        self._reset_group_info()
+        self._setup_group_keys()
+        new_query = self._make_query()
+        if new_query.value_columns != self.query.value_columns:
+            self.change_query(new_query)
+        else:
+            self._reset_group_info()
+
+    def _setup_group_keys(self):
+        if isinstance(self.group_func, ItemListGrouping):
+            self._group_key_func = self.group_func.make_key_func(
+                self.base_query.select_info)
+        else:
+            self._group_key_func = None
+        # maps item ids to their group keys
+        self._group_key_cache = {}
+        # sorted list of rows that start a group, or None if we need to
+        # recalculate it
+        self._group_starts = None
 
     def _reset_group_info(self):
         self.group_info = [None] * len(self)
+        self._group_starts = None
+
+    def _group_key(self, row):
+        id_ = self.id_list[row]
+        try:
+            return self._group_key_cache[id_]
+        except KeyError:
+            if self.column_values is not None:
+                values = self.column_values.get(id_)
+            else:
+                # none of our attributes are in the table
+                values = ()
+            if values is not None:
+                key = self._group_key_func(values)
+            else:
+                # we couldn't select the values, fall back to the row data
+                key = self.group_func(self.get_row(row))
+            self._group_key_cache[id_] = key
+            return key
+
+    def _is_group_start(self, row):
+        return row == 0 or self._group_key(row) != self._group_key(row-1)
+
+    def _calc_group_starts(self):
+        self._group_starts = [row for row in xrange(len(self))
+                              if self._is_group_start(row)]
+
+    def _get_group_info_from_starts(self, row):
+        if not 0 <= row < len(self):
+            raise IndexError("%s is out of range" % row)
+        if self._group_starts is None:
+            self._calc_group_starts()
+        starts = self._group_starts
+        i = bisect.bisect_right(starts, row) - 1
+        start = starts[i]
+        if i + 1 < len(starts):
+            end = starts[i+1]
+        else:
+            end = len(self)
+        return (row-start, end-start, self.get_row(start))
+
+    def _column_values_changed(self, changed_ids):
+        for id_ in changed_ids:
+            self._group_key_cache.pop(id_, None)
+        if self._group_starts is None:
+            return
+        # Only the boundaries around changed rows can move.  If rows moved,
+        # _set_id_list() already reset _group_starts.
+        rows_to_check = set()
+        for id_ in changed_ids:
+            row = self.id_to_index.get(id_)
+            if row is not None:
+                rows_to_check.add(row)
+                if row + 1 < len(self):
+                    rows_to_check.add(row + 1)
+        starts = self._group_starts
+        for row in rows_to_check:
+            pos = bisect.bisect_left(starts, row)
+            in_starts = pos < len(starts) and starts[pos] == row
+            if self._is_group_start(row):
+                if not in_starts:
+                    starts.insert(pos, row)
+            elif in_starts:
+                del starts[pos]
 
     def _calc_group_info(self, row):
-        # FIXME: for normal item lists, this is fairly fast, but it is slow in
-        # a specific case:
-        #
-        # When the group function returns the same value for many items and
-        # those items need to be loaded.  This actually can happen pretty
-        # easily when you add a bunch of music files to miro, and we haven't
-        # run mutagen on them yet.  In that case, when you first switch to the
-        # music tab, basically all items will be in the same group.
+        # This is used for grouping functions that aren't ItemListGroupings.
+        # It can be slow when the group function returns the same value for
+        # many items and those items need to be loaded.
         key = self.group_func(self.get_row(row))
         start = end = row
         while (start > 0 and
@@ -429,24 +540,87 @@ class ItemListPool(object):
             app.item_tracker_updater.remove_tracker(item_list)
 
 # grouping functions
-def album_grouping(info):
-    """Grouping function that groups infos by albums."""
-    return (info.album_artist_sort_key, info.album_sort_key)
+class ItemListGrouping(object):
+    """Grouping function that only depends on a few ItemInfo attributes.
 
-def feed_grouping(info):
-    """Grouping function that groups infos by their feed."""
-    return info.feed_id
+    Calling an ItemListGrouping with an ItemInfo returns its grouping key,
+    just like a plain grouping function.  ItemList also uses sql_columns()
+    and make_key_func() to calculate the keys from values that it selects
+    along with the item ids.
 
-def video_grouping(info):
-    """Grouping function that groups infos for the videos tab.
+    :param attr_names: names of the ItemInfo attributes the key depends on
+    :param key_func: function that inputs the values of those attributes
+    and returns the grouping key
+    """
+    def __init__(self, attr_names, key_func):
+        self.attr_names = attr_names
+        self.key_func = key_func
 
-    For this group, we try to figure out what "show" the item is in.  If the
-    user has set a show we use that, otherwise we use the podcast.
+    def __call__(self, info):
+        return self.key_func(*[getattr(info, name)
+                               for name in self.attr_names])
 
-    """
-    if info.show is not None:
-        return info.show
-    elif info.parent_title is not None:
-        return info.parent_title_for_sort
+    def _columns_by_attr(self, select_info):
+        # ItemTrackerQuery takes columns in the main table unqualified
+        return dict((c.attr_name, c.column)
+                    for c in select_info.select_columns
+                    if c.table == select_info.table_name)
+
+    def sql_columns(self, select_info):
+        """Get the columns to select to calculate our keys.
+
+        Attributes that select_info's table doesn't have are left out.  Their
+        value is always None.
+        """
+        columns = self._columns_by_attr(select_info)
+        return [columns[name] for name in self.attr_names
+                if name in columns]
+
+    def make_key_func(self, select_info):
+        """Make a function that calculates keys from sql_columns() values.
+        """
+        columns = self._columns_by_attr(select_info)
+        positions = []
+        next_position = 0
+        for name in self.attr_names:
+            if name in columns:
+                positions.append(next_position)
+                next_position += 1
+            else:
+                positions.append(None)
+        if None not in positions:
+            return lambda values: self.key_func(*values)
+        def key_func(values):
+            return self.key_func(*[values[i] if i is not None else None
+                                   for i in positions])
+        return key_func
+
+def _album_key(album_artist, artist, album):
+    # matches ItemInfo.album_artist_sort_key and ItemInfo.album_sort_key
+    if album_artist:
+        artist_key = util.name_sort_key(album_artist)
+    else:
+        artist_key = util.name_sort_key(artist)
+    return (artist_key, util.name_sort_key(album))
+
+def _video_key(show, parent_title, feed_id, parent_id):
+    # For this group, we try to figure out what "show" the item is in.  If
+    # the user has set a show we use that, otherwise we use the podcast.
+    # See ItemInfo.parent_title_for_sort.
+    if show is not None:
+        return show
+    elif parent_title is not None:
+        return (parent_title, feed_id, parent_id)
     else:
         return None
+
+#: Grouping function that groups infos by albums.
+album_grouping = ItemListGrouping(('album_artist', 'artist', 'album'),
+                                  _album_key)
+
+#: Grouping function that groups infos by their feed.
+feed_grouping = ItemListGrouping(('feed_id',), lambda feed_id: feed_id)
+
+#: Grouping function that groups infos for the videos tab.
+video_grouping = ItemListGrouping(
+    ('show', 'parent_title', 'feed_id', 'parent_id'), _video_key)
@@ -426,6 +426,8 @@ class ItemListController(object):
         self.titlebar.connect_weak('resume-playing', self.on_resume_playing)
         self.standard_item_view.renderer.signals.connect_weak(
                 'throbber-drawn', self.on_throbber_drawn)
+        self.standard_item_view.renderer.signals.connect_weak(
+                'image-loaded', self.on_thumbnail_loaded)
 
     def set_view(self, _widget, view):
         if view == self.selected_view:
@@ -731,6 +733,9 @@ class ItemListController(object):
     def on_throbber_drawn(self, signaler, item_info):
         self.throbber_manager.start(item_info)
 
+    def on_thumbnail_loaded(self, signaler):
+        self.standard_item_view.queue_redraw()
+
     def on_key_press(self, view, key, mods):
         if key == keyboard.DELETE or key == keyboard.BKSPACE:
             return self.handle_delete()
@@ -79,6 +79,8 @@ PLAYLIST_ORDER_COLOR = widgetutil.BLACK
 PENDING_CONVERSION_TEXT_COLOR = (0.8, 0.8, 0.8)
 FAILED_CONVERSION_TEXT_COLOR = (0.8, 0.0, 0.0)
 FINISHED_CONVERSION_TEXT_COLOR = (0.0, 0.8, 0.0)
+# drawn in place of thumbnails that are still loading
+THUMBNAIL_PLACEHOLDER_COLOR = (0.85, 0.85, 0.85)
 
 # font sizes
 EMBLEM_FONT_SIZE = widgetutil.font_scale_from_osx_points(11)
@@ -181,9 +183,12 @@ class ItemRendererSignals(signals.SignalEmitter):
 
     signals:
         throbber-drawn (obj, item_info) -- a progress throbber was drawn
+        image-loaded (obj) -- a thumbnail that we drew a placeholder for has
+            loaded.  The view should be redrawn.
     """
     def __init__(self):
-        signals.SignalEmitter.__init__(self, 'throbber-drawn')
+        signals.SignalEmitter.__init__(self, 'throbber-drawn',
+                                       'image-loaded')
 
 _cached_images = {} # caches ImageSurface for get_image()
 def get_image(image_name):
@@ -215,8 +220,9 @@ class ItemRenderer(widgetset.ItemListRenderer):
     def __init__(self, display_channel=True, is_podcast=False,
                  wide_image=False):
         widgetset.ItemListRenderer.__init__(self)
-        self.canvas = ItemRendererCanvas(wide_image)
         self.signals = ItemRendererSignals()
+        self.canvas = ItemRendererCanvas(wide_image,
+                                         self.on_thumbnail_loaded)
         self.display_channel = display_channel
         self.is_podcast = is_podcast
         self.setup_torrent_folder_description()
@@ -224,6 +230,9 @@ class ItemRenderer(widgetset.ItemListRenderer):
     def get_size(self, style, layout_manager):
         return self.MIN_WIDTH, self.HEIGHT
 
+    def on_thumbnail_loaded(self):
+        self.signals.emit('image-loaded')
+
     def hotspot_test(self, style, layout_manager, x, y, width, height):
         layout = self.layout_all(layout_manager, width, height, False, None)
         hotspot_info = layout.find_hotspot(x, y)
@@ -522,11 +531,15 @@ class ItemRendererCanvas(object):
     for the cell
     """
 
-    def __init__(self, wide_image):
+    def __init__(self, wide_image, thumbnail_loaded_callback=None):
         """Create a new ItemRendererDrawer
 
         :param wide_image: should we draw our image with a wide aspect ratio?
+        :param thumbnail_loaded_callback: if given, we load thumbnails in the
+        background and draw a placeholder until they're ready.  This gets
+        called once a thumbnail is loaded.
         """
+        self.thumbnail_loaded_callback = thumbnail_loaded_callback
         if wide_image:
             self.image_width = IMAGE_WIDTH_WIDE
         else:
@@ -1077,12 +1090,27 @@ class ItemRendererCanvas(object):
         context.rectangle(x, y, width, height)
         context.fill()
 
+    def get_thumbnail_surface(self, width, height):
+        """Get the ImageSurface to draw for our thumbnail.
+
+        :returns: ImageSurface, or None if it's still loading
+        """
+        invalidator = util.mtime_invalidator(self.thumbnail)
+        if self.thumbnail_loaded_callback is None:
+            return imagepool.get_surface(self.thumbnail, (width, height),
+                                         invalidator=invalidator)
+        return imagepool.get_surface_async(self.thumbnail, (width, height),
+                invalidator=invalidator,
+                callback=self.thumbnail_loaded_callback)
+
     def draw_thumbnail(self, context, x, y, width, height):
-        icon = imagepool.get_surface(self.thumbnail, (width, height),
-                                     invalidator=util.mtime_invalidator(
-                self.thumbnail))
-        icon_x = x + (width - icon.width) // 2
-        icon_y = y + (height - icon.height) // 2
+        icon = self.get_thumbnail_surface(width, height)
+        if icon is not None:
+            icon_x = x + (width - icon.width) // 2
+            icon_y = y + (height - icon.height) // 2
+        else:
+            icon_x = x
+            icon_y = y
         # if our thumbnail is far enough to the left, we need to set a clip
         # path to take off the left corners.
         make_clip_path = (icon_x < x + CORNER_RADIUS)
@@ -1100,8 +1128,13 @@ class ItemRendererCanvas(object):
             context.arc(x + radius, y + radius, radius, PI, PI*3/2)
             context.clip()
         # draw the thumbnail
-        icon.draw(context, icon_x, icon_y, icon.width, icon.height,
-                fraction=self.thumbnail_fraction)
+        if icon is not None:
+            icon.draw(context, icon_x, icon_y, icon.width, icon.height,
+                    fraction=self.thumbnail_fraction)
+        else:
+            context.set_color(THUMBNAIL_PLACEHOLDER_COLOR)
+            context.rectangle(x, y, width, height)
+            context.fill()
         if make_clip_path:
             # undo the clip path
             context.restore()
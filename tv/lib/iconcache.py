@@ -28,13 +28,15 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import re
 import logging
 import collections
+from hashlib import sha1
 
 from miro import httpclient
 from miro import eventloop
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.download_utils import next_free_filename, get_file_url_path
+from miro.download_utils import get_file_url_path
 from miro.util import unicodify
 from miro.plat.utils import unicode_to_filename
 from miro import app
@@ -43,12 +45,62 @@ from miro import fileutil
 
 RUNNING_MAX = 3
 
+class IconCacheStats(object):
+    """Counts how much work IconCacheUpdater did and saved.
+
+    :attribute requests: icon fetches that IconCaches asked for
+    :attribute http_requests: HTTP requests that we actually sent
+    :attribute coalesced: fetches that shared an HTTP request that was
+        already in progress
+    :attribute reused: fetches that used an icon already downloaded for the
+        same URL during this run
+    :attribute not_modified: 304 responses
+    :attribute bytes_downloaded: bytes of icon data that we received
+    :attribute bytes_saved: bytes that we didn't need to download or store
+        because of the above
+    """
+    def __init__(self):
+        self.requests = 0
+        self.http_requests = 0
+        self.coalesced = 0
+        self.reused = 0
+        self.not_modified = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+
+    def __str__(self):
+        return ('%d requests (%d HTTP, %d coalesced, %d reused, '
+                '%d not modified), %d bytes downloaded, %d bytes saved' %
+                (self.requests, self.http_requests, self.coalesced,
+                 self.reused, self.not_modified, self.bytes_downloaded,
+                 self.bytes_saved))
+
 class IconCacheUpdater:
+    """Schedules icon downloads for IconCache objects.
+
+    We run up to RUNNING_MAX IconCache updates at once.  Waiting updates run
+    in this order: vital ones (feeds and guides), ones for items that are
+    visible in the frontend, then everything else.
+
+    Many items often share the same icon URL.  Fetches for the same URL
+    share one HTTP request, and once a URL is fetched, IconCaches requesting
+    it later in the run use the file that we already have.
+    """
     def __init__(self):
-        self.idle = collections.deque()
-        self.vital = collections.deque()
+        # These map IconCache ids to IconCaches waiting for an update, in
+        # the order that they were requested.
+        self.idle = collections.OrderedDict()
+        self.visible = collections.OrderedDict()
+        self.vital = collections.OrderedDict()
         self.running_count = 0
         self.in_shutdown = False
+        # maps (url, etag, modified) to (callback, errback) lists for HTTP
+        # requests in progress
+        self.in_progress = {}
+        # maps urls to (filename, etag, modified) tuples for icons that we
+        # fetched during this run
+        self.fetched_urls = {}
+        self.stats = IconCacheStats()
 
     def request_update(self, item, is_vital=False):
         if is_vital:
@@ -59,39 +111,151 @@ class IconCacheUpdater:
         if self.running_count < RUNNING_MAX:
             eventloop.add_idle(item.request_icon, "Icon Request")
             self.running_count += 1
-        else:
-            if is_vital:
-                self.vital.append(item)
-            else:
-                self.idle.append(item)
+        elif is_vital:
+            self.idle.pop(item.id, None)
+            self.visible.pop(item.id, None)
+            self.vital[item.id] = item
+        elif item.id not in self.vital and item.id not in self.visible:
+            self.idle[item.id] = item
 
     def update_finished(self):
         if self.in_shutdown:
             self.running_count -= 1
             return
 
-        if len(self.vital) > 0:
-            item = self.vital.popleft()
-        elif len(self.idle) > 0:
-            item = self.idle.popleft()
+        for queue in (self.vital, self.visible, self.idle):
+            if queue:
+                item = queue.popitem(last=False)[1]
+                break
         else:
             self.running_count -= 1
             return
 
         eventloop.add_idle(item.request_icon, "Icon Request")
 
+    def prioritize(self, icon_cache_ids):
+        """Update the IconCaches for icons that the user can see first.
+
+        This replaces the previous set of visible icons.
+        """
+        icon_cache_ids = set(icon_cache_ids)
+        for id_ in self.visible.keys():
+            if id_ not in icon_cache_ids:
+                self.idle[id_] = self.visible.pop(id_)
+        for id_ in icon_cache_ids:
+            if id_ in self.idle:
+                self.visible[id_] = self.idle.pop(id_)
+
+    def fetch(self, url, callback, errback, etag=None, modified=None):
+        """Fetch an icon.
+
+        If there's already a request in progress for the same url and
+        headers, we wait for it rather than making a new one.
+
+        :returns: True if we started a new HTTP request
+        """
+        self.stats.requests += 1
+        key = (url, etag, modified)
+        if key in self.in_progress:
+            self.in_progress[key].append((callback, errback))
+            self.stats.coalesced += 1
+            return False
+        self.in_progress[key] = [(callback, errback)]
+        self.stats.http_requests += 1
+        httpclient.grab_url(url,
+                            lambda info: self._fetch_callback(key, info),
+                            lambda error: self._fetch_errback(key, error),
+                            etag=etag, modified=modified)
+        return True
+
+    def _fetch_callback(self, key, info):
+        waiters = self.in_progress.pop(key)
+        if info.get('status') == 304:
+            self.stats.not_modified += 1
+        elif info.get('body'):
+            # IconCaches that shared this request count the bytes that they
+            # saved when they find the data already stored.
+            self.stats.bytes_downloaded += len(info['body'])
+        for callback, errback in waiters:
+            try:
+                callback(info)
+            except StandardError:
+                logging.exception("Error in icon cache callback")
+
+    def _fetch_errback(self, key, error):
+        for callback, errback in self.in_progress.pop(key):
+            try:
+                errback(error)
+            except StandardError:
+                logging.exception("Error in icon cache errback")
+
+    def record_fetched(self, url, filename, etag, modified):
+        """Remember the file for an icon that we got during this run."""
+        self.fetched_urls[url] = (filename, etag, modified)
+
+    def get_fetched(self, url):
+        """Get the (filename, etag, modified) for an icon that we got during
+        this run.
+
+        :returns: the tuple, or None if we haven't got the icon or its file
+        is gone
+        """
+        try:
+            filename, etag, modified = self.fetched_urls[url]
+        except KeyError:
+            return None
+        if not fileutil.access(filename, os.R_OK):
+            del self.fetched_urls[url]
+            return None
+        return (filename, etag, modified)
+
     @eventloop.as_idle
     def clear_vital(self):
-        self.vital = collections.deque()
+        self.vital = collections.OrderedDict()
 
     @eventloop.as_idle
     def shutdown(self):
+        logging.info("icon cache: %s", self.stats)
         self.in_shutdown = True
 
 # FIXME - should create an IconCacheUpdater at startup, NOT at
 # module import time.
 icon_cache_updater = IconCacheUpdater()
 
+_extension_re = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+
+def store_icon_data(data, suggested_filename):
+    """Save icon data in the icon cache directory.
+
+    Files are named after a hash of their contents, so an icon that's
+    shared by many feeds or items is only stored once.
+
+    :param data: icon data
+    :param suggested_filename: filename from the HTTP response.  We use its
+        extension.
+    :returns: (filename, already_stored) tuple
+    """
+    cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+    try:
+        fileutil.makedirs(cachedir)
+    except OSError:
+        pass
+    extension = os.path.splitext(suggested_filename or '')[1]
+    if not _extension_re.match(extension):
+        extension = ''
+    filename = os.path.join(cachedir, 'icon-%s%s' % (sha1(data).hexdigest(),
+                                                     str(extension)))
+    if fileutil.exists(filename):
+        return filename, True
+    tmp_filename = filename + '.part'
+    output = fileutil.open_file(tmp_filename, 'wb')
+    try:
+        output.write(data)
+    finally:
+        output.close()
+    fileutil.rename(tmp_filename, filename)
+    return filename, False
+
 class IconCache(DDBObject):
     def setup_new(self, dbItem):
         self.etag = None
@@ -101,6 +265,7 @@ class IconCache(DDBObject):
 
         self.updating = False
         self.needsUpdate = False
+        self.holding_slot = False
         self.dbItem = dbItem
         self.removed = False
 
@@ -143,16 +308,32 @@ class IconCache(DDBObject):
         self.icon_changed()
 
     def remove_file(self, filename):
+        # IconCaches with the same icon data share a file.  Only remove it
+        # if no other IconCache uses it.
+        others = IconCache.select(['id'], 'filename=? AND id != ?',
+                                  (filename, self.id))
+        if list(others):
+            return
         try:
             fileutil.remove(filename)
         except OSError:
             pass
 
+    def update_finished(self):
+        """Let the IconCacheUpdater run another update.
+
+        We give up our slot as soon as we're waiting on a request started
+        by another IconCache, so this is a no-op after the first call.
+        """
+        if self.holding_slot:
+            self.holding_slot = False
+            icon_cache_updater.update_finished()
+
     def error_callback(self, url, error=None):
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            icon_cache_updater.update_finished()
+            self.update_finished()
             return
 
         # Don't clear the cache on an error.
@@ -161,119 +342,99 @@ class IconCache(DDBObject):
             self.etag = None
             self.modified = None
             self.icon_changed()
+        self.finish_update()
+
+    def finish_update(self):
         self.updating = False
         if self.needsUpdate:
             self.needsUpdate = False
             self.request_update(True)
-        icon_cache_updater.update_finished()
+        self.update_finished()
 
-    def update_icon_cache(self, url, info):
+    def update_icon_cache(self, url, info, cached_copy=None):
+        """Handle the response to our icon request.
+
+        :param url: url we requested
+        :param info: response info from grab_url()
+        :param cached_copy: (filename, etag, modified) tuple for the copy of
+            the icon that our etag/modified headers came from
+        """
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            icon_cache_updater.update_finished()
+            self.update_finished()
             return
 
-        needs_save = False
-        needsChange = False
-
         if info == None or (info['status'] != 304 and info['status'] != 200):
             self.error_callback(url, "bad response")
             return
         try:
-            # Our cache is good.  Hooray!
             if info['status'] == 304:
+                if cached_copy is not None:
+                    # the copy we already have is still good
+                    filename, etag, modified = cached_copy
+                    icon_cache_updater.stats.bytes_saved += \
+                            self._file_size(filename)
+                    self.set_icon_file(url, filename, etag, modified)
+                # Our cache is good.  Hooray!
                 return
 
-            needsChange = True
-
-            # We have to update it, and if we can't write to the file, we
-            # should pick a new filename.
-            if ((self.filename and
-                 not fileutil.access(self.filename, os.R_OK | os.W_OK))):
-                self.filename = None
-
-            cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
-            try:
-                fileutil.makedirs(cachedir)
-            except OSError:
-                pass
-
-            try:
-                # Write to a temp file.
-                if self.filename:
-                    tmp_filename = self.filename + ".part"
-                else:
-                    tmp_filename = os.path.join(cachedir, info["filename"]) + ".part"
-                tmp_filename, output = next_free_filename(tmp_filename)
-                output.write(info["body"])
-                output.close()
-            except IOError:
-                self.remove_file(tmp_filename)
-                return
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#1, candidate = %r', tmp_filename)
-                return
-
-            filename = unicode(info["filename"])
-            filename = unicode_to_filename(filename, cachedir)
-            filename = os.path.join(cachedir, filename)
-            needs_save = True
             try:
-                filename, fp = next_free_filename(filename)
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#2, candidate = %r', filename)
-                return
-
-            if self.filename:
-                filename = self.filename
-                self.filename = None
-                self.remove_file(filename)
-
-            # we need to move the file here--so we close the file
-            # pointer and then move the file.
-            fp.close()
-            try:
-                self.remove_file(filename)
-                fileutil.rename(tmp_filename, filename)
+                filename, already_stored = store_icon_data(info["body"],
+                                                           info["filename"])
             except (IOError, OSError):
-                logging.exception("iconcache: fileutil.move failed")
-                filename = None
-
-            self.filename = filename
-
-            etag = unicodify(info.get("etag"))
-            modified = unicodify(info.get("modified"))
-
-            if self.etag != etag:
-                needs_save = True
-                self.etag = etag
-            if self.modified != modified:
-                needs_save = True
-                self.modified = modified
-            if self.url != url:
-                needs_save = True
-                self.url = url
+                logging.exception("iconcache: error storing icon data")
+                return
+            if already_stored:
+                icon_cache_updater.stats.bytes_saved += len(info["body"])
+            self.set_icon_file(url, filename, unicodify(info.get("etag")),
+                               unicodify(info.get("modified")))
         finally:
-            if needsChange:
-                self.icon_changed(needs_save=needs_save)
-            self.updating = False
-            if self.needsUpdate:
-                self.needsUpdate = False
-                self.request_update(True)
-            icon_cache_updater.update_finished()
+            self.finish_update()
+
+    def set_icon_file(self, url, filename, etag, modified):
+        """Start using a new icon file."""
+        icon_cache_updater.record_fetched(url, filename, etag, modified)
+        old_filename = self.filename
+        self.filename = filename
+        self.etag = etag
+        self.modified = modified
+        self.url = url
+        if old_filename and old_filename != filename:
+            self.remove_file(old_filename)
+        self.icon_changed()
+
+    def _file_size(self, filename):
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def _find_cached_copy(self, url):
+        """Find a copy of the icon for url that another IconCache has.
+
+        :returns: (filename, etag, modified) tuple or None
+        """
+        rows = IconCache.select(['filename', 'etag', 'modified'],
+                                'url=? AND filename IS NOT NULL AND '
+                                '(etag IS NOT NULL OR modified IS NOT NULL)',
+                                (url,))
+        for filename, etag, modified in rows:
+            if fileutil.access(filename, os.R_OK):
+                return (filename, etag, modified)
+        return None
 
     def request_icon(self):
+        # IconCacheUpdater gives us a slot before calling this
+        self.holding_slot = True
         if self.removed:
-            icon_cache_updater.update_finished()
+            self.update_finished()
             return
 
         self.dbItem.confirm_db_thread()
         if self.updating:
             self.needsUpdate = True
-            icon_cache_updater.update_finished()
+            self.update_finished()
             return
 
         if hasattr(self.dbItem, "get_thumbnail_url"):
@@ -284,7 +445,7 @@ class IconCache(DDBObject):
         # Only verify each icon once per run unless the url changes
         if (url == self.url and self.filename
                 and fileutil.access(self.filename, os.R_OK)):
-            icon_cache_updater.update_finished()
+            self.update_finished()
             return
 
         self.updating = True
@@ -294,9 +455,31 @@ class IconCache(DDBObject):
             self.error_callback(url)
             return
 
-        # Last try, get the icon from HTTP.
-        httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+        # If we already got this icon for another IconCache, use that file.
+        fetched = icon_cache_updater.get_fetched(url)
+        if fetched is not None:
+            icon_cache_updater.stats.requests += 1
+            icon_cache_updater.stats.reused += 1
+            icon_cache_updater.stats.bytes_saved += \
+                    self._file_size(fetched[0])
+            self.set_icon_file(url, *fetched)
+            self.finish_update()
+            return
+
+        # Last try, get the icon from HTTP.  If another IconCache has a copy
+        # from a previous run, ask the server if it's still good.
+        cached_copy = self._find_cached_copy(url)
+        if cached_copy is not None:
+            etag, modified = cached_copy[1:]
+        else:
+            etag = modified = None
+        started = icon_cache_updater.fetch(url,
+                lambda info: self.update_icon_cache(url, info, cached_copy),
+                lambda error: self.error_callback(url, error),
+                etag=etag, modified=modified)
+        if not started:
+            # we're waiting on another IconCache's request
+            self.update_finished()
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
@@ -309,6 +492,7 @@ class IconCache(DDBObject):
         self.removed = False
         self.updating = False
         self.needsUpdate = False
+        self.holding_slot = False
 
     def is_valid(self):
         self.dbItem.confirm_db_thread()
@@ -566,11 +566,18 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         """Called when a playlist gets reordered."""
         Item.change_tracker.playlists_changed = True
 
-    def download_stats_changed(self):
-        Item.change_tracker.dlstats_changed = True
+    def download_stats_changed(self, stats_only=False):
+        """Called when our downloader's status changes.
+
+        :param stats_only: True if only the transfer stats (rate, eta, etc.)
+            changed.  These aren't saved to disk right away, so they can't
+            change our views or any item lists in the frontend.
+        """
+        if not stats_only:
+            Item.change_tracker.dlstats_changed = True
         # TODO: I don't think we need the signal_change() call here once we
         # finish replacing the ViewTracker code.
-        self.signal_change(needs_save=False)
+        self.signal_change(needs_save=False, can_change_views=not stats_only)
 
     @classmethod
     def auto_pending_view(cls):
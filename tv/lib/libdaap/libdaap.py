@@ -33,8 +33,10 @@ import errno
 import os
 import sys
 import itertools
+import select
 import socket
 import random
+import time
 import traceback
 # XXX merged into urllib.urlparse in Python 3
 import urlparse
@@ -42,8 +44,10 @@ import urlparse
 import BaseHTTPServer
 import SocketServer
 import threading
+import Queue
 import httplib
 import gzip
+from collections import OrderedDict
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -55,16 +59,31 @@ MAX_SESSION = 2147483647
 
 import mdns
 from const import *
-from subr import (encode_response, decode_response, split_url_path, atoi,
-                  atol, StreamObj, ChunkedStreamObj, find_daap_tag,
-                  find_daap_listitems)
+from subr import (encode_response, encode_tags, decode_response,
+                  split_url_path, atoi, atol, StreamObj, ChunkedStreamObj,
+                  EncodedList, find_daap_tag, find_daap_listitems)
 
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
+DAAP_TIMEOUT_CHECK_INTERVAL = 60    # how often we look for timed out sessions
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
 
+# Worker threads that handle requests.  /update requests block until
+# something changes, so they get a thread of their own instead.
+DAAP_WORKER_THREADS = 4
+# How long a worker waits on a client that stops partway through sending a
+# request or reading our reply (in seconds).
+DAAP_REQUEST_TIMEOUT = 60
+# Open connections we allow for each session: a client uses a control
+# connection, one or more for streaming and one for its heartbeat.
+DAAP_CONNECTIONS_PER_SESSION = 4
+
+# How many different meta lists we keep encoded item records for.  Clients
+# tend to ask for the same handful of lists over and over.
+ITEM_RECORD_META_SETS = 4
+
 # !!! No user servicable parts below. !!!
 
 VERSION = '0.1'
@@ -102,17 +121,372 @@ DEFAULT_DAAP_PLAYLIST_META = ('dmap.itemid,dmap.itemname,dmap.persistentid,' +
 
 class SessionObject(object):
     # Container object for a daap session.  Basically a heartbeat timeout
-    # timer object and a generation counter so we can impose some ordering
-    # on the requests which come in.
-    pass
+    # and a generation counter so we can impose some ordering on the
+    # requests which come in.  We also count the bytes of media files
+    # streamed to the session.
+    bytes_sent = 0
+
+def make_socket_pair():
+    """Make a pair of connected sockets.
+
+    socket.socketpair() doesn't exist on Windows, so fall back to
+    connecting to ourselves there.
+    """
+    try:
+        return socket.socketpair()
+    except AttributeError:
+        pass
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server, address = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+class SocketReader(object):
+    """Buffered reader for a connection's socket.
+
+    This is used as the request handler's rfile.  Like the file objects from
+    socket.makefile(), it reads ahead past the end of a request.  Unlike
+    them, it can tell us if it has, so the dispatcher can handle pipelined
+    requests without waiting on the socket.
+    """
+    def __init__(self, sock, bufsize=8192):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = ''
+
+    def has_buffered_input(self):
+        return len(self.buf) > 0
+
+    def _recv(self):
+        while True:
+            try:
+                data = self.sock.recv(self.bufsize)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.buf += data
+            return len(data) > 0
+
+    def _take(self, size):
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self.buf.find('\n', start)
+            if end >= 0:
+                end += 1
+                break
+            if size >= 0 and len(self.buf) >= size:
+                break
+            start = len(self.buf)
+            if not self._recv():
+                break
+        if end < 0:
+            end = len(self.buf)
+        if size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            if not self._recv():
+                break
+        if size < 0:
+            size = len(self.buf)
+        return self._take(size)
+
+    def close(self):
+        self.buf = ''
+
+class DaapDispatcher(object):
+    """Serves the connections for a DaapTCPServer.
+
+    A selector thread watches all the open connections.  When a request
+    comes in on one, it hands the connection to a fixed pool of worker
+    threads.  A worker handles that one request, calling into the backend as
+    needed, then gives the connection back to the selector.  Idle
+    connections don't use a thread at all.  /update requests, which block
+    until the share changes, are answered from their own threads so that
+    clients polling for updates can't use up the workers.
+
+    Media files are streamed by the selector thread itself, over a
+    non-blocking socket and using sendfile() where possible, so streaming
+    clients don't tie up the workers.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.jobs = Queue.Queue()
+        # all open connections (DaapHttpRequestHandler objects)
+        self.connections = set()
+        # connections that are ready to go back to the selector thread
+        self.returned = []
+        self.threads = []
+        self.quit = False
+        self.wakeup_r, self.wakeup_w = make_socket_pair()
+        self.wakeup_w.setblocking(0)
+
+    def start(self, worker_count):
+        thread = threading.Thread(target=self.selector_loop,
+                                  name='DAAP selector')
+        self.threads.append(thread)
+        for i in xrange(worker_count):
+            thread = threading.Thread(target=self.worker_loop,
+                                      name='DAAP worker %d' % i)
+            self.threads.append(thread)
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def started(self):
+        return bool(self.threads)
+
+    def stop(self):
+        """Stop the dispatcher and close all the connections.
+
+        We don't wait for requests that are in progress.  Their workers
+        close the connections when they finish.
+        """
+        with self.lock:
+            self.quit = True
+        for i in xrange(len(self.threads) - 1):
+            self.jobs.put(None)
+        self.wakeup()
+        if self.threads:
+            self.threads[0].join()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send('x')
+        except socket.error:
+            # Either the selector already has a wakeup pending, or we've
+            # been stopped.
+            pass
+
+    def connection_count(self):
+        with self.lock:
+            return len(self.connections)
+
+    def add_connection(self, handler):
+        with self.lock:
+            self.connections.add(handler)
+        self.return_connection(handler)
+
+    def return_connection(self, handler):
+        with self.lock:
+            quit = self.quit
+            if not quit:
+                self.returned.append(handler)
+        if quit:
+            self.close(handler)
+        else:
+            self.wakeup()
 
-class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    def close(self, handler):
+        if handler.pending_stream is not None:
+            handler.end_stream()
+        with self.lock:
+            self.connections.discard(handler)
+        try:
+            handler.finish()
+        finally:
+            self.server.shutdown_request(handler.request)
+
+    def worker_loop(self):
+        while True:
+            handler = self.jobs.get()
+            if handler is None:
+                return
+            # Don't let a client that stops in the middle of a request tie
+            # up the worker.  handle_one_request() closes the connection if
+            # this times out.
+            handler.request.settimeout(DAAP_REQUEST_TIMEOUT)
+            self.run_request(handler, handler.handle_one_request)
+
+    def run_request(self, handler, request_func):
+        """Handle a request, then close the connection or return it to the
+        selector.
+        """
+        try:
+            request_func()
+        except Exception:
+            self.server.handle_error(handler.request,
+                                     handler.client_address)
+            handler.close_connection = 1
+            handler.long_poll_pending = False
+            if handler.pending_stream is not None:
+                handler.end_stream()
+        if handler.long_poll_pending:
+            self.start_long_poll(handler)
+        elif handler.close_connection and handler.pending_stream is None:
+            self.close(handler)
+        else:
+            self.return_connection(handler)
+
+    def start_long_poll(self, handler):
+        """Answer an /update request that handle_one_request() put off.
+
+        This can take as long as the client stays connected, so it runs on
+        its own thread, like the requests did before we had a worker pool.
+        """
+        thread = threading.Thread(target=self.run_request,
+                                  args=(handler, handler.finish_long_poll),
+                                  name='DAAP update')
+        thread.daemon = True
+        thread.start()
+
+    def selector_loop(self):
+        idle = dict()        # socket -> handler
+        streaming = dict()   # socket -> handler
+        next_timeout_check = time.time() + DAAP_TIMEOUT_CHECK_INTERVAL
+        while True:
+            with self.lock:
+                if self.quit:
+                    break
+                returned = self.returned
+                self.returned = []
+            for handler in returned:
+                if handler.pending_stream is not None:
+                    handler.request.setblocking(0)
+                    streaming[handler.request] = handler
+                elif handler.has_buffered_input():
+                    # A pipelined request: no need to wait for the socket.
+                    self.jobs.put(handler)
+                else:
+                    idle[handler.request] = handler
+            now = time.time()
+            if now >= next_timeout_check:
+                self.server.expire_sessions()
+                next_timeout_check = now + DAAP_TIMEOUT_CHECK_INTERVAL
+            try:
+                r, w, x = select.select([self.wakeup_r] + idle.keys(),
+                                        streaming.keys(), [],
+                                        max(next_timeout_check - now, 0))
+            except select.error, (err, errstring):
+                if err == errno.EINTR:
+                    continue
+                raise
+            for sock in r:
+                if sock is self.wakeup_r:
+                    self.wakeup_r.recv(4096)
+                else:
+                    self.jobs.put(idle.pop(sock))
+            for sock in w:
+                handler = streaming[sock]
+                try:
+                    finished = handler.continue_stream()
+                except (socket.error, IOError, OSError):
+                    # Remote guy cut us off in the middle of the stream.
+                    del streaming[sock]
+                    self.close(handler)
+                    continue
+                if finished:
+                    del streaming[sock]
+                    sock.setblocking(1)
+                    handler.end_stream()
+                    if handler.close_connection:
+                        self.close(handler)
+                    elif handler.has_buffered_input():
+                        self.jobs.put(handler)
+                    else:
+                        idle[sock] = handler
+        for handler in idle.values() + streaming.values():
+            self.close(handler)
+
+class ItemRecordCache(object):
+    """Cache of encoded item listing records.
+
+    Encoding an item's 'mlit' record is by far the most expensive part of
+    an item list reply, and most items don't change between requests.  We
+    keep the encoded records around, keyed by the meta list the client
+    asked for and the item id.  A record gets re-encoded when the item's
+    revision changes.
+
+    Any number of request threads can use the cache at once.
+    """
+    def __init__(self, max_meta_sets=ITEM_RECORD_META_SETS):
+        self.max_meta_sets = max_meta_sets
+        self.lock = threading.Lock()
+        # maps meta list tuples to dicts mapping item ids to
+        # (revision, record) tuples.  Ordered by last use.
+        self.meta_sets = OrderedDict()
+
+    def _records_for_meta(self, meta_list):
+        key = tuple(meta_list)
+        with self.lock:
+            try:
+                records = self.meta_sets.pop(key)
+            except KeyError:
+                records = dict()
+                if len(self.meta_sets) >= self.max_meta_sets:
+                    self.meta_sets.popitem(last=False)
+            self.meta_sets[key] = records
+            return records
+
+    def forget(self, item_ids):
+        """Drop the records for items that have been deleted."""
+        with self.lock:
+            record_dicts = self.meta_sets.values()
+        for records in record_dicts:
+            for item_id in item_ids:
+                records.pop(item_id, None)
+
+    def encode_items(self, items, meta_list):
+        """Get the encoded records for a list of items.
+
+        :param items: list of (item id, item dict) tuples for valid items
+        :param meta_list: list of meta names the client asked for
+        :returns: list of encoded 'mlit' records
+        """
+        records = self._records_for_meta(meta_list)
+        fields = []
+        for m in meta_list:
+            try:
+                fields.append((m, dmap_consts_rmap[m]))
+            except KeyError:
+                continue
+        encoded = []
+        for item_id, itemprop in items:
+            revision = itemprop['revision']
+            try:
+                cached_revision, record = records[item_id]
+            except KeyError:
+                cached_revision = record = None
+            if record is None or cached_revision != revision:
+                record = self.encode_item(itemprop, fields)
+                records[item_id] = (revision, record)
+            encoded.append(record)
+        return encoded
+
+    def encode_item(self, itemprop, fields):
+        # NB: mikd must be the first guy in the listing.
+        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
+        # it doesn't work!
+        # item kind - seems OK to hardcode this.
+        item = [('mikd', DAAP_ITEMKIND_AUDIO)]
+        for m, code in fields:
+            value = itemprop.get(m)
+            if value is not None:
+                item.append((code, value))
+        return encode_tags([('mlit', item)])    # Listing item
+
+class DaapTCPServer(SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
     # Use robust=True (default) in make_daap_server() and it will pick 
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
-    daemon_threads = True
 
     def __init__(self, server_address, RequestHandlerClass,
                  bind_and_activate=True):
@@ -123,6 +497,9 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         self.session_lock = threading.Lock()
         self.debug = False
         self.log_message_callback = None
+        self.item_record_cache = ItemRecordCache()
+        self.dispatcher = DaapDispatcher(self)
+        self.set_maxconn(DAAP_MAXCONN)
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
@@ -143,8 +520,43 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
     def set_maxconn(self, maxconn):
         self.maxconn = maxconn
+        self.max_connections = maxconn * DAAP_CONNECTIONS_PER_SESSION
         self.activeconn = dict()
 
+    def process_request(self, request, client_address):
+        # Called for each new connection.  Rather than starting a thread
+        # for it, let our dispatcher take care of it.
+        if self.dispatcher.connection_count() >= self.max_connections:
+            if self.log_message_callback:
+                self.log_message_callback(
+                    'daap server: too many connections, dropping %s',
+                    client_address)
+            self.shutdown_request(request)
+            return
+        if not self.dispatcher.started():
+            self.dispatcher.start(DAAP_WORKER_THREADS)
+        handler = self.RequestHandlerClass(request, client_address, self)
+        self.dispatcher.add_connection(handler)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.dispatcher.stop()
+
+    def stream_progress(self, session, count):
+        with self.session_lock:
+            try:
+                self.activeconn[session].bytes_sent += count
+            except KeyError:
+                pass
+
+    def bytes_sent(self, session):
+        """Get the number of media bytes streamed to a session."""
+        with self.session_lock:
+            try:
+                return self.activeconn[session].bytes_sent
+            except KeyError:
+                return 0
+
     def daap_timeout_callback(self, s):
         self.del_session(s)
 
@@ -162,31 +574,34 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
                     break
             session_obj = SessionObject()
             self.activeconn[s] = session_obj
-            session_obj.timer = threading.Timer(DAAP_TIMEOUT,
-                                                self.daap_timeout_callback,
-                                                [s])
+            # Our dispatcher calls expire_sessions() to time out the session
+            # once this passes.
+            session_obj.expires = time.time() + DAAP_TIMEOUT
             session_obj.counter = itertools.count()
             current_thread = threading.current_thread()
             current_thread.generation = session_obj.counter.next()
-            self.activeconn[s].timer.start()
         return s
 
     def renew_session(self, s):
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
+                session_obj = self.activeconn[s]
             except KeyError:
                 return False
-            # Pants...  we need to create a new timer object.
-            self.activeconn[s].timer = threading.Timer(DAAP_TIMEOUT,
-                                                   self.daap_timeout_callback,
-                                                   [s])
+            session_obj.expires = time.time() + DAAP_TIMEOUT
             current_thread = threading.current_thread()
-            current_thread.generation = self.activeconn[s].counter.next()
-            self.activeconn[s].timer.start()
+            current_thread.generation = session_obj.counter.next()
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    def expire_sessions(self):
+        now = time.time()
+        with self.session_lock:
+            expired = [s for s, session_obj in self.activeconn.items()
+                       if session_obj.expires < now]
+        for s in expired:
+            self.daap_timeout_callback(s)
+
     def handle_error(self, request, client_address):
         pass
 
@@ -195,7 +610,6 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         # conn.
         with self.session_lock:
             try:
-                self.activeconn[s].timer.cancel()
                 # XXX can't just delete? - need to keep a reference count 
                 # for the connection, we can have data/control connection?
                 del self.activeconn[s]
@@ -205,12 +619,69 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     server_version = 'daap.py' + ' ' + VERSION
+    # Buffer our writes, otherwise every header line goes out in its own
+    # packet and small replies get stuck behind delayed ACKs.  The buffer is
+    # flushed after each request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def __init__(self, request, client_address, server):
+        # Unlike the base class, we don't handle any requests here.  The
+        # server's DaapDispatcher calls handle_one_request() each time a
+        # request comes in on our connection, and finish() when it closes.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.pending_stream = None
+        self.stream_session = self.stream_item_id = 0
+        # Set when do_GET() puts off an /update request for
+        # DaapDispatcher.start_long_poll()
+        self.long_poll_pending = False
+        self.in_long_poll = False
+        self.setup()
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Read through our own buffer, so that we know if it's holding
+        # another request.
+        self.rfile.close()
+        self.rfile = SocketReader(self.connection)
+
+    def has_buffered_input(self):
+        # Has the client sent us another request that we've already read
+        # into our buffer?
+        return self.rfile.has_buffered_input()
+
+    def finish_long_poll(self):
+        """Reply to the /update request that do_GET() put off."""
+        self.long_poll_pending = False
+        self.in_long_poll = True
+        try:
+            self.do_GET()
+            self.wfile.flush()
+        except socket.timeout, e:
+            self.log_error("Request timed out: %r", e)
+            self.close_connection = 1
+        finally:
+            self.in_long_poll = False
 
-    # Not used at the moment.
-    # def __init__(self, request, client_address, server):
-    #    super(BaseHTTPRequestHandler, self).__init__(self, request,
-    #                                                   client_address,
-    #                                                   server)
+    def continue_stream(self):
+        """Send the next part of pending_stream.
+
+        The dispatcher calls this when our socket is writable.  Returns True
+        once the whole stream has been sent.
+        """
+        count = self.pending_stream.send_some(self.request)
+        self.server.stream_progress(self.stream_session, count)
+        return self.pending_stream.done()
+
+    def end_stream(self):
+        stream = self.pending_stream
+        self.pending_stream = None
+        stream.close()
+        count = len(stream) - stream.unread
+        self.server.backend.file_sent(self.stream_session,
+                                      self.stream_item_id, count)
     def log_message(self, format, *args):
         if self.server.log_message_callback:
             self.server.log_message_callback(format, *args)
@@ -247,8 +718,14 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            if isinstance(blob, ChunkedStreamObj):
+                # Our dispatcher streams the file once we're done with the
+                # request.
+                self.wfile.flush()
+                self.pending_stream = blob
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -381,12 +858,15 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     seekend = 0
                 rc = DAAP_PARTIAL_CONTENT
         generation = threading.current_thread().generation
+        session = self.get_session()
         file_obj, hint = self.server.backend.get_file(item_id, generation, ext,
-                                                self.get_session(),
+                                                session,
                                                 self.get_request_path,
                                                 offset=seekpos, chunk=chunk)
         if not file_obj:
             return (DAAP_FILENOTFOUND, [], extra_headers)
+        self.stream_session = session
+        self.stream_item_id = item_id
         self.log_message('daap server: streaming with filobj %s', file_obj)
         # Return a special response, the encode_reponse() will handle correctly
         return (rc, [(file_obj, hint, seekpos, seekend)], extra_headers)
@@ -395,7 +875,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # XXX
         # This API is bad because we can't get the address we used to connect
         # with the client unless we poke into semi-private data.  Ugh.
-        address, addrlength = self.rfile._sock.getsockname()
+        address, addrlength = self.connection.getsockname()
         listen_address, port = self.server.server_address
         return ('daap://%s:%d/databases/1/items/%d.%s?session-id=%d' % 
                 (address, port, itemid, enclosure, self.get_session()))
@@ -458,6 +938,18 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         except (KeyError, ValueError):
             pass
         return revision, delta
+
+    def get_index_range(self, query):
+        """Parse an index=start-end query into an inclusive (start, end)
+        tuple, or return None if the whole listing was asked for."""
+        try:
+            start, end = query['index'].split('-', 1)
+            start, end = int(start), int(end)
+        except (KeyError, ValueError):
+            return None
+        if start < 0 or end < start:
+            return None
+        return start, end
     
     # do_database_xxx(self, path, query): helper functions.  Session already
     # checked and we know we are in database/xxx.
@@ -545,49 +1037,48 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         backend_id = playlist_id
         if backend_id == 2:
             backend_id = None
-        items = self.server.backend.get_items(playlist_id=backend_id)
-        itemlist = []
-        deleted = []
         try:
             meta = query['meta']
         except KeyError:
             meta = DEFAULT_DAAP_META
         revision, delta = self.get_revision(query) 
         meta_list = [m.strip() for m in meta.split(',')]
-        # NB: mikd must be the first guy in the listing.
-        # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
-        # it doesn't work!
-        for k in items.keys():
-            itemprop = items[k]
+        # For an update, the backend only hands us the items that changed
+        # after the client's revision.
+        items = self.server.backend.get_items(playlist_id=backend_id,
+                                              since_revision=delta)
+        valid_items = []
+        deleted = []
+        cache = self.server.item_record_cache
+        for k, itemprop in items.iteritems():
             if itemprop['revision'] <= delta:
                 continue
             if itemprop['valid']:
-                item = []
-                for m in meta_list:
-                    if m in itemprop.keys():
-                        try:
-                            code = dmap_consts_rmap[m]
-                        except KeyError:
-                            continue
-                        if itemprop[m] is not None:
-                            attribute = (code, itemprop[m])
-                            item.append(attribute)
-                itemlist.append(('mlit', [       # Listing item
-                                      # item kind - seems OK to hardcode this.
-                                          ('mikd', DAAP_ITEMKIND_AUDIO),
-                                         ] + item
-                           )) 
+                valid_items.append((k, itemprop))
             else:
                 deleted.append(('miid', k))
+        cache.forget([k for code, k in deleted])
+        total = len(valid_items)
+        page = self.get_index_range(query)
+        if page:
+            # Paged request: hand out items in a stable order so that the
+            # client can walk the listing with consecutive ranges.  Deleted
+            # items only go out with the first page.
+            start, end = page
+            valid_items.sort()
+            valid_items = valid_items[start:end + 1]
+            if start:
+                deleted = []
+        itemlist = EncodedList(cache.encode_items(valid_items, meta_list))
 
         tag = 'apso' if playlist_id else 'adbs'
-        nfiles = len(itemlist)
+        nfiles = len(itemlist.blocks)
         update = 1 if delta else 0
         reply = []
         content = [                          # Container type
                         ('mstt', DAAP_OK),   # Status: OK
                         ('muty', update),    # Update type
-                        ('mtco', nfiles),    # Specified total count
+                        ('mtco', total),     # Specified total count
                         ('mrco', nfiles),    # Returned count
                         ('mlcl', itemlist)
                   ]
@@ -662,6 +1153,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             elif self.path.startswith('/activity'):
                 rcode, reply, extra_headers = self.do_activity()
             elif self.path.startswith('/update'):
+                if not self.in_long_poll:
+                    # do_update() blocks until the share changes, don't
+                    # tie up a worker thread with it.
+                    self.long_poll_pending = True
+                    return
                 rcode, reply, extra_headers = self.do_update()
             elif self.path.startswith('/databases'):
                 rcode, reply, extra_headers = self.do_databases()
@@ -901,6 +1397,7 @@ class DaapClient(object):
         db = find_daap_tag('mlit', db_list)
         self.db_id = find_daap_tag('miid', db)
         self.db_name = find_daap_tag('minm', db)
+        self.db_item_count = find_daap_tag('mimc', db)
 
     def handle_update(self, data):
         revision = find_daap_tag('musr', decode_response(data))
@@ -950,7 +1447,10 @@ class DaapClient(object):
         if deleted is not None:
             for item_id in find_daap_listitems(deleted):
                 deleted_list.append(item_id)
-        self.daap_items = itemdict, deleted_list
+        total = find_daap_tag('mtco', r)
+        if total is None:
+            total = len(itemdict)
+        self.daap_items = itemdict, deleted_list, total
 
     def sessionize(self, request, query):
         if not self.session:
@@ -1057,8 +1557,28 @@ class DaapClient(object):
     # easy way to provide the daap meta without resorting to providing
     # the raw string which includes the names requested.
     def items(self, playlist_id=None, meta=DEFAULT_DAAP_META, update=False):
+        rv = self.fetch_items(playlist_id, meta, update, [])
+        if rv is None:
+            return None
+        itemdict, deleted_list, total = rv
+        return itemdict, deleted_list
+
+    def items_page(self, start, count, playlist_id=None,
+                   meta=DEFAULT_DAAP_META, update=False):
+        """items_page(start, count) -> (itemdict, deleted_list, total)
+
+        Like items(), but only ask for count items starting at position
+        start, so that a large listing can be fetched a piece at a time.
+        total is the number of items in the whole listing.  Servers that
+        don't understand the index query send the whole listing back.
+        """
+        index = [('index', '%d-%d' % (start, start + count - 1))]
+        return self.fetch_items(playlist_id, meta, update, index)
+
+    def fetch_items(self, playlist_id, meta, update, extra_query):
         try:
-            query = self.revision_query(update) + [('meta', meta)]
+            query = (self.revision_query(update) + [('meta', meta)] +
+                     extra_query)
             if playlist_id is None:
                 self.conn.request('GET', self.sessionize(
                     '/databases/%d/items' % self.db_id,
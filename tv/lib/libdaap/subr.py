@@ -28,7 +28,9 @@
 
 # subr.py
 
+import errno
 import os
+import socket
 import stat
 import struct
 import urllib
@@ -40,6 +42,8 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+from miro import fileutil
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -59,27 +63,54 @@ fmts = {
 class StreamObj(object):
     """
        Data object for encoding HTTP responses.  Use once then dispose.
+
+       data can be a string or a list of strings.  A list is never joined
+       into one big string: it gets written out in chunks of about
+       CHUNK_SIZE bytes, and gzipped a piece at a time.
     """
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, data, content_encoding=None):
         self.content_encoding = content_encoding
+        if isinstance(data, basestring):
+            data = [data]
         if content_encoding == 'gzip':
             gzdata = StringIO()
             f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
+            for part in data:
+                f.write(part)
             f.close()
-            self.data = gzdata.getvalue()
-        else:
-            self.data = data
+            data = [gzdata.getvalue()]
+        self.parts = data
+        self.size = sum(len(part) for part in data)
 
     def __str__(self):
-        return self.data
+        return ''.join(self.parts)
 
-    # Treat this as one big block of data.
     def __iter__(self):
-        yield self.data
+        pending = []
+        pending_size = 0
+        for part in self.parts:
+            if len(part) >= self.CHUNK_SIZE:
+                # Big blocks get sliced up rather than copied around.
+                if pending:
+                    yield ''.join(pending)
+                    pending = []
+                    pending_size = 0
+                for start in xrange(0, len(part), self.CHUNK_SIZE):
+                    yield part[start:start + self.CHUNK_SIZE]
+                continue
+            pending.append(part)
+            pending_size += len(part)
+            if pending_size >= self.CHUNK_SIZE:
+                yield ''.join(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield ''.join(pending)
 
     def __len__(self):
-        return len(self.data)
+        return self.size
 
     def get_headers(self):
         headers = []
@@ -90,6 +121,18 @@ class StreamObj(object):
     def get_rangetext(self):
         return ''
 
+class EncodedList(object):
+    """
+       Already encoded contents of a DMAP_TYPE_LIST container.
+
+       Pass one of these as the value of a list code to encode_response()
+       and the blocks are spliced into the reply as they are.  This lets
+       callers cache the encoding of things like listing items.
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.size = sum(len(block) for block in blocks)
+
 class ChunkedStreamObj(object):
     """
        Streaming object.  Use once and then you must dispose.
@@ -125,6 +168,11 @@ class ChunkedStreamObj(object):
         # On error, I think we need to reposition the stream back to the start?
         self.unread = self.streamsize
         self.rangetext = rangetext
+        # State for send_some().  The file object has already been positioned
+        # at the start of the range.
+        self.offset = file_obj.tell()
+        self.pending = ''
+        self.use_sendfile = fileutil.sendfile is not None
 
     # Be careful: debug only: if you call this your object is consumed and 
     # you will need to create new one.
@@ -153,6 +201,61 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def done(self):
+        return self.unread == 0
+
+    def close(self):
+        self.file_obj.close()
+
+    def send_some(self, sock):
+        """
+           send_some(sock) -> count
+
+           Send the next part of the stream to a non-blocking socket and
+           return the number of bytes sent.  Call it each time the socket
+           becomes writable, until done() returns True.
+
+           We use sendfile() where we can, so that the file data never gets
+           copied through Python.
+        """
+        if self.use_sendfile and not self.pending:
+            try:
+                count = fileutil.sendfile(sock.fileno(),
+                                          self.file_obj.fileno(),
+                                          self.offset,
+                                          min(self.unread, self.chunksize))
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return 0
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise socket.error(e.errno, e.strerror)
+                # The file doesn't support sendfile().  Read it instead.
+                self.use_sendfile = False
+                self.file_obj.seek(self.offset, os.SEEK_SET)
+            else:
+                if count == 0:
+                    # Maybe file got truncated
+                    self.unread = 0
+                self.offset += count
+                self.unread -= count
+                return count
+        if not self.pending:
+            self.pending = self.file_obj.read(self._get_readsize())
+            if not self.pending:
+                # Maybe file got truncated
+                self.unread = 0
+                return 0
+        try:
+            count = sock.send(self.pending)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        self.pending = self.pending[count:]
+        self.offset += count
+        self.unread -= count
+        return count
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -276,6 +379,58 @@ def decode_response(reply):
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
 
+def _encode_parts(reply, parts):
+    # Append the encoding of reply to parts.  Returns the number of bytes
+    # appended.
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        fmt, size = fmts[typ]
+        if typ == DMAP_TYPE_LIST:
+            # list container - the header gets the size of the contents,
+            # which follow it.
+            if isinstance(value, EncodedList):
+                header = struct.pack('!4sI', code, value.size)
+                parts.append(header)
+                parts.extend(value.blocks)
+                total += len(header) + value.size
+            else:
+                header_index = len(parts)
+                parts.append(None)
+                size = _encode_parts(value, parts)
+                header = struct.pack('!4sI', code, size)
+                parts[header_index] = header
+                total += len(header) + size
+            continue
+        if typ == DMAP_TYPE_STRING:
+            fmt = str(len(value)) + fmt
+            size = len(value)
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            value = str(buffer(value))
+        # code (4 bytes), length (4 bytes), data (variable), network byte
+        # order
+        try:
+            data = struct.pack('!4sI' + fmt, code, size, value)
+        except struct.error:
+            # This pack did not work.  Let's ignore it
+            continue
+        parts.append(data)
+        total += len(data)
+    return total
+
+def encode_tags(reply):
+    """
+       encode_tags(reply) -> str
+
+       Like encode_response(), but returns the encoded data as a plain
+       string.  Use this to encode pieces of a reply ahead of time, then
+       pass them to encode_response() inside an EncodedList.
+    """
+    parts = []
+    _encode_parts(reply, parts)
+    return ''.join(parts)
+
 def encode_response(reply, content_encoding=None):
     """
        encode_response(reply) -> StreamObj/ChunkedStreamObj
@@ -285,41 +440,15 @@ def encode_response(reply, content_encoding=None):
        to send over the wire.
 
        DMAP_TYPE_LIST should have a value of list containing other response
-       codes.
+       codes, or an EncodedList.
 
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        parts = []
+        _encode_parts(reply, parts)
+        blob = StreamObj(parts, content_encoding=content_encoding)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
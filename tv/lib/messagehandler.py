@@ -43,7 +43,9 @@ from miro import conversions
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro import guide
+from miro import iconcache
 from miro import fileutil
 from miro import commandline
 from miro import item
@@ -563,6 +565,9 @@ class BackendMessageHandler(messages.MessageHandler):
             logging.warning("handle_mark_feed_seen: can't find feed by id %s",
                             message.id)
 
+    def handle_set_feed_visible(self, message):
+        feedupdate.set_feed_visible(message.id, message.visible)
+
     def handle_mark_item_watched(self, message):
         itemsource.get_handler(message.info).mark_watched(message.info)
 
@@ -586,6 +591,16 @@ class BackendMessageHandler(messages.MessageHandler):
         itemsource.get_handler(message.info).set_is_playing(message.info,
                 message.is_playing)
 
+    def handle_prioritize_item_icons(self, message):
+        if message.item_ids:
+            rows = item.Item.select(['icon_cache_id'], 'id IN (%s)' %
+                                    ', '.join('?' * len(message.item_ids)),
+                                    message.item_ids)
+            icon_cache_ids = [r[0] for r in rows if r[0] is not None]
+        else:
+            icon_cache_ids = []
+        iconcache.icon_cache_updater.prioritize(icon_cache_ids)
+
     def handle_rate_item(self, message):
         itemsource.get_handler(message.info).set_rating(message.info,
                 message.rating)
@@ -318,6 +318,15 @@ class MarkFeedSeen(BackendMessage):
     def __init__(self, id_):
         self.id = id_
 
+class SetFeedVisible(BackendMessage):
+    """Tell the backend if the user is looking at a feed or feed folder.
+
+    Visible feeds get updated before others.
+    """
+    def __init__(self, id_, visible):
+        self.id = id_
+        self.visible = visible
+
 class MarkItemWatched(BackendMessage):
     """Mark an item as watched.
     """
@@ -352,6 +361,14 @@ class SetItemIsPlaying(BackendMessage):
         self.info = info
         self.is_playing = is_playing
 
+class PrioritizeItemIcons(BackendMessage):
+    """Download the icons for items that are visible before other icons.
+
+    This replaces the list sent with the previous PrioritizeItemIcons.
+    """
+    def __init__(self, item_ids):
+        self.item_ids = item_ids
+
 class SetItemSubtitleEncoding(BackendMessage):
     """Mark an item as watched.
     """
@@ -466,29 +466,60 @@ class _MetadataProcessor(signals.SignalEmitter):
         pass
 
 class _TaskProcessor(_MetadataProcessor):
-    """Handle sending tasks to the worker process.  """
+    """Handle sending tasks to the worker process.
 
-    def __init__(self, source_name, limit):
+    Tasks get combined into a single batch task when we send them.  The
+    worker process sends the results back in chunks.
+
+    Signals (in addition to the _MetadataProcessor ones):
+
+    - chunk-complete(count) -- we finished processing a chunk of results.
+      count is the number of results in the chunk.
+    """
+
+    def __init__(self, source_name, limit, batch_class):
         _MetadataProcessor.__init__(self, source_name)
+        self.create_signal('chunk-complete')
         self.limit = limit
+        self.batch_class = batch_class
         # map source paths to tasks
         self._active_tasks = {}
         self._pending_tasks = {}
 
     def add_task(self, task):
-        if len(self._active_tasks) < self.limit:
-            self._send_task(task)
-        else:
-            self._pending_tasks[task.source_path] = task
+        self.add_tasks([task])
+
+    def add_tasks(self, tasks):
+        to_send = []
+        for task in tasks:
+            if len(self._active_tasks) < self.limit:
+                self._active_tasks[task.source_path] = task
+                to_send.append(task)
+            else:
+                self._pending_tasks[task.source_path] = task
+        self._send_tasks(to_send)
 
-    def _send_task(self, task):
-        self._active_tasks[task.source_path] = task
-        workerprocess.send(task, self._callback, self._errback)
+    def _send_tasks(self, tasks):
+        if tasks:
+            batch = self.batch_class.from_tasks(tasks)
+            workerprocess.send(batch, self._callback, self._errback)
+
+    def _send_pending_tasks(self):
+        to_send = []
+        while len(self._active_tasks) < self.limit and self._pending_tasks:
+            path, task = self._pending_tasks.popitem()
+            self._active_tasks[path] = task
+            to_send.append(task)
+        self._send_tasks(to_send)
 
     def remove_task_for_path(self, path):
         self.remove_tasks_for_paths([path])
 
     def remove_tasks_for_paths(self, paths):
+        self._remove_tasks_for_paths(paths)
+        self._send_pending_tasks()
+
+    def _remove_tasks_for_paths(self, paths):
         for path in paths:
             try:
                 del self._active_tasks[path]
@@ -499,19 +530,20 @@ class _TaskProcessor(_MetadataProcessor):
                 except KeyError:
                     pass
 
-        while len(self._active_tasks) < self.limit and self._pending_tasks:
-            path, task = self._pending_tasks.popitem()
-            self._send_task(task)
-
-    def _callback(self, task, result):
-        if task.source_path not in self._active_tasks:
-            logging.debug("%s done but already removed: %r", self.source_name,
-                          task.source_path)
-            return
-        logging.debug("%s done: %r", self.source_name, task.source_path)
-        self._check_for_none_values(result)
-        self.emit('task-complete', task.source_path, result)
-        self.remove_task_for_path(task.source_path)
+    def _callback(self, batch, results):
+        for source_path, result in results:
+            if isinstance(result, Exception):
+                self._handle_error(source_path, result)
+            elif source_path not in self._active_tasks:
+                logging.debug("%s done but already removed: %r",
+                              self.source_name, source_path)
+            else:
+                logging.debug("%s done: %r", self.source_name, source_path)
+                self._check_for_none_values(result)
+                self.emit('task-complete', source_path, result)
+                self._remove_tasks_for_paths([source_path])
+        self._send_pending_tasks()
+        self.emit('chunk-complete', len(results))
 
     def _check_for_none_values(self, result):
         """Check that result dicts don't have keys for None values."""
@@ -524,11 +556,19 @@ class _TaskProcessor(_MetadataProcessor):
                                            with_exception=False)
                 del result[key]
 
-    def _errback(self, task, error):
-        logging.warn("Error running %s for %r: %s", task, task.source_path,
-                     error)
-        self.emit('task-error', task.source_path, error)
-        self.remove_task_for_path(task.source_path)
+    def _errback(self, batch, error):
+        # the entire batch failed
+        for source_path in batch.source_paths:
+            if source_path in self._active_tasks:
+                self._handle_error(source_path, error)
+        self._send_pending_tasks()
+        self.emit('chunk-complete', len(batch.source_paths))
+
+    def _handle_error(self, source_path, error):
+        logging.warn("Error running %s for %r: %s", self.source_name,
+                     source_path, error)
+        self.emit('task-error', source_path, error)
+        self._remove_tasks_for_paths([source_path])
 
 class _EchonestQueue(object):
     """Queue for echonest tasks.
@@ -1088,6 +1128,11 @@ class MetadataManagerBase(signals.SignalEmitter):
     # mean more responsiveness, longer times allow us to bulk update many
     # items at once.
     UPDATE_INTERVAL = 1.0
+    # If we get a chunk of at least this many results from the worker
+    # process, process them right away rather than waiting for
+    # UPDATE_INTERVAL.  The chunk already coalesced the results, so this
+    # updates them in one transaction without adding delay.
+    CHUNK_UPDATE_SIZE = 10
     RETRY_TEMPORARY_INTERVAL = 3600
     # how often to re-try net lookups that have failed
     NET_LOOKUP_RETRY_INTERVAL = 60 * 60 * 24 * 7 # 1 week
@@ -1103,11 +1148,15 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.cover_art_dir = cover_art_dir
         self.screenshot_dir = screenshot_dir
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
-        self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
-        self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
+        self.mutagen_processor = _TaskProcessor(u'mutagen', 100,
+                                                workerprocess.MutagenBatchTask)
+        self.moviedata_processor = _TaskProcessor(u'movie-data', 100,
+                workerprocess.MovieDataProgramBatchTask)
         self.echonest_processor = _EchonestProcessor(
             5, self.echonest_cover_art_dir)
-        self.pending_mutagen_tasks = []
+        # map _TaskProcessors to tasks that we're holding until the bulk
+        # add finishes
+        self.pending_tasks = collections.defaultdict(list)
         self.bulk_add_count = 0
         self.metadata_processors = [
             self.mutagen_processor,
@@ -1117,6 +1166,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         for processor in self.metadata_processors:
             processor.connect("task-complete", self._on_task_complete)
             processor.connect("task-error", self._on_task_error)
+        for processor in (self.mutagen_processor, self.moviedata_processor):
+            processor.connect("chunk-complete", self._on_task_chunk_complete)
         self.count_tracker = self.make_count_tracker()
         self._send_net_lookup_counts_caller = eventloop.DelayedFunctionCaller(
             self._send_net_lookup_counts)
@@ -1198,9 +1249,10 @@ class MetadataManagerBase(signals.SignalEmitter):
     def bulk_add(self):
         """Context manager to use when adding lots of files
 
-        While this context manager is active, we will delay calling mutagen.
-        bulk_add() contexts can be nested, we will delay processing metadata
-        until the last one finishes.
+        While this context manager is active, we will delay sending mutagen
+        and movie data tasks, then send them all in one batch.  bulk_add()
+        contexts can be nested, we will delay processing metadata until the
+        last one finishes.
 
         Example:
 
@@ -1211,19 +1263,28 @@ class MetadataManagerBase(signals.SignalEmitter):
         """
         # initialize context
         self.bulk_add_count += 1
-        yield
-        # cleanup context
-        self.bulk_add_count -= 1
+        try:
+            yield
+        finally:
+            # cleanup context
+            self.bulk_add_count -= 1
         if not self.in_bulk_add():
-            self._send_pending_mutagen_tasks()
+            self._send_pending_tasks()
 
     def in_bulk_add(self):
         return self.bulk_add_count != 0
 
-    def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
-        self.pending_mutagen_tasks = []
+    def _send_pending_tasks(self):
+        pending_tasks = self.pending_tasks
+        self.pending_tasks = collections.defaultdict(list)
+        for processor, tasks in pending_tasks.items():
+            processor.add_tasks(tasks)
+
+    def _add_task(self, processor, task):
+        if not self.in_bulk_add():
+            processor.add_task(task)
+        else:
+            self.pending_tasks[processor].append(task)
 
     def _translate_path(self, path):
         """Translate a path value from the db to a filesystem path.
@@ -1613,17 +1674,14 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.check_image_directories()
         path = self._translate_path(path)
         task = workerprocess.MutagenTask(path, self.cover_art_dir)
-        if not self.in_bulk_add():
-            self.mutagen_processor.add_task(task)
-        else:
-            self.pending_mutagen_tasks.append(task)
+        self._add_task(self.mutagen_processor, task)
 
     def _run_movie_data(self, path):
         """Run the movie data program on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
         task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
-        self.moviedata_processor.add_task(task)
+        self._add_task(self.moviedata_processor, task)
 
     def _run_echonest(self, path, echonest_id=None):
         """Run echonest and other internet queries on a path."""
@@ -1659,6 +1717,10 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.metadata_errors.append((processor, path, error))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
+    def _on_task_chunk_complete(self, processor, count):
+        if count >= self.CHUNK_UPDATE_SIZE:
+            self._run_update_caller.call_now()
+
     def _get_metadata_from_filename(self, path):
         """Get metadata that we know from a filename alone."""
         return {
@@ -1678,8 +1740,11 @@ class MetadataManagerBase(signals.SignalEmitter):
         new_metadata_copy = self.new_metadata
         app.bulk_sql_manager.start()
         try:
-            self._process_metadata_finished()
-            self._process_metadata_errors()
+            # use bulk_add() so that the tasks for the next processors get
+            # sent in a single batch
+            with self.bulk_add():
+                self._process_metadata_finished()
+                self._process_metadata_errors()
             self.emit('new-metadata', self.new_metadata)
         finally:
             self._reset_new_metadata()
@@ -27,12 +27,107 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import itertools
+import logging
 import os.path
 
 from miro import download_utils
 from miro import fileutil
+from miro import subprocessmanager
 from miro.plat.utils import run_media_metadata_extractor
 
+# How long to wait for the extractor process to handle a file before killing
+# it.  This should be less than the time the main process waits for a movie
+# data task before it decides the whole worker process is hung.
+EXTRACTOR_TIMEOUT = 60
+
+class ExtractMovieData(subprocessmanager.SubprocessMessage):
+    """Ask the extractor process to handle a file."""
+    def __init__(self, request_id, source_path, screenshot):
+        self.request_id = request_id
+        self.source_path = source_path
+        self.screenshot = screenshot
+
+class MovieDataExtracted(subprocessmanager.SubprocessResponse):
+    """Result from the extractor process.
+
+    result is the return value of run_media_metadata_extractor() or the
+    exception it raised.
+    """
+    def __init__(self, request_id, result):
+        self.request_id = request_id
+        self.result = result
+
+class MovieDataExtractorHandler(subprocessmanager.SubprocessHandler):
+    """Handles ExtractMovieData messages inside the extractor process."""
+
+    def handle_extract_movie_data(self, msg):
+        try:
+            result = run_media_metadata_extractor(msg.source_path,
+                                                  msg.screenshot)
+        except StandardError, e:
+            result = e
+        MovieDataExtracted(msg.request_id, result).send_to_main_process()
+
+class MovieDataExtractor(object):
+    """Runs the movie data extractor in a long-lived process.
+
+    Starting up the extractor (importing gstreamer/QTKit and friends) is
+    much more expensive than handling a single file, so we keep a process
+    around and send it files one at a time.  Running it in a separate process
+    also means that a file that hangs or crashes the extractor only fails
+    that file, rather than taking down the process that called us.
+    """
+
+    def __init__(self, timeout=EXTRACTOR_TIMEOUT):
+        self.timeout = timeout
+        self.process = subprocessmanager.SynchronousSubprocess(
+            MovieDataExtractorHandler)
+        self.request_counter = itertools.count()
+
+    def run(self, source_path, screenshot):
+        """Extract movie data for a file.
+
+        This method starts the extractor process if it isn't running (or it
+        was killed after an earlier file).
+
+        :returns: the result of run_media_metadata_extractor()
+        :raises SubprocessTimeoutError: the extractor didn't finish in time
+        :raises SubprocessQuitError: the extractor crashed
+        """
+        self.process.start()
+        request_id = self.request_counter.next()
+        self.process.send_message(ExtractMovieData(request_id, source_path,
+                                                   screenshot))
+        while True:
+            response = self.process.wait_for_response(self.timeout)
+            if not isinstance(response, MovieDataExtracted):
+                logging.warn("MovieDataExtractor: unexpected response: %s",
+                             response)
+            elif response.request_id == request_id:
+                break
+        if isinstance(response.result, Exception):
+            raise response.result
+        return response.result
+
+    def shutdown(self):
+        self.process.shutdown()
+
+_extractor = None
+
+def _get_extractor():
+    global _extractor
+    if _extractor is None:
+        _extractor = MovieDataExtractor()
+    return _extractor
+
+def shutdown_extractor():
+    """Shutdown the extractor process if it's running."""
+    global _extractor
+    if _extractor is not None:
+        _extractor.shutdown()
+        _extractor = None
+
 def convert_mdp_result(source_path, screenshot, result):
     """Convert the movie data program result for the metadata manager
     """
@@ -86,7 +181,9 @@ def process_file(source_path, image_directory):
     :returns: dictionary with metadata info
     """
     screenshot, fp = _make_screenshot_path(source_path, image_directory)
-    result = run_media_metadata_extractor(source_path, screenshot)
-    # we can close the file now, since MDP has written to it
-    fp.close()
+    try:
+        result = _get_extractor().run(source_path, screenshot)
+    finally:
+        # we can close the file now, since MDP has written to it
+        fp.close()
     return convert_mdp_result(source_path, screenshot, result)
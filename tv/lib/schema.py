@@ -401,6 +401,11 @@ class IconCacheSchema (DDBObjectSchema):
         ('url', SchemaURL(noneOk=True)),
         ]
 
+    indexes = (
+        ('icon_cache_url', ('url',)),
+        ('icon_cache_filename', ('filename',)),
+    )
+
 class ItemSchema(MultiClassObjectSchema):
     table_name = 'item'
 
@@ -493,6 +498,8 @@ class ItemSchema(MultiClassObjectSchema):
             ('item_feed_downloader', ('feed_id', 'downloader_id',)),
             ('item_file_type', ('file_type',)),
             ('item_filename', ('filename',)),
+            ('item_feed_rss_id', ('feed_id', 'rss_id')),
+            ('item_feed_url_title', ('feed_id', 'url', 'entry_title')),
     )
 
 class DeviceItemSchema(ObjectSchema):
@@ -996,7 +1003,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 195
+VERSION = 199
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
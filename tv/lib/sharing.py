@@ -26,6 +26,7 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import bisect
 import errno
 import logging
 import os
@@ -79,8 +80,15 @@ DAAP_META = ('dmap.itemkind,dmap.itemid,dmap.itemname,' +
              'org.participatoryculture.miro.itemkind,' +
              'com.apple.itunes.mediakind')
 
+# Playlist item listings only need the ids, the item data comes from the
+# base playlist.
+DAAP_PLAYLIST_ITEM_META = 'dmap.itemid'
+
 DAAP_PODCAST_KEY = 'com.apple.itunes.is-podcast-playlist'
 
+# Number of items we ask for at once when fetching a share's item list
+SHARING_PAGE_SIZE = 5000
+
 supported_filetypes = filetypes.VIDEO_EXTENSIONS + filetypes.AUDIO_EXTENSIONS
 
 # Conversion factor between our local duration (10th of a second)
@@ -112,6 +120,29 @@ def inet_ntop(af, ip):
                                                                 ip))
         raise ValueError('unknown address family %d' % af)
 
+class _ShareSyncState(object):
+    """Tracks how much of a share we have in our database.
+
+    We keep this around after disconnecting so that when the user reconnects
+    we can ask the server for what changed since then rather than
+    downloading the whole share again.
+
+    Attributes:
+        revision - server revision that our database reflects, or None if we
+                   don't have a complete copy of the share
+        session - DAAP session id used to build the item paths in our
+                  database
+        address - address used to build the item paths in our database
+        item_ids - set of DAAP ids for the items in our database
+        playlist_tracker - _ClientPlaylistTracker for the share
+    """
+    def __init__(self):
+        self.revision = None
+        self.session = None
+        self.address = None
+        self.item_ids = set()
+        self.playlist_tracker = _ClientPlaylistTracker()
+
 class Share(object):
     """Backend object that tracks data for an active DAAP share."""
     _used_db_paths = set()
@@ -125,6 +156,7 @@ class Share(object):
         self.db_info = database.DBInfo(self.db)
         self.__class__._used_db_paths.add(self.db_path)
         self.tracker = None
+        self.sync_state = _ShareSyncState()
         # SharingInfo object for this share.  We use this to send updates to
         # the frontend when things change.
         self.info = None
@@ -194,7 +226,10 @@ class Share(object):
         if self.tracker is not None:
             self.tracker.client_disconnect()
             self.tracker = None
-            self.reset_database()
+            if self.sync_state.revision is None:
+                # We never finished syncing, so there's nothing we could
+                # resume from the next time we connect.
+                self.reset_database()
             if self.info:
                 self.info.is_updating = False
                 self.info.mount = False
@@ -202,8 +237,10 @@ class Share(object):
 
     def reset_database(self):
         SharingItem.delete(db_info=self.db_info)
+        mappings.SharingItemPlaylistMap(self.db.connection).clear()
         self.db.forget_all_objects()
         self.db.cache.clear_all()
+        self.sync_state = _ShareSyncState()
 
     def set_info(self, info):
         """Set the SharingInfo to use to send updates for."""
@@ -552,9 +589,27 @@ class _ClientUpdateResult(object):
         playlist_deleted_items - dictionary tracking items deleted from
                                  playlists.  Maps playlist ids to a list of
                                  item ids.
+        revision - server revision the data was fetched at
+        session - DAAP session id used to build item_paths
+        item_total - number of items the server reported for the base
+                     playlist
+        next_item_index - position of the next page of items to fetch, or
+                          None if we got all of them
+        resumed - True if this is a delta against data kept from a previous
+                  connection
+        reset - True if data kept from a previous connection should be
+                thrown away before using this result
+
+    If first_page_only is True, we only fetch the first SHARING_PAGE_SIZE
+    items.  The rest can be fetched using _ClientItemPage starting at
+    next_item_index.
     """
-    def __init__(self, client, update=False):
+    def __init__(self, client, update=False, first_page_only=False,
+                 resumed=False):
         self.update = update
+        self.first_page_only = first_page_only
+        self.resumed = resumed
+        self.reset = False
         self.items = {}
         self.item_paths = {}
         self.deleted_items = []
@@ -562,6 +617,10 @@ class _ClientUpdateResult(object):
         self.deleted_playlists = []
         self.playlist_items = {}
         self.playlist_deleted_items = {}
+        self.item_total = None
+        self.next_item_index = None
+        self.revision = client.revision
+        self.session = client.session
 
         self.fetch_from_client(client)
 
@@ -577,7 +636,7 @@ class _ClientUpdateResult(object):
                     data[key] = value.replace('\x00', '')
 
     def fetch_from_client(self, client):
-        if not self.update:
+        if not self.update or self.resumed:
             self.check_database_exists(client)
         self.fetch_playlists(client)
         self.fetch_items(client)
@@ -585,7 +644,7 @@ class _ClientUpdateResult(object):
             self.fetch_playlist_items(client, daap_id)
 
     def check_database_exists(self, client):
-        if not client.databases(update=self.update):
+        if not client.databases(update=False):
             raise IOError('Cannot get database')
 
     def fetch_playlists(self, client):
@@ -602,25 +661,59 @@ class _ClientUpdateResult(object):
                 del self.playlists[daap_id]
 
     def fetch_items(self, client):
-        self.items, self.deleted_items = client.items(
-            meta=DAAP_META,
-            update=self.update)
-        if self.items is None:
+        index = 0
+        while index is not None:
+            index = self.fetch_item_page(client, index)
+            if self.first_page_only:
+                break
+        self.next_item_index = index
+
+    def fetch_item_page(self, client, index):
+        """Fetch a page of items from the base playlist.
+
+        :returns: index of the next page, or None if this was the last one
+        """
+        page = client.items_page(index, SHARING_PAGE_SIZE, meta=DAAP_META,
+                                 update=self.update)
+        if page is None:
             raise ValueError('Cannot find items in base playlist')
+        items, deleted_items, total = page
 
-        self.strip_nuls_from_data(self.items.values())
-        for daap_id, item_data in self.items.items():
+        self.strip_nuls_from_data(items.values())
+        for daap_id, item_data in items.items():
             self.item_paths[daap_id] = client.daap_get_file_request(
                 daap_id, item_data['daap.songformat'])
+        self.items.update(items)
+        self.deleted_items.extend(deleted_items)
+        self.item_total = total
+        index += len(items)
+        if not items or index >= total:
+            return None
+        return index
 
     def fetch_playlist_items(self, client, playlist_key):
         items, deleted = client.items(playlist_id=playlist_key,
-                                      meta=DAAP_META, update=self.update)
+                                      meta=DAAP_PLAYLIST_ITEM_META,
+                                      update=self.update)
         if items is None:
             raise ValueError('Cannot find items for playlist %d' % k)
         self.playlist_items[playlist_key] = items.keys()
         self.playlist_deleted_items[playlist_key] = deleted
 
+class _ClientItemPage(_ClientUpdateResult):
+    """Stores a page of items fetched after the initial _ClientUpdateResult.
+
+    index is the position of the first item in the page.  The other
+    attributes are the same as _ClientUpdateResult, but only the item ones
+    get filled in.
+    """
+    def __init__(self, client, index, update=False):
+        self.index = index
+        _ClientUpdateResult.__init__(self, client, update=update)
+
+    def fetch_from_client(self, client):
+        self.next_item_index = self.fetch_item_page(client, self.index)
+
 class _ClientPlaylistTracker(object):
     """Tracks playlist data from the DAAP client for SharingItemTrackerImpl
 
@@ -733,9 +826,12 @@ class SharingItemTrackerImpl(object):
         self.share = share
         self.playlist_item_map = mappings.SharingItemPlaylistMap(
             share.db_info.db.connection)
-        self.current_item_ids = set()
+        # Playlist tabs get removed when we disconnect, so we start out with
+        # none even if we are resuming from an earlier connection.
         self.current_playlist_ids = set()
-        self.playlist_tracker = _ClientPlaylistTracker()
+        # position of the next page of items to fetch in runloop()
+        self.next_item_index = None
+        self.item_total = None
         self.info_cache = dict()
         self.share.update_started()
         self.start_thread()
@@ -778,8 +874,20 @@ class SharingItemTrackerImpl(object):
         return self.run(self.client_update, self.client_update_callback,
                         self.client_update_error_callback)
 
+    def run_fetch_item_pages(self):
+        # Fetch the rest of the item list.  Each page gets sent to the
+        # backend as soon as we have it, so large shares start showing items
+        # before we've downloaded all of them.
+        while self.next_item_index is not None:
+            success = self.run(self.client_fetch_item_page,
+                               self.client_item_page_callback,
+                               self.client_update_error_callback)
+            if not success:
+                return False
+        return True
+
     def runloop(self):
-        success = self.run_client_connect()
+        success = self.run_client_connect() and self.run_fetch_item_pages()
         # If server does not support update, then we short circuit since
         # the loop becomes useless.  There is nothing wait for being updated.
         logging.debug('UPDATE SUPPORTED = %s', self.client.supports_update)
@@ -870,9 +978,58 @@ class SharingItemTrackerImpl(object):
 
     def client_connect(self):
         self.make_client()
-        result = _ClientUpdateResult(self.client)
+        state = self.share.sync_state
+        result = None
+        if self.can_resume(state):
+            # Only ask for what changed since our last connection
+            self.client.old_revision = state.revision
+            result = _ClientUpdateResult(self.client, update=True,
+                                         resumed=True)
+            if not self.resume_count_matches(state, result):
+                logging.debug('%s: item count mismatch after resuming, '
+                              'fetching all items', self.thread.name)
+                result = None
+        if result is None:
+            result = _ClientUpdateResult(self.client, first_page_only=True)
+            result.reset = state.revision is not None
+        self.next_item_index = result.next_item_index
+        self.item_total = result.item_total
         return result
 
+    def can_resume(self, state):
+        """Can we sync from the data kept from our last connection?"""
+        return (state.revision is not None and
+                self.client.supports_update and
+                self.client.revision >= state.revision)
+
+    def resume_count_matches(self, state, result):
+        """Check that a delta leaves us with as many items as the server has.
+
+        If not, the server's revisions don't line up with ours anymore (for
+        example because it was restarted) and we need to fetch everything.
+        """
+        expected = self.client.db_item_count
+        if expected is None:
+            return True
+        item_ids = state.item_ids
+        count = len(item_ids)
+        count += len([i for i in result.items if i not in item_ids])
+        count -= len([i for i in set(result.deleted_items) if i in item_ids])
+        return count == expected
+
+    def client_fetch_item_page(self):
+        page = _ClientItemPage(self.client, self.next_item_index)
+        if page.item_total != self.item_total:
+            # Items got added or removed while we were walking the listing,
+            # so the positions we already fetched may have shifted.  Start
+            # over from the top.
+            logging.debug('%s: item list changed while paging, restarting',
+                          self.thread.name)
+            page = _ClientItemPage(self.client, 0)
+            self.item_total = page.item_total
+        self.next_item_index = page.next_item_index
+        return page
+
     def make_client(self):
         name = self.share.name
         host = self.share.host
@@ -898,45 +1055,111 @@ class SharingItemTrackerImpl(object):
 
     def client_update_callback(self, result):
         logging.debug('CLIENT UPDATE CALLBACK')
+        if self.client is None:
+            # We disconnected while the update was running
+            return
         self.update_sharing_items(result)
         self.update_playlists(result)
+        self.sync_finished(result)
+
+    def client_item_page_callback(self, page):
+        if self.client is None:
+            return
+        self.update_sharing_items(page)
+        if page.next_item_index is None:
+            self.sync_finished(page)
 
     def client_update_error_callback(self, unused):
         self.client_connect_update_error_callback(unused, update=True)
 
     # NB: this runs in the eventloop (backend) thread.
     def client_connect_callback(self, result):
-        # ignore deleted items for the first run
-        result.deleted_items = []
-        result.deleted_playlists = []
-        result.playlist_deleted_items = {}
+        if result.reset:
+            # The data from our last connection is no good, start fresh
+            self.share.reset_database()
+        if result.resumed:
+            self.refresh_item_paths(result)
+        else:
+            # ignore deleted items for the first run
+            result.deleted_items = []
+            result.deleted_playlists = []
+            result.playlist_deleted_items = {}
         self.update_sharing_items(result)
         self.update_playlists(result)
+        if result.next_item_index is None:
+            self.sync_finished(result)
         self.share.update_finished()
 
+    def sync_finished(self, result):
+        """Remember that our database is up to date with result's revision.
+        """
+        state = self.share.sync_state
+        state.revision = result.revision
+        state.session = result.session
+        state.address = self.address
+
+    def refresh_item_paths(self, result):
+        """Point items kept from our last connection at the new session."""
+        state = self.share.sync_state
+        if state.session == result.session and state.address == self.address:
+            return
+        self.share.db.execute("UPDATE sharing_item "
+                              "SET video_path=replace(video_path, ?, ?), "
+                              "address=?",
+                              ('session-id=%s' % state.session,
+                               'session-id=%s' % result.session,
+                               unicode(self.address)),
+                              is_update=True)
+        # Any objects that we've loaded have the old values
+        self.share.db.forget_all_objects()
+        self.share.db.cache.clear_all()
+
     def update_sharing_items(self, result):
         """Create or update SharingItems on the database.
 
+        All the changes get written in a single bulk transaction and items
+        whose data didn't change are left alone.
+
         :param new_item_data: _ClientUpdateResult
         """
-        for daap_id, item_data in result.items.items():
-            if daap_id not in self.current_item_ids:
-                self.make_sharing_item(item_data, result)
-                self.current_item_ids.add(daap_id)
-            else:
-                sharing_item = self.get_sharing_item(daap_id)
-                new_data = self.convert_raw_sharing_item(item_data, result)
-                for key, value in new_data.items():
-                    setattr(sharing_item, key, value)
-                sharing_item.signal_change()
-        for item_id in result.deleted_items:
-            try:
-                sharing_item = SharingItem.get_by_daap_id(
-                    item_id, db_info=self.share.db_info)
-            except database.ObjectNotFound:
-                logging.warn("SharingItemTrackerImpl.update_sharing_items: "
-                             "deleted item not found: %s", item_id)
-            sharing_item.remove()
+        item_ids = self.share.sync_state.item_ids
+        bulk_sql_manager = self.share.db_info.bulk_sql_manager
+        bulk_sql_manager.start()
+        try:
+            for daap_id, item_data in result.items.items():
+                if daap_id not in item_ids:
+                    self.make_sharing_item(item_data, result)
+                    item_ids.add(daap_id)
+                else:
+                    self.update_sharing_item(daap_id, item_data, result)
+            for item_id in result.deleted_items:
+                if item_id not in item_ids:
+                    # A delta can include items that were added and removed
+                    # while we weren't connected.
+                    continue
+                item_ids.remove(item_id)
+                try:
+                    sharing_item = SharingItem.get_by_daap_id(
+                        item_id, db_info=self.share.db_info)
+                except database.ObjectNotFound:
+                    logging.warn("SharingItemTrackerImpl."
+                                 "update_sharing_items: "
+                                 "deleted item not found: %s", item_id)
+                else:
+                    sharing_item.remove()
+        finally:
+            bulk_sql_manager.finish()
+
+    def update_sharing_item(self, daap_id, item_data, result):
+        sharing_item = self.get_sharing_item(daap_id)
+        new_data = self.convert_raw_sharing_item(item_data, result)
+        changed = False
+        for key, value in new_data.items():
+            if getattr(sharing_item, key) != value:
+                setattr(sharing_item, key, value)
+                changed = True
+        if changed:
+            sharing_item.signal_change()
 
     def update_playlists(self, result):
         added = []
@@ -944,15 +1167,16 @@ class SharingItemTrackerImpl(object):
         # contents.
         changed = []
         removed = []
+        playlist_tracker = self.share.sync_state.playlist_tracker
 
         old_playlist_items = {}
-        for daap_id, item_ids in self.playlist_tracker.playlist_items.items():
+        for daap_id, item_ids in playlist_tracker.playlist_items.items():
             old_playlist_items[daap_id] = item_ids.copy()
 
-        self.playlist_tracker.update(result)
+        playlist_tracker.update(result)
         # update the playlist item map
         playlist_items_changed = False
-        new_playlist_items = self.playlist_tracker.playlist_items
+        new_playlist_items = playlist_tracker.playlist_items
         for playlist_id in old_playlist_items:
             if playlist_id not in new_playlist_items:
                 self.playlist_item_map.remove_playlist(playlist_id)
@@ -963,7 +1187,7 @@ class SharingItemTrackerImpl(object):
                                                           item_ids)
                 playlist_items_changed = True
 
-        current_playlists = self.playlist_tracker.current_playlists()
+        current_playlists = playlist_tracker.current_playlists()
         # check for added/changed playlists
         for daap_id, playlist_data in current_playlists.items():
             if daap_id not in self.current_playlist_ids:
@@ -985,10 +1209,11 @@ class SharingItemTrackerImpl(object):
         message.send_to_frontend()
 
     def update_fake_playlists(self):
+        playlist_tracker = self.share.sync_state.playlist_tracker
         self.playlist_item_map.set_playlist_items(
-            u'podcast', self.playlist_tracker.items_in_podcasts())
+            u'podcast', playlist_tracker.items_in_podcasts())
         self.playlist_item_map.set_playlist_items(
-            u'playlist', self.playlist_tracker.items_in_playlists())
+            u'playlist', playlist_tracker.items_in_playlists())
 
     def client_connect_error_callback(self, unused):
         self.client_connect_update_error_callback(unused)
@@ -1048,10 +1273,17 @@ class _SharedDataSet(object):
         # condition gets signaled when changes occur.
         self.lock = threading.RLock()
         self.condition = threading.Condition(self.lock)
-        # current revision number
-        self.revision = 0
+        # current revision number.  We start at 1, since get_items() treats
+        # a since_revision of 0 as a request for every item.
+        self.revision = 1
         # map DAAP ids to dicts of item data
         self.daap_items = dict()
+        # index of daap_items by revision, so that we can find the items
+        # changed since a revision without looking at every item.
+        # item_revisions is a sorted list of the revisions in
+        # items_by_revision, which maps them to sets of DAAP ids.
+        self.item_revisions = []
+        self.items_by_revision = dict()
         # map DAAP ids to dicts of playlist data
         self.daap_playlists = dict()
         # map DAAP playlist ids to sets of items in that playlist
@@ -1165,7 +1397,7 @@ class _SharedDataSet(object):
             for item_info in added + changed:
                 self.make_daap_item(item_info)
             for item_id in removed:
-                self.daap_items[item_id] = self._deleted_item(item_id)
+                self._set_daap_item(item_id, self._deleted_item(item_id))
             self.condition.notify_all()
 
     def on_playlist_added(self, tracker, playlist_or_feed):
@@ -1269,7 +1501,32 @@ class _SharedDataSet(object):
             if isinstance(value, unicode):
                 daap_item[key] = value.encode('utf-8')
         # store the data
-        self.daap_items[item_info.id] = daap_item
+        self._set_daap_item(item_info.id, daap_item)
+
+    def _set_daap_item(self, daap_id, daap_item):
+        """Store the data for an item and update our revision index."""
+        old_item = self.daap_items.get(daap_id)
+        if old_item is not None:
+            old_revision = old_item['revision']
+            ids = self.items_by_revision[old_revision]
+            ids.discard(daap_id)
+            if not ids:
+                del self.items_by_revision[old_revision]
+                index = bisect.bisect_left(self.item_revisions, old_revision)
+                del self.item_revisions[index]
+        revision = daap_item['revision']
+        if revision not in self.items_by_revision:
+            self.items_by_revision[revision] = set()
+            bisect.insort(self.item_revisions, revision)
+        self.items_by_revision[revision].add(daap_id)
+        self.daap_items[daap_id] = daap_item
+
+    def _item_ids_changed_since(self, revision):
+        start = bisect.bisect_right(self.item_revisions, revision)
+        item_ids = set()
+        for changed_revision in self.item_revisions[start:]:
+            item_ids.update(self.items_by_revision[changed_revision])
+        return item_ids
 
     # XXX TEMPORARY: should this item be podcast?  We won't need this when
     # the item type's metadata is completely accurate and won't lie to us.
@@ -1395,8 +1652,14 @@ class _SharedDataSet(object):
         with self.lock:
             return self.daap_items[item_id]
 
-    def get_items(self, playlist_id):
+    def get_items(self, playlist_id, since_revision=0):
         with self.lock:
+            if since_revision:
+                item_ids = self._item_ids_changed_since(since_revision)
+                if playlist_id is not None:
+                    item_ids.intersection_update(
+                        self.playlist_item_map[playlist_id])
+                return dict((id_, self.daap_items[id_]) for id_ in item_ids)
             if playlist_id is None:
                 return self.daap_items.copy()
             else:
@@ -1445,6 +1708,10 @@ class SharingManagerBackend(object):
         self.transcode_lock = threading.Lock()
         self.transcode = dict()
         self.in_shutdown = False
+        # maps session ids to the number of media bytes we've streamed to
+        # them, see file_sent().
+        self.bandwidth_lock = threading.Lock()
+        self.session_bytes = dict()
 
     # Reserved for future use: you can register new sharing protocols here.
     def register_protos(self, proto):
@@ -1475,6 +1742,10 @@ class SharingManagerBackend(object):
                  offset=0, chunk=None):
         """Get a file to serve
 
+        Once the file has been streamed to the client (or the client cuts
+        the stream off), the server calls file_sent() with the number of
+        bytes that went out.
+
         :returns (fileobj, filename_hint) tuple:
         """
         # FIXME: the above docstring could realy use some more details.
@@ -1562,6 +1833,24 @@ class SharingManagerBackend(object):
                     file_obj.close()
         return file_obj, os.path.basename(path)
 
+    def file_sent(self, session, itemid, count):
+        """Account for bytes streamed to a session.
+
+        Called by the server from its network thread, so this must be quick.
+
+        :param session: session id
+        :param itemid: DAAP id of the item that was streamed
+        :param count: number of bytes sent
+        """
+        with self.bandwidth_lock:
+            self.session_bytes[session] = (self.session_bytes.get(session, 0)
+                                           + count)
+
+    def get_bytes_sent(self, session):
+        """Get the number of media bytes streamed to a session."""
+        with self.bandwidth_lock:
+            return self.session_bytes.get(session, 0)
+
     def get_playlists(self):
         """Get the current list of playlists
 
@@ -1578,7 +1867,7 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_playlists()
 
-    def get_items(self, playlist_id=None):
+    def get_items(self, playlist_id=None, since_revision=0):
         """Get the current list of items
 
         This should return a dict mapping DAAP item ids to dicts of item data.
@@ -1591,8 +1880,10 @@ class SharingManagerBackend(object):
 
         :param playlist_id: playlist to fetch items from, or None to fetch all
         items.
+        :param since_revision: if non-zero, only return items that were
+        updated after this revision.
         """
-        return self.data_set.get_items(playlist_id)
+        return self.data_set.get_items(playlist_id, since_revision)
 
     def finished_callback(self, session):
         # Like shutdown but only shuts down one of the sessions.  No need to
@@ -1604,6 +1895,11 @@ class SharingManagerBackend(object):
                 self.transcode[session].shutdown()
             except KeyError:
                 pass
+        with self.bandwidth_lock:
+            bytes_sent = self.session_bytes.pop(session, 0)
+        if bytes_sent:
+            logging.debug('sharing: session %s streamed %d bytes', session,
+                          bytes_sent)
 
     def shutdown(self):
         # Set the in_shutdown flag inside the transcode lock to ensure that
@@ -1835,6 +2131,9 @@ class SharingManager(object):
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
                             del self.thread
+                            # Stops the server's threads and breaks off
+                            # existing connections.
+                            self.server.server_close()
                             del self.server
                             self.reload_done_event.set()
                             return
@@ -1919,7 +2218,6 @@ class SharingManager(object):
         if self.sharing:
             if self.discoverable:
                 self.disable_discover()
-            # XXX: need to break off existing connections
             self.disable_sharing()
         self.backend.shutdown()
 
@@ -40,18 +40,19 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+those, we store a BLOB created by the containercodec module.  We use the
+type ``pythonrepr`` to label these columns, since older versions stored
+the python representation of the object there.  We can still read those
+values and we convert them to the new format as objects get restored.
 """
 
+import collections
 import glob
+import re
 import shutil
 import cPickle
 import itertools
 import logging
-import datetime
 import traceback
 import time
 import os
@@ -64,6 +65,7 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 
 from miro import app
+from miro import containercodec
 from miro import crashreport
 from miro import convert20database
 from miro import databaseupgrade
@@ -369,6 +371,51 @@ class SharingLiveStorageErrorHandler(LiveStorageErrorHandler):
     def handle_save_succeeded(self):
         pass
 
+class TransactionLog(object):
+    """Statements that we've run in the current transaction.
+
+    LiveStorage uses this to re-run the transaction after an error.  We
+    try to keep it compact: each SQL string is only stored once and values
+    are stored as tuples.
+
+    Attributes:
+
+    - statements -- list of (sql, values, many) tuples
+    - row_count -- number of parameter rows in statements.  A statement
+      run with executemany() counts once for each row.
+    """
+    def __init__(self):
+        self.statements = []
+        self.row_count = 0
+        self._sql_strings = {}
+
+    def __len__(self):
+        return len(self.statements)
+
+    def __iter__(self):
+        return iter(self.statements)
+
+    def append(self, sql, values, many):
+        sql = self._sql_strings.setdefault(sql, sql)
+        if many:
+            values = tuple(self._compact_values(row) for row in values)
+            self.row_count += len(values)
+        else:
+            values = self._compact_values(values)
+            self.row_count += 1
+        self.statements.append((sql, values, many))
+
+    def _compact_values(self, values):
+        if isinstance(values, list):
+            return tuple(values)
+        else:
+            return values
+
+    def clear(self):
+        self.statements = []
+        self.row_count = 0
+        self._sql_strings = {}
+
 class LiveStorage(signals.SignalEmitter):
     """Handles the storage of DDBObjects.
 
@@ -386,6 +433,35 @@ class LiveStorage(signals.SignalEmitter):
     - transaction-finished(success) -- We committed or rolled back a
     transaction
     """
+
+    # Schedule a merge of the item_fts segments after we re-index this many
+    # rows in batched mode.
+    FTS_MERGE_THRESHOLD = 1000
+
+    # How many prepared statements sqlite3 caches per connection.  The
+    # default of 100 is smaller than the number of different statements we
+    # run over and over again.
+    STATEMENT_CACHE_SIZE = 500
+
+    # Stop caching statement shapes after we see this many different SQL
+    # strings.
+    MAX_STATEMENT_SHAPES = 1000
+
+    # Commit the current transaction once the statements in it have this
+    # many rows of values.  This keeps the log that we use to re-run the
+    # transaction after an error from growing without bound during a large
+    # import.  None means never commit early.
+    TRANSACTION_LOG_LIMIT = 10000
+
+    # Used by _statement_shape() to strip the literal values out of a SQL
+    # statement.
+    _shape_substitutions = [
+        (re.compile(r"'(?:[^']|'')*'"), "'...'"),
+        (re.compile(r"\b\d+(?:\.\d+)?\b"), "N"),
+        (re.compile(r"\?(?:\s*,\s*\?)+"), "?, ..."),
+        (re.compile(r"\s+"), " "),
+    ]
+
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
                  start_in_temp_mode=False):
@@ -433,6 +509,17 @@ class LiveStorage(signals.SignalEmitter):
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
         self._query_times = {}
+        # maps statement shapes to [count, rows, total time, max time]
+        self._statement_stats = {}
+        # maps SQL strings to their shapes
+        self._statement_shapes = {}
+        # maps (table_name, id) to (obj_schema, values) for UPDATE statements
+        # that we haven't sent to SQLite yet.  values maps column names to
+        # their SQL values.
+        self._pending_updates = collections.OrderedDict()
+        # errors from queued UPDATEs that didn't match exactly one row.
+        # finish_transaction() raises these.
+        self._update_errors = []
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
@@ -442,7 +529,10 @@ class LiveStorage(signals.SignalEmitter):
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
-        self._statements_in_transaction = []
+        self._transaction_log = TransactionLog()
+        self._fts_dirty_queue = None
+        self._fts_rows_since_merge = 0
+        self._fts_merge_call = None
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -465,6 +555,7 @@ class LiveStorage(signals.SignalEmitter):
     def open_connection(self, path=None, start_in_temp_mode=False):
         if path is None:
             path = self.path
+        self._fts_dirty_queue = None
         if start_in_temp_mode:
             self._switch_to_temp_mode()
         else:
@@ -473,7 +564,8 @@ class LiveStorage(signals.SignalEmitter):
             try:
                 self.connection = sqlite3.connect(path,
                         isolation_level=None,
-                        detect_types=sqlite3.PARSE_DECLTYPES)
+                        detect_types=sqlite3.PARSE_DECLTYPES,
+                        cached_statements=self.STATEMENT_CACHE_SIZE)
             except sqlite3.DatabaseError, e:
                 logging.warn("Error opening sqlite database: %s", e)
                 action = self.error_handler.handle_open_error()
@@ -492,6 +584,30 @@ class LiveStorage(signals.SignalEmitter):
         if path != ':memory:' and not self.temp_mode:
             self._switch_to_wal_mode()
 
+    # Any code that uses our connection or cursor directly needs to see the
+    # changes from the UPDATE statements that we've queued up, so we flush
+    # them before handing either one out.
+
+    def _get_connection(self):
+        if self._pending_updates:
+            self._flush_pending_updates()
+        return self._connection
+
+    def _set_connection(self, connection):
+        self._connection = connection
+
+    connection = property(_get_connection, _set_connection)
+
+    def _get_cursor(self):
+        if self._pending_updates:
+            self._flush_pending_updates()
+        return self._cursor
+
+    def _set_cursor(self, cursor):
+        self._cursor = cursor
+
+    cursor = property(_get_cursor, _set_cursor)
+
     def _switch_to_wal_mode(self):
         """Switch to write-ahead logging mode for our connection
 
@@ -527,8 +643,10 @@ class LiveStorage(signals.SignalEmitter):
         trying to open a database file.
         """
         self.connection = sqlite3.connect(':memory:',
-                                          isolation_level=None,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=self.STATEMENT_CACHE_SIZE)
+        self._fts_dirty_queue = None
         self.temp_mode = True
         eventloop.add_timeout(300,
                               self._try_save_temp_to_disk,
@@ -601,8 +719,27 @@ class LiveStorage(signals.SignalEmitter):
 
         # copy data
         for table, sql in table_info:
-            self.cursor.execute("INSERT INTO newdb.%s SELECT * FROM main.%s" %
-                                (table, table))
+            if sql.startswith("CREATE VIRTUAL TABLE"):
+                # "SELECT *" doesn't include the docid column for fts tables,
+                # copy it explicitly so they still match up with their rows
+                self.cursor.execute("PRAGMA main.table_info(%s)" % table)
+                columns = ['docid'] + [r[1] for r in self.cursor.fetchall()]
+                column_list = ', '.join(columns)
+                self.cursor.execute("INSERT INTO newdb.%s(%s) "
+                                    "SELECT %s FROM main.%s" %
+                                    (table, column_list, column_list, table))
+            else:
+                self.cursor.execute("INSERT INTO newdb.%s "
+                                    "SELECT * FROM main.%s" % (table, table))
+
+        # copy triggers.  Do this after copying the data so they don't fire
+        # for the rows that we just copied.
+        self.cursor.execute("SELECT name, sql FROM main.sqlite_master "
+                            "WHERE type='trigger'")
+        for trigger, sql in self.cursor.fetchall():
+            sql = sql.replace("TRIGGER %s" % trigger,
+                              "TRIGGER newdb.%s" % trigger)
+            self.cursor.execute(sql)
 
     def _change_path(self, new_path):
         """Change the path of our database.
@@ -636,8 +773,13 @@ class LiveStorage(signals.SignalEmitter):
 
     def close(self):
         logging.info("closing database")
+        if self._fts_merge_call is not None:
+            self._fts_merge_call.cancel()
+            self._fts_merge_call = None
         self.finish_transaction()
         self.connection.close()
+        for line in self.get_statement_timing_report():
+            logging.timing(line)
 
     def get_backup_directory(self):
         """This returns the backup directory path.
@@ -774,6 +916,8 @@ class LiveStorage(signals.SignalEmitter):
                                               self._schema_version,
                                               context,
                                               self.show_upgrade_progress())
+            # the upgrades may have added the item_fts_dirty table
+            self._fts_dirty_queue = None
             self.set_version()
             self._change_database_file_back()
         self.current_version = self._schema_version
@@ -918,38 +1062,91 @@ class LiveStorage(signals.SignalEmitter):
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        The UPDATE statement isn't run right away.  We queue it up, then
+        send all the queued UPDATEs to SQLite before the next statement runs
+        or the transaction finishes.  UPDATEs that change the same columns
+        run together with executemany().
+        """
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        new_values = {}
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
             except schema.ValidationError:
                 logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            new_values[name] = self._converter.to_sql(obj_schema, name,
+                schema_item, value)
         obj.reset_changed_attributes()
-        if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self.execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
-                    self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+        if new_values:
+            self._queue_update(obj_schema, obj.id, new_values)
+
+    def _queue_update(self, obj_schema, id_, new_values):
+        """Queue an UPDATE for a row.
+
+        new_values maps column names to values that have already been
+        converted with our SQLiteConverter.
+        """
+        key = (obj_schema.table_name, id_)
+        try:
+            values = self._pending_updates[key][1]
+        except KeyError:
+            self._pending_updates[key] = (obj_schema, new_values)
+        else:
+            values.update(new_values)
+
+    def _flush_pending_updates(self):
+        """Run the UPDATE statements queued by update_obj()."""
+        pending = self._pending_updates
+        # clear _pending_updates first, since execute() accesses our cursor
+        self._pending_updates = collections.OrderedDict()
+        groups = collections.OrderedDict()
+        for (table_name, id_), (obj_schema, values) in pending.iteritems():
+            columns = tuple(name for name, schema_item in obj_schema.fields
+                            if name in values)
+            row = [values[name] for name in columns]
+            row.append(id_)
+            groups.setdefault((table_name, columns), []).append(row)
+        errors = []
+        for (table_name, columns), rows in groups.iteritems():
+            sql = "UPDATE %s SET %s WHERE id=?" % (table_name,
+                    ', '.join('%s=?' % name for name in columns))
+            self.execute(sql, rows, is_update=True, many=True)
+            if self._quitting_from_operational_error:
+                continue
+            rowcount = self._cursor.rowcount
+            if rowcount != len(rows):
+                errors.append((table_name, [row[-1] for row in rows],
+                               rowcount))
+        for table_name, id_list, rowcount in errors:
+            try:
+                self._check_update_rowcount(table_name, id_list, rowcount)
+            except (KeyError, ValueError), e:
+                # Raising here would blame whatever statement caused the
+                # flush, rather than the update_obj() call that queued the
+                # UPDATE.  Save the error for finish_transaction().
+                logging.error("error running queued UPDATE: %s", e)
+                self._update_errors.append(e)
+
+    def _check_update_rowcount(self, table_name, id_list, rowcount):
+        if rowcount > len(id_list):
+            raise ValueError("Update changed multiple rows "
+                    "(table: %s, ids: %s, count: %s)" %
+                    (table_name, id_list, rowcount))
+        found_ids = set()
+        for id_chunk in util.split_values_for_sqlite(id_list):
+            found_ids.update(self.query_ids(table_name, 'id IN (%s)' %
+                ', '.join('?' for id_ in id_chunk), id_chunk))
+        missing = [id_ for id_ in id_list if id_ not in found_ids]
+        raise KeyError("Updating non-existent row (table: %s, ids: %s)" %
+                (table_name, missing))
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
@@ -1018,6 +1215,25 @@ class LiveStorage(signals.SignalEmitter):
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def table_fields(self, table_name):
+        """Get the schema fields for a table.
+
+        :returns: list of (name, schema_item) tuples, or None if we don't
+            have a schema for table_name
+        """
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return oschema.fields
+        return None
+
+    def get_loaded_obj(self, id_, table_name):
+        """Get a DDBObject if it's loaded into memory.
+
+        Unlike get_obj_by_id(), this takes a table name rather than a class
+        and returns None rather than throwing a KeyError.
+        """
+        return self._object_map.get((id_, table_name))
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -1082,8 +1298,10 @@ class LiveStorage(signals.SignalEmitter):
         restored_data = {}
         columns_to_update = []
         values_to_update = []
+        legacy_values = {}
         for (name, schema_item), value in \
                 itertools.izip(schema.fields, db_row):
+            is_legacy = self._converter.is_legacy_value(schema_item, value)
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -1104,7 +1322,16 @@ class LiveStorage(signals.SignalEmitter):
                 columns_to_update.append(name)
                 values_to_update.append(self._converter.to_sql(schema, name,
                     schema_item, value))
+            else:
+                if is_legacy:
+                    legacy_values[name] = self._converter.to_sql(schema,
+                            name, schema_item, value)
             restored_data[name] = value
+        if legacy_values:
+            # Some columns were saved by an older version using repr().
+            # Queue an UPDATE to store them in the current format, that
+            # way we only need to eval() them once.
+            self._queue_update(schema, restored_data['id'], legacy_values)
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
@@ -1156,19 +1383,110 @@ class LiveStorage(signals.SignalEmitter):
         return rows
 
     def on_event_finished(self, eventloop, success):
-        self.finish_transaction(commit=success)
+        try:
+            self.finish_transaction(commit=success)
+        except (KeyError, ValueError):
+            # Nothing above us catches errors from event-finished handlers,
+            # so report the error from the queued UPDATE like trap_call()
+            # would have before the UPDATEs were queued.
+            signals.system.failed_exn("When finishing a transaction")
 
     def finish_transaction(self, commit=True):
-        if len(self._statements_in_transaction) == 0:
+        """Commit or roll back the current transaction.
+
+        :raises KeyError: a queued UPDATE was for a row that doesn't exist
+        :raises ValueError: a queued UPDATE changed multiple rows
+        """
+        if self._pending_updates:
+            if commit:
+                self._flush_pending_updates()
+            else:
+                self._pending_updates = collections.OrderedDict()
+        update_errors = self._update_errors
+        self._update_errors = []
+        self._end_transaction(commit)
+        # Raise errors from the queued UPDATEs once the rest of the
+        # transaction is finished, like update_obj() used to raise them
+        # before the UPDATEs were queued.
+        if commit and update_errors:
+            raise update_errors[0]
+
+    def _end_transaction(self, commit):
+        if len(self._transaction_log) == 0:
             return
+        if commit and not self._quitting_from_operational_error:
+            self._flush_fulltext_search()
         if not self._quitting_from_operational_error:
             if commit:
                 self.cursor.execute("COMMIT TRANSACTION")
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
-        self._statements_in_transaction = []
+        self._transaction_log.clear()
         self.emit("transaction-finished", commit)
 
+    def _transaction_log_full(self):
+        return (self.TRANSACTION_LOG_LIMIT is not None and
+                self._transaction_log.row_count >=
+                self.TRANSACTION_LOG_LIMIT)
+
+    def _commit_part_of_transaction(self):
+        """Commit the statements run so far and start a new transaction log.
+
+        execute() calls this when the transaction log gets too big.  The rest
+        of the transaction gets committed or rolled back as usual by
+        finish_transaction().  This means that rolling back a large
+        transaction only undoes the changes since the last partial commit.
+        That's okay, since rolling back doesn't undo the changes to our
+        DDBObjects either.
+        """
+        if self._quitting_from_operational_error:
+            return
+        try:
+            self._cursor.execute("COMMIT TRANSACTION")
+        except sqlite3.DatabaseError, e:
+            self._log_error("COMMIT TRANSACTION", (), False, e)
+            # We still have the log for the statements since the last
+            # commit.  Use the normal error handling to re-run them, then
+            # try committing again with the next update.
+            self._current_select_statement = None
+            self._handle_operational_error(e, True)
+        else:
+            self._transaction_log.clear()
+
+    def _flush_fulltext_search(self):
+        """Re-index the items that changed in this transaction.
+
+        This is a no-op unless the database uses the batched item_fts mode.
+        """
+        if self._fts_dirty_queue is None:
+            self._fts_dirty_queue = fulltextsearch.has_dirty_queue(
+                self.connection)
+        if not self._fts_dirty_queue:
+            return
+        count = self.execute("SELECT COUNT(*) FROM item_fts_dirty")[0][0]
+        if count == 0:
+            return
+        for sql in fulltextsearch.flush_dirty_rows_sql():
+            self.execute(sql, is_update=True)
+        self._fts_rows_since_merge += count
+        if (self._fts_rows_since_merge >= self.FTS_MERGE_THRESHOLD and
+                self._fts_merge_call is None):
+            self._fts_merge_call = eventloop.add_idle(
+                self._merge_fulltext_search, "merge item_fts segments")
+
+    def _merge_fulltext_search(self):
+        """Merge the b-tree segments that build up in item_fts.
+
+        Each transaction that re-indexes items adds a new segment.  Merging
+        them keeps full text queries fast.  We run this from an idle callback
+        after enough rows have been re-indexed.
+        """
+        self._fts_merge_call = None
+        self._fts_rows_since_merge = 0
+        command = fulltextsearch.merge_command(sqlite3.sqlite_version_info)
+        self.execute("INSERT INTO item_fts(item_fts) VALUES(?)", (command,),
+                     is_update=True)
+
     def execute(self, sql, values=None, is_update=False, many=False):
         """Execute an sql statement and return the results.
 
@@ -1180,18 +1498,24 @@ class LiveStorage(signals.SignalEmitter):
         :returns: list of result rows, or None if the statement is an update.
         """
 
+        if self._pending_updates:
+            self._flush_pending_updates()
+
+        if is_update and self._transaction_log_full():
+            self._commit_part_of_transaction()
+
         if is_update and self._quitting_from_operational_error:
             # We want to avoid updating the database at this point.
             return
 
-        if is_update and len(self._statements_in_transaction) == 0:
+        if is_update and len(self._transaction_log) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
 
         if values is None:
             values = ()
 
         if is_update:
-            self._statements_in_transaction.append((sql, values, many))
+            self._transaction_log.append(sql, values, many)
         try:
             self._time_execute(sql, values, many)
         except sqlite3.DatabaseError, e:
@@ -1216,10 +1540,12 @@ class LiveStorage(signals.SignalEmitter):
         start = time.time()
         if many:
             self.cursor.executemany(sql, values)
+            row_count = len(values)
         else:
             self.cursor.execute(sql, values)
+            row_count = 1
         end = time.time()
-        self._check_time(sql, end-start)
+        self._check_time(sql, end-start, row_count)
 
     def _log_error(self, sql, values, many, e):
             # printing the traceback here in whole rather than doing
@@ -1231,11 +1557,11 @@ class LiveStorage(signals.SignalEmitter):
                           "many: %s\n\n", e, sql, values, many, exc_info=True)
 
     def _try_rerunning_transaction(self):
-        if self._statements_in_transaction:
+        if self._transaction_log:
             # We may have only been trying to execute SELECT statements.  If
             # that's true, don't start a transaction. (#12885)
             self.cursor.execute("BEGIN TRANSACTION")
-        to_run = self._statements_in_transaction[:]
+        to_run = list(self._transaction_log)
         if self._current_select_statement:
             to_run.append(self._current_select_statement)
         for (sql, values, many) in to_run:
@@ -1290,9 +1616,8 @@ class LiveStorage(signals.SignalEmitter):
             return True
         elif action == LiveStorageErrorHandler.ACTION_USE_TEMPORARY:
             self._switch_to_temp_mode()
-            # reset _statements_in_transaction.  The data for the old DB is
-            # now lost
-            self._statements_in_transaction = []
+            # reset _transaction_log.  The data for the old DB is now lost
+            self._transaction_log.clear()
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -1300,12 +1625,22 @@ class LiveStorage(signals.SignalEmitter):
             logging.warn("Bad return value for handle_save_error: %s", action)
             raise
 
-    def _check_time(self, sql, query_time):
+    def _check_time(self, sql, query_time, row_count=1):
         SINGLE_QUERY_LIMIT = 0.5
         CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
 
+        shape = self._statement_shape(sql)
+        try:
+            stats = self._statement_stats[shape]
+        except KeyError:
+            stats = self._statement_stats[shape] = [0, 0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += row_count
+        stats[2] += query_time
+        stats[3] = max(stats[3], query_time)
+
         return # comment out to test cumulative query times
 
         # more than half a second in the last
@@ -1324,6 +1659,39 @@ class LiveStorage(signals.SignalEmitter):
             logging.timing('query cumulatively slow: %0.2f '
                     '(%0.03f): %s', cumulative, query_time, sql)
 
+    def _statement_shape(self, sql):
+        """Get the shape of a SQL statement.
+
+        Statements that only differ in their literal values, or in the
+        number of ? placeholders in a list, have the same shape.
+        """
+        try:
+            return self._statement_shapes[sql]
+        except KeyError:
+            pass
+        shape = sql.strip()
+        for regex, replacement in self._shape_substitutions:
+            shape = regex.sub(replacement, shape)
+        if len(self._statement_shapes) < self.MAX_STATEMENT_SHAPES:
+            self._statement_shapes[sql] = shape
+        return shape
+
+    def get_statement_timing_report(self, limit=20):
+        """Get a report on the time we've spent running SQL statements.
+
+        Statements are grouped by their shape (see _statement_shape()).
+
+        :param limit: max number of shapes to include
+        :returns: list of lines, with the most expensive shapes first
+        """
+        stats = sorted(self._statement_stats.items(),
+                       key=lambda (shape, stat): stat[2], reverse=True)
+        lines = []
+        for shape, (count, rows, total, longest) in stats[:limit]:
+            lines.append("%0.3fs total, %d calls, %d rows, %0.3fs max: %s" %
+                         (total, count, rows, longest, shape))
+        return lines
+
     def _calc_created_new(self):
         """Decide if the database that we just opened is new."""
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
@@ -1332,7 +1700,6 @@ class LiveStorage(signals.SignalEmitter):
 
     def _init_database(self):
         """Create a new empty database."""
-
         for schema in self._object_schemas:
             type_specs = [self._create_sql_for_column(name, schema_item)
                           for (name, schema_item) in schema.fields]
@@ -1349,7 +1716,10 @@ class LiveStorage(signals.SignalEmitter):
         self.setup_fulltext_search()
 
     def setup_fulltext_search(self):
-        fulltextsearch.setup_fulltext_search(self.connection)
+        fulltextsearch.setup_fulltext_search(self.connection, batched=True)
+        # set_version() commits before we get here, which can cache that
+        # there's no item_fts_dirty table.
+        self._fts_dirty_queue = None
 
     def _get_size_info(self):
         """Get info about the database size
@@ -1502,13 +1872,13 @@ class SQLiteConverter(object):
                 schema.SchemaStringSet: self._string_set_from_sql,
         }
 
-        repr_types = (schema.SchemaTimeDelta,
+        self._repr_types = (schema.SchemaTimeDelta,
                 schema.SchemaReprContainer,
                 schema.SchemaTuple,
                 schema.SchemaDict,
                 schema.SchemaList,
                 )
-        for schema_class in repr_types:
+        for schema_class in self._repr_types:
             self._to_sql_converters[schema_class] = self._repr_to_sql
             self._from_sql_converters[schema_class] = self._repr_from_sql
 
@@ -1526,6 +1896,16 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value, schema_item)
 
+    def is_legacy_value(self, schema_item, value):
+        """Check if a value from the DB uses a format that we've replaced.
+
+        Currently this means container columns that older versions stored
+        using repr().
+        """
+        return (value is not None and
+                schema_item.__class__ in self._repr_types and
+                not containercodec.is_encoded(value))
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1567,23 +1947,16 @@ class SQLiteConverter(object):
         return filename_to_unicode(value)
 
     def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+        return buffer(containercodec.encode(value))
 
     def _repr_from_sql(self, value, schema_item):
-        return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
+        if containercodec.is_encoded(value):
+            return containercodec.decode(value)
+        else:
+            return databaseupgrade.eval_container(value)
 
     def _string_set_to_sql(self, value, schema_item):
         return schema_item.delimiter.join(value)
 
     def _string_set_from_sql(self, value, schema_item):
         return set(value.split(schema_item.delimiter))
-
-class TimeModuleShadow:
-    """In Python 2.6, time.struct_time is a named tuple and evals poorly,
-    so we have struct_time_shadow which takes the arguments that struct_time
-    should have and returns a 9-tuple
-    """
-    def struct_time(self, tm_year=0, tm_mon=0, tm_mday=0, tm_hour=0, tm_min=0, tm_sec=0, tm_wday=0, tm_yday=0, tm_isdst=0):
-        return (tm_year, tm_mon, tm_mday, tm_hour, tm_min, tm_sec, tm_wday, tm_yday, tm_isdst)
-
-_TIME_MODULE_SHADOW = TimeModuleShadow()
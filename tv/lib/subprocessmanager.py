@@ -38,14 +38,19 @@ Platforms need to ensure that this script is available and that it can be run
 with the command line and env from plat.utils.miro_helper_program_info().
 """
 
+import collections
 import ctypes
 import cPickle as pickle
+import cStringIO
 import logging
+import mmap
 import os
 import struct
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import trapcall
 import warnings
 import Queue
@@ -67,13 +72,17 @@ def _on_windows():
     """Test if we are unfortunate enough to be running in windows."""
     return sys.platform == 'win32'
 
+# Set to True inside subprocesses started by the unit tests
+subprocess_in_unit_tests = False
+
 # DESIGN NOTES:
 #
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Each message contains a header with a length
+# followed by a pickled object.  Large pickles are written to a memory-mapped
+# temporary file and only its path goes through the pipe.
 #
 # The communication goes like this:
 #
@@ -261,7 +270,28 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("Q")
+class SubprocessTimeoutError(StandardError):
+    """A task failed because the subprocess didn't respond in enough time."""
+
+class SubprocessQuitError(StandardError):
+    """A task failed because the subprocess quit before responding."""
+
+# pickle protocol for our messages.  Both sides of the pipe run the same code,
+# so we can always use the fastest one.
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Each message starts with a header that contains:
+#   - the size of the data that follows
+#   - the channel that the pickle data is sent over
+#   - when the sender started sending it (used for latency stats)
+HEADER_FORMAT = "<QBd"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# channels for the pickle data
+CHANNEL_PIPE = 0 # pickle data follows the header in the pipe
+CHANNEL_MMAP = 1 # pickle data is in a file, its path follows the header
+# Messages with this much pickle data or more get sent using a memory-mapped
+# temporary file rather than going through the pipe.  Set to None to always
+# use the pipe.
+SIDE_CHANNEL_THRESHOLD = 1024 * 1024
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -282,27 +312,150 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
-def _load_obj(pipe):
-    """Load an object from one side of a pipe.
+class MessageStats(object):
+    """Counters for one type of message sent through a pipe.
 
-    _load_obj blocks until the all the data has been sent.
+    :attribute count: number of messages
+    :attribute bytes: total size of the pickle data
+    :attribute total_time: total time spent on the messages
+    :attribute max_time: longest time spent on a single message
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, size, elapsed):
+        self.count += 1
+        self.bytes += size
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def average_time(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_time / self.count
+
+class TransportStats(object):
+    """Tracks the messages that go through our pipes.
+
+    Stats are kept per message type.  For sent messages we track the time it
+    took to pickle and write the message.  For received messages we track the
+    latency: the time from when the other side started sending the message to
+    when we finished unpickling it.
+
+    TransportStats can be used by multiple threads at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.sent = collections.defaultdict(MessageStats)
+            self.received = collections.defaultdict(MessageStats)
+
+    def record_sent(self, obj, size, elapsed):
+        with self.lock:
+            self.sent[type(obj).__name__].add(size, elapsed)
+
+    def record_received(self, obj, size, latency):
+        with self.lock:
+            self.received[type(obj).__name__].add(size, latency)
+
+    def log_summary(self):
+        with self.lock:
+            for direction, stats_map in (('sent', self.sent),
+                                         ('received', self.received)):
+                for name, stats in sorted(stats_map.items()):
+                    logging.debug("%s %s: %d messages, %d bytes, "
+                                  "avg %0.4fs, max %0.4fs", direction, name,
+                                  stats.count, stats.bytes,
+                                  stats.average_time(), stats.max_time)
+
+class PipeReader(object):
+    """Reads objects written by _dump_obj() from a pipe.
+
+    PipeReader reads the data for each message into a buffer that it reuses
+    for the next message, then unpickles directly from that buffer.
+    """
 
-    :raises IOError: low-level error while reading from the pipe
-    :raises LoadError: data read was corrupted
+    # initial size of our buffer
+    INITIAL_BUFFER_SIZE = 64 * 1024
+    # Don't keep buffers bigger than this around between messages
+    MAX_BUFFER_SIZE = 4 * 1024 * 1024
 
-    :returns: Python object send from the other side
-    """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
-        raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
+    def __init__(self, pipe, stats=None):
+        """Create a PipeReader
+
+        :param pipe: file object to read from
+        :param stats: TransportStats to record received messages to
+        """
+        self.pipe = pipe
+        self.stats = stats
+        self.buffer = bytearray(self.INITIAL_BUFFER_SIZE)
+
+    def _read_into_buffer(self, length):
+        """Read length bytes from our pipe
+
+        :returns: (buffer, bytes_read) tuple.  buffer is normally our reusable
+        buffer, but may be a temporary one for very large messages
+        """
+        if length <= len(self.buffer):
+            buf = self.buffer
+        else:
+            buf = bytearray(max(length, len(self.buffer) * 2))
+            if len(buf) <= self.MAX_BUFFER_SIZE:
+                self.buffer = buf
+        if not hasattr(self.pipe, 'readinto'):
+            data = _read_bytes_from_pipe(self.pipe, length)
+            buf[:len(data)] = data
+            return buf, len(data)
+        view = memoryview(buf)
+        bytes_read = 0
+        while bytes_read < length:
+            count = self.pipe.readinto(view[bytes_read:length])
+            if not count:
+                break
+            bytes_read += count
+        return buf, bytes_read
+
+    def load_obj(self):
+        """Load an object from the pipe.
+
+        load_obj() blocks until the all the data has been sent.
+
+        :raises IOError: low-level error while reading from the pipe
+        :raises LoadError: data read was corrupted
+
+        :returns: Python object send from the other side
+        """
+        buf, bytes_read = self._read_into_buffer(HEADER_SIZE)
+        if bytes_read < HEADER_SIZE:
+            raise LoadError("EOF reached while reading header "
+                    "(read %s bytes)" % bytes_read)
+        size, channel, send_time = struct.unpack_from(HEADER_FORMAT, buf)
+        buf, bytes_read = self._read_into_buffer(size)
+        if bytes_read < size:
+            raise LoadError("EOF reached while reading pickle data "
+                    "(read %s bytes)" % bytes_read)
+        if channel == CHANNEL_PIPE:
+            obj = _unpickle(buffer(buf, 0, size))
+        elif channel == CHANNEL_MMAP:
+            path = str(buf[:size])
+            obj, size = _load_from_side_channel(path)
+        else:
+            raise LoadError("Unknown channel: %s" % channel)
+        if self.stats is not None:
+            self.stats.record_received(obj, size, time.time() - send_time)
+        return obj
+
+def _unpickle(data):
+    """Unpickle an object from a string or buffer."""
     try:
-        return pickle.loads(pickle_data)
+        # Use cStringIO to avoid copying data if it's a buffer
+        return pickle.load(cStringIO.StringIO(data))
     except pickle.PickleError:
         raise LoadError("Pickle data corrupt")
     except ImportError:
@@ -312,24 +465,91 @@ def _load_obj(pipe):
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
 
-def _dump_obj(obj, pipe):
+def _write_to_side_channel(pickle_data):
+    """Write pickle data to a temporary file for the other side to read.
+
+    :returns: path to the file
+    """
+    fd, path = tempfile.mkstemp(prefix='miro-ipc-')
+    f = os.fdopen(fd, 'r+b')
+    try:
+        # use truncate() to size the file, since windows doesn't have
+        # os.ftruncate()
+        f.truncate(len(pickle_data))
+        mapping = mmap.mmap(f.fileno(), len(pickle_data))
+        try:
+            mapping.write(pickle_data)
+        finally:
+            mapping.close()
+    finally:
+        f.close()
+    return path
+
+def _load_from_side_channel(path):
+    """Load an object written with _write_to_side_channel()
+
+    The file at path is deleted afterwards.
+
+    :returns: (obj, size) tuple
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        raise LoadError("Error opening side channel file: %s" % e)
+    try:
+        size = os.fstat(f.fileno()).st_size
+        mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            obj = _unpickle(buffer(mapping))
+        finally:
+            mapping.close()
+    finally:
+        f.close()
+        os.remove(path)
+    return obj, size
+
+def _load_obj(pipe):
+    """Load an object from one side of a pipe.
+
+    _load_obj blocks until the all the data has been sent.  Use PipeReader to
+    read several objects from the same pipe.
+
+    :raises IOError: low-level error while reading from the pipe
+    :raises LoadError: data read was corrupted
+
+    :returns: Python object send from the other side
+    """
+    return PipeReader(pipe).load_obj()
+
+def _dump_obj(obj, pipe, stats=None):
     """Dump an object to the other side of the pipe.
 
+    :param stats: TransportStats to record the message to
     :raises IOError: low-level error while writing to the pipe
     :raises pickle.PickleError: obj could not be pickled
     """
-
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("Q", len(pickle_data))
+    start_time = time.time()
+    pickle_data = pickle.dumps(obj, PICKLE_PROTOCOL)
+    size = len(pickle_data)
+    if (SIDE_CHANNEL_THRESHOLD is not None and
+            size >= SIDE_CHANNEL_THRESHOLD):
+        channel = CHANNEL_MMAP
+        data = _write_to_side_channel(pickle_data)
+    else:
+        channel = CHANNEL_PIPE
+        data = pickle_data
+    header = struct.pack(HEADER_FORMAT, len(data), channel, start_time)
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
     # pushing the data into a Queue.  However, there's some chance that the
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    pipe.write(header)
+    pipe.write(data)
     pipe.flush()
+    if stats is not None:
+        stats.record_sent(obj, size, time.time() - start_time)
 
 class SubprocessManager(object):
     """Manages a running subprocess
@@ -346,7 +566,8 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install a handler, use send_message() to send messages.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -358,7 +579,8 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -368,6 +590,7 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        self.stats = TransportStats()
 
     # Process management
 
@@ -390,7 +613,7 @@ class SubprocessManager(object):
         # This thread only handles the subprocess output.  We write to the
         # subprocess stdin from the eventloop.
         self.thread = SubprocessResponderThread(self.process.stdout,
-                self.responder, self._on_thread_quit)
+                self.responder, self._on_thread_quit, self.stats)
         self.thread.daemon = True
         self.thread.start()
         # work is all done, do some finishing touches
@@ -400,15 +623,7 @@ class SubprocessManager(object):
         trapcall.trap_call("subprocess startup", self.responder.on_startup)
 
     def _start_subprocess(self):
-        cmd_line, env = utils.miro_helper_program_info()
-        kwargs = {
-                  "stdout": subprocess.PIPE,
-                  "stdin": subprocess.PIPE,
-                  "stderr": open(os.devnull, 'wb'),
-                  "env": env,
-                  "close_fds": True
-        }
-        process = Popen(cmd_line, **kwargs)
+        process = _start_helper_process()
         self.start_time = clock.clock()
         return process
 
@@ -423,6 +638,7 @@ class SubprocessManager(object):
 
         # we're about to shut down, tell our responder
         trapcall.trap_call("subprocess shutdown", self.responder.on_shutdown)
+        self.stats.log_summary()
         # Politely ask our process to shutdown
         self.send_quit()
         # If things go right, the process will quit, then our thread will
@@ -518,7 +734,7 @@ class SubprocessManager(object):
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            _dump_obj(msg, self.process.stdin, self.stats)
         except IOError:
             logging.warn("Broken pipe in send_message()")
             # we could try to restart our subprocess here, but if the pipe is
@@ -533,30 +749,184 @@ class SubprocessManager(object):
         self.sent_quit = True
 
     def _send_startup_info(self):
-        self.send_message(StartupInfo(self._get_config_dict(),
-                                      hasattr(app, 'in_unit_tests')))
+        self.send_message(StartupInfo(_get_config_dict(), _in_unit_tests()))
         self.send_message(HandlerInfo(self.handler_class, self.handler_args))
 
-    def _get_config_dict(self):
-        """Generate a dict with the config items needed in the subprocess.
-
-        We just send over the bare minimum needed to make sure basic modules
-        like gtcache load properly.
-        """
-        # On OS X, the proxy information is in a CFDictionary, so we can't
-        # pickle it.  Just avoid sending it for now
-        prefs_to_send = [p for p in prefs.all_prefs()
-                if not p.key.startswith("HttpProxy")
-        ]
-        return dict((p.key, app.config.get(p)) for p in prefs_to_send)
-
     # implement the MessageHandler interface
 
     def handle(self, msg):
         # just forward the message to our process
         self.send_message(msg)
 
-def _read_from_pipe(pipe):
+class SynchronousSubprocess(object):
+    """Subprocess that we send requests to and block waiting for responses.
+
+    SubprocessManager is built around the eventloop, which makes it a poor fit
+    for code running inside a subprocess (like the worker process).  This
+    class is a simpler alternative: send_message() writes a message to the
+    child process and wait_for_response() blocks until it sends something
+    back.
+
+    If the child doesn't respond in time, we kill it and raise
+    SubprocessTimeoutError.  If it quits on its own, we raise
+    SubprocessQuitError.  Either way, the next call to start() will spawn a
+    fresh process.
+    """
+    def __init__(self, handler_class, handler_args=None):
+        if handler_args is None:
+            handler_args = ()
+        self.handler_class = handler_class
+        self.handler_args = handler_args
+        self.process = None
+        self.thread = None
+        self.responses = None
+        self.stats = TransportStats()
+
+    def is_running(self):
+        return self.process is not None
+
+    def start(self):
+        """Startup the subprocess if it's not already running."""
+        if self.is_running():
+            return
+        self.process = _start_helper_process()
+        self.responses = Queue.Queue()
+        self.thread = threading.Thread(target=self._read_responses,
+                                       args=(self.process.stdout,
+                                             self.responses))
+        self.thread.daemon = True
+        self.thread.start()
+        self.send_message(StartupInfo(_get_config_dict(), _in_unit_tests()))
+        self.send_message(HandlerInfo(self.handler_class, self.handler_args))
+
+    def _read_responses(self, stdout, responses):
+        # runs in our reader thread.  We pass in stdout and responses, rather
+        # than using our attributes, since a new process may have been
+        # started by the time we finish.
+        try:
+            for msg in _read_from_pipe(stdout, self.stats):
+                responses.put(msg)
+        except (IOError, LoadError), e:
+            logging.warn("Error reading from synchronous subprocess: %s", e)
+        # put None to signal that the process quit
+        responses.put(None)
+
+    def send_message(self, msg):
+        """Send a message to the subprocess.
+
+        :raises SubprocessQuitError: the pipe to the subprocess is broken
+        """
+        if not self.is_running():
+            raise ValueError("subprocess not running")
+        try:
+            _dump_obj(msg, self.process.stdin, self.stats)
+        except IOError:
+            self.kill()
+            raise SubprocessQuitError()
+
+    def wait_for_response(self, timeout):
+        """Wait for the subprocess to send a message back.
+
+        SubprocessError messages are logged and skipped over.
+
+        :param timeout: max number of seconds to wait
+        :raises SubprocessTimeoutError: timeout expired, the subprocess was
+            killed.
+        :raises SubprocessQuitError: the subprocess quit.
+        """
+        if not self.is_running():
+            raise ValueError("subprocess not running")
+        end_time = clock.clock() + timeout
+        while True:
+            time_left = end_time - clock.clock()
+            try:
+                if time_left <= 0:
+                    raise Queue.Empty()
+                msg = self.responses.get(timeout=time_left)
+            except Queue.Empty:
+                logging.warn("%s timed out, killing it",
+                             self.handler_class.__name__)
+                self.kill()
+                raise SubprocessTimeoutError()
+            if msg is None:
+                logging.warn("%s quit unexpectedly",
+                             self.handler_class.__name__)
+                self.kill()
+                raise SubprocessQuitError()
+            elif isinstance(msg, SubprocessError):
+                logging.warn("Error in subprocess: %s", msg.report)
+            else:
+                return msg
+
+    def kill(self):
+        """Kill the subprocess without waiting for it to finish."""
+        if not self.is_running():
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        try:
+            self.process.kill()
+        except OSError:
+            # process already quit
+            pass
+        self._cleanup_process()
+
+    def shutdown(self, timeout=1.0):
+        """Shutdown the subprocess.
+
+        This method asks the subprocess to quit, waits until timeout expires,
+        then kills it.
+        """
+        if not self.is_running():
+            return
+        try:
+            _dump_obj(None, self.process.stdin)
+        except IOError:
+            pass
+        self.thread.join(timeout)
+        self.kill()
+
+    def _cleanup_process(self):
+        self.process = None
+        self.thread = None
+        self.responses = None
+
+def _start_helper_process():
+    """Spawn a miro_helper process to run a subprocess in."""
+    cmd_line, env = utils.miro_helper_program_info()
+    kwargs = {
+              "stdout": subprocess.PIPE,
+              "stdin": subprocess.PIPE,
+              "stderr": open(os.devnull, 'wb'),
+              "env": env,
+              "close_fds": True
+    }
+    return Popen(cmd_line, **kwargs)
+
+def _get_config_dict():
+    """Generate a dict with the config items needed in a subprocess.
+
+    We just send over the bare minimum needed to make sure basic modules
+    like gtcache load properly.
+    """
+    # On OS X, the proxy information is in a CFDictionary, so we can't
+    # pickle it.  Just avoid sending it for now
+    prefs_to_send = [p for p in prefs.all_prefs()
+            if not p.key.startswith("HttpProxy")
+    ]
+    return dict((p.key, app.config.get(p)) for p in prefs_to_send)
+
+def _in_unit_tests():
+    """Check if we are running as part of the unit tests.
+
+    This is also True inside subprocesses started from the unit tests, so
+    that processes they start themselves skip logging setup too.
+    """
+    return hasattr(app, 'in_unit_tests') or subprocess_in_unit_tests
+
+def _read_from_pipe(pipe, stats=None):
     """Read objects from a pipe.
 
     This method is a generator that reads pickled objects from pipe.  It
@@ -567,8 +937,9 @@ def _read_from_pipe(pipe):
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
+    reader = PipeReader(pipe, stats)
     while True:
-        msg = _load_obj(pipe)
+        msg = reader.load_obj()
         if msg is None:
             return # other side wants to quit
         yield msg
@@ -585,11 +956,13 @@ class SubprocessResponderThread(threading.Thread):
     QUIT_BAD_DATA = 2
     QUIT_UNKNOWN = 3
 
-    def __init__(self, subprocess_stdout, responder, quit_callback):
+    def __init__(self, subprocess_stdout, responder, quit_callback,
+                 stats=None):
         """Create a new SubprocessResponderThread
 
         :param subprocess_stdout: STDOUT pipe from our subprocess
         :param responder: SubprocessResponder object to handle messages
+        :param stats: TransportStats to record received messages to
         """
 
         threading.Thread.__init__(self)
@@ -597,11 +970,12 @@ class SubprocessResponderThread(threading.Thread):
         self.subprocess_stdout = subprocess_stdout
         self.responder = responder
         self.quit_callback = quit_callback
+        self.stats = stats
         self.quit_type = None
 
     def run(self):
         try:
-            for msg in _read_from_pipe(self.subprocess_stdout):
+            for msg in _read_from_pipe(self.subprocess_stdout, self.stats):
                 self.responder.handle(msg)
         except LoadError, e:
             logging.warn("Quiting from bad data from our subprocess in "
@@ -690,7 +1064,7 @@ def _subprocess_setup(stdin, stdout):
     :raises IOError: low-level error while reading from the pipe
     :raises LoadError: data read was corrupted
     """
-    global logging_setup
+    global logging_setup, subprocess_in_unit_tests
     # disable warnings so we don't get too much junk on stderr
     warnings.filterwarnings("ignore")
     # setup MessageHandler for messages going to the main process
@@ -705,6 +1079,7 @@ def _subprocess_setup(stdin, stdout):
     config.load(config.ManualConfig())
     app.config.set_dictionary(msg.config_dict)
     gtcache.init()
+    subprocess_in_unit_tests = msg.in_unit_tests
     if not msg.in_unit_tests:
         utils.setup_logging(app.config.get(prefs.HELPER_LOG_PATHNAME))
         util.setup_logging()
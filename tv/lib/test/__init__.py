@@ -60,6 +60,7 @@ from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -87,6 +88,7 @@ from miro.test.idleiteratetest import *
 from miro.test.itemtracktest import *
 from miro.test.itemlisttest import *
 from miro.test.itemrenderertest import *
+from miro.test.imagepooltest import *
 from miro.test.sharingtest import *
 from miro.test.databaseerrortest import *
 
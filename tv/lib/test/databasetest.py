@@ -4,6 +4,7 @@ from miro.test.framework import MiroTestCase
 from miro import app
 from miro import database
 from miro import databaselog
+from miro import downloader
 from miro import item
 from miro import feed
 from miro import schema
@@ -159,6 +160,115 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class ViewPredicateTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.feed.set_title(u"booya")
+        self.start_download(self.i1, u'downloading')
+        self.start_download(self.i3, u'paused')
+        # make sure everything is saved, so we can check the objects in
+        # python
+        for obj in (self.i1, self.i2, self.i3, self.i1.downloader,
+                    self.i3.downloader):
+            obj.signal_change()
+
+    def start_download(self, item_, state):
+        item_.url = u'http://example.com/%s.mkv' % item_.id
+        item_.download()
+        downloader.RemoteDownloader.update_status({
+            'current_size': 0,
+            'total_size': None,
+            'state': state,
+            'rate': 0,
+            'eta': None,
+            'type': 'HTTP',
+            'dlid': item_.downloader.dlid,
+        })
+
+    def check_matches_sql(self, view):
+        tracker = view.make_tracker()
+        ids_in_view = set(view.id_list())
+        evaluated = 0
+        for obj in (self.i1, self.i2, self.i3):
+            result = tracker._evaluate_predicate(obj)
+            if result is not None:
+                self.assertEquals(result, obj.id in ids_in_view)
+                evaluated += 1
+        tracker.unlink()
+        return evaluated
+
+    def test_matches_sql(self):
+        for view in (item.Item.downloading_view(),
+                     item.Item.only_downloading_view(),
+                     item.Item.paused_view(),
+                     item.Item.download_tab_view(),
+                     item.Item.auto_pending_view(),
+                     item.Item.watchable_view(),
+                     item.Item.unique_new_video_view(),
+                     item.Item.visible_feed_view(self.feed.id),
+                     item.Item.feed_downloading_view(self.feed.id),
+                     item.Item.make_view("feed.userTitle='booya'",
+                         joins={'feed': 'feed.id=item.feed_id'})):
+            self.assertEquals(self.check_matches_sql(view), 3)
+
+    def test_not_compiled(self):
+        for view in (feed.Feed.make_view("userTitle LIKE 'booya%'"),
+                     item.Item.orphaned_from_feed_view(),
+                     item.Item.playlist_view(1)):
+            tracker = view.make_tracker()
+            self.assertEquals(tracker.predicate, None)
+            tracker.unlink()
+
+    def test_no_query_for_compiled(self):
+        tracker = item.Item.only_downloading_view().make_tracker()
+        self.assertNotEquals(tracker.predicate, None)
+        mock_query_count = self.patch_for_test(
+            'miro.storedatabase.LiveStorage.query_count')
+        mock_query_ids = self.patch_for_test(
+            'miro.storedatabase.LiveStorage.query_ids')
+        tracker.check_object(self.i1)
+        tracker.check_objects([self.i1, self.i2, self.i3])
+        self.assertEquals(mock_query_count.call_count, 0)
+        self.assertEquals(mock_query_ids.call_count, 0)
+        self.assertEquals(tracker.current_ids, set([self.i1.id]))
+
+    def test_unsaved_changes(self):
+        # if an object has changes that haven't been saved, we need to use
+        # SQL so that the result matches the other views
+        tracker = item.Item.only_downloading_view().make_tracker()
+        self.assertEquals(tracker._evaluate_predicate(self.i1), True)
+        self.i1.title = u'new title'
+        self.assertEquals(tracker._evaluate_predicate(self.i1), None)
+        self.i1.downloader.state = u'paused'
+        self.i1.signal_change()
+        self.assertEquals(tracker._evaluate_predicate(self.i1), None)
+        self.i1.downloader.signal_change()
+        self.assertEquals(tracker._evaluate_predicate(self.i1), False)
+        self.assertEquals(len(tracker), 0)
+
+    def test_bulk_signals(self):
+        tracker = item.Item.visible_feed_view(self.feed.id).make_tracker()
+        tracker.set_bulk_mode(True)
+        bulk_added = []
+        bulk_removed = []
+        tracker.connect('bulk-added',
+                        lambda tracker, objs: bulk_added.append(objs))
+        tracker.connect('bulk-removed',
+                        lambda tracker, objs: bulk_removed.append(objs))
+        app.bulk_sql_manager.start()
+        i4 = item.Item(item.FeedParserValues({'title': u'item4'}),
+                       feed_id=self.feed.id)
+        i5 = item.Item(item.FeedParserValues({'title': u'item5'}),
+                       feed_id=self.feed.id)
+        i6 = item.Item(item.FeedParserValues({'title': u'item6'}),
+                       feed_id=self.feed2.id)
+        self.i2.remove()
+        app.bulk_sql_manager.finish()
+        self.assertEquals(len(bulk_added), 1)
+        self.assertSameSet(bulk_added[0], [i4, i5])
+        self.assertEquals(bulk_removed, [[self.i2]])
+        self.assertSameSet(tracker.current_ids, [self.i1.id, i4.id, i5.id])
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
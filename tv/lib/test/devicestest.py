@@ -36,6 +36,8 @@ except ImportError:
 import datetime
 import shutil
 import sqlite3
+import threading
+import time
 
 from miro.gtcache import gettext as _
 from miro.plat.utils import (PlatformFilenameType, unicode_to_filename,
@@ -275,9 +277,118 @@ class DeviceHelperTest(MiroTestCase):
         data = {u'a': 2,
                 u'b': {u'c': [5, 6]}}
         devices.write_database(data, self.tempdir)
-        with open(os.path.join(self.tempdir, '.miro', 'json')) as f:
-            new_data = json.load(f)
-        self.assertEqual(data, new_data)
+        ddb = devices.load_database(self.tempdir)
+        self.assertEqual(ddb, data)
+
+    def test_journal(self):
+        # changes after the first write get appended to the journal,
+        # rather than rewriting the database
+        ddb = devices.DeviceDatabase({u'a': 1, u'b': {u'c': 2}})
+        devices.write_database(ddb, self.tempdir)
+        db_path = os.path.join(self.tempdir, '.miro', 'devicedb')
+        journal_path = os.path.join(self.tempdir, '.miro', 'devicedb-journal')
+        db_contents = open(db_path, 'rb').read()
+        ddb[u'a'] = 3
+        ddb[u'b'][u'd'] = 4
+        ddb[u'e'] = 5
+        del ddb[u'e']
+        devices.write_database(ddb, self.tempdir)
+        self.assertEqual(open(db_path, 'rb').read(), db_contents)
+        self.assert_(os.path.exists(journal_path))
+        new_ddb = devices.load_database(self.tempdir)
+        self.assertEqual(new_ddb, {u'a': 3, u'b': {u'c': 2, u'd': 4}})
+
+    def test_journal_incomplete_entry(self):
+        ddb = devices.DeviceDatabase({u'a': 1})
+        devices.write_database(ddb, self.tempdir)
+        ddb[u'a'] = 2
+        devices.write_database(ddb, self.tempdir)
+        journal_path = os.path.join(self.tempdir, '.miro', 'devicedb-journal')
+        with open(journal_path, 'ab') as f:
+            f.write('["a", 3')
+        with self.allow_warnings():
+            new_ddb = devices.load_database(self.tempdir)
+        self.assertEqual(new_ddb, {u'a': 2})
+
+    def test_compaction(self):
+        old_limit = devices.DEVICE_DB_JOURNAL_LIMIT
+        devices.DEVICE_DB_JOURNAL_LIMIT = 100
+        try:
+            ddb = devices.DeviceDatabase({u'a': 0})
+            devices.write_database(ddb, self.tempdir)
+            journal_path = os.path.join(self.tempdir, '.miro',
+                                        'devicedb-journal')
+            for i in xrange(50):
+                ddb[u'a'] = u'x' * i
+                devices.write_database(ddb, self.tempdir)
+                if os.path.exists(journal_path):
+                    self.assert_(os.path.getsize(journal_path) < 200)
+        finally:
+            devices.DEVICE_DB_JOURNAL_LIMIT = old_limit
+        self.assertEqual(devices.load_database(self.tempdir),
+                         {u'a': u'x' * 49})
+
+    def test_lazy_load(self):
+        # big dictionaries are stored entry by entry and only decoded when
+        # accessed
+        items = dict((u'path-%d' % i, {u'title': u'title-%d' % i})
+                     for i in xrange(devices.DEVICE_DB_SPLIT_SIZE * 2))
+        devices.write_database(devices.DeviceDatabase({u'audio': items}),
+                               self.tempdir)
+        ddb = devices.load_database(self.tempdir)
+        audio = ddb[u'audio']
+        self.assert_(isinstance(dict.__getitem__(audio, u'path-5'),
+                                devices._RawValue))
+        self.assertEqual(ddb._find_item_data(u'path-5'),
+                         ({u'title': u'title-5'}, u'audio'))
+        self.assert_(isinstance(dict.__getitem__(audio, u'path-6'),
+                                devices._RawValue))
+        # changing an entry should journal the dictionary, including the
+        # entries that we never decoded
+        audio[u'path-5'] = {u'title': u'new title'}
+        devices.write_database(ddb, self.tempdir)
+        items[u'path-5'] = {u'title': u'new title'}
+        self.assertEqual(devices.load_database(self.tempdir),
+                         {u'audio': items})
+
+    def test_migrate_json_database(self):
+        data = {u'a': 2,
+                u'b': {u'c': [5, 6]}}
+        os.makedirs(os.path.join(self.tempdir, '.miro'))
+        with open(os.path.join(self.tempdir, '.miro', 'json'), 'w') as f:
+            json.dump(data, f)
+        ddb = devices.load_database(self.tempdir)
+        ddb[u'a'] = 3
+        devices.write_database(ddb, self.tempdir)
+        self.assert_(os.path.exists(os.path.join(self.tempdir, '.miro',
+                                                 'devicedb')))
+        # the old database should be gone, so that older versions don't
+        # load stale data from it
+        self.assert_(not os.path.exists(os.path.join(self.tempdir, '.miro',
+                                                     'json')))
+        self.assertEqual(devices.load_database(self.tempdir),
+                         {u'a': 3, u'b': {u'c': [5, 6]}})
+
+    def test_load_after_older_version_writes(self):
+        ddb = devices.DeviceDatabase({u'a': 1, u'b': {u'c': 2, u'd': 3}})
+        devices.write_database(ddb, self.tempdir)
+        ddb[u'a'] = 2
+        devices.write_database(ddb, self.tempdir)
+        # an older version of Miro mounts the device.  It doesn't see our
+        # database, so it starts from scratch and writes out the JSON
+        # database.
+        json_path = os.path.join(self.tempdir, '.miro', 'json')
+        with open(json_path, 'w') as f:
+            json.dump({u'b': {u'c': 4}, u'e': 5}, f)
+        ddb = devices.load_database(self.tempdir)
+        expected = {u'a': 2, u'b': {u'c': 4, u'd': 3}, u'e': 5}
+        self.assertEqual(ddb, expected)
+        # the next write replaces the JSON database again
+        ddb[u'a'] = 3
+        devices.write_database(ddb, self.tempdir)
+        self.assert_(not os.path.exists(json_path))
+        expected[u'a'] = 3
+        self.assertEqual(devices.load_database(self.tempdir), expected)
 
 class ScanDeviceForFilesTest(EventLoopTest):
     def setUp(self):
@@ -648,9 +759,19 @@ class DeviceSyncManagerTest(EventLoopTest):
         infos, expired = dsm.get_sync_items()
         dsm.start()
         dsm.add_items(infos)
-        self.runPendingIdles()
+        self.wait_for_copies(dsm)
         return infos
 
+    def wait_for_copies(self, dsm, timeout=10.0):
+        """Wait for the copy threads to finish and process the results."""
+        end = time.time() + timeout
+        self.runPendingIdles()
+        while dsm.copying:
+            if time.time() > end:
+                raise AssertionError("copies didn't finish")
+            time.sleep(0.01)
+            self.runPendingIdles()
+
     def test_add_items(self):
         # Test add_items()
         self.check_device_items([])
@@ -767,7 +888,7 @@ class DeviceSyncManagerTest(EventLoopTest):
         dsm.start()
         dsm.add_items(playlist_items)
         dsm.add_items(auto_sync_items, auto_sync=True)
-        self.runPendingIdles()
+        self.wait_for_copies(dsm)
         # check that the device items got created and that auto_sync is set
         # correctly
         db_info=self.device.db_info
@@ -784,6 +905,133 @@ class DeviceSyncManagerTest(EventLoopTest):
         self.assertSameSet(set(i.title for i in self.feed_items),
                            set(i.title for i in auto_sync_items))
 
+    def test_cancel(self):
+        # Test that canceling a sync stops the copies and removes the
+        # partial files
+        dsm = app.device_manager.get_sync_for_device(self.device)
+        infos, expired = dsm.get_sync_items()
+        dsm.start()
+        dsm.add_items(infos)
+        self.assert_(dsm.copying)
+        # Some copies may finish before the cancel, but we process the
+        # results afterwards, so none of them should make it to the device.
+        dsm.cancel()
+        self.wait_for_copies(dsm)
+        self.check_device_items([])
+        for dirpath, dirnames, filenames in os.walk(
+            dsm.audio_target_folder):
+            self.assertEquals(filenames, [])
+        for dirpath, dirnames, filenames in os.walk(
+            dsm.video_target_folder):
+            self.assertEquals(filenames, [])
+
     def test_run_conversion(self):
         # FIXME: Should write this one
         pass
+
+class DeviceFileCopierTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.source_dir = self.make_temp_dir_path()
+        self.dest_dir = self.make_temp_dir_path()
+        self.progress = {}
+        self.progress_calls = 0
+        self.finished = {}
+        self.canceled = False
+        self.copier = devices.DeviceFileCopier(self.on_progress,
+                                               self.on_finished,
+                                               lambda: self.canceled,
+                                               stream_count=2,
+                                               buffer_size=1024)
+
+    def on_progress(self, progress):
+        self.progress_calls += 1
+        for key, count in progress.items():
+            self.progress[key] = self.progress.get(key, 0) + count
+
+    def on_finished(self, key, success):
+        self.finished[key] = success
+
+    def make_source(self, name, size):
+        path = os.path.join(self.source_dir, name)
+        f = open(path, 'wb')
+        f.write(os.urandom(size))
+        f.close()
+        return path
+
+    def copy_files(self, count, size):
+        paths = {}
+        for i in xrange(count):
+            source = self.make_source('file-%d' % i, size)
+            dest = os.path.join(self.dest_dir, 'file-%d' % i)
+            paths[dest] = source
+            self.copier.copy(dest, source, dest)
+        return paths
+
+    def wait_for_copies(self, count, timeout=10.0):
+        end = time.time() + timeout
+        while len(self.finished) < count:
+            if time.time() > end:
+                raise AssertionError("copies didn't finish")
+            time.sleep(0.01)
+            self.runPendingIdles()
+
+    def test_copy(self):
+        paths = self.copy_files(5, 10000)
+        self.wait_for_copies(5)
+        for dest, source in paths.items():
+            self.assertEquals(self.finished[dest], True)
+            self.assertEquals(open(dest, 'rb').read(),
+                              open(source, 'rb').read())
+            self.assertEquals(self.progress[dest], 10000)
+        # progress is reported in batches, not once per block
+        self.assert_(self.progress_calls <= 5)
+        self.assert_(not self.copier.is_active())
+
+    def test_stream_count(self):
+        # check that we never run more copies at once than stream_count
+        lock = threading.Lock()
+        counts = {'current': 0, 'max': 0}
+        real_copy = devices.DeviceFileCopier._copy
+        def count_copies(copier, key, source, dest):
+            with lock:
+                counts['current'] += 1
+                counts['max'] = max(counts['max'], counts['current'])
+            try:
+                time.sleep(0.05)
+                return real_copy(copier, key, source, dest)
+            finally:
+                with lock:
+                    counts['current'] -= 1
+        self.patch_function('miro.devices.DeviceFileCopier._copy',
+                            count_copies)
+        self.copy_files(6, 1000)
+        self.wait_for_copies(6)
+        self.assertEquals(counts['max'], 2)
+
+    def test_cancel(self):
+        self.canceled = True
+        paths = self.copy_files(3, 10000)
+        self.wait_for_copies(3)
+        for dest in paths:
+            self.assertEquals(self.finished[dest], False)
+
+    def test_copy_error(self):
+        dest = os.path.join(self.dest_dir, 'missing')
+        with self.allow_warnings():
+            self.copier.copy(dest, os.path.join(self.source_dir, 'missing'),
+                             dest)
+            self.wait_for_copies(1)
+        self.assertEquals(self.finished[dest], False)
+
+    def test_unexpected_copy_error(self):
+        # errors other than EnvironmentError should also count as a failed
+        # copy, rather than killing the copy thread
+        self.patch_function('miro.fileutil.copy_with_callback',
+                            mock.Mock(side_effect=ValueError()))
+        with self.allow_warnings():
+            paths = self.copy_files(3, 1000)
+            self.wait_for_copies(3)
+        for dest in paths:
+            self.assertEquals(self.finished[dest], False)
+        self.assert_(not self.copier.is_active())
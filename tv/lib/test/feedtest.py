@@ -377,6 +377,84 @@ support participatory culture and build a fairer music industry.</description>
         self.assertEquals(Item.make_view().count(), 4)
         self.check_guids(3, 4, 5, 6)
 
+class ItemMatchingTest(FeedTestCase):
+    # Test matching up entries in a feed with the items we already have
+    def write_feed(self, entries):
+        parts = ["""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Downhill Battle Pics</title>
+      <link>http://downhillbattle.org/</link>
+      <description>Downhill Battle</description>
+"""]
+        for guid, title, url in entries:
+            parts.append("<item>\n")
+            if guid is not None:
+                parts.append("<guid>%s</guid>\n" % guid)
+            parts.append("<title>%s</title>\n" % title)
+            parts.append('<enclosure url="%s" length="100" '
+                         'type="video/mpeg" />\n' % url)
+            parts.append("</item>\n")
+        parts.append("""
+   </channel>
+</rss>""")
+        self.write_file("".join(parts))
+
+    def item_data(self):
+        return sorted((i.rss_id, i.entry_title, i.url)
+                      for i in Item.make_view())
+
+    def test_match_by_guid(self):
+        self.write_feed([(u'guid-1', u'One', u'http://example.com/1.mpg'),
+                         (u'guid-2', u'Two', u'http://example.com/2.mpg')])
+        feed = self.make_feed()
+        # change the title and url, we should still match on the guid
+        self.write_feed([(u'guid-1', u'New', u'http://example.com/new.mpg'),
+                         (u'guid-2', u'Two', u'http://example.com/2.mpg')])
+        self.update_feed(feed)
+        self.assertEquals(self.item_data(), [
+            (u'guid-1', u'New', u'http://example.com/new.mpg'),
+            (u'guid-2', u'Two', u'http://example.com/2.mpg'),
+        ])
+
+    def test_match_by_url_and_title(self):
+        self.write_feed([(None, u'One', u'http://example.com/1.mpg'),
+                         (None, u'Two', u'http://example.com/2.mpg')])
+        feed = self.make_feed()
+        self.update_feed(feed)
+        self.assertEquals(len(self.item_data()), 2)
+        # adding a guid to an entry shouldn't make a new item
+        self.write_feed([(u'guid-1', u'One', u'http://example.com/1.mpg'),
+                         (None, u'Two', u'http://example.com/2.mpg')])
+        self.update_feed(feed)
+        self.assertEquals(self.item_data(), [
+            (None, u'Two', u'http://example.com/2.mpg'),
+            (u'guid-1', u'One', u'http://example.com/1.mpg'),
+        ])
+
+    def test_match_keyless_by_enclosure(self):
+        self.write_feed([(None, u'One', u'http://example.com/1.mpg'),
+                         (None, u'Two', u'http://example.com/2.mpg')])
+        feed = self.make_feed()
+        # a new title for an item without a guid.  The enclosure is the
+        # same, so we should update the old item rather than making a new
+        # one.
+        self.write_feed([(None, u'New', u'http://example.com/1.mpg'),
+                         (None, u'Two', u'http://example.com/2.mpg')])
+        self.update_feed(feed)
+        self.assertEquals(self.item_data(), [
+            (None, u'New', u'http://example.com/1.mpg'),
+            (None, u'Two', u'http://example.com/2.mpg'),
+        ])
+
+    def test_many_entries(self):
+        entries = [(None, u'Title %d' % i, u'http://example.com/%d.mpg' % i)
+                   for i in xrange(1200)]
+        self.write_feed(entries)
+        feed = self.make_feed()
+        self.update_feed(feed)
+        self.assertEquals(len(self.item_data()), 1200)
+
 class FeedParserAttributesTestCase(FeedTestCase):
     """Test that we save/restore attributes from feedparser correctly.
 
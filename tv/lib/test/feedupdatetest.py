@@ -0,0 +1,169 @@
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class MockFeed(signals.SignalEmitter):
+    def __init__(self, id_, url, autodownload_mode=u'off', folder_id=None):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.url = url
+        self.autodownload_mode = autodownload_mode
+        self.folder_id = folder_id
+
+    def get_url(self):
+        return self.url
+
+    def get_autodownload_mode(self):
+        return self.autodownload_mode
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.time = 1000.0
+        self.patch_function('miro.feedupdate.clock', lambda: self.time)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.updating = []
+        self.feed_counter = 0
+
+    def make_feed(self, host, **kwargs):
+        self.feed_counter += 1
+        return MockFeed(self.feed_counter,
+                        u'http://%s/feed-%d' % (host, self.feed_counter),
+                        **kwargs)
+
+    def schedule(self, feed, delay=0):
+        self.queue.schedule_update(delay, feed,
+                                   lambda: self.updating.append(feed))
+
+    def run_due_updates(self):
+        self.queue.do_updates()
+
+    def finish_update(self, feed, update_time=1.0, error=False):
+        self.time += update_time
+        if error:
+            self.queue.report_error(feed)
+        self.updating.remove(feed)
+        feed.emit('update-finished')
+        self.runPendingIdles()
+
+    def test_limit(self):
+        feeds = [self.make_feed('host%d' % i) for i in xrange(10)]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_due_updates()
+        self.assertEquals(self.updating, feeds[:feedupdate.INITIAL_UPDATES])
+        self.finish_update(feeds[0])
+        self.assertEquals(len(self.updating), feedupdate.INITIAL_UPDATES)
+        self.assert_(feeds[feedupdate.INITIAL_UPDATES] in self.updating)
+
+    def test_delay(self):
+        feed = self.make_feed('host')
+        self.schedule(feed, 60)
+        self.run_due_updates()
+        self.assertEquals(self.updating, [])
+        self.time += 61
+        self.run_due_updates()
+        self.assertEquals(self.updating, [feed])
+
+    def test_cancel(self):
+        feed = self.make_feed('host')
+        self.schedule(feed)
+        self.queue.cancel_update(feed)
+        self.run_due_updates()
+        self.assertEquals(self.updating, [])
+
+    def test_priority(self):
+        plain = self.make_feed('host1')
+        autodownload = self.make_feed('host2', autodownload_mode=u'new')
+        frequent = self.make_feed('host3')
+        visible = self.make_feed('host4')
+        self.queue.record_new_items(frequent, 5)
+        self.queue.set_feed_visible(visible.id, True)
+        self.queue.max_updates = 1
+        for feed in (plain, frequent, autodownload, visible):
+            self.schedule(feed)
+        self.run_due_updates()
+        order = []
+        while self.updating:
+            order.append(self.updating[0])
+            self.finish_update(self.updating[0])
+        self.assertEquals(order, [visible, autodownload, frequent, plain])
+
+    def test_same_host_grouping(self):
+        self.queue.max_updates = 1
+        feeds = [self.make_feed('host1'), self.make_feed('host2'),
+                 self.make_feed('host1')]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_due_updates()
+        order = []
+        while self.updating:
+            order.append(self.updating[0])
+            self.finish_update(self.updating[0])
+        # after updating the first host1 feed, we should stick with host1
+        self.assertEquals(order, [feeds[0], feeds[2], feeds[1]])
+
+    def test_per_host_limit(self):
+        feeds = [self.make_feed('host') for i in xrange(5)]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_due_updates()
+        self.assertEquals(self.updating,
+                          feeds[:feedupdate.MAX_UPDATES_PER_HOST])
+
+    def test_backoff(self):
+        feed = self.make_feed('host')
+        feed2 = self.make_feed('host')
+        other_host_feed = self.make_feed('host2')
+        self.schedule(feed)
+        self.run_due_updates()
+        self.finish_update(feed, error=True)
+        # the error should make us wait before updating from host again
+        self.schedule(feed2)
+        self.schedule(other_host_feed)
+        self.run_due_updates()
+        self.assertEquals(self.updating, [other_host_feed])
+        self.time += feedupdate.BACKOFF_MIN
+        self.run_due_updates()
+        self.assertEquals(self.updating, [other_host_feed, feed2])
+        # errors in a row should double the backoff time
+        self.finish_update(feed2, error=True)
+        error_count, retry_time = self.queue.host_errors['host']
+        self.assertEquals(error_count, 2)
+        self.assertEquals(retry_time - self.time,
+                          feedupdate.BACKOFF_MIN * 2)
+        # a successful update should reset it
+        self.time = retry_time
+        self.schedule(feed)
+        self.run_due_updates()
+        self.finish_update(feed)
+        self.assert_('host' not in self.queue.host_errors)
+
+    def test_adapt_max_updates(self):
+        feeds = [self.make_feed('host%d' % i) for i in xrange(50)]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_due_updates()
+        # fast updates with feeds waiting should raise the limit
+        for i in xrange(20):
+            self.finish_update(self.updating[0], update_time=1.0)
+        self.assert_(self.queue.max_updates > feedupdate.INITIAL_UPDATES)
+        # slow updates should lower it
+        old_max = self.queue.max_updates
+        for i in xrange(20):
+            self.finish_update(self.updating[0], update_time=60.0)
+        self.assert_(self.queue.max_updates < old_max)
+        self.assert_(self.queue.max_updates >= feedupdate.MIN_UPDATES)
+
+    def test_cycle_stats(self):
+        feeds = [self.make_feed('host%d' % i) for i in xrange(4)]
+        for feed in feeds:
+            self.schedule(feed)
+        self.run_due_updates()
+        while self.updating:
+            self.finish_update(self.updating[0], update_time=2.0)
+        stats = self.queue.stats
+        self.assertEquals(stats.update_count, 4)
+        self.assertEquals(stats.cycle_count, 1)
+        self.assertEquals(stats.last_cycle_updates, 4)
+        self.assertEquals(stats.last_cycle_time, 8.0)
@@ -35,6 +35,7 @@ from miro import threadcheck
 from time import sleep
 from miro import models
 from miro import workerprocess
+from miro.data import downloadstats
 from miro.data import itemtrack
 from miro.fileobject import FilenameType
 
@@ -284,6 +285,7 @@ class MiroTestCase(unittest.TestCase):
         app.in_unit_tests = True
         app.device_manager = devices.DeviceManager()
         models.Item._path_count_tracker.reset()
+        downloadstats.reset()
         testobjects.test_started(self)
         # Tweak Item to allow us to make up fake paths for FileItems
         models.Item._allow_nonexistent_paths = True
@@ -628,6 +630,15 @@ class EventLoopTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
         self.hadToStopEventLoop = False
+        # Threads left over from earlier tests can call eventloop.shutdown()
+        # after we've created a new eventloop.  Make sure we start with the
+        # quit flags cleared, otherwise the thread pool drops its results.
+        self.reset_quit_flags()
+
+    def reset_quit_flags(self):
+        eventloop._eventloop.quit_flag = False
+        eventloop._eventloop.idle_queue.quit_flag = False
+        eventloop._eventloop.urgent_queue.quit_flag = False
 
     def stopEventLoop(self, abnormal = True):
         self.hadToStopEventLoop = abnormal
@@ -652,9 +663,7 @@ class EventLoopTest(MiroTestCase):
 
     def runEventLoop(self, timeout=10, timeoutNormal=False):
         eventloop.thread_pool_init()
-        eventloop._eventloop.quit_flag = False
-        eventloop._eventloop.idle_queue.quit_flag = False
-        eventloop._eventloop.urgent_queue.quit_flag = False
+        self.reset_quit_flags()
         try:
             self.hadToStopEventLoop = False
             timeout_handle = eventloop.add_timeout(timeout,
@@ -1,11 +1,17 @@
+import os
+
+from miro import app
 from miro import database
+from miro import prefs
 
 from miro import iconcache
 from miro import item
 from miro import feed
 from miro import guide
 
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test import mock
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                  uses_httpclient)
 
 class IconCacheTest(EventLoopTest):
     def setUp(self):
@@ -52,3 +58,102 @@ class IconCacheTest(EventLoopTest):
                 iconcache.IconCache.get_by_id, item_icon_cache_id)
         self.assertRaises(database.ObjectNotFoundError,
                 iconcache.IconCache.get_by_id, guide_icon_cache_id)
+
+    def test_shared_file_removed_with_last_user(self):
+        # IconCaches with the same icon data share a file.  It should only be
+        # removed once nothing uses it.
+        app.config.set(prefs.ICON_CACHE_DIRECTORY, self.tempdir)
+        filename, already_stored = iconcache.store_icon_data('data', 'a.png')
+        for obj in (self.feed, self.item):
+            obj.icon_cache.filename = filename
+            obj.icon_cache.signal_change()
+        self.item.remove()
+        self.assert_(os.path.exists(filename))
+        self.feed.remove()
+        self.assert_(not os.path.exists(filename))
+
+    def test_coalesce_requests(self):
+        app.config.set(prefs.ICON_CACHE_DIRECTORY, self.tempdir)
+        grab_url = self.patch_for_test('miro.httpclient.grab_url')
+        updater = iconcache.IconCacheUpdater()
+        patcher = mock.patch.object(iconcache, 'icon_cache_updater', updater)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+        url = u'http://example.com/icon.png'
+        items = []
+        for i in xrange(3):
+            items.append(item.Item(item.FeedParserValues({}),
+                                   feed_id=self.feed.id))
+            items[-1].thumbnail_url = url
+        for obj in items:
+            obj.icon_cache.request_icon()
+        # the IconCaches should share one request
+        self.assertEquals(grab_url.call_count, 1)
+        grab_url.call_args[0][1]({'status': 200, 'body': 'x' * 100,
+                                  'filename': 'icon.png'})
+        filenames = set(obj.icon_cache.filename for obj in items)
+        self.assertEquals(len(filenames), 1)
+        self.assertEquals(open(filenames.pop()).read(), 'x' * 100)
+        stats = updater.stats
+        self.assertEquals(stats.requests, 3)
+        self.assertEquals(stats.http_requests, 1)
+        self.assertEquals(stats.coalesced, 2)
+        self.assertEquals(stats.bytes_downloaded, 100)
+        # each IconCache after the first saved the bytes once
+        self.assertEquals(stats.bytes_saved, 200)
+        # a request with different headers shouldn't be merged
+        updater.fetch(url, mock.Mock(), None)
+        updater.fetch(url, mock.Mock(), None, etag=u'abc')
+        self.assertEquals(grab_url.call_count, 3)
+
+class IconCacheUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.updater = iconcache.IconCacheUpdater()
+        self.grab_url = self.patch_for_test('miro.httpclient.grab_url')
+        self.add_idle = self.patch_for_test('miro.eventloop.add_idle')
+
+    def make_icon_cache(self, id_):
+        icon_cache = mock.Mock()
+        icon_cache.id = id_
+        return icon_cache
+
+    def test_conditional_request(self):
+        url = u'http://example.com/icon.png'
+        self.updater.fetch(url, mock.Mock(), None, etag=u'abc',
+                           modified=u'yesterday')
+        kwargs = self.grab_url.call_args[1]
+        self.assertEquals(kwargs['etag'], u'abc')
+        self.assertEquals(kwargs['modified'], u'yesterday')
+        self.grab_url.call_args[0][1]({'status': 304})
+        self.assertEquals(self.updater.stats.not_modified, 1)
+
+    def test_prioritize(self):
+        icon_caches = [self.make_icon_cache(i) for i in xrange(5)]
+        self.updater.running_count = iconcache.RUNNING_MAX
+        for icon_cache in icon_caches:
+            self.updater.request_update(icon_cache)
+        self.updater.prioritize([3, 4])
+        self.updater.prioritize([2, 3])
+        order = []
+        for i in xrange(5):
+            self.updater.update_finished()
+            order.append(self.add_idle.call_args[0][0])
+        self.assertEquals(order, [icon_caches[i].request_icon
+                                  for i in (3, 2, 0, 1, 4)])
+
+    def test_store_icon_data(self):
+        app.config.set(prefs.ICON_CACHE_DIRECTORY, self.tempdir)
+        filename, already_stored = iconcache.store_icon_data('data',
+                                                             'icon.png')
+        self.assertEquals(already_stored, False)
+        self.assert_(filename.endswith('.png'))
+        self.assertEquals(open(filename).read(), 'data')
+        # the same data should be stored in the same file
+        self.assertEquals(iconcache.store_icon_data('data', 'other.png'),
+                          (filename, True))
+        # different data goes to a different file
+        filename2, already_stored = iconcache.store_icon_data('data2',
+                                                              'icon.png')
+        self.assertNotEquals(filename, filename2)
+        self.assertEquals(already_stored, False)
@@ -0,0 +1,292 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""imagepooltest.py -- Test loading and caching images."""
+
+import os
+import threading
+
+from miro.frontends.widgets import imagepool
+from miro.test import mock
+from miro.test.framework import MiroTestCase
+
+class FakeImage(object):
+    """Image that "decodes" files containing a WIDTHxHEIGHT string.
+
+    decoded counts how many times we decoded each path.
+    """
+    decoded = {}
+
+    def __init__(self, path=None, width=None, height=None):
+        if path is not None:
+            FakeImage.decoded[path] = FakeImage.decoded.get(path, 0) + 1
+            width, height = [int(x) for x in open(path).read().split('x')]
+        self.width = width
+        self.height = height
+
+    def resize(self, width, height):
+        return FakeImage(width=width, height=height)
+
+    def crop_and_scale(self, src_x, src_y, src_width, src_height,
+                       dest_width, dest_height):
+        return FakeImage(width=dest_width, height=dest_height)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write('%dx%d' % (self.width, self.height))
+
+class FakeSurface(object):
+    def __init__(self, image):
+        self.image = image
+        self.width = image.width
+        self.height = image.height
+
+class ImagePoolTestCase(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        FakeImage.decoded = {}
+        widgetset = mock.Mock()
+        widgetset.Image = FakeImage
+        widgetset.ImageSurface = FakeSurface
+        # callbacks that loader threads send to the UI thread.  The test
+        # runs them with run_ui_thread_callbacks().
+        self.ui_thread_callbacks = []
+        self.ui_thread_lock = threading.Lock()
+        self.patch_object('widgetset', widgetset)
+        self.patch_object('call_on_ui_thread', self.call_on_ui_thread)
+        self.patch_object('_imagepool', imagepool.ImagePool(10))
+        self.patch_object('_image_surface_pool',
+                          imagepool.ImageSurfacePool(10))
+        self.patch_object('_thumbnail_cache', imagepool.ThumbnailCache())
+        self.patch_object('_image_loader', None)
+
+    def patch_object(self, name, value):
+        patcher = mock.patch.object(imagepool, name, value)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+
+    def call_on_ui_thread(self, func, *args):
+        with self.ui_thread_lock:
+            self.ui_thread_callbacks.append((func, args))
+
+    def run_ui_thread_callbacks(self):
+        with self.ui_thread_lock:
+            callbacks = self.ui_thread_callbacks
+            self.ui_thread_callbacks = []
+        for func, args in callbacks:
+            func(*args)
+
+    def make_image_file(self, width, height):
+        path = self.make_temp_path('.png')
+        with open(path, 'w') as f:
+            f.write('%dx%d' % (width, height))
+        return path
+
+class ThumbnailCacheTest(ImagePoolTestCase):
+    def setUp(self):
+        ImagePoolTestCase.setUp(self)
+        self.cache = imagepool.ThumbnailCache()
+
+    def test_miss(self):
+        path = self.make_image_file(100, 100)
+        self.assertEquals(self.cache.load(path, (10, 10)), None)
+        # missing source files don't have thumbnails
+        self.assertEquals(self.cache.load(path + 'x', (10, 10)), None)
+
+    def test_hit(self):
+        path = self.make_image_file(100, 100)
+        self.cache.save(path, (10, 10), FakeImage(width=10, height=10))
+        image = self.cache.load(path, (10, 10))
+        self.assertEquals((image.width, image.height), (10, 10))
+        # other sizes are stored separately
+        self.assertEquals(self.cache.load(path, (20, 20)), None)
+
+    def test_source_changed(self):
+        path = self.make_image_file(100, 100)
+        self.cache.save(path, (10, 10), FakeImage(width=10, height=10))
+        mtime = os.path.getmtime(path)
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertEquals(self.cache.load(path, (10, 10)), None)
+
+    def test_load_image_uses_cache(self):
+        path = self.make_image_file(100, 50)
+        image = imagepool.load_image(path, (20, 20), save_thumbnail=True)
+        self.assertEquals((image.width, image.height), (20, 20))
+        self.assertEquals(FakeImage.decoded[path], 1)
+        # the second load should come from the thumbnail cache
+        image = imagepool.load_image(path, (20, 20))
+        self.assertEquals((image.width, image.height), (20, 20))
+        self.assertEquals(FakeImage.decoded[path], 1)
+
+    def test_sync_load_doesnt_save(self):
+        # loading an image on the UI thread shouldn't write to the cache
+        path = self.make_image_file(100, 50)
+        image = imagepool.get(path, (20, 20))
+        self.assertEquals((image.width, image.height), (20, 20))
+        self.assertEquals(self.cache.load(path, (20, 20)), None)
+        self.assertEquals(os.listdir(self.cache.directory()), [])
+
+    def test_trim(self):
+        paths = []
+        for i in xrange(5):
+            path = self.make_image_file(100, 100)
+            self.cache.save(path, (10, 10), FakeImage(width=10, height=10))
+            cache_path = self.cache.cache_path(path, (10, 10))
+            # make the files older to newer
+            os.utime(cache_path, (1000 + i, 1000 + i))
+            paths.append(path)
+        self.cache.trim(max_files=2)
+        self.assertEquals(len(os.listdir(self.cache.directory())), 2)
+        for path in paths[:3]:
+            self.assertEquals(self.cache.load(path, (10, 10)), None)
+        for path in paths[3:]:
+            self.assertNotEquals(self.cache.load(path, (10, 10)), None)
+
+class ImageLoaderTest(ImagePoolTestCase):
+    def setUp(self):
+        ImagePoolTestCase.setUp(self)
+        # don't start any threads, we run the requests ourselves
+        self.loader = imagepool.ImageLoader(thread_count=0)
+        # skip the initial trim() request
+        self.loader.queue.get()
+
+    def run_next_request(self):
+        self.loader.queue.get_nowait()()
+
+    def test_load(self):
+        path = self.make_image_file(100, 100)
+        callback = mock.Mock()
+        self.loader.load((path, (10, 10)), None, callback)
+        self.run_next_request()
+        # the callback should wait for the UI thread
+        self.assertEquals(callback.call_count, 0)
+        self.run_ui_thread_callbacks()
+        callback.assert_called_once_with()
+        image = imagepool._imagepool.get_if_cached((path, (10, 10)))
+        self.assertEquals((image.width, image.height), (10, 10))
+        # loader threads should store the thumbnail on disk
+        self.assertNotEquals(
+            imagepool._thumbnail_cache.load(path, (10, 10)), None)
+
+    def test_merge_requests(self):
+        path = self.make_image_file(100, 100)
+        callbacks = [mock.Mock() for i in xrange(3)]
+        for callback in callbacks:
+            self.loader.load((path, (10, 10)), None, callback)
+        self.loader.load((path, (10, 10)), None, None)
+        self.assertEquals(self.loader.queue.qsize(), 1)
+        self.run_next_request()
+        self.run_ui_thread_callbacks()
+        self.assertEquals(FakeImage.decoded[path], 1)
+        for callback in callbacks:
+            callback.assert_called_once_with()
+        # once the load is finished, new requests load the image again
+        self.loader.load((path, (10, 10)), None, None)
+        self.assertEquals(self.loader.queue.qsize(), 1)
+
+    def test_newest_first(self):
+        paths = [self.make_image_file(100, 100) for i in xrange(3)]
+        loaded = []
+        for path in paths:
+            self.loader.load((path, (10, 10)), None,
+                             lambda path=path: loaded.append(path))
+        for i in xrange(3):
+            self.run_next_request()
+        self.run_ui_thread_callbacks()
+        self.assertEquals(loaded, list(reversed(paths)))
+
+    def test_callback_error(self):
+        path = self.make_image_file(100, 100)
+        bad_callback = mock.Mock(side_effect=ValueError())
+        callback = mock.Mock()
+        self.loader.load((path, (10, 10)), None, bad_callback)
+        self.loader.load((path, (10, 10)), None, callback)
+        self.run_next_request()
+        with self.allow_warnings():
+            self.run_ui_thread_callbacks()
+        callback.assert_called_once_with()
+
+class GetSurfaceAsyncTest(ImagePoolTestCase):
+    def test_load_in_thread(self):
+        path = self.make_image_file(100, 100)
+        callback_threads = []
+        def callback():
+            callback_threads.append(threading.current_thread())
+        self.assertEquals(imagepool.get_surface_async(path, (10, 10),
+                                                      callback=callback),
+                          None)
+        imagepool._image_loader.wait_until_idle()
+        self.assertEquals(callback_threads, [])
+        self.run_ui_thread_callbacks()
+        # the callback should run on our thread, not the loader thread
+        self.assertEquals(callback_threads, [threading.current_thread()])
+        # now the surface should be ready without loading anything
+        callback = mock.Mock()
+        surface = imagepool.get_surface_async(path, (10, 10),
+                                              callback=callback)
+        self.assertEquals((surface.width, surface.height), (10, 10))
+        self.assertEquals(FakeImage.decoded[path], 1)
+        self.assertEquals(callback.call_count, 0)
+
+    def test_image_already_loaded(self):
+        # if the image is in the cache, we should make a surface right away
+        path = self.make_image_file(100, 100)
+        imagepool.get(path, (10, 10))
+        surface = imagepool.get_surface_async(path, (10, 10))
+        self.assertEquals((surface.width, surface.height), (10, 10))
+        self.assertEquals(imagepool._image_loader, None)
+
+    def test_invalidated(self):
+        path = self.make_image_file(100, 100)
+        imagepool.get_surface(path, (10, 10), invalidator=lambda key: True)
+        self.assertEquals(imagepool.get_surface_async(
+            path, (10, 10), invalidator=lambda key: True), None)
+        imagepool._image_loader.wait_until_idle()
+
+class ImagePoolEvictionTest(ImagePoolTestCase):
+    def test_byte_budget(self):
+        pool = imagepool.ImagePool(10, 3 * 10 * 10 *
+                                   imagepool.BYTES_PER_PIXEL)
+        paths = [self.make_image_file(100, 100) for i in xrange(4)]
+        for path in paths:
+            pool.get((path, (10, 10)))
+        # only 3 10x10 images fit in the budget
+        self.assertFalse(pool.is_cached((paths[0], (10, 10))))
+        for path in paths[1:]:
+            self.assert_(pool.is_cached((path, (10, 10))))
+        self.assertEquals(pool.stats()['evictions'], 1)
+
+    def test_release_memory(self):
+        paths = [self.make_image_file(100, 100) for i in xrange(4)]
+        for path in paths:
+            imagepool.get_surface(path, (10, 10))
+        imagepool.release_memory(0.5)
+        stats = imagepool.get_stats()
+        self.assertEquals(stats['images']['entries'], 2)
+        self.assertEquals(stats['surfaces']['entries'], 2)
@@ -36,6 +36,7 @@ import string
 import weakref
 
 from miro import app
+from miro import messages
 from miro import models
 from miro import util
 from miro.frontends.widgets import itemlist
@@ -187,6 +188,51 @@ class ItemListTest(MiroTestCase):
         self.item_list.set_sort(itemsort.TitleSort())
         self.check_group_info(last_letter_grouping)
 
+    def test_sql_grouping(self):
+        # give items albums so that they form several groups
+        albums = itertools.cycle([u'Album A', u'Album B', u'Album C'])
+        for item in self.items:
+            item.album = albums.next()
+            item.artist = u'Artist'
+            item.signal_change()
+        app.db.finish_transaction()
+        self.item_list.set_sort(itemsort.AlbumSort())
+        self.item_list.set_grouping(itemlist.album_grouping)
+        self.assertEquals(self.item_list.query.value_columns,
+                          [('item', 'album_artist'), ('item', 'artist'),
+                           ('item', 'album')])
+        self.check_group_info(itemlist.album_grouping)
+        # changing the sort should keep the values and the groups
+        self.item_list.set_sort(itemsort.DateSort())
+        self.check_group_info(itemlist.album_grouping)
+        # change an item so that it joins the group of the item before it.
+        # The row order stays the same, so the list shouldn't change.
+        first_item = self.item_list.get_row(0)
+        item = self.items[[i.id for i in self.items].index(
+            self.item_list.get_row(1).id)]
+        item.album = first_item.album
+        item.signal_change()
+        app.db.finish_transaction()
+        self.list_changed_handler.reset_mock()
+        self.item_list.on_item_changes(messages.ItemChanges(
+            set(), set([item.id]), set(), set(['album']), False, False))
+        self.assertEquals(self.list_changed_handler.call_count, 0)
+        self.assertEquals(self.item_list.get_group_info(1)[0], 1)
+        self.check_group_info(itemlist.album_grouping)
+        # change it back
+        item.album = u'Other Album'
+        item.signal_change()
+        app.db.finish_transaction()
+        self.item_list.on_item_changes(messages.ItemChanges(
+            set(), set([item.id]), set(), set(['album']), False, False))
+        self.check_group_info(itemlist.album_grouping)
+        # switching back to a plain grouping function should still work
+        def title_grouping(info):
+            return info.title[-1]
+        self.item_list.set_grouping(title_grouping)
+        self.assertEquals(self.item_list.query.value_columns, [])
+        self.check_group_info(title_grouping)
+
 class TestItemListPool(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
@@ -8,11 +8,12 @@ from miro import prefs
 from miro.feed import Feed
 from miro.item import Item, FileItem, FeedParserValues, on_new_metadata
 from miro.fileobject import FilenameType
-from miro.downloader import RemoteDownloader
+from miro.downloader import RemoteDownloader, shutdown_downloader_objects
 from miro.test import mock, testobjects
 from miro.test.framework import MiroTestCase, EventLoopTest
 from miro.singleclick import _build_entry
 from miro.plat.utils import unicode_to_filename
+from miro.data import downloadstats
 
 def fp_values_for_url(url, additional=None):
     return FeedParserValues(_build_entry(url, 'video/x-unknown', additional))
@@ -541,3 +542,74 @@ class ItemSizeTest(MiroTestCase):
         with self.allow_warnings():
             item.set_filename('non-existant-path')
         self.check_size(item, None)
+
+class DownloadStatsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = testobjects.make_feed()
+        self.item = testobjects.make_item(self.feed, u'my item')
+        self.item.download()
+        self.downloader = self.item.downloader
+        self.update_status(rate=100, eta=50, current_size=500)
+
+    def update_status(self, **kwargs):
+        status = {
+            'dlid': self.downloader.dlid,
+            'state': u'downloading',
+            'total_size': 10000,
+            'type': u'HTTP',
+        }
+        status.update(kwargs)
+        RemoteDownloader.update_status(status, cmd_done=True)
+
+    def saved_value(self, column):
+        app.db.cursor.execute("SELECT %s FROM remote_downloader "
+                              "WHERE id=?" % column, (self.downloader.id,))
+        return app.db.cursor.fetchone()[0]
+
+    def test_stats_not_saved(self):
+        # changes that only touch the transfer stats shouldn't be written
+        # to disk right away
+        self.update_status(rate=200, eta=40, current_size=1000)
+        self.assertEquals(self.downloader.rate, 200)
+        self.assertEquals(self.saved_value('rate'), 100)
+        self.assertEquals(self.saved_value('current_size'), 500)
+        # ItemInfo should get the stats from downloadstats
+        info = testobjects.make_item_info(self.item)
+        self.assertEquals(info.rate, 200)
+        self.assertEquals(info.eta, 40)
+        self.assertEquals(info.downloaded_size, 1000)
+
+    def test_checkpoint(self):
+        self.downloader.last_stats_checkpoint -= (
+            RemoteDownloader.STATS_CHECKPOINT_INTERVAL)
+        self.update_status(rate=200, eta=40, current_size=1000)
+        self.assertEquals(self.saved_value('rate'), 200)
+        self.assertEquals(self.saved_value('current_size'), 1000)
+        # the next update is soon after the checkpoint, so it's not saved
+        self.update_status(rate=300, eta=30, current_size=1500)
+        self.assertEquals(self.saved_value('rate'), 200)
+
+    def test_other_changes_saved(self):
+        # changes to other attributes should also save the stats
+        self.update_status(rate=200, eta=40, current_size=1000,
+                           total_size=20000)
+        self.assertEquals(self.saved_value('total_size'), 20000)
+        self.assertEquals(self.saved_value('rate'), 200)
+
+    def test_stats_removed(self):
+        self.assert_(downloadstats.get(self.downloader.id) is not None)
+        self.downloader.pause()
+        self.assertEquals(downloadstats.get(self.downloader.id), None)
+        self.downloader.start()
+        self.update_status(rate=200, eta=40, current_size=1000)
+        self.assert_(downloadstats.get(self.downloader.id) is not None)
+        downloader_id = self.downloader.id
+        self.item.remove()
+        self.assertEquals(downloadstats.get(downloader_id), None)
+
+    def test_saved_on_shutdown(self):
+        self.update_status(rate=200, eta=40, current_size=1000)
+        shutdown_downloader_objects()
+        self.assertEquals(self.saved_value('rate'), 200)
+        self.assertEquals(self.saved_value('current_size'), 1000)
@@ -372,6 +372,60 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_no_signals()
         self.check_tracker_items()
 
+    def test_incremental_update(self):
+        # test that ItemTracker updates its list without re-running the query
+        # for simple changes
+        rows_changed_handler = mock.Mock()
+        self.tracker.connect('rows-changed', rows_changed_handler)
+        self.run_all_tracker_idles()
+        self.tracker._fetch_id_list = mock.Mock(
+            wraps=self.tracker._fetch_id_list)
+        new_item = testobjects.make_item(self.tracked_feed, u'new-item')
+        to_remove = self.tracked_items.pop(0)
+        old_index = self.tracker.get_index(to_remove.id)
+        to_remove.remove()
+        self.check_list_change_after_message()
+        self.assertEquals(self.tracker._fetch_id_list.call_count, 0)
+        # the rows for the old items should still be loaded
+        self.assertEquals(len(self.tracker.row_data), len(self.tracker) - 1)
+        self.check_tracker_items()
+        # check the rows-changed signal
+        self.assertEquals(rows_changed_handler.call_count, 1)
+        changes = rows_changed_handler.call_args[0][1]
+        self.assertEquals(changes.removed, [(old_index, 1)])
+        self.assertEquals(changes.inserted,
+                          [(self.tracker.get_index(new_item.id), 1)])
+        self.assertEquals(changes.moved, [])
+        # test items moving in the list
+        rows_changed_handler.reset_mock()
+        item1 = models.Item.get_by_id(self.tracker.get_row(0).id)
+        item1.release_date += datetime.timedelta(days=400)
+        item1.signal_change()
+        old_index = self.tracker.get_index(item1.id)
+        self.check_list_change_after_message()
+        self.check_tracker_items()
+        self.assertEquals(self.tracker._fetch_id_list.call_count, 0)
+        changes = rows_changed_handler.call_args[0][1]
+        self.assertEquals(changes.moved,
+                          [(old_index, self.tracker.get_index(item1.id))])
+        # test changes to an order by column that don't move the item
+        item1.release_date += datetime.timedelta(seconds=1)
+        item1.signal_change()
+        self.check_items_changed_after_message([item1])
+
+    def test_incremental_update_fallback(self):
+        # test that we re-run the query when we can't calculate where items go
+        query = self.tracker.query.copy()
+        query.set_complex_order_by(['release_date'],
+                                   'item.release_date DESC')
+        self.tracker.change_query(query)
+        self.check_one_signal('list-changed')
+        self.tracker._fetch_id_list = mock.Mock(
+            wraps=self.tracker._fetch_id_list)
+        testobjects.make_item(self.tracked_feed, u'new-item')
+        self.check_list_change_after_message()
+        self.assertEquals(self.tracker._fetch_id_list.call_count, 1)
+
     def test_extra_conditions(self):
         # test adding more conditions
         titles = [i.title for i in self.tracked_items]
@@ -628,6 +682,102 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
                           u'new title')
         self.assertRaises(KeyError, self.tracker.get_item, item2.id)
 
+    def wait_for_prefetch(self):
+        itemtrack.get_prefetch_worker().wait_until_idle()
+
+    def test_prefetch(self):
+        # test that set_visible_range() loads rows in the background
+        self.tracker.set_visible_range(0, 2)
+        self.wait_for_prefetch()
+        for i in xrange(len(self.tracker)):
+            self.tracker.get_row(i)
+        stats = self.tracker.get_stats()
+        self.assertEquals(stats.hits, len(self.tracked_items))
+        self.assertEquals(stats.misses, 0)
+        self.assertEquals(stats.prefetched, len(self.tracked_items))
+        self.check_tracker_items()
+
+    def test_prefetch_uses_read_transaction(self):
+        # test that prefetched data comes from the same read transaction that
+        # we selected the ids with.
+        item1 = self.tracked_items[0]
+        old_title = item1.title
+        item1.title = u'new title'
+        item1.signal_change()
+        app.db.finish_transaction()
+        self.tracker.set_visible_range(0, 2)
+        self.wait_for_prefetch()
+        self.assertEquals(self.tracker.get_item(item1.id).title, old_title)
+        self.assertEquals(self.tracker.get_stats().misses, 0)
+        # After ItemTracker gets the ItemChanges message, it should load the
+        # new data
+        self.process_items_changed_messages()
+        self.assertEquals(self.tracker.get_item(item1.id).title,
+                          u'new title')
+
+    def test_prefetch_results_after_change(self):
+        # test that rows prefetched before an ItemChanges message don't
+        # replace the new data
+        item1 = self.tracked_items[0]
+        self.tracker.set_visible_range(0, 2)
+        self.wait_for_prefetch()
+        item1.title = u'new title'
+        item1.signal_change()
+        self.process_items_changed_messages()
+        self.assertEquals(self.tracker.get_item(item1.id).title,
+                          u'new title')
+
+    def test_row_cache_size(self):
+        # test that we only keep a limited number of rows in memory
+        self.tracker.row_data.capacity = 4
+        for i in xrange(len(self.tracker)):
+            self.tracker.get_row(i)
+        self.assertEquals(len(self.tracker.row_data), 4)
+        # the most recently used rows should be kept
+        last_ids = [self.tracker.get_row(i).id
+                    for i in xrange(len(self.tracker)-4, len(self.tracker))]
+        self.assertSameSet(self.tracker.row_data.keys(), last_ids)
+        # idle callbacks shouldn't try to load a list that doesn't fit in
+        # memory
+        self.run_all_tracker_idles()
+        self.assertEquals(len(self.tracker.row_data), 4)
+        self.check_tracker_items()
+
+    def test_big_list_keeps_snapshot(self):
+        # if the list doesn't fit in memory, we load rows as they're needed.
+        # The ItemFetcher should keep reading from the data our id list came
+        # from until we get the ItemChanges message.
+        self.tracker.row_data.capacity = 4
+        done_fetching = mock.Mock()
+        self.tracker.item_fetcher.done_fetching = done_fetching
+        self.run_all_tracker_idles()
+        self.assertEquals(done_fetching.call_count, 0)
+        correct_items = self.calc_items_in_tracker()
+        self.tracked_items[0].remove()
+        self.tracked_items[1].title = u'new title'
+        self.tracked_items[1].signal_change()
+        app.db.finish_transaction()
+        self.check_tracker_items(correct_items)
+        self.assertNotEquals(
+            self.tracker.get_item(self.tracked_items[1].id).title,
+            u'new title')
+
+    def test_row_missing_from_fetch(self):
+        # if the ItemFetcher doesn't return a row, get_row() should return a
+        # placeholder rather than raising an error
+        missing_id = self.tracker.get_row(0).id
+        self.tracker.row_data.clear()
+        real_fetch_items = self.tracker.item_fetcher.fetch_items
+        def fetch_items(id_list):
+            return [item_info for item_info in real_fetch_items(id_list)
+                    if item_info.id != missing_id]
+        self.tracker.item_fetcher.fetch_items = fetch_items
+        with self.allow_warnings():
+            item_info = self.tracker.get_row(0)
+        self.assertEquals(item_info.id, missing_id)
+        self.assert_(isinstance(item_info, item.DBErrorItemInfo))
+        self.check_tracker_items()
+
 class ItemTrackTestNonWALMode(ItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
@@ -47,6 +47,8 @@ class MockMetadataProcessor(object):
             'echonest': {},
         }
         self.canceled_files = set()
+        # store the batch tasks that we see
+        self.batches_sent = []
         # store the codes we see in query_echonest calls
         self.query_echonest_codes = {}
         self.query_echonest_metadata = {}
@@ -85,10 +87,14 @@ class MockMetadataProcessor(object):
     def send(self, task, callback, errback):
         task_data = (task, callback, errback)
 
-        if isinstance(task, workerprocess.MutagenTask):
-            self.add_task_data(task.source_path, 'mutagen', task_data)
-        elif isinstance(task, workerprocess.MovieDataProgramTask):
-            self.add_task_data(task.source_path, 'movie-data', task_data)
+        if isinstance(task, workerprocess.MutagenBatchTask):
+            self.batches_sent.append(task)
+            for path in task.source_paths:
+                self.add_task_data(path, 'mutagen', task_data)
+        elif isinstance(task, workerprocess.MovieDataProgramBatchTask):
+            self.batches_sent.append(task)
+            for path in task.source_paths:
+                self.add_task_data(path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
             self.canceled_files.update(task.paths)
         else:
@@ -107,24 +113,33 @@ class MockMetadataProcessor(object):
         self.add_task_data(path, 'echonest', (callback, errback))
 
     def run_mutagen_callback(self, source_path, metadata):
-        task, callback, errback = self.pop_task_data(source_path, 'mutagen')
-        callback_data = {'source_path': source_path}
-        callback_data.update(metadata)
-        callback(task, callback_data)
+        self.run_chunk_callback('mutagen', [(source_path, metadata)])
 
     def run_mutagen_errback(self, source_path, error):
-        task, callback, errback = self.pop_task_data(source_path, 'mutagen')
-        errback(task, error)
+        self.run_chunk_callback('mutagen', [(source_path, error)])
 
     def run_movie_data_callback(self, source_path, metadata):
-        task, callback, errback = self.pop_task_data(source_path, 'movie-data')
-        callback_data = {'source_path': source_path}
-        callback_data.update(metadata)
-        callback(task, callback_data)
+        self.run_chunk_callback('movie-data', [(source_path, metadata)])
 
     def run_movie_data_errback(self, source_path, error):
-        task, callback, errback = self.pop_task_data(source_path, 'movie-data')
-        errback(task, error)
+        self.run_chunk_callback('movie-data', [(source_path, error)])
+
+    def run_chunk_callback(self, name, results):
+        """Send a chunk of results for a batch task
+
+        :param name: 'mutagen' or 'movie-data'
+        :param results: list of (source_path, metadata_or_error) tuples.  All
+        paths must be from the same batch task.
+        """
+        chunk = []
+        for source_path, result in results:
+            task, callback, errback = self.pop_task_data(source_path, name)
+            if not isinstance(result, Exception):
+                callback_data = {'source_path': source_path}
+                callback_data.update(result)
+                result = callback_data
+            chunk.append((source_path, result))
+        callback(task, chunk)
 
     def run_echonest_codegen_callback(self, source_path, code):
         callback, errback = self.pop_task_data(source_path,
@@ -1254,6 +1269,47 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_mutagen('/videos2/bar.mp3', 'audio', 120, 'Bar',
                                'Fights')
 
+    def test_batches(self):
+        # test that tasks get sent in batches and results are processed in
+        # chunks
+        paths = ['/videos/video-%d.avi' % i for i in xrange(40)]
+        with self.metadata_manager.bulk_add():
+            for p in paths:
+                self.metadata_manager.add_file(p)
+        # all the mutagen tasks should be sent in one batch
+        self.assertEquals(len(self.processor.batches_sent), 1)
+        self.assertSameSet(self.processor.batches_sent[0].source_paths, paths)
+        self.processor.batches_sent = []
+        # send back a chunk of results.  Since the chunk is large, we should
+        # process it right away, without waiting for UPDATE_INTERVAL
+        signal_handler = mock.Mock()
+        self.metadata_manager.connect("new-metadata", signal_handler)
+        mutagen_data = {
+            'file_type': u'video',
+            'title': u'Title',
+            'drm': False,
+        }
+        self.processor.run_chunk_callback(
+            'mutagen', [(p, mutagen_data) for p in paths[:20]])
+        self.assertEquals(signal_handler.call_count, 1)
+        self.assertSameSet(signal_handler.call_args[0][1].keys(),
+                           paths[:20])
+        # the movie data tasks for the chunk should be sent in one batch
+        self.assertEquals(len(self.processor.batches_sent), 1)
+        self.assertSameSet(self.processor.batches_sent[0].source_paths,
+                           paths[:20])
+        self.assertSameSet(self.processor.movie_data_paths(), paths[:20])
+        # errors in a chunk should only affect their path
+        with self.allow_warnings():
+            self.processor.run_chunk_callback('mutagen',
+                [(p, ValueError()) for p in paths[20:30]] +
+                [(p, mutagen_data) for p in paths[30:]])
+        self.assertEquals(signal_handler.call_count, 2)
+        self.assertSameSet(self.processor.movie_data_paths(), paths)
+        for p in paths[20:30]:
+            status = metadata.MetadataStatus.get_by_path(p)
+            self.assertEquals(status.mutagen_status, status.STATUS_FAILURE)
+
     def test_queueing_with_delete(self):
         # test that we remove files that are queued as well
         paths = ['/videos/video-%d.avi' % i for i in xrange(200)]
@@ -1497,8 +1553,8 @@ class DeviceMetadataTest(EventLoopTest):
                 self.tempdir, self.device.db_info, self.device.id)
         self.assertEquals(mock_send.call_count, 1)
         task = mock_send.call_args[0][0]
-        self.assertEquals(task.source_path,
-                          os.path.join(self.tempdir, 'test-song.ogg'))
+        self.assertEquals(task.source_paths,
+                          [os.path.join(self.tempdir, 'test-song.ogg')])
 
     @mock.patch('miro.fileutil.migrate_file')
     def test_copy(self, mock_migrate_file):
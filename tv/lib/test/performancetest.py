@@ -0,0 +1,826 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""performancetest -- Benchmarks for performance-sensitive code.
+
+These tests don't run by default.  Run them by listing them on the command
+line, for example: ./run.sh --unittest performancetest
+"""
+
+import cPickle as pickle
+import gzip
+import httplib
+import os
+import struct
+import sys
+import threading
+import time
+from cStringIO import StringIO
+
+from miro import app
+from miro import containercodec
+from miro import directorysnapshot
+from miro import eventloop
+from miro import fileutil
+from miro import item
+from miro import libdaap
+from miro import metadata
+from miro import prefs
+from miro import subprocessmanager
+from miro import util
+from miro import widgetstate
+from miro import workerprocess
+from miro.plat import utils
+from miro.test import mock
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class PerformanceTest(MiroTestCase):
+    """Base class for benchmarks.
+
+    Subclasses time some code, then call report() with the results.
+    """
+    def time_call(self, func, *args, **kwargs):
+        """Call a function and return how long it took."""
+        start = time.time()
+        func(*args, **kwargs)
+        return time.time() - start
+
+    def report(self, description, old_time, new_time, value_format='%0.4fs'):
+        """Print the results of a benchmark
+
+        :param description: what we measured
+        :param old_time: time for the old code path
+        :param new_time: time for the new code path
+        :param value_format: format string for old_time and new_time, for
+            benchmarks that measure something besides time
+        """
+        if new_time > 0:
+            speedup = float(old_time) / new_time
+        else:
+            speedup = float('inf')
+        template = "\n%%s: before %s, after %s (%%0.1fx)\n" % (value_format,
+                                                                value_format)
+        sys.stdout.write(template % (description, old_time, new_time,
+                                     speedup))
+
+class FullTextSearchCommitTest(PerformanceTest):
+    """Measure the per-commit cost of keeping item_fts up to date."""
+    item_count = 5000
+    commit_count = 20
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(
+            self.item_count)
+        app.db.finish_transaction()
+
+    def use_unbatched_triggers(self):
+        # These are the triggers we used before version 196.  They re-index
+        # the entire row on every UPDATE.
+        columns = ['title', 'description', 'artist', 'album', 'genre',
+                   'filename', 'parent_title', ]
+        column_list = ', '.join(columns)
+        column_list_for_new = ', '.join("new.%s" % c for c in columns)
+        cursor = app.db.cursor
+        for trigger in ('item_bu', 'item_bd', 'item_au', 'item_ai'):
+            cursor.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+        cursor.execute("CREATE TRIGGER item_bu "
+                       "BEFORE UPDATE ON item BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "END;")
+        cursor.execute("CREATE TRIGGER item_bd "
+                       "BEFORE DELETE ON item BEGIN "
+                       "DELETE FROM item_fts WHERE docid=old.id; "
+                       "END;")
+        cursor.execute("CREATE TRIGGER item_au "
+                       "AFTER UPDATE ON item BEGIN "
+                       "INSERT INTO item_fts(docid, %s) "
+                       "VALUES(new.id, %s); "
+                       "END;" % (column_list, column_list_for_new))
+        cursor.execute("CREATE TRIGGER item_ai "
+                       "AFTER INSERT ON item BEGIN "
+                       "INSERT INTO item_fts(docid, %s) "
+                       "VALUES(new.id, %s); "
+                       "END;" % (column_list, column_list_for_new))
+
+    def run_commits(self, change_item):
+        for i in xrange(self.commit_count):
+            for item in self.items:
+                change_item(item, i)
+                item.signal_change()
+            app.db.finish_transaction()
+
+    def change_resume_time(self, item, i):
+        item.resume_time = i
+
+    def change_title_twice(self, item, i):
+        # change the title, then the description.  Each change gets its own
+        # UPDATE, like when the metadata manager updates an item.
+        item.title = u'title %s' % i
+        item.signal_change()
+        item.description = u'description %s' % i
+
+    def check_commit_time(self, description, change_item):
+        new_time = self.time_call(self.run_commits, change_item)
+        self.use_unbatched_triggers()
+        old_time = self.time_call(self.run_commits, change_item)
+        self.report(description, old_time / self.commit_count,
+                    new_time / self.commit_count)
+
+    def test_non_text_updates(self):
+        self.check_commit_time("commit non-text updates",
+                               self.change_resume_time)
+
+    def test_text_updates(self):
+        self.check_commit_time("commit text updates",
+                               self.change_title_twice)
+
+class ViewTrackerUpdateTest(PerformanceTest):
+    """Measure download status updates with many ViewTrackers open."""
+    download_count = 50
+    tracker_count = 40
+    tick_count = 20
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(
+            self.download_count)
+        for item_ in self.items:
+            item_.download()
+        self.downloaders = [item_.downloader for item_ in self.items]
+        for dl in self.downloaders:
+            dl.state = u'downloading'
+            dl.signal_change()
+        self.trackers = [view.make_tracker() for view in self.make_views()]
+        app.db.finish_transaction()
+
+    def make_views(self):
+        # The views that the download tab and the sidebar track, then
+        # per-feed views to fill out the count.
+        views = [
+            item.Item.downloading_view(),
+            item.Item.only_downloading_view(),
+            item.Item.paused_view(),
+            item.Item.download_tab_view(),
+            item.Item.auto_downloads_view(),
+            item.Item.manual_downloads_view(),
+            item.Item.watchable_view(),
+            item.Item.watchable_video_view(),
+            item.Item.unique_new_video_view(),
+            item.Item.toplevel_view(),
+        ]
+        feed_views = [item.Item.visible_feed_view,
+                      item.Item.feed_downloading_view,
+                      item.Item.feed_downloaded_view,
+                      item.Item.feed_available_view,
+                      item.Item.feed_unwatched_view]
+        while len(views) < self.tracker_count:
+            make_view = feed_views[len(views) % len(feed_views)]
+            views.append(make_view(self.feed.id))
+        return views
+
+    def run_ticks(self):
+        for i in xrange(self.tick_count):
+            for dl in self.downloaders:
+                dl.current_size = i * 1000
+                dl.rate = 1000 + i
+                dl.signal_change()
+            app.db.finish_transaction()
+
+    def test_status_updates(self):
+        compiled = len([t for t in self.trackers if t.predicate is not None])
+        new_time = self.time_call(self.run_ticks)
+        for tracker in self.trackers:
+            tracker.predicate = None
+        old_time = self.time_call(self.run_ticks)
+        self.report("status tick with %d downloads, %d trackers "
+                    "(%d compiled)" % (self.download_count,
+                                       len(self.trackers), compiled),
+                    old_time / self.tick_count, new_time / self.tick_count)
+
+class ContainerRestoreTest(PerformanceTest):
+    """Measure restoring objects with container columns from the DB."""
+    view_state_count = 5000
+    restore_count = 5
+    columns = [u'state', u'name', u'artist', u'album', u'track', u'year',
+               u'genre', u'rating', u'date', u'length', u'size', u'feed-name']
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        for i in xrange(self.view_state_count):
+            view_state = widgetstate.ViewState((u'feed', unicode(i), i % 3))
+            view_state.scroll_position = (0, i)
+            view_state.columns_enabled = list(self.columns)
+            view_state.column_widths = dict((name, 100 + i % 50)
+                                            for name in self.columns)
+            view_state.signal_change()
+        app.db.finish_transaction()
+
+    def use_repr_columns(self):
+        # Store the columns using repr(), like we did before version 198.
+        # Also stop LiveStorage from converting them to the new format, so
+        # that each restore has to eval() them.
+        cursor = app.db.cursor
+        cursor.execute("SELECT id, scroll_position, columns_enabled, "
+                       "column_widths FROM view_state")
+        rows = [[repr(containercodec.decode(value)) for value in row[1:]] +
+                [row[0]] for row in cursor.fetchall()]
+        cursor.executemany("UPDATE view_state SET scroll_position=?, "
+                           "columns_enabled=?, column_widths=? WHERE id=?",
+                           rows)
+        app.db.finish_transaction()
+        app.db._converter.is_legacy_value = lambda schema_item, value: False
+
+    def restore_all(self):
+        for i in xrange(self.restore_count):
+            app.db.forget_all_objects()
+            restored = list(widgetstate.ViewState.make_view())
+            self.assertEquals(len(restored), self.view_state_count)
+            self.assertEquals(restored[0].columns_enabled, self.columns)
+
+    def test_restore(self):
+        new_time = self.time_call(self.restore_all)
+        self.use_repr_columns()
+        old_time = self.time_call(self.restore_all)
+        self.report("restore %d view states" % self.view_state_count,
+                    old_time / self.restore_count,
+                    new_time / self.restore_count)
+
+class TransactionMemoryTest(PerformanceTest):
+    """Measure memory used by a large import done in a single transaction.
+    """
+    item_count = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reload_database(self.make_temp_path('.sqlite'))
+
+    def measure_import(self):
+        """Add items to a new feed without committing.
+
+        :returns: (memory_growth, max_log_rows) where memory_growth is how
+            much our memory usage grew in KB and max_log_rows is the most
+            rows the transaction log held at once
+        """
+        transaction_log = app.db._transaction_log
+        real_append = transaction_log.append
+        log_rows = [0]
+        def append(sql, values, many):
+            real_append(sql, values, many)
+            log_rows[0] = max(log_rows[0], transaction_log.row_count)
+        feed = testobjects.make_feed()
+        # load the existing objects first, so that only the import counts
+        start_usage = util.db_mem_usage_test()
+        with mock.patch.object(transaction_log, 'append', append):
+            testobjects.add_items_to_feed(feed, self.item_count)
+        end_usage = util.get_mem_usage()
+        app.db.finish_transaction()
+        return end_usage - start_usage, log_rows[0]
+
+    def test_large_import(self):
+        # Memory doesn't usually get returned to the OS, so measure the
+        # bounded log first.  The unbounded import can't reuse much of that
+        # memory since it keeps more alive at once.
+        log_limit = app.db.TRANSACTION_LOG_LIMIT
+        new_usage, new_log_rows = self.measure_import()
+        app.db.TRANSACTION_LOG_LIMIT = None
+        old_usage, old_log_rows = self.measure_import()
+        self.report("memory growth importing %d items in one transaction" %
+                    self.item_count, old_usage, new_usage,
+                    value_format='%dKB')
+        self.report("max transaction log rows importing %d items" %
+                    self.item_count, old_log_rows, new_log_rows,
+                    value_format='%d')
+        self.assert_(new_log_rows <= log_limit)
+        self.assert_(new_log_rows < old_log_rows)
+        self.assert_(new_usage < old_usage)
+
+def make_feedparser_like_data(entry_count):
+    """Make some data that looks like the results of parsing a feed."""
+    entries = []
+    for i in xrange(entry_count):
+        entries.append({
+            'title': u'Entry %d' % i,
+            'link': u'http://example.com/entries/%d' % i,
+            'summary': u'Description for entry %d. ' % i * 10,
+            'enclosures': [{'url': u'http://example.com/%d.mp4' % i,
+                            'length': u'123456',
+                            'type': u'video/mp4'}],
+            'updated_parsed': (2012, 1, 1, 0, 0, 0, 6, 1, 0),
+        })
+    return {'feed': {'title': u'Test Feed'}, 'entries': entries}
+
+def legacy_dump_obj(obj, pipe):
+    # _dump_obj() before we changed the protocol
+    pickle_data = pickle.dumps(obj)
+    pipe.write(struct.pack("Q", len(pickle_data)))
+    pipe.write(pickle_data)
+    pipe.flush()
+
+def legacy_load_obj(pipe):
+    # _load_obj() before we changed the protocol
+    size_data = subprocessmanager._read_bytes_from_pipe(pipe,
+                                                        struct.calcsize("Q"))
+    size = struct.unpack("Q", size_data)[0]
+    return pickle.loads(subprocessmanager._read_bytes_from_pipe(pipe, size))
+
+class SubprocessTransportTest(PerformanceTest):
+    """Measure sending messages through a pipe in-process."""
+    message_count = 20
+
+    def send_through_pipe(self, dump_obj, make_loader, obj):
+        """Send obj message_count times through a pipe
+
+        :param dump_obj: function to write a message to the pipe
+        :param make_loader: function that inputs the read end of a pipe and
+        returns a function that reads a message from it
+        """
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb', 0)
+        writer = os.fdopen(write_fd, 'wb', 0)
+        def write_thread():
+            for i in xrange(self.message_count):
+                dump_obj(obj, writer)
+            writer.close()
+        thread = threading.Thread(target=write_thread)
+        thread.start()
+        load_obj = make_loader(reader)
+        for i in xrange(self.message_count):
+            load_obj()
+        thread.join()
+        reader.close()
+
+    def check_transport_time(self, description, obj):
+        def make_legacy_loader(pipe):
+            return lambda: legacy_load_obj(pipe)
+        def make_loader(pipe):
+            return subprocessmanager.PipeReader(pipe).load_obj
+        old_time = self.time_call(self.send_through_pipe, legacy_dump_obj,
+                                  make_legacy_loader, obj)
+        new_time = self.time_call(self.send_through_pipe,
+                                  subprocessmanager._dump_obj, make_loader,
+                                  obj)
+        self.report(description, old_time / self.message_count,
+                    new_time / self.message_count)
+
+    def test_small_feed(self):
+        self.check_transport_time("send 20 entry feed",
+                                  make_feedparser_like_data(20))
+
+    def test_large_feed(self):
+        self.check_transport_time("send 5000 entry feed",
+                                  make_feedparser_like_data(5000))
+
+class BenchmarkMessage(subprocessmanager.SubprocessMessage):
+    pass
+
+class EchoRequest(BenchmarkMessage):
+    def __init__(self, payload):
+        self.payload = payload
+
+class EchoReply(subprocessmanager.SubprocessResponse):
+    def __init__(self, payload):
+        self.payload = payload
+
+class BenchmarkSubprocessHandler(subprocessmanager.SubprocessHandler):
+    def handle_echo_request(self, msg):
+        EchoReply(msg.payload).send_to_main_process()
+
+class BenchmarkSubprocessResponder(subprocessmanager.SubprocessResponder):
+    def __init__(self, test_case):
+        subprocessmanager.SubprocessResponder.__init__(self)
+        self.test_case = test_case
+        self.reply_count = 0
+        self.wait_for_count = None
+
+    def handle_echo_reply(self, msg):
+        self.reply_count += 1
+        if self.reply_count == self.wait_for_count:
+            self.test_case.stopEventLoop(abnormal=False)
+
+class WorkerRoundTripTest(PerformanceTest, EventLoopTest):
+    """Measure round trips through a subprocess."""
+    message_count = 50
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.responder = BenchmarkSubprocessResponder(self)
+        self.subprocess = subprocessmanager.SubprocessManager(
+            BenchmarkMessage, self.responder, BenchmarkSubprocessHandler)
+        self.subprocess.start()
+        # wait for the subprocess to start up by sending it a message
+        self.run_round_trips(None, 1)
+
+    def tearDown(self):
+        self.subprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def run_round_trips(self, payload, count):
+        self.responder.reply_count = 0
+        self.responder.wait_for_count = count
+        for i in xrange(count):
+            EchoRequest(payload).send_to_process()
+        self.runEventLoop(60)
+        self.assertEquals(self.responder.reply_count, count)
+
+    def check_round_trip_throughput(self, description, payload):
+        self.subprocess.stats.reset()
+        elapsed = self.time_call(self.run_round_trips, payload,
+                                 self.message_count)
+        reply_stats = self.subprocess.stats.received['EchoReply']
+        sys.stdout.write("\n%s: %0.1f round trips/s, %0.1f MB/s, "
+                         "avg latency %0.4fs, max latency %0.4fs\n" %
+                         (description, self.message_count / elapsed,
+                          reply_stats.bytes * 2 / elapsed / (1024 * 1024),
+                          reply_stats.average_time(), reply_stats.max_time))
+
+    def test_small_messages(self):
+        self.check_round_trip_throughput("round trip 20 entry feed",
+                                         make_feedparser_like_data(20))
+
+    def test_large_messages(self):
+        self.check_round_trip_throughput("round trip 5000 entry feed",
+                                         make_feedparser_like_data(5000))
+
+class ImportWorkerProcessHandler(workerprocess.WorkerProcessHandler):
+    """Worker process handler that fakes running mutagen.
+
+    This lets us measure the overhead of sending tasks to the worker process
+    and applying the results, rather than the speed of mutagen.
+    """
+    def handle_mutagen_task(self, msg):
+        return {
+            'source_path': msg.source_path,
+            'file_type': u'audio',
+            'duration': 100,
+            'title': u'Title',
+            'drm': False,
+        }
+
+class CPUBoundImportWorkerProcessHandler(ImportWorkerProcessHandler):
+    """Worker process handler that simulates mutagen using the CPU."""
+    def handle_mutagen_task(self, msg):
+        end = time.time() + 0.005
+        while time.time() < end:
+            pass
+        return ImportWorkerProcessHandler.handle_mutagen_task(self, msg)
+
+def send_unbatched(msg, callback, errback):
+    """Replacement for workerprocess.send() that splits up batch tasks.
+
+    Each path gets its own task and round trip, like before we had batch
+    tasks.
+    """
+    def single_callback(task, result):
+        callback(msg, [(task.source_path, result)])
+    for task in msg.make_tasks():
+        workerprocess._miro_task_queue.add_task(task, single_callback,
+                                                single_callback)
+
+class MetadataImportTest(PerformanceTest, EventLoopTest):
+    """Measure how fast we can import files into the metadata system."""
+    file_count = 2000
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.setup_dummy_message_handlers()
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        workerprocess._subprocess_manager.handler_class = (
+            ImportWorkerProcessHandler)
+        workerprocess.startup()
+        # import a couple files to make sure the worker process is running
+        self.run_import('warmup', 10)
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def run_import(self, name, count):
+        metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                           self.tempdir)
+        processor = metadata_manager.mutagen_processor
+        paths = ['/music/%s-%d.mp3' % (name, i) for i in xrange(count)]
+        def check_done():
+            if processor._active_tasks or processor._pending_tasks:
+                eventloop.add_timeout(0.01, check_done, 'check import done')
+            else:
+                metadata_manager.run_updates()
+                self.stopEventLoop(abnormal=False)
+        with metadata_manager.bulk_add():
+            for path in paths:
+                metadata_manager.add_file(path)
+        check_done()
+        self.runEventLoop(300)
+        for path in paths:
+            self.assertEquals(metadata_manager.get_metadata(path)['duration'],
+                              100)
+
+    def test_import(self):
+        new_time = self.time_call(self.run_import, 'batched',
+                                  self.file_count)
+        self.patch_function('miro.workerprocess.send', send_unbatched)
+        old_time = self.time_call(self.run_import, 'unbatched',
+                                  self.file_count)
+        self.report("import %d files" % self.file_count, old_time, new_time)
+        sys.stdout.write("import throughput: before %0.1f files/s, "
+                         "after %0.1f files/s\n" %
+                         (self.file_count / old_time,
+                          self.file_count / new_time))
+
+    def test_process_pool_scaling(self):
+        process_count = utils.get_logical_cpu_count()
+        file_count = 1000
+        workerprocess.shutdown()
+        workerprocess._subprocess_manager.handler_class = (
+            CPUBoundImportWorkerProcessHandler)
+        workerprocess.startup(process_count=1)
+        self.run_import('warmup-single', 10)
+        old_time = self.time_call(self.run_import, 'single', file_count)
+        workerprocess.shutdown()
+        workerprocess.startup(process_count=process_count)
+        self.run_import('warmup-pool', 10)
+        new_time = self.time_call(self.run_import, 'pool', file_count)
+        self.report("import %d CPU-bound files with 1 vs %d worker "
+                    "processes" % (file_count, process_count),
+                    old_time, new_time)
+
+class DirectoryRescanTest(PerformanceTest):
+    """Measure rescanning a large watched folder where little changed."""
+    directory_count = 1000
+    files_per_directory = 100
+
+    def setUp(self):
+        PerformanceTest.setUp(self)
+        self.root = self.make_temp_dir_path()
+        # make the mtimes old enough for the snapshot to trust them
+        old_time = time.time() - 3600
+        for i in xrange(self.directory_count):
+            directory = os.path.join(self.root, 'dir-%d' % i)
+            os.mkdir(directory)
+            for j in xrange(self.files_per_directory):
+                open(os.path.join(directory, 'file-%d.mp3' % j), 'w').close()
+            os.utime(directory, (old_time, old_time))
+        os.utime(self.root, (old_time, old_time))
+        self.changed_dir = os.path.join(self.root, 'dir-0')
+
+    def change_tree(self):
+        open(os.path.join(self.changed_dir, 'new-file.mp3'), 'w').close()
+
+    def full_rescan(self):
+        # what DirectoryScannerImplBase.do_update() did before we used
+        # DirectorySnapshot: stat each existing file, then walk the tree.
+        for path in self.known_paths:
+            fileutil.isfile(path)
+        return list(fileutil.miro_allfiles(self.root))
+
+    def test_rescan(self):
+        file_count = self.directory_count * self.files_per_directory
+        snapshot = directorysnapshot.DirectorySnapshot(self.root)
+        snapshot.rescan()
+        self.known_paths = list(snapshot.all_files())
+        self.change_tree()
+        old_time = self.time_call(self.full_rescan)
+        new_time = self.time_call(snapshot.rescan)
+        self.report("rescan %d files, 1 directory changed" % file_count,
+                    old_time, new_time)
+
+class FakeDaapBackend(object):
+    """Minimal DAAP server backend that serves a large library."""
+    def __init__(self, item_count, media_path=None):
+        self.revision = 1
+        self.media_path = media_path
+        self.bytes_sent = 0
+        self.items = {}
+        for i in xrange(item_count):
+            self.items[i + 100] = {
+                'dmap.itemid': i + 100,
+                'dmap.itemname': 'Track %d' % i,
+                'dmap.containeritemid': i + 100,
+                'daap.songalbumartist': 'Artist %d' % (i % 100),
+                'daap.songtime': 180000 + i,
+                'daap.songsize': 4000000 + i,
+                'daap.songformat': 'mp3',
+                'com.apple.itunes.mediakind': libdaap.DAAP_MEDIAKIND_AUDIO,
+                'revision': self.revision,
+                'valid': True,
+            }
+
+    def change_items(self, item_ids):
+        self.revision += 1
+        for item_id in item_ids:
+            item = self.items[item_id].copy()
+            item['dmap.itemname'] += ' (changed)'
+            item['revision'] = self.revision
+            self.items[item_id] = item
+
+    def get_items(self, playlist_id=None, since_revision=0):
+        return dict((k, v) for k, v in self.items.iteritems()
+                    if v['revision'] > since_revision)
+
+    def get_playlists(self):
+        return {}
+
+    def get_revision(self, session, old_revision, request):
+        return self.revision
+
+    def get_file(self, itemid, generation, ext, session, request_path_func,
+                 offset=0, chunk=None):
+        file_obj = open(self.media_path, 'rb')
+        file_obj.seek(offset, os.SEEK_SET)
+        return file_obj, os.path.basename(self.media_path)
+
+    def file_sent(self, session, itemid, count):
+        self.bytes_sent += count
+
+class UncachedItemRecordCache(libdaap.ItemRecordCache):
+    """ItemRecordCache that encodes every item for every request, like the
+    server did before we cached records.
+    """
+    def _records_for_meta(self, meta_list):
+        return dict()
+
+class DaapServerLoadTest(PerformanceTest):
+    """Measure many clients using a DAAP server with a large share."""
+    item_count = 20000
+    client_count = 8
+    requests_per_client = 4
+    streaming_client_count = 32
+    media_size = 8 * 1024 * 1024
+
+    def setUp(self):
+        PerformanceTest.setUp(self)
+        self.media_path = os.path.join(self.make_temp_dir_path(), 'song.mp3')
+        with open(self.media_path, 'wb') as f:
+            f.write(os.urandom(self.media_size))
+        self.backend = FakeDaapBackend(self.item_count, self.media_path)
+        self.server = libdaap.make_daap_server(
+            self.backend, port=0, max_conn=self.streaming_client_count)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, name='DAAP load test server')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        PerformanceTest.tearDown(self)
+
+    def request(self, conn, path, use_gzip=False, headers=None,
+                status=httplib.OK):
+        if headers is None:
+            headers = {}
+        if use_gzip:
+            headers['Accept-encoding'] = 'gzip'
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        self.assertEquals(response.status, status)
+        self.assertEquals(int(response.getheader('Content-length')),
+                          len(data))
+        if response.getheader('Content-encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        return data
+
+    def login(self, conn):
+        reply = libdaap.decode_response(self.request(conn, '/login'))
+        return libdaap.find_daap_tag('mlid', reply)
+
+    def item_list_path(self, session, revision=0, delta=0):
+        path = '/databases/1/items?session-id=%d' % session
+        if delta:
+            path += '&revision-number=%d&delta=%d' % (revision, delta)
+        return path
+
+    def run_client(self, index, errors):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1',
+                                          self.server.server_address[1])
+            session = self.login(conn)
+            for i in xrange(self.requests_per_client):
+                self.request(conn, self.item_list_path(session),
+                             use_gzip=(index % 2 == 1))
+            conn.close()
+        except Exception, e:
+            errors.append(e)
+
+    def run_clients(self, target=None, client_count=None):
+        if target is None:
+            target = self.run_client
+        if client_count is None:
+            client_count = self.client_count
+        errors = []
+        threads = [threading.Thread(target=target, args=(i, errors),
+                                    name='DAAP load test client %d' % i)
+                   for i in xrange(client_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def run_streaming_client(self, index, errors):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1',
+                                          self.server.server_address[1])
+            session = self.login(conn)
+            path = '/databases/1/items/100.mp3?session-id=%d' % session
+            start = index * 1000
+            data = self.request(conn, path, status=httplib.PARTIAL_CONTENT,
+                                headers={'Range': 'bytes=%d-' % start})
+            with open(self.media_path, 'rb') as f:
+                f.seek(start)
+                if data != f.read():
+                    raise AssertionError("wrong data streamed")
+            self.thread_names.update(t.name for t in threading.enumerate())
+            conn.close()
+        except Exception, e:
+            errors.append(e)
+
+    def fetch_item_list(self, revision=0, delta=0):
+        conn = httplib.HTTPConnection('127.0.0.1',
+                                      self.server.server_address[1])
+        try:
+            session = self.login(conn)
+            return self.request(conn, self.item_list_path(session, revision,
+                                                          delta))
+        finally:
+            conn.close()
+
+    def test_item_list_load(self):
+        self.server.item_record_cache = UncachedItemRecordCache()
+        uncached_reply = self.fetch_item_list()
+        old_time = self.time_call(self.run_clients)
+        self.server.item_record_cache = libdaap.ItemRecordCache()
+        self.assertEquals(self.fetch_item_list(), uncached_reply)
+        new_time = self.time_call(self.run_clients)
+        self.report("%d clients each fetching %d items %d times" %
+                    (self.client_count, self.item_count,
+                     self.requests_per_client), old_time, new_time)
+
+    def test_streaming_clients(self):
+        start_threads = set(t.name for t in threading.enumerate())
+        self.thread_names = set()
+        elapsed = self.time_call(self.run_clients, self.run_streaming_client,
+                                 self.streaming_client_count)
+        total = sum(self.media_size - i * 1000
+                    for i in xrange(self.streaming_client_count))
+        self.assertEquals(self.backend.bytes_sent, total)
+        # The server should only use its fixed pool of threads, not one
+        # per connection.
+        for name in self.thread_names - start_threads:
+            self.assertTrue(name.startswith('DAAP '), name)
+        sys.stdout.write("\n%d clients streaming %dMB each: %0.4fs "
+                         "(%0.1fMB/s)\n" %
+                         (self.streaming_client_count,
+                          self.media_size / (1024 * 1024), elapsed,
+                          total / elapsed / (1024 * 1024)))
+
+    def test_delta_request(self):
+        self.fetch_item_list()
+        old_revision = self.backend.revision
+        changed_ids = range(100, 110)
+        self.backend.change_items(changed_ids)
+        reply = libdaap.decode_response(self.fetch_item_list(
+            self.backend.revision, old_revision))
+        self.assertEquals(libdaap.find_daap_tag('mrco', reply),
+                          len(changed_ids))
+        items = libdaap.find_daap_listitems(
+            libdaap.find_daap_tag('mlcl', reply))
+        self.assertEquals(
+            sorted(libdaap.find_daap_tag('minm', item) for item in items),
+            sorted(self.backend.items[i]['dmap.itemname']
+                   for i in changed_ids))
+        old_time = self.time_call(self.fetch_item_list)
+        new_time = self.time_call(self.fetch_item_list,
+                                  self.backend.revision, old_revision)
+        self.report("update request for %d of %d items vs full list" %
+                    (len(changed_ids), self.item_count), old_time, new_time)
@@ -2,7 +2,7 @@ from time import time, sleep
 import threading
 
 from miro import eventloop
-from miro.test.framework import EventLoopTest
+from miro.test.framework import EventLoopTest, MiroTestCase
 
 class SchedulerTest(EventLoopTest):
     def setUp(self):
@@ -57,3 +57,106 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class TimerWheelTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.time = 1000.0
+        self.patch_function('miro.eventloop.clock', lambda: self.time)
+        self.scheduler = eventloop.Scheduler()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def add_timeout(self, delay, value):
+        return self.scheduler.add_timeout(delay, self.callback, 'test',
+                                          args=(value,))
+
+    def run_timeouts(self):
+        while self.scheduler.has_pending_timeout():
+            self.scheduler.process_next_timeout()
+
+    def test_order(self):
+        # use delays that end up in each level of the wheel
+        delays = [0.001, 0.5, 3, 100, 5000, 100000, 1e7, 1e8]
+        for delay in reversed(delays):
+            self.add_timeout(delay, delay)
+        for delay in delays:
+            next_timeout = self.scheduler.next_timeout()
+            self.assert_(0 <= next_timeout <= delay + 0.01)
+            # advance to just before the timeout, it shouldn't fire
+            self.time = 1000.0 + delay - 0.01
+            self.run_timeouts()
+            self.assertEquals(self.calls[-1:], [d for d in delays
+                                                if d < delay][-1:])
+            self.time = 1000.0 + delay + 0.001
+            self.run_timeouts()
+            self.assertEquals(self.calls[-1], delay)
+        self.assertEquals(self.calls, delays)
+        self.assertEquals(self.scheduler.next_timeout(), None)
+
+    def test_cancel(self):
+        calls = [self.add_timeout(1000, i) for i in xrange(100)]
+        self.assertEquals(self.scheduler.call_count, 100)
+        for dc in calls[1:]:
+            dc.cancel()
+        # canceled calls should be removed right away
+        self.assertEquals(self.scheduler.call_count, 1)
+        self.assertEquals(sum(len(bucket)
+                              for buckets in self.scheduler.buckets
+                              for bucket in buckets.values()), 1)
+        self.time += 1001
+        self.run_timeouts()
+        self.assertEquals(self.calls, [0])
+        # canceling a call that already ran should be a no-op
+        calls[0].cancel()
+        self.assertEquals(self.scheduler.call_count, 0)
+
+    def test_cancel_due(self):
+        first = self.add_timeout(1, 'first')
+        self.add_timeout(1, 'second')
+        self.time += 2
+        self.assert_(self.scheduler.has_pending_timeout())
+        first.cancel()
+        self.run_timeouts()
+        self.assertEquals(self.calls, ['second'])
+
+class IdleQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = eventloop.CallQueue()
+        self.calls = []
+
+    def callback(self, value):
+        self.calls.append(value)
+
+    def test_keyed_calls(self):
+        self.queue.add_idle(self.callback, 'foo', args=(1,), key='foo')
+        self.queue.add_idle(self.callback, 'bar', args=(2,))
+        dc = self.queue.add_idle(self.callback, 'foo', args=(3,), key='foo')
+        self.assertEquals(self.queue.queue.qsize(), 2)
+        self.queue.process_idles()
+        # the second foo call should have replaced the first one, but kept
+        # its place in the queue
+        self.assertEquals(self.calls, [3, 2])
+        # once a keyed call runs, the key can be used again
+        self.queue.add_idle(self.callback, 'foo', args=(4,), key='foo')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [3, 2, 4])
+        # same thing for canceled calls
+        dc = self.queue.add_idle(self.callback, 'foo', args=(5,), key='foo')
+        dc.cancel()
+        self.queue.add_idle(self.callback, 'foo', args=(6,), key='foo')
+        self.queue.process_idles()
+        self.assertEquals(self.calls, [3, 2, 4, 6])
+
+    def test_stats(self):
+        eventloop.stats.reset()
+        for i in xrange(3):
+            self.queue.add_idle(self.callback, 'foo', args=(i,))
+        self.queue.process_idles()
+        call_stats = eventloop.stats.calls['idle (foo)']
+        self.assertEquals(call_stats.count, 3)
+        self.assertEquals(sum(call_stats.histogram), 3)
+        self.assertEquals(eventloop.stats.max_queue_depth['idle'], 3)
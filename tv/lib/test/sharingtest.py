@@ -28,11 +28,15 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro import sharing
+import httplib
 import os
+import socket
+import threading
 
 import sqlite3
 
 from miro import app
+from miro import libdaap
 from miro import messages
 from miro import messagehandler
 from miro import models
@@ -121,6 +125,24 @@ class ShareTest(MiroTestCase):
         # second call shouldn't cause an error
         share.stop_tracking()
 
+    def test_stop_tracking_keeps_synced_items(self):
+        # Check that stop_tracking() keeps the items around if we finished
+        # syncing so that we can resume from them later
+        share = testobjects.make_share()
+        share.start_tracking()
+        testobjects.make_sharing_items(share, u'one', u'two')
+        share.sync_state.revision = 5
+        share.stop_tracking()
+        self.assertEquals(
+            models.SharingItem.make_view(db_info=share.db_info).count(), 2)
+        self.assertEquals(share.sync_state.revision, 5)
+        # If we didn't finish, then we should throw them away
+        share.start_tracking()
+        share.sync_state.revision = None
+        share.stop_tracking()
+        self.assertEquals(
+            models.SharingItem.make_view(db_info=share.db_info).count(), 0)
+
 class SharingTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
@@ -155,9 +177,9 @@ class SharingTest(EventLoopTest):
 
     def check_tracker_items(self, correct_items):
         # check the SharingItems in the database.  correct_items should be a
-        # dictionary that maps item ids to item titles.
+        # dictionary that maps daap ids to item titles.
         item_view = models.SharingItem.make_view(db_info=self.share.db_info)
-        data_from_db = dict((i.id, i.title) for i in item_view)
+        data_from_db = dict((i.daap_id, i.title) for i in item_view)
         # check that the IDs are correct
         self.assertSameSet(data_from_db.keys(), correct_items.keys())
         # check that the titles are correct
@@ -335,6 +357,90 @@ class SharingTest(EventLoopTest):
         self.share.tracker.client_disconnect_callback_common()
         self.check_tabs_changed([], [], [101])
 
+    def start_reconnect_test(self):
+        # Connect to the share, then disconnect
+        self.share.start_tracking()
+        self.client.set_items(self.make_daap_items(
+            {1: 'title-1', 2: 'title-2'}))
+        self.client.add_playlist(
+            testobjects.make_mock_daap_playlist(101, 'playlist-1')
+        )
+        self.client.set_playlist_items(101, [1, 2])
+        self.check_client_connect()
+        self.share.stop_tracking()
+        # change the share while we're disconnected
+        self.client.set_items(self.make_daap_items(
+            {1: 'new-title-1', 3: 'title-3'}))
+        self.client.set_playlist_items(101, [1, 3])
+        self.share.start_tracking()
+        self.MockTabsChanged.reset_mock()
+
+    def check_reconnect(self, result):
+        self.share.tracker.client_connect_callback(result)
+        self.check_tracker_items({1: 'new-title-1', 3: 'title-3'})
+        self.check_playlist_items_map({
+            101: set([1, 3]),
+            u'playlist': set([1, 3]),
+        })
+        # the playlist tab should get re-added
+        self.check_tabs_changed([101], [], [])
+
+    def test_reconnect_fetches_changes(self):
+        # test that when we reconnect, we only ask for changed items
+        self.start_reconnect_test()
+        result = self.share.tracker.client_connect()
+        self.assertEquals(result.resumed, True)
+        self.assertEquals(result.reset, False)
+        self.assertSameSet(result.items.keys(), [1, 3])
+        self.assertEquals(result.deleted_items, [2])
+        self.check_reconnect(result)
+        self.assertEquals(self.share.sync_state.revision, 1)
+
+    def test_reconnect_to_older_revision(self):
+        # test that if the server's revision went backwards, we fetch
+        # everything and throw away our old data
+        self.start_reconnect_test()
+        self.client.revision = 0
+        result = self.share.tracker.client_connect()
+        self.assertEquals(result.resumed, False)
+        self.assertEquals(result.reset, True)
+        self.check_reconnect(result)
+
+    def test_reconnect_count_mismatch(self):
+        # test that if a delta doesn't add up to the number of items on the
+        # server, we fetch everything and throw away our old data
+        self.start_reconnect_test()
+        # make the client forget what it sent, so it sends the full listing
+        # without the deleted items
+        self.client.last_sent_library.clear()
+        self.client.last_sent_library_for_playlists = None
+        result = self.share.tracker.client_connect()
+        self.assertEquals(result.resumed, False)
+        self.assertEquals(result.reset, True)
+        self.check_reconnect(result)
+
+    @mock.patch('miro.sharing.SHARING_PAGE_SIZE', 2)
+    def test_item_pages(self):
+        # test fetching the item list a page at a time
+        self.share.start_tracking()
+        tracker = self.share.tracker
+        self.client.set_items(self.make_daap_items(
+            dict((i, 'title-%s' % i) for i in range(1, 6))))
+        result = tracker.client_connect()
+        self.assertSameSet(result.items.keys(), [1, 2])
+        tracker.client_connect_callback(result)
+        self.check_tracker_items({1: 'title-1', 2: 'title-2'})
+        # we shouldn't consider ourselves synced until we get all the items
+        self.assertEquals(self.share.sync_state.revision, None)
+        for correct_ids in ([3, 4], [5]):
+            page = tracker.client_fetch_item_page()
+            self.assertSameSet(page.items.keys(), correct_ids)
+            tracker.client_item_page_callback(page)
+        self.assertEquals(tracker.next_item_index, None)
+        self.check_tracker_items(dict((i, 'title-%s' % i)
+                                      for i in range(1, 6)))
+        self.assertEquals(self.share.sync_state.revision, 1)
+
     def test_nul_in_playlist_data(self):
         # test that we remove NUL chars from playlist data (#17537)
         self.share.start_tracking()
@@ -360,6 +466,123 @@ class SharingTest(EventLoopTest):
             1, db_info=self.share.db_info)
         self.assertEquals(db_item.title, "title-one")
 
+class SocketReaderTest(MiroTestCase):
+    # Test the rfile that the DAAP request handler reads requests from
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.server_sock, self.client_sock = libdaap.make_socket_pair()
+        self.reader = libdaap.SocketReader(self.server_sock, bufsize=16)
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+        MiroTestCase.tearDown(self)
+
+    def test_readline(self):
+        self.client_sock.sendall('GET / HTTP/1.1\r\nHost: foo\r\n\r\n')
+        self.assertEquals(self.reader.readline(), 'GET / HTTP/1.1\r\n')
+        self.assertEquals(self.reader.readline(4), 'Host')
+        self.assertEquals(self.reader.readline(), ': foo\r\n')
+        self.assertEquals(self.reader.readline(), '\r\n')
+        self.assertFalse(self.reader.has_buffered_input())
+
+    def test_pipelined_requests(self):
+        self.client_sock.sendall('GET /1 HTTP/1.1\r\n\r\n'
+                                 'GET /2 HTTP/1.1\r\n\r\n')
+        self.assertEquals(self.reader.readline(), 'GET /1 HTTP/1.1\r\n')
+        self.assertEquals(self.reader.readline(), '\r\n')
+        # the second request was read along with the first one
+        self.assert_(self.reader.has_buffered_input())
+        self.assertEquals(self.reader.readline(), 'GET /2 HTTP/1.1\r\n')
+        self.assertEquals(self.reader.readline(), '\r\n')
+        self.assertFalse(self.reader.has_buffered_input())
+
+    def test_read(self):
+        self.client_sock.sendall('a' * 40)
+        self.client_sock.shutdown(socket.SHUT_WR)
+        self.assertEquals(self.reader.read(30), 'a' * 30)
+        self.assertEquals(self.reader.read(), 'a' * 10)
+        self.assertEquals(self.reader.readline(), '')
+
+class DaapDispatcherTest(MiroTestCase):
+    # Test that slow clients can't tie up the DAAP server's worker threads
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        for name, value in (('DAAP_WORKER_THREADS', 1),
+                            ('DAAP_REQUEST_TIMEOUT', 0.5)):
+            patcher = mock.patch('miro.libdaap.libdaap.' + name, value)
+            patcher.start()
+            self.mock_patchers.append(patcher)
+        self.update_sent = threading.Event()
+        self.share_changed = threading.Event()
+        self.backend = mock.Mock()
+        self.backend.get_revision.side_effect = self.get_revision
+        self.server = libdaap.make_daap_server(self.backend, port=0)
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, name='DAAP test server')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        self.share_changed.set()
+        for conn in self.connections:
+            conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        MiroTestCase.tearDown(self)
+
+    def get_revision(self, session, old_revision, request):
+        self.update_sent.set()
+        self.share_changed.wait(10)
+        return old_revision + 1
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1',
+                                      self.server.server_address[1],
+                                      timeout=5)
+        self.connections.append(conn)
+        return conn
+
+    def request(self, conn, path):
+        conn.request('GET', path)
+        response = conn.getresponse()
+        self.assertEquals(response.status, httplib.OK)
+        return libdaap.decode_response(response.read())
+
+    def login(self, conn):
+        return libdaap.find_daap_tag('mlid', self.request(conn, '/login'))
+
+    def check_server_responds(self):
+        self.request(self.connect(), '/server-info')
+
+    def test_update_doesnt_use_worker(self):
+        update_conn = self.connect()
+        session = self.login(update_conn)
+        update_conn.request('GET', '/update?session-id=%d&revision-number=1'
+                            % session)
+        self.assert_(self.update_sent.wait(10))
+        # the /update request is blocked waiting for a change, but our only
+        # worker thread should still be free for other requests.
+        self.check_server_responds()
+        self.share_changed.set()
+        response = update_conn.getresponse()
+        self.assertEquals(response.status, httplib.OK)
+        reply = libdaap.decode_response(response.read())
+        self.assertEquals(libdaap.find_daap_tag('musr', reply), 2)
+
+    def test_partial_request_times_out(self):
+        # Send half a request and then nothing else.  Once the request times
+        # out, the server should close the connection and handle other
+        # requests.
+        sock = socket.create_connection(self.server.server_address, 5)
+        self.connections.append(sock)
+        sock.sendall('GET /server-info HT')
+        with self.allow_warnings():
+            self.assertEquals(sock.recv(1024), '')
+        self.check_server_responds()
+
 class SharingServerTest(EventLoopTest):
     """Test the sharing server."""
     def setUp(self):
@@ -578,6 +801,53 @@ class SharingServerTest(EventLoopTest):
             if item not in self.video_playlist_items:
                 self.check_daap_item_deleted(self.backend.get_items(), item)
 
+    def test_items_since_revision(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.data_set.revision
+        self.assertEquals(self.backend.get_items(
+            since_revision=initial_revision), {})
+        changed = self.audio_items[0]
+        changed.set_user_metadata({'title': u'New title'})
+        changed.signal_change()
+        removed = self.audio_items[-1]
+        removed.remove()
+        self.send_changes_from_trackers()
+        # only the changed and removed items should be returned
+        items = self.backend.get_items(since_revision=initial_revision)
+        self.assertSameSet(items.keys(), [changed.id, removed.id])
+        self.check_daap_list(items, [changed])
+        self.check_daap_item_deleted(items, removed)
+        self.check_daap_list(
+            self.backend.get_items(self.video_playlist.id,
+                                   since_revision=initial_revision), [])
+        # change the item again, it should only be indexed by its newest
+        # revision
+        second_revision = self.backend.data_set.revision
+        changed.set_user_metadata({'title': u'Newer title'})
+        changed.signal_change()
+        self.send_changes_from_trackers()
+        items = self.backend.get_items(self.audio_playlist.id,
+                                       since_revision=second_revision)
+        self.check_daap_list(items, [changed])
+        data_set = self.backend.data_set
+        revisions = [revision for revision, ids in
+                     data_set.items_by_revision.items() if changed.id in ids]
+        self.assertEquals(revisions, [data_set.revision])
+        self.assertEquals(data_set.item_revisions,
+                          sorted(data_set.items_by_revision.keys()))
+
+    def test_bandwidth_accounting(self):
+        self.setup_sharing_manager_backend()
+        self.backend.file_sent(123, self.audio_items[0].id, 1000)
+        self.backend.file_sent(123, self.audio_items[1].id, 500)
+        self.backend.file_sent(456, self.audio_items[0].id, 10)
+        self.assertEquals(self.backend.get_bytes_sent(123), 1500)
+        self.assertEquals(self.backend.get_bytes_sent(456), 10)
+        # when the session finishes, we should forget about it
+        self.backend.finished_callback(123)
+        self.assertEquals(self.backend.get_bytes_sent(123), 0)
+        self.assertEquals(self.backend.get_bytes_sent(456), 10)
+
     def test_client_disconnects_in_get_revision(self):
         # get_revision() blocks waiting for chainges, but it should return if
         # the client disconnects.  Test that this happens
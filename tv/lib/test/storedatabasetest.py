@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import cPickle
 import os
 import unittest
 import string
@@ -8,12 +9,14 @@ import time
 import sqlite3
 
 from miro import app
+from miro import containercodec
 from miro import database
 from miro import databaseupgrade
 from miro import devices
 from miro import dialogs
 from miro import downloader
 from miro import item
+from miro import eventloop
 from miro import feed
 from miro import folder
 from miro import widgetstate
@@ -29,6 +32,7 @@ from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
 
 from miro.test import mock
+from miro.test import testobjects
 from miro.test.framework import (MiroTestCase, EventLoopTest,
                                  skip_for_platforms, MatchAny)
 from miro.schema import (SchemaString, SchemaInt, SchemaFloat,
@@ -356,6 +360,88 @@ class DiskTest(FakeSchemaTest):
         self.reload_test_database()
         self.check_database()
 
+    def test_grouped_updates(self):
+        # UPDATEs should be queued until the transaction finishes, then sent
+        # with one executemany() for each set of changed columns
+        lee2 = Human(u"lee2", 25, 1.4, [])
+        lee3 = Human(u"lee3", 25, 1.4, [])
+        self.db.extend([lee2, lee3])
+        app.db.finish_transaction()
+        statements = []
+        real_time_execute = app.db._time_execute
+        def time_execute(sql, values, many):
+            statements.append((sql, many, len(values)))
+            real_time_execute(sql, values, many)
+        app.db._time_execute = time_execute
+
+        self.lee.age = 26
+        self.lee.signal_change()
+        lee2.age = 26
+        lee2.signal_change()
+        lee3.age = 26
+        lee3.signal_change()
+        lee3.name = u'lee three'
+        lee3.signal_change()
+        self.assertEquals(statements, [])
+        app.db.finish_transaction()
+        updates = [s for s in statements if s[0].startswith('UPDATE')]
+        self.assertEquals(len(updates), 2)
+        self.assertSameSet([(many, count) for sql, many, count in updates],
+                           [(True, 2), (True, 1)])
+        for sql, many, count in updates:
+            self.assert_(sql.endswith('WHERE id=?'))
+        report = '\n'.join(app.db.get_statement_timing_report())
+        self.assert_('UPDATE human SET' in report)
+        self.reload_test_database()
+        self.check_database()
+
+    def test_queued_update_missing_row(self):
+        lee2 = Human(u"lee2", 25, 1.4, [])
+        # delete lee's row behind LiveStorage's back
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (self.lee.id,))
+        self.lee.age = 26
+        self.lee.signal_change()
+        lee2.age = 26
+        lee2.signal_change()
+        with self.allow_warnings():
+            # running an unrelated statement flushes the UPDATEs, but
+            # shouldn't raise the error
+            self.assertEquals(Human.make_view('age=26').count(), 1)
+            # finishing the transaction should
+            self.assertRaises(KeyError, app.db.finish_transaction)
+        # the other UPDATE should still be saved
+        self.assertEquals(app.db.execute("SELECT age FROM human WHERE id=?",
+                                         (lee2.id,)), [(26,)])
+        # the error should only be raised once
+        app.db.finish_transaction()
+
+    def test_queued_update_missing_row_in_eventloop(self):
+        # errors from queued UPDATEs shouldn't stop the eventloop
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (self.lee.id,))
+        def change_lee():
+            self.lee.age = 26
+            self.lee.signal_change()
+        def check_still_running():
+            self.still_running = True
+            eventloop.shutdown()
+        self.still_running = False
+        self.error_signal_okay = True
+        eventloop.add_idle(change_lee, 'change lee')
+        eventloop.add_timeout(0.1, check_still_running, 'check eventloop')
+        with self.allow_warnings():
+            self.runEventLoop(timeoutNormal=True)
+        self.assert_(self.saw_error)
+        self.assert_(self.still_running)
+
+    def test_update_visible_to_queries(self):
+        # queued UPDATEs need to run before we query the database
+        self.lee.age = 26
+        self.lee.signal_change()
+        self.assertEquals(Human.make_view('age=26').count(), 1)
+        app.db.cursor.execute("SELECT age FROM human WHERE id=?",
+                              (self.lee.id,))
+        self.assertEquals(app.db.cursor.fetchall(), [(26,)])
+
     def test_schema_repr(self):
         self.joe.stuff = {
             '1234': datetime.now(),
@@ -623,7 +709,7 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(containercodec.decode(row[0]), 'testing123')
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
@@ -631,6 +717,103 @@ class CorruptReprTest(FakeSchemaTest):
         with self.allow_warnings():
             self.assertRaises(SyntaxError, self.reload_object, self.ben)
 
+class LegacyReprTest(FakeSchemaTest):
+    # Test container columns that older versions stored using repr()
+    def test_legacy_values_converted(self):
+        app.db.cursor.execute("UPDATE human "
+                              "SET friend_names=?, high_scores=?, stuff=? "
+                              "WHERE id=?",
+                              (u"[u'joe']", u"{u'pong': 10}",
+                               u"{'car': u'honda', 'year': 2004L}",
+                               self.lee.id))
+        restored_lee = self.reload_object(self.lee)
+        self.assertEquals(restored_lee.friend_names, [u'joe'])
+        self.assertEquals(restored_lee.high_scores, {u'pong': 10})
+        self.assertEquals(restored_lee.stuff,
+                          {'car': u'honda', 'year': 2004L})
+        # restoring the object should convert the columns to the new format
+        app.db.cursor.execute("SELECT friend_names, high_scores, stuff "
+                              "FROM human WHERE id=?", (self.lee.id,))
+        row = app.db.cursor.fetchone()
+        for value in row:
+            self.assert_(containercodec.is_encoded(value))
+        self.assertEquals(containercodec.decode(row[2]),
+                          {'car': u'honda', 'year': 2004L})
+
+    def test_new_values_not_rewritten(self):
+        self.reload_object(self.lee)
+        self.assertEquals(len(app.db._pending_updates), 0)
+
+class TransactionLogTest(FakeSchemaTest):
+    # test committing large transactions in pieces
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.TRANSACTION_LOG_LIMIT = 50
+
+    def add_humans(self, start, count):
+        for i in xrange(start, start + count):
+            Human(u"human-%d" % i, 20, 1.5, [])
+
+    def committed_count(self):
+        # use a separate connection, so we only see committed rows
+        connection = sqlite3.connect(self.save_path)
+        try:
+            cursor = connection.execute("SELECT COUNT(*) FROM human")
+            return cursor.fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_log_bounded(self):
+        self.add_humans(0, 500)
+        self.assert_(app.db._transaction_log.row_count <= 50)
+        # most of the rows should be committed already
+        self.assert_(self.committed_count() > 450)
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_count(), 501)
+        self.assertEquals(len(app.db._transaction_log), 0)
+
+    def test_no_limit(self):
+        app.db.TRANSACTION_LOG_LIMIT = None
+        self.add_humans(0, 100)
+        self.assertEquals(app.db._transaction_log.row_count, 100)
+        self.assertEquals(self.committed_count(), 1)
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_count(), 101)
+
+    def test_sql_stored_once(self):
+        self.add_humans(0, 10)
+        sql_strings = set(id(sql) for (sql, values, many)
+                          in app.db._transaction_log)
+        self.assertEquals(len(sql_strings), 1)
+
+    def test_rollback(self):
+        # rolling back only undoes the rows since the last partial commit
+        self.add_humans(0, 120)
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.committed_count(), 101)
+
+    def test_retry_after_partial_commit(self):
+        retry = storedatabase.LiveStorageErrorHandler.ACTION_RETRY
+        app.db.error_handler = mock.Mock()
+        app.db.error_handler.handle_save_error.return_value = retry
+        self.add_humans(0, 120)
+        # make the next statement fail.  We should re-run the statements
+        # since the last partial commit, but not the ones before it.
+        real_time_execute = app.db._time_execute
+        def time_execute_intercept(*args, **kwargs):
+            app.db._time_execute = real_time_execute
+            raise sqlite3.OperationalError()
+        app.db._time_execute = time_execute_intercept
+        with self.allow_warnings():
+            self.add_humans(120, 10)
+        self.assertEquals(
+            app.db.error_handler.handle_save_error.call_count, 1)
+        app.db.finish_transaction()
+        self.assertEquals(self.committed_count(), 131)
+        names = set(h.name for h in Human.make_view())
+        self.assertEquals(len(names), 131)
+
 class ConverterTest(StoreDatabaseTest):
     def test_convert_repr(self):
         converter = storedatabase.SQLiteConverter()
@@ -650,6 +833,65 @@ tm_isdst=0)}"""
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_convert_container(self):
+        converter = storedatabase.SQLiteConverter()
+        value = {
+            'updated_parsed': time.gmtime(0),
+            u'tags': [u'a', (1, 2L)],
+            'when': datetime(2011, 1, 2, 3, 4, 5),
+            'rating': 1.5,
+            'enabled': True,
+            'extra': None,
+        }
+        sql_value = converter._repr_to_sql(value, None)
+        self.assert_(isinstance(sql_value, buffer))
+        val = converter._repr_from_sql(sql_value, None)
+        # struct_time values get converted to tuples, like with repr()
+        value['updated_parsed'] = tuple(value['updated_parsed'])
+        self.assertEquals(val, value)
+        self.assertEquals(type(val['updated_parsed']), tuple)
+        self.assertEquals(type(val[u'tags'][1][1]), long)
+
+    def test_convert_subclasses(self):
+        # subclasses of the container types (for example FeedParserDict)
+        # should come back as the base type
+        class SubclassedDict(dict):
+            pass
+        class SubclassedList(list):
+            pass
+        converter = storedatabase.SQLiteConverter()
+        value = SubclassedDict(a=SubclassedList([1, 2]))
+        val = converter._repr_from_sql(converter._repr_to_sql(value, None),
+                                       None)
+        self.assertEquals(val, {'a': [1, 2]})
+        self.assertEquals(type(val), dict)
+        self.assertEquals(type(val['a']), list)
+
+    def test_convert_timedelta(self):
+        converter = storedatabase.SQLiteConverter()
+        value = timedelta(days=1, seconds=2, microseconds=3)
+        val = converter._repr_from_sql(converter._repr_to_sql(value, None),
+                                       None)
+        self.assertEquals(val, value)
+        val = converter._repr_from_sql(u'datetime.timedelta(1, 2, 3)', None)
+        self.assertEquals(val, value)
+
+    def test_decode_only_allows_simple_types(self):
+        data = containercodec._PREFIX + cPickle.dumps(os.path.join, 2)
+        self.assertRaises(containercodec.DecodeError,
+                          containercodec.decode, data)
+        data = containercodec.HEADER + chr(99) + cPickle.dumps([], 2)
+        self.assertRaises(containercodec.DecodeError,
+                          containercodec.decode, data)
+
+    def test_eval_container(self):
+        # databaseupgrade.eval_container() needs to handle both the old and
+        # new formats
+        value = [1, {u'a': None, 'b': (u'c', 2.5)}]
+        self.assertEquals(databaseupgrade.eval_container(repr(value)), value)
+        encoded = databaseupgrade.encode_container(value)
+        self.assertEquals(databaseupgrade.eval_container(encoded), value)
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -899,5 +1141,87 @@ class TemporaryModeTest(MiroTestCase):
             self.last_connect_path = path
             return self.real_sqlite3_connect(path, *args, **kwargs)
 
+class FullTextSearchTest(EventLoopTest):
+    # test the batched item_fts updates
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(5)
+        app.db.finish_transaction()
+
+    def search(self, term):
+        app.db.cursor.execute("SELECT docid FROM item_fts "
+                              "WHERE item_fts MATCH ?", (term,))
+        return set(row[0] for row in app.db.cursor.fetchall())
+
+    def dirty_count(self):
+        app.db.cursor.execute("SELECT COUNT(*) FROM item_fts_dirty")
+        return app.db.cursor.fetchone()[0]
+
+    def test_insert(self):
+        new_item = testobjects.make_item(self.feed, u'aardvark')
+        new_item.title = u'aardvark'
+        new_item.signal_change()
+        self.assertEquals(self.dirty_count(), 1)
+        app.db.finish_transaction()
+        self.assertEquals(self.dirty_count(), 0)
+        self.assertEquals(self.search(u'aardvark'), set([new_item.id]))
+
+    def test_update_text_column(self):
+        self.items[0].title = u'zebra'
+        self.items[0].signal_change()
+        self.items[1].title = u'zebra'
+        self.items[1].signal_change()
+        self.items[0].description = u'zebra'
+        self.items[0].signal_change()
+        # we should only queue each row once
+        self.assertEquals(self.dirty_count(), 2)
+        # item_fts shouldn't be updated until we commit
+        self.assertEquals(self.search(u'zebra'), set())
+        app.db.finish_transaction()
+        self.assertEquals(self.dirty_count(), 0)
+        self.assertEquals(self.search(u'zebra'),
+                          set([self.items[0].id, self.items[1].id]))
+
+    def test_update_other_column(self):
+        # updates that don't touch the indexed columns shouldn't queue
+        # anything
+        self.items[0].resume_time = 10
+        self.items[0].signal_change()
+        self.assertEquals(self.dirty_count(), 0)
+        app.db.finish_transaction()
+
+    def test_rollback(self):
+        self.items[0].title = u'zebra'
+        self.items[0].signal_change()
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.dirty_count(), 0)
+        self.assertEquals(self.search(u'zebra'), set())
+
+    def test_remove(self):
+        self.items[0].title = u'zebra'
+        self.items[0].signal_change()
+        self.items[0].remove()
+        self.assertEquals(self.dirty_count(), 0)
+        app.db.finish_transaction()
+        self.assertEquals(self.search(u'zebra'), set())
+
+    def test_merge(self):
+        app.db.FTS_MERGE_THRESHOLD = 2
+        # don't count the items that setUp() indexed
+        app.db._fts_rows_since_merge = 0
+        self.items[0].title = u'zebra'
+        self.items[0].signal_change()
+        app.db.finish_transaction()
+        self.assertEquals(app.db._fts_merge_call, None)
+        self.items[1].title = u'zebra'
+        self.items[1].signal_change()
+        app.db.finish_transaction()
+        self.assertNotEquals(app.db._fts_merge_call, None)
+        self.runPendingIdles()
+        app.db.finish_transaction()
+        self.assertEquals(app.db._fts_merge_call, None)
+        self.assertEquals(self.search(u'zebra'),
+                          set([self.items[0].id, self.items[1].id]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import os
+import threading
 import time
 import Queue
 
@@ -8,7 +9,8 @@ from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (MiroTestCase, EventLoopTest,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -58,6 +60,16 @@ class TestSubprocessResponder(subprocessmanager.SubprocessResponder):
         if msg.event == 'startup':
             self.subprocess_ready = True
 
+class SynchronousTestHandler(subprocessmanager.SubprocessHandler):
+    def handle_ping(self, msg):
+        Pong().send_to_main_process()
+
+    def handle_hang(self, msg):
+        time.sleep(10.0)
+
+    def handle_crash(self, msg):
+        os._exit(1)
+
 class TestMessage(subprocessmanager.SubprocessMessage):
     pass
 
@@ -67,6 +79,12 @@ class Ping(TestMessage):
 class ForceException(TestMessage):
     pass
 
+class Hang(TestMessage):
+    pass
+
+class Crash(TestMessage):
+    pass
+
 class Pong(subprocessmanager.SubprocessResponse):
     pass
 
@@ -80,6 +98,10 @@ class SlowRunningTask(workerprocess.TaskMessage):
     """
     priority = -10
 
+class GetPidTask(workerprocess.TaskMessage):
+    """Task that returns the pid of the worker process that handled it."""
+    priority = -10
+
 # Actual tests go below here
 
 class SubprocessManagerTest(EventLoopTest):
@@ -226,6 +248,106 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class PipeTransportTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        read_fd, write_fd = os.pipe()
+        self.read_pipe = os.fdopen(read_fd, 'rb', 0)
+        self.write_pipe = os.fdopen(write_fd, 'wb', 0)
+        self.stats = subprocessmanager.TransportStats()
+        self.reader = subprocessmanager.PipeReader(self.read_pipe, self.stats)
+        self.side_channel_paths = []
+        real_write_to_side_channel = subprocessmanager._write_to_side_channel
+        def write_to_side_channel(pickle_data):
+            path = real_write_to_side_channel(pickle_data)
+            self.side_channel_paths.append(path)
+            return path
+        self.patch_function('miro.subprocessmanager._write_to_side_channel',
+                            write_to_side_channel)
+
+    def tearDown(self):
+        self.read_pipe.close()
+        self.write_pipe.close()
+        MiroTestCase.tearDown(self)
+
+    def send_objects(self, objects):
+        # write in a thread, since large objects could fill up the pipe
+        def write_objects():
+            for obj in objects:
+                subprocessmanager._dump_obj(obj, self.write_pipe)
+        thread = threading.Thread(target=write_objects)
+        thread.start()
+        received = [self.reader.load_obj() for obj in objects]
+        thread.join()
+        return received
+
+    def test_send_objects(self):
+        objects = [None, {'foo': u'bar'}, range(1000), 'a' * 100000]
+        self.assertEquals(self.send_objects(objects), objects)
+        # the reader should reuse its buffer for small messages
+        buf = self.reader.buffer
+        self.send_objects([{'foo': u'bar'}])
+        self.assert_(self.reader.buffer is buf)
+
+    def test_side_channel(self):
+        big_obj = 'a' * subprocessmanager.SIDE_CHANNEL_THRESHOLD
+        self.assertEquals(self.send_objects([big_obj, None]), [big_obj, None])
+        self.assertEquals(len(self.side_channel_paths), 1)
+        # the temporary file should be deleted once it's read
+        self.assert_(not os.path.exists(self.side_channel_paths[0]))
+        # small messages should go through the pipe
+        self.send_objects([u'small'])
+        self.assertEquals(len(self.side_channel_paths), 1)
+
+    def test_stats(self):
+        self.send_objects([u'one', u'two', None])
+        self.assertEquals(self.stats.received['unicode'].count, 2)
+        self.assertEquals(self.stats.received['NoneType'].count, 1)
+        self.assert_(self.stats.received['unicode'].bytes > 0)
+
+class SynchronousSubprocessTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.subprocess = subprocessmanager.SynchronousSubprocess(
+            SynchronousTestHandler)
+        self.subprocess.start()
+
+    def tearDown(self):
+        self.subprocess.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def ping(self):
+        self.subprocess.start()
+        self.subprocess.send_message(Ping())
+        self.assert_(isinstance(self.subprocess.wait_for_response(6.0),
+                                Pong))
+
+    def test_send_and_receive(self):
+        process = self.subprocess.process
+        self.ping()
+        self.ping()
+        # we should use the same process for both messages
+        self.assert_(self.subprocess.process is process)
+
+    def test_timeout(self):
+        self.ping()
+        self.subprocess.send_message(Hang())
+        with self.allow_warnings():
+            self.assertRaises(subprocessmanager.SubprocessTimeoutError,
+                              self.subprocess.wait_for_response, 0.5)
+        self.assert_(not self.subprocess.is_running())
+        # the next message should start a fresh process
+        self.ping()
+
+    def test_crash(self):
+        self.ping()
+        self.subprocess.send_message(Crash())
+        with self.allow_warnings():
+            self.assertRaises(subprocessmanager.SubprocessQuitError,
+                              self.subprocess.wait_for_response, 6.0)
+        self.assert_(not self.subprocess.is_running())
+        self.ping()
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -238,6 +360,10 @@ class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
         time.sleep(0.5)
         return None
 
+    def handle_get_pid_task(self, msg):
+        time.sleep(0.1)
+        return os.getpid()
+
 class WorkerProcessTest(EventLoopTest):
     """Test our worker process."""
     def setUp(self):
@@ -299,15 +425,15 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        worker = workerprocess._subprocess_manager.workers[0]
+        original_pid = worker.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        worker.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, worker.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -320,6 +446,145 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerPoolTest(WorkerProcessTest):
+    def test_tasks_use_all_processes(self):
+        workerprocess.startup(thread_count=1, process_count=2)
+        pids = []
+        def callback(msg, pid):
+            pids.append(pid)
+            if len(pids) == 8:
+                self.stopEventLoop(abnormal=False)
+        for i in xrange(8):
+            workerprocess.send(GetPidTask(), callback, self.errback)
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(pids), 8)
+        worker_pids = [w.process.pid
+                       for w in workerprocess._subprocess_manager.workers]
+        self.assertSameSet(set(pids), worker_pids)
+
+class MockWorkerProcess(object):
+    def __init__(self, max_tasks):
+        self.max_tasks = max_tasks
+        self.is_running = True
+        self.tasks_in_progress = {}
+        self.messages_sent = []
+
+    def has_room_for_task(self):
+        return len(self.tasks_in_progress) < self.max_tasks
+
+    def send_task(self, msg):
+        self.tasks_in_progress[msg.task_id] = msg
+        self.send_message(msg)
+
+    def send_message(self, msg):
+        self.messages_sent.append(msg)
+
+class MiroTaskQueueTest(MiroTestCase):
+    """Test dispatching tasks to the worker processes."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.workers = [MockWorkerProcess(2) for i in xrange(3)]
+        # patch the workers in, so that they are gone by the time tearDown()
+        # calls workerprocess.shutdown()
+        for name, value in (('workers', self.workers),
+                            ('process_count', len(self.workers))):
+            patcher = mock.patch.object(workerprocess._subprocess_manager,
+                                        name, value)
+            patcher.start()
+            self.mock_patchers.append(patcher)
+        self.task_queue = workerprocess._miro_task_queue
+        self.results = []
+
+    def callback(self, msg, result):
+        self.results.append((msg, result))
+
+    def tasks_sent(self):
+        return [msg for w in self.workers for msg in w.messages_sent
+                if isinstance(msg, workerprocess.TaskMessage)]
+
+    def test_dispatch_by_priority(self):
+        for i in xrange(6):
+            self.task_queue.add_task(SlowRunningTask(), self.callback,
+                                     self.callback)
+        # all the workers are full now, the next tasks should wait in the
+        # queue.
+        self.assertEquals(len(self.tasks_sent()), 6)
+        feedparser_task = workerprocess.FeedparserTask('')
+        mutagen_task = workerprocess.MutagenTask('/foo.mp3', '/cover-art')
+        self.task_queue.add_task(mutagen_task, self.callback, self.callback)
+        self.task_queue.add_task(feedparser_task, self.callback,
+                                 self.callback)
+        self.assertEquals(len(self.tasks_sent()), 6)
+        # when a worker finishes a task, we should send the highest priority
+        # task to it.
+        worker = self.workers[1]
+        task_id = worker.tasks_in_progress.keys()[0]
+        self.task_queue.process_result(workerprocess.TaskResult(task_id,
+                                                                None))
+        self.task_queue.dispatch_tasks()
+        self.assertEquals(worker.messages_sent[-1], feedparser_task)
+
+    def test_results_by_priority(self):
+        slow_task = SlowRunningTask()
+        feedparser_task = workerprocess.FeedparserTask('')
+        self.task_queue.add_task(slow_task, self.callback, self.callback)
+        self.task_queue.add_task(feedparser_task, self.callback,
+                                 self.callback)
+        # results from different workers should be processed by priority
+        self.task_queue.add_result(workerprocess.TaskResult(
+            slow_task.task_id, None))
+        self.task_queue.add_result(workerprocess.TaskResult(
+            feedparser_task.task_id, None))
+        self.task_queue.process_results()
+        self.assertEquals([msg for msg, result in self.results],
+                          [feedparser_task, slow_task])
+
+    def test_split_batch(self):
+        paths = ['/videos/video-%d.mp4' % i for i in xrange(30)]
+        batch = workerprocess.MutagenBatchTask(paths, '/cover-art')
+        self.task_queue.add_task(batch, self.callback, self.callback)
+        parts = self.tasks_sent()
+        # the batch should be split between all of the workers
+        self.assertEquals(len(parts), 3)
+        for worker in self.workers:
+            self.assertEquals(len(worker.tasks_in_progress), 1)
+        self.assertSameSet(sum((p.source_paths for p in parts), []), paths)
+        # the task should be done once we get results for all the parts
+        for part in parts:
+            chunk = [(path, {}) for path in part.source_paths]
+            self.task_queue.process_result_chunk(
+                workerprocess.TaskResultChunk(part.task_id, chunk, True))
+        self.assertEquals(len(self.results), 3)
+        self.assertEquals(self.task_queue.tasks_in_progress, {})
+
+    def test_cancel(self):
+        for worker in self.workers:
+            worker.max_tasks = 1
+        dispatched = workerprocess.MutagenTask('/a.mp3', '/cover-art')
+        self.task_queue.add_task(dispatched, self.callback, self.callback)
+        # this batch gets split into 3 parts, the last part can't be sent
+        # yet
+        paths = ['/videos/video-%d.mp4' % i for i in xrange(100)]
+        batch = workerprocess.MutagenBatchTask(paths, '/cover-art')
+        self.task_queue.add_task(batch, self.callback, self.callback)
+        self.assertEquals(len(self.task_queue.tasks_in_progress), 4)
+        canceled_paths = ['/a.mp3'] + paths[60:]
+        workerprocess.cancel_tasks_for_files(canceled_paths)
+        # the message should be sent to all workers
+        for worker in self.workers:
+            self.assert_(isinstance(worker.messages_sent[-1],
+                                    workerprocess.CancelFileOperations))
+        # The part that we haven't sent yet should be removed from the
+        # queue.
+        self.assertEquals(len(self.task_queue.tasks_in_progress), 3)
+        self.assertEquals(self.task_queue.pending_tasks.get_next_task(
+            block=False), None)
+        # We shouldn't wait for results for the canceled paths
+        for paths_remaining in \
+                self.task_queue.batch_paths_remaining.values():
+            self.assertEquals(paths_remaining & set(canceled_paths), set())
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
@@ -422,6 +687,26 @@ class MutagenTest(WorkerProcessTest):
         self.check_mutagen_call('drm.m4v', 'video', 2668832, 'Thinkers',
                                 True)
 
+    def test_mutagen_batch(self):
+        workerprocess.startup()
+        paths = [resources.path("testdata/metadata/" + filename)
+                 for filename in ('mp3-0.mp3', 'mp3-1.mp3', 'mp3-2.mp3')]
+        results = {}
+        def chunk_callback(msg, chunk):
+            results.update(chunk)
+            if len(results) == len(paths):
+                self.stopEventLoop(abnormal=False)
+        msg = workerprocess.MutagenBatchTask(paths, self.tempdir)
+        workerprocess.send(msg, chunk_callback, self.errback)
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertSameSet(results.keys(), paths)
+        self.assertEquals(results[paths[0]]['title'], 'Invisible Walls')
+        self.assertEquals(results[paths[1]]['title'], 'Race Lieu')
+        # once we have all the results the task should be done
+        self.assertEquals(workerprocess._miro_task_queue.tasks_in_progress,
+                          {})
+
 
 # TODO:
 #   Test task priority system in worker process
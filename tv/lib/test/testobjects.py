@@ -213,6 +213,10 @@ class MockDAAPClient(mock.Mock):
         self.host = '127.0.0.1'
         self.port = 8000
         self.conn.sock.getpeername.return_value = ('127.0.0.1', 8000)
+        self.supports_update = True
+        self.revision = self.old_revision = 1
+        self.session = 1
+        self.db_item_count = None
         self.library = MockDAAPClientLibrary()
         # maps playlist ids to the last library we used to send items for that
         # playlist.  We use this to calculate which items we need to send when
@@ -317,6 +321,19 @@ class MockDAAPClient(mock.Mock):
         self.last_sent_library[playlist_id] = self.library.copy()
         return items, deleted_items
 
+    def items_page(self, start, count, playlist_id=None, meta=None,
+                   update=False):
+        # Calculate the items to send on the first page, then hand out
+        # slices of them for the next pages.
+        if start == 0:
+            self.paged_items = self.items(playlist_id, meta, update)
+        items, deleted_items = self.paged_items
+        page_ids = sorted(items.keys())[start:start+count]
+        if start != 0:
+            deleted_items = []
+        return (dict((k, items[k]) for k in page_ids), deleted_items,
+                len(items))
+
     def playlists(self, meta=None, update=False):
         if not update or self.last_sent_library_for_playlists is None:
             playlists = self.library.playlists.copy()
@@ -340,6 +357,7 @@ class MockDAAPClient(mock.Mock):
         return playlists, deleted_playlists
 
     def databases(self, update):
+        self.db_item_count = len(self.library.all_items)
         return True
 
     def daap_get_file_request(self, daap_id, file_format):
@@ -390,11 +408,12 @@ def make_sharing_items(share, *titles):
 
 def make_sharing_item(share, daap_id, path, title, file_type=u'video'):
     kwargs = {
+        'daap_id': daap_id,
         'video_path': path,
         'host': share.host,
         'port': share.port,
+        'address': share.host,
         'title': title,
         'file_type': file_type,
-        'db_info': share.db_info,
     }
-    return item.SharingItem(daap_id, **kwargs)
+    return item.SharingItem(share, **kwargs)
@@ -1089,6 +1089,102 @@ class CacheTestCase(MiroTestCase):
         self.assertEquals(self.cache.get(1, invalidator=invalidator),
                           (1, 1))
 
+    def test_lru_order_uses_gets(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        # accessing 1 makes 2 the least recently used key
+        self.cache.get(1)
+        self.cache.get(3)
+        self.assertEquals(set(self.cache.keys()), set((1, 3)))
+
+    def test_eviction_removes_invalidators(self):
+        for i in xrange(10):
+            self.cache.set(i, i, invalidator=lambda key: False)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(set(self.cache.invalidators.keys()), set((8, 9)))
+
+    def test_stats(self):
+        self.cache.get(1)
+        self.cache.get(1)
+        self.cache.get(2)
+        self.cache.get(3)
+        stats = self.cache.stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 3)
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['entries'], 2)
+
+    def test_get_if_cached(self):
+        # get_if_cached() shouldn't create values for missing keys
+        self.assertEquals(self.cache.get_if_cached(1), None)
+        self.assertEquals(self.cache.get_if_cached(1, 'default'), 'default')
+        self.assertFalse(self.cache.is_cached(1))
+        self.assertEquals(list(self.cache.keys()), [])
+        self.cache.set(1, 'one')
+        self.assert_(self.cache.is_cached(1))
+        self.assertEquals(self.cache.get_if_cached(1), 'one')
+        self.assertEquals(self.cache.stats()['hits'], 1)
+
+    def test_get_if_cached_updates_lru(self):
+        self.cache.set(1, 1)
+        self.cache.set(2, 2)
+        self.cache.get_if_cached(1)
+        self.cache.set(3, 3)
+        # 2 was used least recently, so it should have expired out
+        self.assertEquals(set(self.cache.keys()), set((1, 3)))
+
+    def test_get_if_cached_invalidator(self):
+        def invalidator(key):
+            return True
+        self.cache.set(1, 1, invalidator=invalidator)
+        self.assertFalse(self.cache.is_cached(1))
+        self.assertEquals(self.cache.get_if_cached(1), None)
+
+class SizedMockCache(MockCache):
+    """MockCache where each value uses key bytes."""
+    def value_size(self, value):
+        return value[0]
+
+class CacheMaxBytesTestCase(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = SizedMockCache(100)
+        self.cache.max_bytes = 10
+
+    def test_byte_budget(self):
+        self.cache.get(4)
+        self.cache.get(5)
+        self.assertEquals(self.cache.total_bytes, 9)
+        # adding 3 puts us over the budget, so 4 should get evicted
+        self.cache.get(3)
+        self.assertEquals(set(self.cache.keys()), set((5, 3)))
+        self.assertEquals(self.cache.total_bytes, 8)
+
+    def test_oversized_value(self):
+        self.cache.get(4)
+        self.cache.get(20)
+        # we keep the value we just added, even though it's too big
+        self.assertEquals(list(self.cache.keys()), [20])
+        self.assertEquals(self.cache.total_bytes, 20)
+
+    def test_remove_updates_bytes(self):
+        self.cache.get(4)
+        self.cache.set(4, (2, 0))
+        self.assertEquals(self.cache.total_bytes, 2)
+        self.cache.remove(4)
+        self.assertEquals(self.cache.total_bytes, 0)
+
+    def test_shrink(self):
+        for i in xrange(1, 5):
+            self.cache.get(i)
+        self.cache.shrink(0.5)
+        # we should keep the most recently used entries
+        self.assertEquals(set(self.cache.keys()), set((4,)))
+        self.assertEquals(self.cache.stats()['evictions'], 3)
+        self.cache.clear()
+        self.assertEquals(len(self.cache), 0)
+        self.assertEquals(self.cache.total_bytes, 0)
+
 
 class AlarmTestCase(MiroTestCase):
     @staticmethod
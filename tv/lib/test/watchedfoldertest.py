@@ -1,7 +1,10 @@
 import os
 import shutil
+import time
 
 from miro import app
+from miro import directorysnapshot
+from miro import eventloop
 from miro import models
 from miro import signals
 from miro.test import mock
@@ -24,8 +27,11 @@ class WatchedFolderTest(EventLoopTest):
         self.directory_watcher = self.feed.actualFeed.watcher
         # not having to wait for a timeout makes the tests simpler and faster
         self.feed.actualFeed.DIRECTORY_WATCH_UPDATE_TIMEOUT = 0.0
+        # directory scans happen in the thread pool
+        eventloop.thread_pool_init()
 
     def tearDown(self):
+        eventloop.thread_pool_quit()
         app.directory_watcher = None
         EventLoopTest.tearDown(self)
 
@@ -36,7 +42,16 @@ class WatchedFolderTest(EventLoopTest):
     def run_feed_update(self):
         self.feed.update()
         # make sure the update processes
+        self.wait_for_update()
+
+    def wait_for_update(self, timeout=10.0):
+        end = time.time() + timeout
         self.runPendingIdles()
+        while self.feed.actualFeed.updating:
+            if time.time() > end:
+                raise AssertionError("Directory scan didn't finish")
+            time.sleep(0.01)
+            self.runPendingIdles()
 
     def check_items(self, *filenames):
         files = [i.get_filename() for i in self.feed.items]
@@ -125,12 +140,12 @@ class WatchedFolderTest(EventLoopTest):
         # setup is done, try calling update twice
         self.feed.update()
         self.feed.update()
-        self.runPendingIdles()
+        self.wait_for_update()
         self.assertEquals(self.update_count, 1)
         # We're done with the update, check that a new call results in another
         # scan
         self.feed.update()
-        self.runPendingIdles()
+        self.wait_for_update()
         self.assertEquals(self.update_count, 2)
 
     def test_remove_duplicates_on_update(self):
@@ -154,3 +169,82 @@ class WatchedFolderTest(EventLoopTest):
         self.feed.actualFeed._make_child(os.path.join(self.dir, 'a.mp3'))
         self.run_feed_update()
         self.check_failed_soft_count(1)
+
+    def make_old(self, *filenames):
+        """Set the mtime of paths inside our directory to the past.
+
+        This makes the directory snapshot trust the mtime, so the next scan
+        won't list the directory.
+        """
+        old_time = 1000000000
+        for filename in filenames:
+            os.utime(os.path.join(self.dir, filename), (old_time, old_time))
+
+    def test_subdirectories(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.copy_new_file('a.mp3')
+        self.copy_new_file(os.path.join('sub', 'b.mp3'))
+        self.run_feed_update()
+        self.check_items('a.mp3', os.path.join('sub', 'b.mp3'))
+        self.copy_new_file(os.path.join('sub', 'c.mp3'))
+        self.remove_file(os.path.join('sub', 'b.mp3'))
+        self.run_feed_update()
+        self.check_items('a.mp3', os.path.join('sub', 'c.mp3'))
+
+    def test_unchanged_directories_not_listed(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.copy_new_file(os.path.join('sub', 'a.mp3'))
+        self.copy_new_file('b.mp3')
+        self.make_old('', 'sub')
+        self.run_feed_update()
+        snapshot = self.feed.actualFeed._snapshot
+        # a file that shows up without the directory mtime changing isn't
+        # noticed, which shows that we're not listing the directory again.
+        self.copy_new_file(os.path.join('sub', 'c.mp3'))
+        self.make_old('', 'sub')
+        changes = snapshot.rescan()
+        self.assertEquals(changes.directories_listed, 0)
+        self.assertEquals(changes.directories_reused, 2)
+        self.assertEquals(changes.added, [])
+        # once the mtime changes, we pick it up
+        os.utime(os.path.join(self.dir, 'sub'), None)
+        self.run_feed_update()
+        self.check_items(os.path.join('sub', 'a.mp3'),
+                os.path.join('sub', 'c.mp3'), 'b.mp3')
+
+    def test_snapshot_saved(self):
+        self.copy_new_file('a.mp3')
+        self.make_old('')
+        self.run_feed_update()
+        path = self.feed.actualFeed._snapshot_path()
+        # the snapshot gets saved in the thread pool
+        end = time.time() + 10.0
+        while not os.path.exists(path):
+            if time.time() > end:
+                raise AssertionError("Snapshot wasn't saved")
+            time.sleep(0.01)
+        snapshot = directorysnapshot.load(path, self.dir)
+        self.assert_(snapshot.contains_file(os.path.join(self.dir, 'a.mp3')))
+        # a new feed object for the same directory starts from the saved
+        # snapshot and still reconciles its items with it
+        self.feed.actualFeed._snapshot = None
+        self.remove_file('a.mp3')
+        self.copy_new_file('b.mp3')
+        self.run_feed_update()
+        self.check_items('b.mp3')
+        # removing the feed removes the snapshot
+        self.feed.remove()
+        self.assert_(not os.path.exists(path))
+
+    def test_file_owned_by_other_feed_released(self):
+        self.copy_new_file('a.mp3')
+        path = os.path.join(self.dir, 'a.mp3')
+        other_feed = models.Feed(u'dtv:manualFeed')
+        other_item = models.FileItem(path, feed_id=other_feed.id)
+        self.run_feed_update()
+        self.check_items()
+        # once the other item goes away, we should pick up the file, even
+        # though the directory didn't change.
+        other_item.remove()
+        self.run_feed_update()
+        self.check_items('a.mp3')
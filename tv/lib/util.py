@@ -450,8 +450,19 @@ def clamp_text(text, max_length=20):
         return text
 
 def db_mem_usage_test():
+    """Load every DDBObject and log how much memory each class uses.
+
+    Only classes stored in the main database get loaded.  Device and sharing
+    items live in their own databases.
+
+    :returns: total memory usage in KB after loading the objects
+    """
     from miro import models
+    from miro import schema
     from miro.database import DDBObject
+    main_db_classes = set()
+    for object_schema in schema.object_schemas:
+        main_db_classes.update(object_schema.ddb_object_classes())
     last_usage = get_mem_usage()
     logging.debug("baseline memory usage: %s", last_usage)
     for name in dir(models):
@@ -461,6 +472,8 @@ def db_mem_usage_test():
                 continue
         except TypeError:
             continue
+        if ddb_object_class not in main_db_classes:
+            continue
         if name == 'FileItem':
             # Item and FileItem share a db table, so we only need to
             # load one
@@ -479,6 +492,7 @@ def db_mem_usage_test():
     logging.debug("total memory usage: %s", last_usage)
     logging.debug("feed count: %s", models.Feed.make_view().count())
     logging.debug("item count: %s", models.Item.make_view().count())
+    return last_usage
 
 def get_mem_usage():
     return int(call_command('ps', '-o', 'rss', 'hp', str(os.getpid())))
@@ -1118,56 +1132,127 @@ def mtime_invalidator(path):
     return invalidator
 
 class Cache(object):
-    def __init__(self, size):
+    """Least-recently-used cache.
+
+    Subclasses implement create_new_value() to make values for keys that
+    aren't in the cache.
+
+    The cache holds at most size entries.  If max_bytes is given, it also
+    keeps the total of value_size() for its values under that budget.  We
+    always keep the most recently set value, even if it's bigger than the
+    budget by itself.
+
+    hits, misses and evictions count cache activity since the cache was
+    created.
+    """
+    def __init__(self, size, max_bytes=None):
         self.size = size
-        self.dict = {}
-        self.counter = itertools.count()
-        self.access_times = {}
+        self.max_bytes = max_bytes
+        # maps keys to values, the least recently used key comes first
+        self.dict = collections.OrderedDict()
         self.invalidators = {}
+        self.value_sizes = {}
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
 
     def get(self, key, invalidator=None):
-        if key in self.dict:
-            existing_invalidator = self.invalidators[key]
-            if (existing_invalidator is None or
-                not existing_invalidator(key)):
-                self.access_times[key] = self.counter.next()
-                return self.dict[key]
-
+        if self.is_cached(key):
+            return self._use(key)
+        self.misses += 1
         value = self.create_new_value(key, invalidator=invalidator)
         self.set(key, value, invalidator=invalidator)
         return value
 
+    def get_if_cached(self, key, default=None):
+        """Get a value without creating a new one.
+
+        :returns: the cached value, or default if key isn't cached or its
+        value is no longer valid
+        """
+        if self.is_cached(key):
+            return self._use(key)
+        return default
+
+    def is_cached(self, key):
+        """Check if we have a valid value for key."""
+        if key not in self.dict:
+            return False
+        invalidator = self.invalidators[key]
+        return invalidator is None or not invalidator(key)
+
+    def _use(self, key):
+        # move the key to the end of the LRU order
+        value = self.dict.pop(key)
+        self.dict[key] = value
+        self.hits += 1
+        return value
+
     def set(self, key, value, invalidator=None):
-        if len(self.dict) == self.size:
-            self.shrink_size()
-        self.access_times[key] = self.counter.next()
+        self.remove(key)
+        value_size = self.value_size(value)
         self.dict[key] = value
         self.invalidators[key] = invalidator
+        self.value_sizes[key] = value_size
+        self.total_bytes += value_size
+        self._evict(self.size, self.max_bytes, keep=1)
 
     def remove(self, key):
         if key in self.dict:
             del self.dict[key]
-            del self.access_times[key]
-        if key in self.invalidators:
             del self.invalidators[key]
+            self.total_bytes -= self.value_sizes.pop(key)
 
     def keys(self):
         return self.dict.iterkeys()
 
-    def shrink_size(self):
-        # shrink by LRU
-        to_sort = self.access_times.items()
-        to_sort.sort(key=lambda m: m[1])
-        new_dict = {}
-        new_access_times = {}
-        new_invalidators = {}
-        latest_times = to_sort[len(self.dict) // 2:]
-        for (key, time) in latest_times:
-            new_dict[key] = self.dict[key]
-            new_invalidators[key] = self.invalidators[key]
-            new_access_times[key] = time
-        self.dict = new_dict
-        self.access_times = new_access_times
+    def __len__(self):
+        return len(self.dict)
+
+    def clear(self):
+        self.dict.clear()
+        self.invalidators.clear()
+        self.value_sizes.clear()
+        self.total_bytes = 0
+
+    def _evict(self, max_entries, max_bytes, keep=0):
+        """Drop least recently used entries until we're under the limits.
+
+        :param keep: number of most recently used entries to never drop
+        """
+        while len(self.dict) > keep:
+            if (len(self.dict) <= max_entries and
+                (max_bytes is None or self.total_bytes <= max_bytes)):
+                break
+            key = iter(self.dict).next()
+            self.remove(key)
+            self.evictions += 1
+
+    def shrink(self, fraction=0.5):
+        """Drop entries to free up memory.
+
+        Call this when the system is low on memory.  We drop least recently
+        used entries until both the entry count and the byte total are at
+        most fraction of what they are now.
+        """
+        self._evict(int(len(self.dict) * fraction),
+                    int(self.total_bytes * fraction))
+
+    def stats(self):
+        """Get a dict with info about how well the cache is working."""
+        return {
+            'entries': len(self.dict),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def value_size(self, value):
+        """Get the number of bytes value uses.
+
+        Subclasses that set max_bytes should override this.
+        """
+        return 0
 
     def create_new_value(self, val, invalidator=None):
         raise NotImplementedError()
@@ -0,0 +1,465 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""Evaluate the WHERE clauses of views in python.
+
+ViewTracker needs to know if an object is in its view every time that
+object changes.  Asking SQLite means a query per tracker per change, which
+adds up quickly when downloads are updating their items several times a
+second.  This module compiles the simple WHERE clauses that our views use
+into python functions that check the objects we already have in memory.
+
+Only a small subset of SQL is supported: AND, OR, NOT, comparisons, IS [NOT]
+NULL and [NOT] IN with a list of values.  Joins are supported if they are of
+the form ``table.column=alias.id``.  compile_where() returns None for
+anything else.
+
+Even a compiled predicate can't always give an answer.  For example, SQLite
+converts between numbers and strings when comparing them, which we don't try
+to copy.  In those cases, Predicate.evaluate() raises CantEvaluate and the
+caller should ask SQLite instead.
+"""
+
+import operator
+import re
+
+class CompileError(StandardError):
+    """We can't compile a WHERE clause."""
+    pass
+
+class CantEvaluate(StandardError):
+    """We can't be sure that python will give the same result as SQLite."""
+    pass
+
+def _comparable_types():
+    """Get the schema types that we can compare with python.
+
+    Other columns can only be used with IS NULL/IS NOT NULL.  We import schema
+    here rather than at module level since schema imports database, which
+    imports us.
+    """
+    from miro import schema
+    return (schema.SchemaBool, schema.SchemaInt, schema.SchemaFloat,
+            schema.SchemaString, schema.SchemaURL)
+
+_token_re = re.compile(r"""\s*(?:
+    (?P<number>\d+(?:\.\d*)?) |
+    (?P<string>'(?:[^']|'')*') |
+    (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?) |
+    (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,|\?)
+    )""", re.VERBOSE)
+
+_compare_ops = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+_NUMBER = 'number'
+_TEXT = 'text'
+
+def _kind(value):
+    if isinstance(value, (int, long, float)):
+        return _NUMBER
+    elif isinstance(value, basestring):
+        return _TEXT
+    else:
+        raise CantEvaluate("can't compare %r" % (value,))
+
+def _truth(value):
+    """Get the truth value of a SQL value.
+
+    :returns: True, False, or None for NULL
+    """
+    if value is None or value is True or value is False:
+        return value
+    if _kind(value) is _TEXT:
+        # SQLite converts strings to numbers here, don't try to copy that.
+        raise CantEvaluate("string used as a boolean")
+    return value != 0
+
+def tokenize(sql):
+    """Split a SQL expression into a list of (kind, text) tuples.
+
+    kind is one of "number", "string", "name", "op" or "keyword".
+
+    :raises CompileError: sql contains something that we don't understand
+    """
+    tokens = []
+    pos = 0
+    sql = sql.rstrip()
+    while pos < len(sql):
+        match = _token_re.match(sql, pos)
+        if match is None or match.end() == pos:
+            raise CompileError("can't parse %r" % sql[pos:])
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'name' and text.lower() in ('and', 'or', 'not', 'is',
+                                               'null', 'in'):
+            kind, text = 'keyword', text.lower()
+        tokens.append((kind, text))
+        pos = match.end()
+    return tokens
+
+class Predicate(object):
+    """Compiled WHERE clause for a view.
+
+    :attribute param_count: number of ? placeholders in the WHERE clause
+    """
+    def __init__(self, table_name, joins, expr, param_count):
+        self.table_name = table_name
+        # maps aliases to (table_name, foreign key attribute)
+        self.joins = joins
+        self.expr = expr
+        self.param_count = param_count
+
+    def evaluate(self, obj, values, fetch_joined):
+        """Check if an object matches the WHERE clause.
+
+        :param obj: DDBObject from our table
+        :param values: values for the ? placeholders
+        :param fetch_joined: function that takes an id and a table name and
+            returns the object for a joined row.  It should raise
+            CantEvaluate if that object isn't available.
+        :raises CantEvaluate: we can't be sure about the result
+        """
+        rows = {self.table_name: obj}
+        def get_row(alias):
+            try:
+                return rows[alias]
+            except KeyError:
+                pass
+            join_table, fk_attr = self.joins[alias]
+            fk = getattr(obj, fk_attr)
+            if fk is None:
+                # LEFT JOIN with no match: all columns are NULL
+                row = None
+            else:
+                row = fetch_joined(fk, join_table)
+            rows[alias] = row
+            return row
+        return _truth(self.expr(get_row, values)) is True
+
+def compile_where(where, table_name, joins, table_fields):
+    """Compile a WHERE clause for a view into a Predicate.
+
+    :param where: WHERE clause, or None
+    :param table_name: table that the view selects from
+    :param joins: dict mapping join tables to ON clauses, like the joins
+        argument to DDBObject.make_view(), or None
+    :param table_fields: function that takes a table name and returns a list
+        of (name, schema_item) tuples for it, or None for unknown tables
+    :returns: Predicate, or None if the where clause can't be compiled
+    """
+    try:
+        return _Compiler(table_name, joins, table_fields).compile(where)
+    except CompileError:
+        return None
+
+class _Compiler(object):
+    def __init__(self, table_name, joins, table_fields):
+        self.table_name = table_name.lower()
+        # maps aliases to dicts that map lowercase column names to (name,
+        # schema_item) tuples
+        self.scope = {}
+        self.scope[self.table_name] = self._column_map(table_fields,
+                                                       table_name)
+        join_tables = {}
+        if joins:
+            for join_table, on in joins.items():
+                alias, real_table = self._parse_join_table(join_table)
+                if alias in self.scope:
+                    raise CompileError("duplicate alias: %s" % alias)
+                self.scope[alias] = self._column_map(table_fields,
+                                                     real_table)
+                join_tables[alias] = (real_table, on)
+        self.joins = {}
+        for alias, (real_table, on) in join_tables.items():
+            self.joins[alias] = (real_table, self._parse_join_on(alias, on))
+
+    def _column_map(self, table_fields, table_name):
+        fields = table_fields(table_name)
+        if fields is None:
+            raise CompileError("unknown table: %s" % table_name)
+        return dict((name.lower(), (name, schema_item))
+                    for name, schema_item in fields)
+
+    def _parse_join_table(self, join_table):
+        parts = join_table.split()
+        if len(parts) == 1:
+            return parts[0].lower(), parts[0]
+        elif len(parts) == 2:
+            return parts[1].lower(), parts[0]
+        elif len(parts) == 3 and parts[1].lower() == 'as':
+            return parts[2].lower(), parts[0]
+        else:
+            raise CompileError("can't parse join: %s" % join_table)
+
+    def _parse_join_on(self, alias, on):
+        """Parse an ON clause.
+
+        :returns: the attribute of our objects that holds the joined id
+        """
+        tokens = tokenize(on)
+        if (len(tokens) != 3 or tokens[0][0] != 'name' or
+                tokens[1] not in (('op', '='), ('op', '==')) or
+                tokens[2][0] != 'name'):
+            raise CompileError("can't compile join: %s" % on)
+        left = self._resolve_column(tokens[0][1])
+        right = self._resolve_column(tokens[2][1])
+        if right[:2] == (alias, 'id'):
+            own_column = left
+        elif left[:2] == (alias, 'id'):
+            own_column = right
+        else:
+            raise CompileError("join isn't on %s.id: %s" % (alias, on))
+        own_alias, attr, schema_item = own_column
+        from miro import schema
+        if (own_alias != self.table_name or
+                not isinstance(schema_item, schema.SchemaInt)):
+            raise CompileError("can't compile join: %s" % on)
+        return attr
+
+    def _resolve_column(self, name):
+        """Find the column that a name refers to.
+
+        :returns: (alias, attribute name, schema_item) tuple
+        """
+        name = name.lower()
+        if '.' in name:
+            alias, column = name.split('.')
+            try:
+                attr, schema_item = self.scope[alias][column]
+            except KeyError:
+                raise CompileError("unknown column: %s" % name)
+            return alias, attr, schema_item
+        matches = [(alias, columns[name])
+                   for alias, columns in self.scope.items()
+                   if name in columns]
+        if len(matches) != 1:
+            raise CompileError("unknown or ambiguous column: %s" % name)
+        alias, (attr, schema_item) = matches[0]
+        return alias, attr, schema_item
+
+    def compile(self, where):
+        self.param_count = 0
+        if where is None or not where.strip():
+            expr = lambda get_row, values: True
+        else:
+            self.tokens = tokenize(where)
+            self.pos = 0
+            expr = self._parse_or()
+            if self.pos != len(self.tokens):
+                raise CompileError("unexpected %r" % (self.tokens[self.pos],))
+        return Predicate(self.table_name, self.joins, expr, self.param_count)
+
+    # parser
+
+    def _peek(self, offset=0):
+        try:
+            return self.tokens[self.pos + offset]
+        except IndexError:
+            return (None, None)
+
+    def _accept(self, kind, text):
+        if self._peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, kind, text):
+        if not self._accept(kind, text):
+            raise CompileError("expected %s, got %r" % (text, self._peek()))
+
+    def _parse_or(self):
+        parts = [self._parse_and()]
+        while self._accept('keyword', 'or'):
+            parts.append(self._parse_and())
+        if len(parts) == 1:
+            return parts[0]
+        def or_expr(get_row, values):
+            result = False
+            for part in parts:
+                value = _truth(part(get_row, values))
+                if value is True:
+                    return True
+                elif value is None:
+                    result = None
+            return result
+        return or_expr
+
+    def _parse_and(self):
+        parts = [self._parse_not()]
+        while self._accept('keyword', 'and'):
+            parts.append(self._parse_not())
+        if len(parts) == 1:
+            return parts[0]
+        def and_expr(get_row, values):
+            result = True
+            for part in parts:
+                value = _truth(part(get_row, values))
+                if value is False:
+                    return False
+                elif value is None:
+                    result = None
+            return result
+        return and_expr
+
+    def _parse_not(self):
+        if self._accept('keyword', 'not'):
+            operand = self._parse_not()
+            def not_expr(get_row, values):
+                value = _truth(operand(get_row, values))
+                if value is None:
+                    return None
+                return not value
+            return not_expr
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        left, comparable = self._parse_operand()
+        kind, text = self._peek()
+        if kind == 'op' and text in _compare_ops:
+            self.pos += 1
+            right, right_comparable = self._parse_operand()
+            if not (comparable and right_comparable):
+                raise CompileError("can't compare column")
+            return self._make_comparison(_compare_ops[text], left, right)
+        elif (kind, text) == ('keyword', 'is'):
+            self.pos += 1
+            negate = self._accept('keyword', 'not')
+            self._expect('keyword', 'null')
+            def is_null(get_row, values):
+                return (left(get_row, values) is None) != negate
+            return is_null
+        elif ((kind, text) == ('keyword', 'in') or
+              ((kind, text) == ('keyword', 'not') and
+               self._peek(1) == ('keyword', 'in'))):
+            negate = self._accept('keyword', 'not')
+            self._expect('keyword', 'in')
+            if not comparable:
+                raise CompileError("can't compare column")
+            return self._make_in(left, self._parse_in_list(), negate)
+        if not comparable:
+            raise CompileError("can't use column as a boolean")
+        return left
+
+    def _make_comparison(self, op, left, right):
+        def comparison(get_row, values):
+            left_value = left(get_row, values)
+            right_value = right(get_row, values)
+            if left_value is None or right_value is None:
+                return None
+            kind = _kind(left_value)
+            if kind is not _kind(right_value):
+                raise CantEvaluate("comparing number to text")
+            if kind is _TEXT and op not in (operator.eq, operator.ne):
+                # SQLite compares the UTF-8 bytes, which doesn't always
+                # match python's unicode ordering
+                raise CantEvaluate("ordering text")
+            return op(left_value, right_value)
+        return comparison
+
+    def _parse_in_list(self):
+        self._expect('op', '(')
+        items = []
+        while True:
+            item, comparable = self._parse_operand()
+            items.append(item)
+            if not self._accept('op', ','):
+                break
+        self._expect('op', ')')
+        return items
+
+    def _make_in(self, left, items, negate):
+        def in_expr(get_row, values):
+            value = left(get_row, values)
+            if value is None:
+                return None
+            kind = _kind(value)
+            result = False
+            for item in items:
+                item_value = item(get_row, values)
+                if item_value is None:
+                    result = None
+                    continue
+                if _kind(item_value) is not kind:
+                    raise CantEvaluate("comparing number to text")
+                if value == item_value:
+                    result = True
+                    break
+            if result is None:
+                return None
+            return result != negate
+        return in_expr
+
+    def _parse_operand(self):
+        """Parse a single value.
+
+        :returns: (function, comparable) tuple.  comparable is False for
+            columns that can only be used with IS NULL.
+        """
+        kind, text = self._peek()
+        self.pos += 1
+        if (kind, text) == ('op', '('):
+            expr = self._parse_or()
+            self._expect('op', ')')
+            return expr, True
+        elif (kind, text) == ('op', '?'):
+            index = self.param_count
+            self.param_count += 1
+            return (lambda get_row, values: values[index]), True
+        elif kind == 'number':
+            if '.' in text:
+                number = float(text)
+            else:
+                number = int(text)
+            return (lambda get_row, values: number), True
+        elif kind == 'string':
+            string = text[1:-1].replace("''", "'").decode('utf-8')
+            return (lambda get_row, values: string), True
+        elif (kind, text) == ('keyword', 'null'):
+            return (lambda get_row, values: None), True
+        elif kind == 'name':
+            if self._peek() == ('op', '('):
+                raise CompileError("function calls not supported")
+            alias, attr, schema_item = self._resolve_column(text)
+            def column(get_row, values):
+                row = get_row(alias)
+                if row is None:
+                    return None
+                return getattr(row, attr)
+            return column, isinstance(schema_item, _comparable_types())
+        else:
+            raise CompileError("unexpected %r" % ((kind, text),))
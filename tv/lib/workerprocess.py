@@ -30,11 +30,14 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to worker processes.  See #17328 for more details.  This includes
+feedparser, mutagen and the movie data program.  We run a pool of worker
+processes so that metadata extraction can use all of the cores.
 """
 
 from collections import deque, namedtuple
+import copy
+import heapq
 import itertools
 import logging
 import threading
@@ -50,8 +53,7 @@ from miro import util
 
 from miro.plat import utils
 
-class SubprocessTimeoutError(StandardError):
-    """A task failed because the subprocess didn't respond in enough time."""
+SubprocessTimeoutError = subprocessmanager.SubprocessTimeoutError
 
 # define messages/handlers
 
@@ -65,6 +67,9 @@ class WorkerStartupInfo(WorkerMessage):
 class TaskMessage(WorkerMessage):
     _id_counter = itertools.count()
     priority = 0
+    # BatchTaskResults object for tasks that are part of a batch.  This only
+    # gets set inside the worker process.
+    batch_results = None
 
     def __init__(self):
         subprocessmanager.SubprocessMessage.__init__(self)
@@ -96,6 +101,80 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class BatchTaskMessage(TaskMessage):
+    """Task that runs a per-file task for a list of paths.
+
+    The worker process splits batches into one task per path, handles those
+    using its normal queue/threads and sends the results back in chunks using
+    TaskResultChunk.
+
+    Subclasses must define make_task() and from_tasks().
+    """
+    def __init__(self, source_paths):
+        TaskMessage.__init__(self)
+        self.source_paths = list(source_paths)
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        """Create a batch task that handles a list of per-file tasks."""
+        raise NotImplementedError()
+
+    def make_task(self, source_path):
+        """Create the task to handle a single path in our batch."""
+        raise NotImplementedError()
+
+    def make_tasks(self):
+        return [self.make_task(path) for path in self.source_paths]
+
+    def split(self, part_count):
+        """Split this batch into smaller batches.
+
+        Each part gets a new task_id.
+
+        :param part_count: number of batches to create
+        :returns: list of BatchTaskMessages
+        """
+        part_size = -(-len(self.source_paths) // part_count)
+        parts = []
+        for start in xrange(0, len(self.source_paths), part_size):
+            part = copy.copy(self)
+            part.task_id = TaskMessage._id_counter.next()
+            part.source_paths = self.source_paths[start:start+part_size]
+            parts.append(part)
+        return parts
+
+    def __str__(self):
+        return '%s (%d paths)' % (self.__class__.__name__,
+                                  len(self.source_paths))
+
+class MovieDataProgramBatchTask(BatchTaskMessage):
+    priority = MovieDataProgramTask.priority
+    def __init__(self, source_paths, screenshot_directory):
+        BatchTaskMessage.__init__(self, source_paths)
+        self.screenshot_directory = screenshot_directory
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        return cls([t.source_path for t in tasks],
+                   tasks[0].screenshot_directory)
+
+    def make_task(self, source_path):
+        return MovieDataProgramTask(source_path, self.screenshot_directory)
+
+class MutagenBatchTask(BatchTaskMessage):
+    priority = MutagenTask.priority
+    def __init__(self, source_paths, cover_art_directory):
+        BatchTaskMessage.__init__(self, source_paths)
+        self.cover_art_directory = cover_art_directory
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        return cls([t.source_path for t in tasks],
+                   tasks[0].cover_art_directory)
+
+    def make_task(self, source_path):
+        return MutagenTask(source_path, self.cover_art_directory)
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -111,16 +190,33 @@ class TaskResult(subprocessmanager.SubprocessResponse):
         self.task_id = task_id
         self.result = result
 
+class TaskResultChunk(subprocessmanager.SubprocessResponse):
+    """Results for part of a BatchTaskMessage.
+
+    :attribute task_id: task_id of the batch
+    :attribute results: list of (source_path, result) tuples.  result is an
+        Exception if we failed to process source_path.
+    :attribute finished: True if this is the last chunk for the batch
+    """
+    def __init__(self, task_id, results, finished):
+        self.task_id = task_id
+        self.results = results
+        self.finished = finished
+
 class MovieDataTaskStatus(subprocessmanager.SubprocessResponse):
     """Report when we are handling movie data tasks.
 
     This is sent to the main process before and after we handle a movie data
     task.  The movie data code has some change of just hanging, and we use
     this message in the main process to catch that.
+
+    For tasks that are part of a batch, task_id is the id of the batch and
+    source_path is the path that we're processing.
     """
 
-    def __init__(self, task_id):
+    def __init__(self, task_id, source_path=None):
         self.task_id = task_id
+        self.source_path = source_path
 
 class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     def __init__(self):
@@ -133,8 +229,13 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     def call_handler(self, method, msg):
         try:
             if isinstance(msg, CancelFileOperations):
-                # handle this message as soon as we can.
-                handle_task(method, msg)
+                # handle this message as soon as we can.  The main process
+                # doesn't wait for a result.
+                method(msg)
+            elif isinstance(msg, BatchTaskMessage):
+                # split up batches right away, the per-file tasks get
+                # queued using the rules below.
+                method(msg)
             elif isinstance(msg, MovieDataProgramTask):
                 # we have to handle this message on this thread, since
                 # QtKit will break if we use it on any thread except the main
@@ -178,6 +279,7 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
 
     def on_shutdown(self):
         self.task_queue.shutdown()
+        moviedata.shutdown_extractor()
 
     def handle_worker_startup_info(self, msg):
         for i in xrange(msg.thread_count):
@@ -192,13 +294,34 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque()
+        for method, task in self.main_thread_tasks:
+            if task.source_path not in path_set:
+                filtered_tasks.append((method, task))
+            elif task.batch_results is not None:
+                task.batch_results.task_canceled()
         self.main_thread_tasks = filtered_tasks
         return None
 
+    def start_batch_task(self, msg, handler_method):
+        """Split up a BatchTaskMessage and queue up the per-file tasks."""
+        batch_results = BatchTaskResults(msg)
+        if not msg.source_paths:
+            batch_results.send_chunk()
+            return
+        for task in msg.make_tasks():
+            task.batch_results = batch_results
+            self.call_handler(handler_method, task)
+
+    def handle_movie_data_program_batch_task(self, msg):
+        self.start_batch_task(msg, self.handle_movie_data_program_task)
+
+    def handle_mutagen_batch_task(self, msg):
+        self.start_batch_task(msg, self.handle_mutagen_task)
+
     # handle_movie_data_program_task gets called in the main thread, unlike
-    # all other task handler methods
+    # all other task handler methods.  The work happens in a separate
+    # extractor process that moviedata keeps running between tasks.
 
     def handle_movie_data_program_task(self, msg):
         return moviedata.process_file(msg.source_path,
@@ -222,6 +345,54 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         with util.alarm(2):
             return self.handle_mutagen_task(msg)
 
+class BatchTaskResults(object):
+    """Collects the results for a BatchTaskMessage in the worker process.
+
+    Results get sent back to the main process as TaskResultChunk messages
+    once we have RESULT_CHUNK_SIZE of them, RESULT_CHUNK_INTERVAL seconds
+    have passed since the last chunk, or the batch is done.
+
+    BatchTaskResults is shared between all of our threads, so all methods
+    need to be thread-safe.
+    """
+    RESULT_CHUNK_SIZE = 50
+    RESULT_CHUNK_INTERVAL = 0.5
+
+    def __init__(self, msg):
+        self.task_id = msg.task_id
+        self.lock = threading.Lock()
+        self.pending_count = len(msg.source_paths)
+        self.results = []
+        self.last_send_time = clock.clock()
+
+    def add_result(self, source_path, result):
+        """Add the result for one of our paths."""
+        with self.lock:
+            self.results.append((source_path, result))
+            self.pending_count -= 1
+            self._send_chunk_if_needed()
+
+    def task_canceled(self):
+        """Call this when one of our tasks gets canceled."""
+        with self.lock:
+            self.pending_count -= 1
+            self._send_chunk_if_needed()
+
+    def _send_chunk_if_needed(self):
+        if (self.pending_count <= 0 or
+                len(self.results) >= self.RESULT_CHUNK_SIZE or
+                (self.results and clock.clock() - self.last_send_time >=
+                 self.RESULT_CHUNK_INTERVAL)):
+            self.send_chunk()
+
+    def send_chunk(self):
+        """Send the results that we have so far to the main process."""
+        finished = self.pending_count <= 0
+        TaskResultChunk(self.task_id, self.results,
+                        finished).send_to_main_process()
+        self.results = []
+        self.last_send_time = clock.clock()
+
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue
 
@@ -243,7 +414,14 @@ class _SinglePriorityQueue(object):
         self.fifo_count = len(self.fifo_map)
 
     def add_task(self, handler_method, msg):
-        self.fifo_map[msg.__class__].append((handler_method, msg))
+        try:
+            fifo = self.fifo_map[msg.__class__]
+        except KeyError:
+            # TaskMessage class was created after we were
+            fifo = self.fifo_map[msg.__class__] = deque()
+            self.fifo_cycler = itertools.cycle(self.fifo_map.values())
+            self.fifo_count = len(self.fifo_map)
+        fifo.append((handler_method, msg))
 
     def get_next_task(self):
         for i, fifo in enumerate(self.fifo_cycler):
@@ -258,12 +436,21 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages that were removed
         """
-        fifo = self.fifo_map[message_class]
-        new_items = tuple((method, msg) for (method, msg) in fifo
-                         if filterfunc(msg))
+        fifo = self.fifo_map.get(message_class)
+        if not fifo:
+            return []
+        new_items = []
+        removed = []
+        for (method, msg) in fifo:
+            if filterfunc(msg):
+                new_items.append((method, msg))
+            else:
+                removed.append(msg)
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
 class WorkerTaskQueue(object):
     """Store the pending tasks for the worker process.
@@ -273,6 +460,9 @@ class WorkerTaskQueue(object):
 
     It's shared between the main subprocess thread, and all worker threads, so
     all methods need to be thread-safe.
+
+    The main process also uses a WorkerTaskQueue to decide which task to
+    dispatch to the worker process pool next.
     """
     def __init__(self):
         self.should_quit = False
@@ -295,13 +485,24 @@ class WorkerTaskQueue(object):
     def add_task(self, handler_method, msg):
         """Add a new task to the queue.  """
         with self.condition:
-            self.queue_map[msg.priority].add_task(handler_method, msg)
+            try:
+                queue = self.queue_map[msg.priority]
+            except KeyError:
+                # TaskMessage class was created after we were
+                queue = self.queue_map[msg.priority] = _SinglePriorityQueue(
+                    msg.priority)
+                self.queues_by_priority.append(queue)
+                self.queues_by_priority.sort(key=lambda q: q.priority,
+                                             reverse=True)
+            queue.add_task(handler_method, msg)
             self.condition.notify()
 
-    def get_next_task(self):
+    def get_next_task(self, block=True):
         """Get the next task to be processed from the queue.
 
-        This method will block if there are no tasks ready in the queue.
+        This method will block if there are no tasks ready in the queue,
+        unless block is False.  In that case, we return None if there are no
+        tasks.
 
         It will return the tuple (handler_method, message) once there is
         something ready.  The worker thread should call
@@ -314,7 +515,7 @@ class WorkerTaskQueue(object):
             if self.should_quit:
                 return None
             next_task_info = self._get_next_task()
-            if next_task_info is not None:
+            if next_task_info is not None or not block:
                 return next_task_info
             # no tasks yet, need to wait for more
             self.condition.wait()
@@ -331,15 +532,33 @@ class WorkerTaskQueue(object):
         return None
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        Batch tasks have the paths removed from their source_paths list.
+
+        :returns: list of messages that were removed from the queue
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
         with self.condition:
             def filter_func(msg):
-                return msg.source_path not in path_set
-            for cls in (MutagenTask, MovieDataProgramTask):
+                if msg.source_path not in path_set:
+                    return True
+                if msg.batch_results is not None:
+                    msg.batch_results.task_canceled()
+                return False
+            def batch_filter_func(msg):
+                msg.source_paths = [p for p in msg.source_paths
+                                    if p not in path_set]
+                return len(msg.source_paths) > 0
+            removed = []
+            for cls, func in ((MutagenTask, filter_func),
+                              (MovieDataProgramTask, filter_func),
+                              (MutagenBatchTask, batch_filter_func),
+                              (MovieDataProgramBatchTask, batch_filter_func)):
                 queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+                removed.extend(queue.filter_messages(func, cls))
+            return removed
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -353,7 +572,11 @@ def handle_task(handler_method, msg):
     # This starts a timer on the frontend to kill this process if movie data
     # hangs
     if isinstance(msg, MovieDataProgramTask):
-        MovieDataTaskStatus(msg.task_id).send_to_main_process()
+        if msg.batch_results is not None:
+            MovieDataTaskStatus(msg.batch_results.task_id,
+                                msg.source_path).send_to_main_process()
+        else:
+            MovieDataTaskStatus(msg.task_id).send_to_main_process()
     try:
         # normally we send the result of our handler method back
         logging.info("starting task: %s", msg)
@@ -370,7 +593,10 @@ def handle_task(handler_method, msg):
     if isinstance(msg, MovieDataProgramTask):
         MovieDataTaskStatus(None).send_to_main_process()
 
-    TaskResult(msg.task_id, rv).send_to_main_process()
+    if msg.batch_results is not None:
+        msg.batch_results.add_result(msg.source_path, rv)
+    else:
+        TaskResult(msg.task_id, rv).send_to_main_process()
 
 def worker_thread(task_queue):
     """Thread loop in the worker process."""
@@ -382,29 +608,33 @@ def worker_thread(task_queue):
         handle_task(*next_task)
 
 MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
-                                     'task_id start_time')
+                                     'task_id source_path start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, worker):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.worker = worker
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.worker.send_message(WorkerStartupInfo(self.worker.thread_count))
+        _miro_task_queue.requeue_tasks(self.worker)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
         self.process_handler_queue()
+        _miro_task_queue.process_results()
         self.worker_ready = False
 
     def on_restart(self):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        _miro_task_queue.add_result(msg)
+
+    def handle_task_result_chunk(self, msg):
+        _miro_task_queue.add_result(msg)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -412,7 +642,7 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
     def handle_movie_data_task_status(self, msg):
         if msg.task_id is not None:
             self.movie_data_task_status = MovieDataTaskStatusInfo(
-                    msg.task_id, clock.clock())
+                    msg.task_id, msg.source_path, clock.clock())
         else:
             self.movie_data_task_status = None
 
@@ -421,43 +651,208 @@ class MiroTaskQueue(object):
 
     Responsible for:
         - Storing callbacks/errbacks for each pending task
+        - Deciding which task to send to the worker processes next, based on
+          the task priorities
         - Calling the callback/errback for a finished task
+        - Tracking which paths are still unfinished for batch tasks
     """
+
+    # Batch tasks are split into parts so that they can be spread across the
+    # worker processes.  Parts are between MIN_BATCH_PART_SIZE and
+    # MAX_BATCH_PART_SIZE paths.
+    MIN_BATCH_PART_SIZE = 5
+    MAX_BATCH_PART_SIZE = 50
+
     def __init__(self):
-        # maps task_ids to (msg, callback, errback) tuples
-        self.tasks_in_progress = {}
+        self._process_results_caller = eventloop.DelayedFunctionCaller(
+            self.process_results)
+        self.reset()
 
     def reset(self):
+        self._process_results_caller.cancel_call()
+        # maps task_ids to (msg, callback, errback) tuples
         self.tasks_in_progress = {}
+        # maps task_ids for batch tasks to the set of paths that we haven't
+        # gotten results for yet
+        self.batch_paths_remaining = {}
+        # tasks that we haven't sent to a worker process yet
+        self.pending_tasks = WorkerTaskQueue()
+        # maps task_ids to the WorkerProcess handling them
+        self.dispatched_tasks = {}
+        # heap of (-priority, counter, reply) for results that we haven't
+        # processed yet
+        self.results = []
+        self.result_counter = itertools.count()
 
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
-        self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        if isinstance(msg, CancelFileOperations):
+            self.cancel_file_operations(msg)
+            callback(msg, None)
+            return
+        if isinstance(msg, BatchTaskMessage):
+            tasks = self._split_batch(msg)
+        else:
+            tasks = [msg]
+        for task in tasks:
+            self.tasks_in_progress[task.task_id] = (task, callback, errback)
+            if isinstance(task, BatchTaskMessage):
+                self.batch_paths_remaining[task.task_id] = set(
+                    task.source_paths)
+            self.pending_tasks.add_task(None, task)
+        self.dispatch_tasks()
+
+    def _split_batch(self, msg):
+        path_count = len(msg.source_paths)
+        part_count = max(
+            min(_subprocess_manager.process_count,
+                path_count // self.MIN_BATCH_PART_SIZE),
+            -(-path_count // self.MAX_BATCH_PART_SIZE))
+        if part_count <= 1:
+            return [msg]
+        return msg.split(part_count)
+
+    def dispatch_tasks(self):
+        """Send pending tasks to worker processes that have room for them."""
+        while True:
+            worker = _subprocess_manager.get_worker_for_task()
+            if worker is None:
+                return
+            next_task = self.pending_tasks.get_next_task(block=False)
+            if next_task is None:
+                return
+            msg = next_task[1]
+            self.dispatched_tasks[msg.task_id] = worker
+            worker.send_task(msg)
+
+    def requeue_tasks(self, worker):
+        """Requeue the tasks that were sent to a worker process.
+
+        Call this when a worker process restarts.
+        """
+        for msg in worker.tasks_in_progress.values():
+            del self.dispatched_tasks[msg.task_id]
+            if isinstance(msg, BatchTaskMessage):
+                # only send the paths that we still need results for
+                paths_remaining = self.batch_paths_remaining[msg.task_id]
+                msg.source_paths = [p for p in msg.source_paths
+                                    if p in paths_remaining]
+                if not msg.source_paths:
+                    self._task_finished(msg.task_id)
+                    continue
+            self.pending_tasks.add_task(None, msg)
+        worker.tasks_in_progress = {}
+        self.dispatch_tasks()
+
+    def cancel_file_operations(self, msg):
+        """Cancel mutagen/movie data tasks for a CancelFileOperations message.
+
+        Tasks that we haven't dispatched yet are removed from our queue, and
+        we forward the message to every worker process.
+        """
+        path_set = set(msg.paths)
+        for removed in self.pending_tasks.cancel_file_operations(path_set):
+            self._task_finished(removed.task_id)
+        for task_id, paths_remaining in self.batch_paths_remaining.items():
+            if task_id in self.dispatched_tasks:
+                paths_remaining.difference_update(path_set)
+            else:
+                task = self.tasks_in_progress[task_id][0]
+                paths_remaining.intersection_update(task.source_paths)
+        _subprocess_manager.send_to_all_workers(msg)
+
+    def _task_finished(self, task_id):
+        """Remove a task from our system.
+
+        :returns: (msg, callback, errback) tuple for the task
+        """
+        worker = self.dispatched_tasks.pop(task_id, None)
+        if worker is not None:
+            worker.tasks_in_progress.pop(task_id, None)
+        self.batch_paths_remaining.pop(task_id, None)
+        return self.tasks_in_progress.pop(task_id)
+
+    def add_result(self, reply):
+        """Add a TaskResult or TaskResultChunk to process.
+
+        Results from all worker processes get processed in priority order
+        from an idle callback.
+        """
+        try:
+            priority = self.tasks_in_progress[reply.task_id][0].priority
+        except KeyError:
+            priority = 0
+        heapq.heappush(self.results,
+                       (-priority, self.result_counter.next(), reply))
+        self._process_results_caller.call_when_idle()
+
+    def process_results(self):
+        """Process all results from add_result()."""
+        while self.results:
+            reply = heapq.heappop(self.results)[2]
+            if isinstance(reply, TaskResultChunk):
+                self.process_result_chunk(reply)
+            else:
+                self.process_result(reply)
+        self.dispatch_tasks()
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self._task_finished(reply.task_id)
+        except KeyError:
+            logging.warn("TaskResult for unknown task: %s", reply.task_id)
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def process_result_chunk(self, reply):
+        """Process a TaskResultChunk from our subprocess."""
+        try:
+            msg, callback, errback = self.tasks_in_progress[reply.task_id]
+        except KeyError:
+            # This can happen if we timed out on a movie data task and
+            # restarted the subprocess.
+            logging.warn("TaskResultChunk for unknown task: %s",
+                         reply.task_id)
+            return
+        paths_remaining = self.batch_paths_remaining[reply.task_id]
+        for source_path, result in reply.results:
+            paths_remaining.discard(source_path)
+        if reply.finished or not paths_remaining:
+            self._task_finished(reply.task_id)
+        callback(msg, reply.results)
 
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
-class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+# Manage subprocesses
+class WorkerProcess(subprocessmanager.SubprocessManager):
+    """Manages a single worker process in the pool.
+
+    :attribute tasks_in_progress: maps task_ids to the TaskMessages that
+        we've sent to the process and haven't gotten a result for yet.
+    """
+    def __init__(self, handler_class, thread_count, restart_delay):
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), handler_class,
+                restart_delay=restart_delay)
+        self.thread_count = thread_count
+        # Only send a couple tasks at a time.  The rest wait in the
+        # MiroTaskQueue, so that they can go to whatever process frees up
+        # first, and so higher priority tasks don't have to wait behind them.
+        self.max_tasks = thread_count + 1
+        self.tasks_in_progress = {}
         self.check_hung_timeout = None
 
+    def has_room_for_task(self):
+        return self.is_running and len(self.tasks_in_progress) < self.max_tasks
+
+    def send_task(self, msg):
+        self.tasks_in_progress[msg.task_id] = msg
+        self.send_message(msg)
+
     def _start(self):
         subprocessmanager.SubprocessManager._start(self)
         self.schedule_check_subprocess_hung()
@@ -486,30 +881,109 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         if (task_status is not None and
                 clock.clock() - task_status.start_time > 90):
             logging.warn("Worker process is hanging on a movie data task.")
-            error_result = TaskResult(task_status.task_id,
-                    SubprocessTimeoutError())
-            self.responder.handle_task_result(error_result)
+            if task_status.source_path is not None:
+                # task is part of a batch, only fail the path that hung.
+                # The rest get re-sent when the subprocess restarts.
+                error_result = TaskResultChunk(task_status.task_id,
+                        [(task_status.source_path, SubprocessTimeoutError())],
+                        False)
+                _miro_task_queue.process_result_chunk(error_result)
+            else:
+                error_result = TaskResult(task_status.task_id,
+                        SubprocessTimeoutError())
+                _miro_task_queue.process_result(error_result)
             self.restart()
         else:
             self.schedule_check_subprocess_hung()
 
+class WorkerSubprocessManager(object):
+    """Manages the pool of worker processes.
+
+    Mutagen and the other tasks are mostly CPU-bound python code, so threads
+    inside a single process get serialized by the GIL.  To make use of
+    multiple cores, we start several worker processes (by default, one for
+    each core).  MiroTaskQueue decides which task to send next and this class
+    picks the process to send it to.
+
+    handler_class and restart_delay can be changed before calling start().
+    """
+    def __init__(self):
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.process_count = utils.get_logical_cpu_count()
+        self.workers = []
+        self.is_running = False
+
+    def start(self, thread_count=3, process_count=None):
+        """Start the worker processes.
+
+        :param thread_count: number of threads for each process
+        :param process_count: number of processes, or None to start one for
+            each core.
+        """
+        if self.is_running:
+            return
+        if process_count is not None:
+            self.process_count = process_count
+        self.workers = [WorkerProcess(self.handler_class, thread_count,
+                                      self.restart_delay)
+                        for i in xrange(self.process_count)]
+        self.is_running = True
+        for worker in self.workers:
+            worker.start()
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown()
+            # move tasks back into the queue in case we start up again
+            _miro_task_queue.requeue_tasks(worker)
+        self.is_running = False
+
+    def restart(self, clean=False):
+        for worker in self.workers:
+            worker.restart(clean)
+
+    def get_worker_for_task(self):
+        """Pick a worker process to send a task to.
+
+        :returns: the least busy WorkerProcess, or None if all of them have
+            as many tasks as they can handle.
+        """
+        candidates = [w for w in self.workers if w.has_room_for_task()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: len(w.tasks_in_progress))
+
+    def send_to_all_workers(self, msg):
+        for worker in self.workers:
+            if worker.is_running:
+                worker.send_message(msg)
+
 _subprocess_manager = WorkerSubprocessManager()
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    :param thread_count: number of threads for each worker process
+    :param process_count: number of worker processes.  By default we start
+        one for each core.
+    """
+    _subprocess_manager.start(thread_count, process_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
 
 # API for sending tasks
 def send(msg, callback, errback):
     """Send a message to the worker process.
 
+    For BatchTaskMessages, callback gets called once for each chunk of
+    results with a list of (source_path, result) tuples.  result is an
+    Exception if we couldn't process source_path.  Large batches get split
+    across the worker processes, in that case msg is the part of the batch
+    that the results are for.
+
     :param msg: Message to send
     :param callback: function to call on success
     :param errback: function to call on error